@@ -0,0 +1,449 @@
+"""
+Runs a JSONL file of questions through the knowledge base and one or more models concurrently, for
+evaluation and regression checks.
+
+    python app/batch_qa.py --input questions.jsonl --output answers.jsonl --kb_id <kb-id> \
+        --models "Anthropic Claude 3.5 Sonnet" "Amazon Nova Pro" --max_workers 16 --requests_per_minute 60
+
+Every input line is {"id": str, "prompt": str, "attachments": [paths of images or documents]}, id and
+attachments are optional. Every output line holds the answer of one model to one question with the retrieved
+sources, token usage and latency. Run the same command again to resume: questions already answered by a model
+are skipped, failed ones are retried.
+
+With --mode batch the prompts are rendered as Bedrock batch inference records instead and answered by one
+model invocation job per model, for nightly runs over thousands of ordersets. Submitted jobs are kept in
+<output>.jobs.json, so an interrupted run resumes tracking them instead of submitting them again:
+
+    python app/batch_qa.py --mode batch --input ordersets.jsonl --output answers.jsonl --kb_id <kb-id> \
+        --bucket <bucket> --role_arn <batch inference service role>
+    python app/batch_qa.py --mode batch --input ordersets.jsonl --output answers.jsonl --local_dir /tmp/local-bedrock
+"""
+
+import argparse
+import json
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+import boto3
+from botocore.config import Config
+from pydantic import BaseModel
+from utils.batch_inference import BatchInferenceClient, BatchJob, BatchRecord, BatchResult, native_model_input
+from utils.bedrock import BedrockHandler, KBHandler
+from utils.chat import ChatPipeline, InMemoryConversationStore, model_params
+from utils.local_bedrock import LocalBedrockBatchClient, LocalS3Client
+from utils.uploads import UploadSpooler
+
+
+def load_config():
+    path = Path(__file__).parent.absolute()
+    with open(path / "config.json", encoding="utf-8") as f:
+        return json.load(f)
+
+configs = load_config()
+
+
+class Question(BaseModel):
+    id: str
+    prompt: str
+    attachments: List[str] = []
+
+
+class Answer(BaseModel):
+    id: str
+    model: str
+    prompt: str
+    answer: Optional[str] = None
+    sources: List[Dict[str, Any]] = []
+    usage: Dict[str, int] = {}
+    retrieval_seconds: float = 0.0
+    generation_seconds: float = 0.0
+    latency_seconds: float = 0.0
+    error: Optional[str] = None
+
+
+class ModelSummary(BaseModel):
+    model: str
+    answered: int
+    errors: int
+    wall_seconds: float
+    answers_per_minute: float
+    p50_latency_seconds: float
+    p95_latency_seconds: float
+    input_tokens: int
+    output_tokens: int
+    output_tokens_per_second: float
+
+
+class AttachedFile:
+    """A file on disk with the interface of a Streamlit upload, as BedrockHandler.user_message expects."""
+
+    def __init__(self, path: str):
+        self.name = Path(path).name
+        self.path = path
+
+    def getvalue(self) -> bytes:
+        return Path(self.path).read_bytes()
+
+
+class RateLimiter:
+    """Spaces calls evenly to at most requests_per_minute, shared by all threads calling one model."""
+
+    def __init__(self, requests_per_minute: float):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute > 0 else 0.0
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def read_questions(path: str) -> List[Question]:
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if line.strip():
+                record = json.loads(line)
+                record.setdefault("id", str(line_number))
+                questions.append(Question(**record))
+    return questions
+
+
+def completed_answers(path: str) -> Set[Tuple[str, str]]:
+    """(question id, model) pairs answered without error by a previous run."""
+    if not Path(path).exists():
+        return set()
+    done = set()
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line of an interrupted run may be incomplete
+                continue
+            if not record.get("error"):
+                done.add((record["id"], record["model"]))
+    return done
+
+
+class BatchRunner:
+    """
+    Answers every question with every model on a thread pool. Retrieval runs once per question and is shared
+    by the models, Bedrock calls of each model are rate limited separately.
+    """
+
+    def __init__(
+        self,
+        region: str,
+        models: List[str],
+        kb_id: Optional[str] = None,
+        max_workers: int = 8,
+        requests_per_minute: float = 0
+    ):
+        region_name = configs["regions"][region]
+        available = configs["multimodal_llms"][region]
+        unknown = [model for model in models if model not in available]
+        if unknown:
+            raise ValueError(f"Unknown models {unknown} in {region}, choice of {list(available)}")
+        self.model_ids = {model: available[model] for model in models}
+        self.max_workers = max_workers
+        client_config = Config(max_pool_connections=max_workers, retries={"max_attempts": 10, "mode": "adaptive"})
+        self.bedrock_runtime = boto3.client("bedrock-runtime", region_name=region_name, config=client_config)
+        self.retriever = KBHandler(
+            boto3.client("bedrock-agent-runtime", region_name=region_name, config=client_config),
+            configs["kb_configs"],
+            kb_id=kb_id,
+        )
+        self.limiters = {model: RateLimiter(requests_per_minute) for model in models}
+        # Turns attachments into image and document blocks, without a spooler user_message drops documents
+        upload_configs = configs.get("uploads", {})
+        self.spooler = UploadSpooler(
+            upload_configs.get("spool_dir") or tempfile.mkdtemp(prefix="batch-qa-"),
+            inline_max_bytes=int(upload_configs.get("inline_max_mb", 1) * 1024 * 1024),
+        )
+        self.retrievals: Dict[str, Future] = {}
+        self.retrievals_lock = threading.Lock()
+
+    def retrieve(self, question: Question) -> Tuple[List[Dict[str, Any]], float]:
+        """The documents of a question and the seconds it took, the first model to ask retrieves them."""
+        with self.retrievals_lock:
+            future = self.retrievals.get(question.id)
+            owner = future is None
+            if owner:
+                future = self.retrievals[question.id] = Future()
+        if owner:
+            start = time.perf_counter()
+            try:
+                future.set_result((self.retriever.get_relevant_docs(question.prompt), time.perf_counter() - start))
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    def pipeline(self, model: str) -> ChatPipeline:
+        model_id = self.model_ids[model]
+        return ChatPipeline(
+            BedrockHandler(
+                self.bedrock_runtime,
+                model_id,
+                model_params(configs, model_id),
+                configs.get("system_prompt"),
+                spooler=self.spooler,
+            ),
+            self.retriever,
+            InMemoryConversationStore(),
+        )
+
+    @staticmethod
+    def sources(docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [{"uri": doc["location"].get("s3Location", {}).get("uri", ""), "score": doc.get("score")} for doc in docs]
+
+    def answer(self, question: Question, model: str) -> Answer:
+        start = time.perf_counter()
+        result = Answer(id=question.id, model=model, prompt=question.prompt)
+        pipeline = self.pipeline(model)
+        try:
+            docs, result.retrieval_seconds = self.retrieve(question)
+            result.sources = self.sources(docs)
+            pipeline.add_user_message(question.id, question.prompt, docs, [AttachedFile(p) for p in question.attachments])
+            self.limiters[model].acquire()
+            generation_start = time.perf_counter()
+            response = pipeline.bedrock_handler.converse(pipeline.conversation(question.id))
+            result.generation_seconds = time.perf_counter() - generation_start
+            result.answer = response["output"]["message"]["content"][0]["text"]
+            result.usage = response.get("usage", {})
+        except Exception as e:
+            result.error = str(e)
+        result.latency_seconds = time.perf_counter() - start
+        return result
+
+    def run(self, questions: List[Question], output: str, resume: bool = True) -> List[ModelSummary]:
+        """Answer the questions not answered yet, appending every answer to output as soon as it is ready."""
+        done = completed_answers(output) if resume else set()
+        jobs = [
+            (question, model)
+            for question in questions
+            for model in self.model_ids
+            if (question.id, model) not in done
+        ]
+        print(f"{len(jobs)} answers to generate, {len(questions) * len(self.model_ids) - len(jobs)} already done")
+        answers: List[Answer] = []
+        start = time.perf_counter()
+        with open(output, "a" if resume else "w", encoding="utf-8") as f, ThreadPoolExecutor(self.max_workers) as executor:
+            futures = [executor.submit(self.answer, question, model) for question, model in jobs]
+            for i, future in enumerate(as_completed(futures), start=1):
+                answer = future.result()
+                answers.append(answer)
+                f.write(answer.model_dump_json() + "\n")
+                f.flush()
+                status = f"error: {answer.error}" if answer.error else f"{answer.latency_seconds:.1f}s"
+                print(f"[{i}/{len(jobs)}] {answer.model} {answer.id} {status}")
+        return self.summarize(answers, time.perf_counter() - start)
+
+    def run_batch(
+        self,
+        questions: List[Question],
+        output: str,
+        batch_client: BatchInferenceClient,
+        resume: bool = True,
+        poll_interval: float = 60
+    ) -> List[ModelSummary]:
+        """
+        Answer the questions not answered yet with one batch inference job per model, the records hold the same
+        system prompt, knowledge base context and user message as the on-demand calls.
+        """
+        start = time.perf_counter()
+        state_path = Path(f"{output}.jobs.json")
+        if resume and state_path.exists():
+            with open(state_path, encoding="utf-8") as f:
+                state = json.load(f)
+            jobs = [BatchJob(**job) for job in state["jobs"]]
+            print(f"Resuming {len(jobs)} submitted jobs from {state_path}")
+        else:
+            done = completed_answers(output) if resume else set()
+            pending = {
+                model: [q for q in questions if (q.id, model) not in done] for model in self.model_ids
+            }
+            to_retrieve = list({q.id: q for model_questions in pending.values() for q in model_questions}.values())
+            with ThreadPoolExecutor(self.max_workers) as executor:
+                retrieved = dict(zip([q.id for q in to_retrieve], executor.map(self.retrieve, to_retrieve)))
+            state = {
+                "jobs": [],
+                "records": {},
+                # questions that cannot be rendered as a record of the model, written as errors
+                "failed": [],
+                "questions": {
+                    q.id: {"prompt": q.prompt, "sources": self.sources(retrieved[q.id][0]), "retrieval_seconds": retrieved[q.id][1]}
+                    for q in to_retrieve
+                },
+            }
+            jobs = []
+            run_id = time.strftime("%Y%m%d%H%M%S")
+            for model_index, (model, model_questions) in enumerate(pending.items()):
+                if not model_questions:
+                    continue
+                pipeline = self.pipeline(model)
+                records = []
+                for question in model_questions:
+                    record_id = f"R{len(state['records']):010d}"
+                    state["records"][record_id] = {"id": question.id, "model": model}
+                    attachments = [AttachedFile(p) for p in question.attachments]
+                    pipeline.add_user_message(question.id, question.prompt, retrieved[question.id][0], attachments)
+                    try:
+                        model_input = native_model_input(
+                            self.model_ids[model],
+                            pipeline.bedrock_handler.params,
+                            pipeline.bedrock_handler.validated(pipeline.conversation(question.id)),
+                        )
+                    except ValueError as e:
+                        del state["records"][record_id]
+                        state["failed"].append(Answer(
+                            id=question.id,
+                            model=model,
+                            prompt=question.prompt,
+                            sources=state["questions"][question.id]["sources"],
+                            error=f"Cannot render the batch record: {e}",
+                        ).model_dump())
+                        continue
+                    records.append(BatchRecord(record_id=record_id, model_input=model_input))
+                if records:
+                    jobs += batch_client.submit(self.model_ids[model], records, f"batch-qa-{run_id}-{model_index}")
+            state["jobs"] = [job.model_dump() for job in jobs]
+            with open(state_path, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            print(f"Submitted {len(jobs)} jobs for {len(state['records'])} records, tracked in {state_path}")
+
+        answers: List[Answer] = [Answer(**answer) for answer in state.get("failed", [])]
+        with open(output, "a" if resume else "w", encoding="utf-8") as f:
+            for answer in answers:
+                f.write(answer.model_dump_json() + "\n")
+            if answers:
+                # written once, a resumed run only tracks the jobs
+                f.flush()
+                state["failed"] = []
+                with open(state_path, "w", encoding="utf-8") as state_file:
+                    json.dump(state, state_file)
+            for job in batch_client.wait(jobs, poll_interval=poll_interval):
+                results = {result.record_id: result for result in batch_client.results(job)}
+                missing = [record_id for record_id in job.record_ids if record_id not in results]
+                if job.status != "Completed" or missing:
+                    print(f"{job.job_name} ended {job.status}, {len(missing)} records without output: {job.message}")
+                # Failed, Stopped and Expired jobs leave some or all of their records without output
+                for record_id in missing:
+                    results[record_id] = BatchResult(
+                        record_id=record_id,
+                        error=f"No output from batch job {job.job_name}, it ended {job.status}: {job.message}".rstrip(": "),
+                    )
+                for result in results.values():
+                    record = state["records"][result.record_id]
+                    question = state["questions"][record["id"]]
+                    answer = Answer(
+                        id=record["id"],
+                        model=record["model"],
+                        prompt=question["prompt"],
+                        answer=result.text,
+                        sources=question["sources"],
+                        usage=result.usage,
+                        retrieval_seconds=question["retrieval_seconds"],
+                        latency_seconds=job.finished_at - job.submitted_at,
+                        error=result.error,
+                    )
+                    answers.append(answer)
+                    f.write(answer.model_dump_json() + "\n")
+        # every record has an answer or an error in the output now, a new run submits new jobs for the errors
+        state_path.unlink()
+        return self.summarize(answers, time.perf_counter() - start)
+
+    def summarize(self, answers: List[Answer], wall_seconds: float) -> List[ModelSummary]:
+        summaries = []
+        for model in self.model_ids:
+            model_answers = [a for a in answers if a.model == model]
+            answered = [a for a in model_answers if not a.error]
+            latencies = [a.latency_seconds for a in answered]
+            output_tokens = sum(a.usage.get("outputTokens", 0) for a in answered)
+            generation_seconds = sum(a.generation_seconds for a in answered)
+            summaries.append(ModelSummary(
+                model=model,
+                answered=len(answered),
+                errors=len(model_answers) - len(answered),
+                wall_seconds=round(wall_seconds, 1),
+                answers_per_minute=round(len(answered) / wall_seconds * 60, 1) if wall_seconds else 0.0,
+                p50_latency_seconds=round(percentile(latencies, 50), 2),
+                p95_latency_seconds=round(percentile(latencies, 95), 2),
+                input_tokens=sum(a.usage.get("inputTokens", 0) for a in answered),
+                output_tokens=output_tokens,
+                output_tokens_per_second=round(output_tokens / generation_seconds, 1) if generation_seconds else 0.0,
+            ))
+        return summaries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a JSONL of questions with the knowledge base and several models")
+    parser.add_argument("--input", type=str, required=True, help="JSONL of {id, prompt, attachments}")
+    parser.add_argument("--output", type=str, required=True, help="JSONL the answers are appended to")
+    parser.add_argument("--region", type=str, default="N. Virginia", choices=list(configs["regions"]))
+    parser.add_argument("--models", type=str, nargs="+", default=["Anthropic Claude 3.5 Sonnet"], help="Model names from config.json")
+    parser.add_argument("--kb_id", type=str, help="KnowledgeBase to retrieve from, no retrieval without it")
+    parser.add_argument("--max_workers", type=int, default=8, help="Questions answered at the same time")
+    parser.add_argument("--requests_per_minute", type=float, default=0, help="Bedrock calls per model and minute, 0 for no limit")
+    parser.add_argument("--no_resume", action="store_true", help="Overwrite the output instead of skipping answered questions")
+    parser.add_argument("--summary", type=str, help="Also write the per model summary to this JSON file")
+    parser.add_argument("--mode", type=str, default="on_demand", choices=["on_demand", "batch"])
+    parser.add_argument("--bucket", type=str, help="Batch mode: bucket for the job input and output")
+    parser.add_argument("--role_arn", type=str, help="Batch mode: role Bedrock assumes to access the bucket")
+    parser.add_argument("--poll_interval", type=float, default=60, help="Batch mode: seconds between job status checks")
+    parser.add_argument(
+        "--local_dir", type=str, help="Batch mode: run the jobs on the local S3 and Bedrock stand-in in this directory"
+    )
+    args = parser.parse_args()
+
+    runner = BatchRunner(
+        args.region, args.models, kb_id=args.kb_id, max_workers=args.max_workers,
+        requests_per_minute=args.requests_per_minute,
+    )
+    if args.mode == "batch":
+        if args.local_dir:
+            s3_client = LocalS3Client(args.local_dir)
+            bedrock_client = LocalBedrockBatchClient(s3_client)
+        else:
+            if not args.bucket or not args.role_arn:
+                parser.error("--mode batch needs --bucket and --role_arn, or --local_dir")
+            region_name = configs["regions"][args.region]
+            s3_client = boto3.client("s3", region_name=region_name)
+            bedrock_client = boto3.client("bedrock", region_name=region_name)
+        batch_client = BatchInferenceClient(
+            bedrock_client, s3_client, args.role_arn or "local", args.bucket or "local"
+        )
+        summaries = runner.run_batch(
+            read_questions(args.input), args.output, batch_client,
+            resume=not args.no_resume, poll_interval=args.poll_interval,
+        )
+    else:
+        summaries = runner.run(read_questions(args.input), args.output, resume=not args.no_resume)
+
+    print(f"\n{'model':<32} {'answered':>8} {'errors':>6} {'per min':>8} {'p50 s':>6} {'p95 s':>6} {'out tok/s':>9}")
+    for s in summaries:
+        print(
+            f"{s.model:<32} {s.answered:>8} {s.errors:>6} {s.answers_per_minute:>8.1f} "
+            f"{s.p50_latency_seconds:>6.2f} {s.p95_latency_seconds:>6.2f} {s.output_tokens_per_second:>9.1f}"
+        )
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            json.dump([s.model_dump() for s in summaries], f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
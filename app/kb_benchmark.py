@@ -0,0 +1,168 @@
+"""
+Benchmark of the two knowledge base paths over a multi-turn conversation: retrieve then converse_stream, two
+round trips with the history and retrieved context sent by the client, against one RetrieveAndGenerate stream
+with the conversation kept by Bedrock. Reports end-to-end latency and the request bytes the client sends.
+By default the calls go to a local stand-in endpoint, so no AWS account is needed and nothing is billed.
+
+    python app/kb_benchmark.py --turns 10 --network_latency 0.08
+    python app/kb_benchmark.py --kb_id <kb-id> --region us-east-1 --turns 5
+"""
+
+import argparse
+import json
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+import boto3
+from pydantic import BaseModel
+from utils.bedrock import BedrockHandler, KBHandler
+from utils.chat import ChatPipeline, InMemoryConversationStore
+from utils.local_bedrock import LocalBedrockEndpoint
+
+
+def load_config():
+    path = Path(__file__).parent.absolute()
+    with open(path / "config.json", encoding="utf-8") as f:
+        return json.load(f)
+
+configs = load_config()
+
+MODEL_ID = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+LOCAL_KB_ID = "LOCALKB"
+LOCAL_CREDENTIALS = {"aws_access_key_id": "local", "aws_secret_access_key": "local"}
+PROMPTS = [
+    "What should an admission orderset for community acquired pneumonia contain?",
+    "Which empiric antibiotics do the guidelines recommend?",
+    "How should the orderset handle penicillin allergies?",
+    "What monitoring parameters are missing?",
+    "Summarize the recommendations with their references.",
+]
+
+
+class TurnTiming(BaseModel):
+    first_token_seconds: float
+    total_seconds: float
+    request_bytes: int
+
+
+class BenchmarkResult(BaseModel):
+    mode: str
+    turns: int
+    p50_first_token_seconds: float
+    p50_total_seconds: float
+    p95_total_seconds: float
+    mean_request_bytes: int
+    last_turn_request_bytes: int
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+class RequestBytes:
+    """Counts the request body bytes boto3 clients send."""
+
+    def __init__(self, *clients: Any):
+        self.total = 0
+        for client in clients:
+            client.meta.events.register("before-send", self._count)
+
+    def _count(self, request: Any, **kwargs: Any) -> None:
+        if isinstance(request.body, (bytes, bytearray, str)):
+            self.total += len(request.body)
+
+
+def run_mode(mode: str, client_args: Dict[str, Any], kb_id: str, turns: int) -> BenchmarkResult:
+    runtime = boto3.client("bedrock-runtime", **client_args)
+    agent_runtime = boto3.client("bedrock-agent-runtime", **client_args)
+    counter = RequestBytes(runtime, agent_runtime)
+    pipeline = ChatPipeline(
+        BedrockHandler(runtime, MODEL_ID, configs["claude_model_params"], configs.get("system_prompt")),
+        KBHandler(agent_runtime, configs["kb_configs"], kb_id=kb_id, mode=mode),
+        InMemoryConversationStore()
+    )
+
+    timings: List[TurnTiming] = []
+    kb_session_id = None
+    for turn in range(turns):
+        prompt = PROMPTS[turn % len(PROMPTS)]
+        sent_before = counter.total
+        start = time.perf_counter()
+        first_token = None
+        if pipeline.retriever.generates:
+            events = pipeline.stream_retrieve_and_generate("benchmark", prompt, kb_session_id)
+        else:
+            events = pipeline.stream("benchmark", prompt)
+        for event in events:
+            if event["event"] == "session":
+                kb_session_id = event["data"]["session_id"]
+            elif event["event"] == "delta":
+                first_token = first_token or time.perf_counter() - start
+        timings.append(TurnTiming(
+            first_token_seconds=first_token or 0.0,
+            total_seconds=time.perf_counter() - start,
+            request_bytes=counter.total - sent_before,
+        ))
+
+    return BenchmarkResult(
+        mode=mode,
+        turns=turns,
+        p50_first_token_seconds=round(percentile([t.first_token_seconds for t in timings], 50), 3),
+        p50_total_seconds=round(percentile([t.total_seconds for t in timings], 50), 3),
+        p95_total_seconds=round(percentile([t.total_seconds for t in timings], 95), 3),
+        mean_request_bytes=sum(t.request_bytes for t in timings) // max(1, turns),
+        last_turn_request_bytes=timings[-1].request_bytes if timings else 0,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare retrieve then converse to RetrieveAndGenerate")
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--modes", nargs="+", default=list(KBHandler.MODES), choices=list(KBHandler.MODES))
+    parser.add_argument("--kb_id", type=str, help="Knowledge base to benchmark instead of the local stand-in")
+    parser.add_argument("--region", type=str, default="us-east-1")
+    parser.add_argument("--network_latency", type=float, default=0.08, help="Local stand-in only, per request")
+    parser.add_argument("--first_token_latency", type=float, default=0.3, help="Local stand-in only")
+    parser.add_argument("--token_delay", type=float, default=0.02, help="Local stand-in only")
+    parser.add_argument("--tokens", type=int, default=50, help="Local stand-in only")
+    parser.add_argument("--document_chars", type=int, default=1500, help="Local stand-in only, per retrieved document")
+    args = parser.parse_args()
+
+    endpoint = None
+    client_args = {"region_name": args.region}
+    kb_id = args.kb_id
+    if not kb_id:
+        endpoint = LocalBedrockEndpoint(
+            first_token_latency=args.first_token_latency,
+            token_delay=args.token_delay,
+            tokens=args.tokens,
+            network_latency=args.network_latency,
+            document_chars=args.document_chars
+        ).start()
+        client_args.update(endpoint_url=endpoint.url, **LOCAL_CREDENTIALS)
+        kb_id = LOCAL_KB_ID
+        print(f"Local Bedrock stand-in on {endpoint.url}")
+
+    results = []
+    for mode in args.modes:
+        results.append(run_mode(mode, client_args, kb_id, args.turns))
+        print(results[-1].model_dump_json())
+
+    print(
+        f"\n{'mode':<22} {'turns':>5} {'ttft p50':>8} {'total p50':>9} {'total p95':>9} "
+        f"{'bytes/turn':>10} {'last turn':>9}"
+    )
+    for r in results:
+        print(
+            f"{r.mode:<22} {r.turns:>5} {r.p50_first_token_seconds:>8.3f} {r.p50_total_seconds:>9.3f} "
+            f"{r.p95_total_seconds:>9.3f} {r.mean_request_bytes:>10} {r.last_turn_request_bytes:>9}"
+        )
+    if endpoint:
+        endpoint.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+Load test of the synchronous and asynchronous Bedrock paths: N concurrent converse_stream calls, each holding
+a worker thread with BedrockHandler or sharing one event loop with AsyncBedrockHandler.
+By default the calls go to a local stand-in endpoint, so no AWS account is needed and nothing is billed.
+
+    python app/load_test.py --concurrency 50 200 500
+    python app/load_test.py --concurrency 100 --first_token_latency 0.5 --token_delay 0.03 --tokens 100
+"""
+
+import argparse
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+import boto3
+from botocore.config import Config
+from pydantic import BaseModel
+from utils.bedrock import BedrockHandler
+from utils.bedrock_async import AsyncBedrockHandler, async_client
+from utils.local_bedrock import LocalBedrockEndpoint
+
+MODEL_ID = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+MESSAGES = [{"role": "user", "content": [{"text": "What is Amazon Bedrock?"}]}]
+LOCAL_CREDENTIALS = {"aws_access_key_id": "local", "aws_secret_access_key": "local"}
+
+
+class StreamTiming(BaseModel):
+    first_token_seconds: float
+    total_seconds: float
+    tokens: int
+
+
+class LoadTestResult(BaseModel):
+    mode: str
+    concurrency: int
+    wall_seconds: float
+    streams_per_second: float
+    p50_first_token_seconds: float
+    p95_first_token_seconds: float
+    p50_total_seconds: float
+    p95_total_seconds: float
+    peak_threads: int
+    errors: int
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+class ThreadCounter:
+    """Samples the number of live threads while a test runs."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = threading.active_count()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __enter__(self) -> "ThreadCounter":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.stopped.set()
+        self.thread.join()
+
+
+def summarize(
+    mode: str, concurrency: int, wall_seconds: float, timings: List[Optional[StreamTiming]], peak_threads: int
+) -> LoadTestResult:
+    completed = [t for t in timings if t]
+    return LoadTestResult(
+        mode=mode,
+        concurrency=concurrency,
+        wall_seconds=round(wall_seconds, 2),
+        streams_per_second=round(len(completed) / wall_seconds, 1),
+        p50_first_token_seconds=round(percentile([t.first_token_seconds for t in completed], 50), 3),
+        p95_first_token_seconds=round(percentile([t.first_token_seconds for t in completed], 95), 3),
+        p50_total_seconds=round(percentile([t.total_seconds for t in completed], 50), 3),
+        p95_total_seconds=round(percentile([t.total_seconds for t in completed], 95), 3),
+        peak_threads=peak_threads,
+        errors=len(timings) - len(completed),
+    )
+
+
+def run_threads(client_args: Dict[str, Any], concurrency: int) -> LoadTestResult:
+    client = boto3.client("bedrock-runtime", config=Config(max_pool_connections=concurrency), **client_args)
+    handler = BedrockHandler(client, MODEL_ID, {})
+
+    def one_stream(_: int) -> Optional[StreamTiming]:
+        start = time.perf_counter()
+        first_token = None
+        tokens = 0
+        try:
+            for event in handler.invoke_model_with_stream(MESSAGES)["stream"]:
+                if "contentBlockDelta" in event:
+                    first_token = first_token or time.perf_counter() - start
+                    tokens += 1
+        except Exception as e:
+            print(f"threads: {e}")
+            return None
+        return StreamTiming(
+            first_token_seconds=first_token or 0.0, total_seconds=time.perf_counter() - start, tokens=tokens
+        )
+
+    with ThreadCounter() as counter:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            timings = list(executor.map(one_stream, range(concurrency)))
+        wall_seconds = time.perf_counter() - start
+    return summarize("threads", concurrency, wall_seconds, timings, counter.peak)
+
+
+async def run_asyncio(client_args: Dict[str, Any], concurrency: int) -> LoadTestResult:
+    config = Config(max_pool_connections=concurrency)
+    async with async_client("bedrock-runtime", config=config, **client_args) as client:
+        handler = AsyncBedrockHandler(client, MODEL_ID, {})
+
+        async def one_stream() -> Optional[StreamTiming]:
+            start = time.perf_counter()
+            first_token = None
+            tokens = 0
+            try:
+                async for event in handler.converse_stream(MESSAGES):
+                    if "contentBlockDelta" in event:
+                        first_token = first_token or time.perf_counter() - start
+                        tokens += 1
+            except Exception as e:
+                print(f"asyncio: {e}")
+                return None
+            return StreamTiming(
+                first_token_seconds=first_token or 0.0, total_seconds=time.perf_counter() - start, tokens=tokens
+            )
+
+        with ThreadCounter() as counter:
+            start = time.perf_counter()
+            timings = await asyncio.gather(*(one_stream() for _ in range(concurrency)))
+            wall_seconds = time.perf_counter() - start
+    return summarize("asyncio", concurrency, wall_seconds, timings, counter.peak)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare threads to asyncio for concurrent Bedrock streams")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[50, 200, 500])
+    parser.add_argument("--modes", nargs="+", default=["threads", "asyncio"], choices=["threads", "asyncio"])
+    parser.add_argument(
+        "--endpoint_url", type=str, help="Bedrock runtime endpoint to test instead of the local stand-in"
+    )
+    parser.add_argument("--region", type=str, default="us-east-1")
+    parser.add_argument("--first_token_latency", type=float, default=0.3, help="Local stand-in only")
+    parser.add_argument("--token_delay", type=float, default=0.02, help="Local stand-in only")
+    parser.add_argument("--tokens", type=int, default=50, help="Local stand-in only")
+    args = parser.parse_args()
+
+    endpoint = None
+    client_args = {"region_name": args.region}
+    if args.endpoint_url:
+        client_args["endpoint_url"] = args.endpoint_url
+    else:
+        endpoint = LocalBedrockEndpoint(
+            first_token_latency=args.first_token_latency, token_delay=args.token_delay, tokens=args.tokens
+        ).start()
+        client_args.update(endpoint_url=endpoint.url, **LOCAL_CREDENTIALS)
+        print(f"Local Bedrock stand-in on {endpoint.url}")
+
+    results = []
+    for concurrency in args.concurrency:
+        for mode in args.modes:
+            try:
+                if mode == "threads":
+                    results.append(run_threads(client_args, concurrency))
+                else:
+                    results.append(asyncio.run(run_asyncio(client_args, concurrency)))
+            except ImportError as e:
+                print(f"Skipping {mode}: {e}")
+                continue
+            print(results[-1].model_dump_json())
+
+    print(
+        f"\n{'mode':<8} {'streams':>7} {'wall s':>7} {'streams/s':>9} {'ttft p50':>8} {'ttft p95':>8} "
+        f"{'total p95':>9} {'threads':>7} {'errors':>6}"
+    )
+    for r in results:
+        print(
+            f"{r.mode:<8} {r.concurrency:>7} {r.wall_seconds:>7.2f} {r.streams_per_second:>9.1f} "
+            f"{r.p50_first_token_seconds:>8.3f} {r.p95_first_token_seconds:>8.3f} {r.p95_total_seconds:>9.3f} "
+            f"{r.peak_threads:>7} {r.errors:>6}"
+        )
+    if endpoint:
+        endpoint.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,29 @@
 import json
+import uuid
 import boto3
 import streamlit as st
+from botocore.exceptions import BotoCoreError, ClientError
 from pathlib import Path
 from typing import Dict, Any, Optional, Union
 from utils.bedrock import BedrockHandler, KBHandler, S3Handler
+from utils.chat import ChatPipeline, InMemoryConversationStore
+from utils.generation import Generation, GenerationRegistry
+from utils.image_cache import MAX_IMAGE_SEED, ImageCache
+from utils.model_capabilities import CapabilityRegistry, RequestValidationError
+from utils.regions import (
+    EndpointProbe,
+    RegionSelector,
+    StaticProbe,
+    base_model_id,
+    inference_profile,
+    is_regional_failure,
+    model_regions,
+)
+from utils.response_cache import ResponseCache
+from utils.uploads import UploadSpooler
+from utils.usage import UsageBudget, UsageLedger
+from utils.video_events import VideoEventListener
+from utils.video_preview import PosterCache, VideoPreview
 import base64
 import time
 
@@ -14,12 +34,23 @@ def load_config():
 
 configs = load_config()
 
+KB_MODE_LABELS = {"retrieve": "Retrieve, then converse", "retrieve_and_generate": "RetrieveAndGenerate"}
+
+def new_chat_session() -> None:
+    """Start a new conversation, its usage is accounted and budgeted separately."""
+    st.session_state.chat_session_id = uuid.uuid4().hex
+    st.session_state.downgraded = False
+    # Bedrock session ids of the knowledge bases answering with RetrieveAndGenerate, by knowledge base id
+    st.session_state.kb_sessions = {}
+
 def clear_screen() -> None:
     """Clear the chat history and reset the messages."""
     st.session_state.messages = [
         {"role": "assistant", "content": configs["start_message"]}
     ]
-    st.session_state.bedrock_messages = []
+    st.session_state.conversation_store = InMemoryConversationStore()
+    get_generation_registry().cancel(st.session_state.chat_session_id)
+    new_chat_session()
     st.session_state.uploaded_document_content = {}
     if "video_job" in st.session_state:
         st.session_state.video_job = None
@@ -41,6 +72,152 @@ def on_region_change() -> None:
         ).list_knowledge_bases(maxResults=10)
     )
 
+def get_video_event_listener() -> Optional[VideoEventListener]:
+    """Return an S3 event listener if video notifications are configured."""
+    notifications = configs.get("video_notifications", {})
+    if not notifications.get("queue_url"):
+        return None
+    return VideoEventListener(
+        notifications["queue_url"],
+        region_name=notifications.get("region", "us-east-1")
+    )
+
+@st.cache_resource
+def get_video_preview() -> VideoPreview:
+    """Create the process wide video preview helper, shared by all sessions."""
+    preview_configs = configs.get("video_preview", {})
+    posters = None
+    if preview_configs.get("posters", True) and preview_configs.get("cache_dir"):
+        posters = PosterCache(preview_configs["cache_dir"], preview_configs.get("cache_max_mb", 50) * 1024 * 1024)
+    return VideoPreview(
+        S3Handler(),
+        expires_in=preview_configs.get("presigned_url_expiry", 3600),
+        posters=posters
+    )
+
+@st.cache_resource
+def get_capability_registry() -> CapabilityRegistry:
+    """Resolve the capabilities and params of every configured model once per process."""
+    return CapabilityRegistry.from_config(configs)
+
+@st.cache_resource
+def get_response_cache() -> Optional[ResponseCache]:
+    """Create the process wide response cache if it is enabled, shared by all sessions."""
+    cache_configs = configs.get("response_cache", {})
+    if not cache_configs.get("enabled") or not cache_configs.get("cache_dir"):
+        return None
+    return ResponseCache(
+        cache_configs["cache_dir"],
+        cache_configs.get("max_mb", 100) * 1024 * 1024,
+        cache_configs.get("ttl_seconds", 86400)
+    )
+
+@st.cache_resource
+def get_image_cache() -> Optional[ImageCache]:
+    """Create the process wide cache of generated images if a cache directory is configured."""
+    image_configs = configs.get("image_cache", {})
+    if not image_configs.get("cache_dir"):
+        return None
+    return ImageCache(image_configs["cache_dir"], image_configs.get("max_mb", 500) * 1024 * 1024)
+
+@st.cache_resource
+def get_upload_spooler() -> Optional[UploadSpooler]:
+    """Create the process wide spooler for large uploads if a spool directory is configured."""
+    upload_configs = configs.get("uploads", {})
+    if not upload_configs.get("spool_dir"):
+        return None
+    return UploadSpooler(
+        upload_configs["spool_dir"],
+        inline_max_bytes=int(upload_configs.get("inline_max_mb", 1) * 1024 * 1024),
+        s3_handler=S3Handler() if upload_configs.get("s3_uri") else None,
+        s3_uri=upload_configs.get("s3_uri") or None
+    )
+
+@st.cache_resource
+def get_usage_ledger() -> UsageLedger:
+    """Create the process wide usage ledger, written to ledger_path when one is configured."""
+    return UsageLedger(configs.get("usage", {}).get("ledger_path") or None, configs.get("model_prices", {}))
+
+@st.cache_resource
+def get_usage_budget() -> UsageBudget:
+    """The per session budget from the config, no limit when session_budget_usd is 0, checked once per process."""
+    return UsageBudget.from_config(configs, get_capability_registry())
+
+def render_usage(ledger: UsageLedger, session_id: str) -> None:
+    """Show the running token and cost totals of the conversation in the sidebar."""
+    totals = ledger.totals(session_id)
+    if not totals:
+        return
+    total = ledger.session_total(session_id)
+    with st.sidebar.expander(f"Usage: ${total.cost:.4f}"):
+        st.caption(f"{total.turns} turns, {total.input_tokens} tokens in, {total.output_tokens} tokens out")
+        st.caption(
+            f"Of the input, ~{total.context_tokens} tokens knowledge base context "
+            f"and ~{total.system_prompt_tokens} tokens system prompt"
+        )
+        for model_id, model_totals in totals.items():
+            st.caption(
+                f"{model_id}: {model_totals.input_tokens} in, {model_totals.output_tokens} out, "
+                f"${model_totals.cost:.4f}"
+            )
+
+@st.cache_resource
+def get_region_selector() -> RegionSelector:
+    """Create the process wide region selector, probing the runtime endpoints of all configured regions."""
+    region_configs = configs.get("region_selection", {})
+    if region_configs.get("mock_latencies_ms"):
+        probe = StaticProbe(region_configs["mock_latencies_ms"])
+    else:
+        probe = EndpointProbe(
+            region_configs.get("endpoint_url") or "https://bedrock-runtime.{region}.amazonaws.com",
+            timeout=region_configs.get("probe_timeout_seconds", 3)
+        )
+    return RegionSelector(
+        list(configs["regions"].values()),
+        probe,
+        probe_interval=region_configs.get("probe_interval_seconds", 60),
+        error_window=region_configs.get("error_window", 10),
+        max_error_rate=region_configs.get("max_error_rate", 0.3)
+    )
+
+@st.cache_resource
+def get_generation_registry() -> GenerationRegistry:
+    """Create the process wide registry of running answers, it stops the answers of sessions that went away."""
+    return GenerationRegistry(abandon_after=configs.get("generation", {}).get("abandon_after_seconds", 30))
+
+def stop_generation() -> None:
+    """Stop the running answer of the session, its stream connection is closed right away."""
+    get_generation_registry().cancel(st.session_state.chat_session_id)
+
+def create_bedrock_handler(
+    region: str, model_id: str, capabilities: Any, use_inference_profile: bool = False
+) -> BedrockHandler:
+    """A handler on the runtime endpoint of a region, optionally on the inference profile of the model there."""
+    return BedrockHandler(
+        boto3.client(service_name="bedrock-runtime", region_name=region),
+        inference_profile(configs, model_id, region) if use_inference_profile else model_id,
+        capabilities.params,
+        configs.get("system_prompt"),
+        cache=get_response_cache(),
+        capabilities=capabilities,
+        spooler=get_upload_spooler(),
+        image_cache=get_image_cache()
+    )
+
+def render_video(video: Dict[str, str], collapsed: bool = False) -> None:
+    """Play a generated video from S3, optionally behind its poster frame."""
+    preview = get_video_preview()
+    if collapsed:
+        poster = preview.poster(video["bucket"], video["key"])
+        if poster:
+            st.image(poster)
+        # Earlier videos get a player only when asked for, not on every rerun
+        if not st.toggle("▶ Play video", key=f"play_{video['bucket']}/{video['key']}"):
+            return
+    else:
+        preview.request_poster(video["bucket"], video["key"])
+    st.video(preview.source(video["bucket"], video["key"]))
+
 def get_video_status(client: Any, invocation_arn: str) -> Dict[str, Any]:
     """Get the status of a video generation job."""
     try:
@@ -59,19 +236,31 @@ def get_video_status(client: Any, invocation_arn: str) -> Dict[str, Any]:
             "error": str(e)
         }
 
-def setup_sidebar(configs: Dict[str, Any]) -> tuple[str, str, bool, str, str]:
+def setup_sidebar(configs: Dict[str, Any]) -> tuple[str, str, bool, str, str, bool, str]:
     """Setup and handle sidebar UI elements."""
     st.sidebar.title(configs["page_title"])
+
+    auto_region = st.sidebar.toggle(
+        "Automatic region",
+        value=configs.get("region_selection", {}).get("automatic", False),
+        key="auto_region",
+        help="Answer from the fastest healthy region offering the model"
+    )
     
     selected_region = st.sidebar.selectbox(
-        "Choose Region",
+        "Knowledge base region" if auto_region else "Choose Region",
         configs["regions"],
         index=0,
         on_change=on_region_change,
         key="selected_region"
     )
     
-    available_models = list(configs["multimodal_llms"][selected_region].keys())
+    if auto_region:
+        available_models = list(dict.fromkeys(
+            model for models in configs["multimodal_llms"].values() for model in models
+        ))
+    else:
+        available_models = list(configs["multimodal_llms"][selected_region].keys())
     selected_model = st.sidebar.selectbox(
         "Choose Bedrock model", available_models, index=1
     )
@@ -94,7 +283,28 @@ def setup_sidebar(configs: Dict[str, Any]) -> tuple[str, str, bool, str, str]:
         if not (is_image_model or is_video_model)
         else "None"
     )
+
+    kb_mode = "retrieve"
+    if kb_selection != "None":
+        kb_mode = st.sidebar.radio(
+            "Knowledge base mode",
+            KBHandler.MODES,
+            index=KBHandler.MODES.index(configs.get("kb_modes", {}).get(kb_selection, "retrieve")),
+            format_func=KB_MODE_LABELS.get,
+            key=f"kb_mode_{kb_selection}",
+            help="RetrieveAndGenerate answers in one round trip, Bedrock keeps the conversation"
+        )
     
+    if is_image_model:
+        st.sidebar.number_input(
+            "Image seed",
+            min_value=0,
+            max_value=MAX_IMAGE_SEED,
+            value=configs["nova_canvas_params"].get("seed", 12),
+            key="image_seed",
+            help="The same prompt, settings and seed give the same image, repeated ones come from the image cache"
+        )
+
     s3_uri = None
     if is_video_model:
         account_id = boto3.client('sts').get_caller_identity().get('Account')
@@ -123,14 +333,12 @@ def setup_sidebar(configs: Dict[str, Any]) -> tuple[str, str, bool, str, str]:
                     with st.sidebar.expander(f"Uploaded: {file.name}", expanded=True):
                         st.info("PDF detected. Processing content...")
                         try:
-                            # Extract first 500 chars to verify content
-                            file_bytes = file.getvalue()
                             st.session_state.uploaded_document_content[file.name] = {
                                 "extension": file_extension,
-                                "size": len(file_bytes),
+                                "size": file.size,
                                 "processed": True
                             }
-                            st.success(f"✅ PDF processed ({len(file_bytes)} bytes)")
+                            st.success(f"✅ PDF processed ({file.size} bytes)")
                         except Exception as e:
                             st.error(f"Error processing PDF: {str(e)}")
                 else:
@@ -141,7 +349,7 @@ def setup_sidebar(configs: Dict[str, Any]) -> tuple[str, str, bool, str, str]:
             
     st.sidebar.button("New Chat", on_click=clear_screen, type="primary")
     
-    return selected_region, selected_model, streaming_on, kb_selection, s3_uri
+    return selected_region, selected_model, streaming_on, kb_selection, s3_uri, auto_region, kb_mode
 
 def main():
     """Main application logic."""
@@ -149,6 +357,9 @@ def main():
     
     if 'selected_region' not in st.session_state:
         st.session_state.selected_region = "Frankfurt"
+
+    if "chat_session_id" not in st.session_state:
+        new_chat_session()
         
     if 'all_kbs' not in st.session_state:
         bedrock_agents_client = boto3.client(
@@ -159,28 +370,45 @@ def main():
             bedrock_agents_client.list_knowledge_bases(maxResults=10)
         )
 
-    selected_region, selected_model, streaming_on, kb_selection, s3_uri = setup_sidebar(configs)
+    selected_region, selected_model, streaming_on, kb_selection, s3_uri, auto_region, kb_mode = setup_sidebar(configs)
 
+    # Regions to answer from in order, the first one unless it fails
+    route = [configs["regions"][selected_region]]
+    if auto_region:
+        selector = get_region_selector()
+        route = selector.ranked(list(model_regions(configs, selected_model).values()))
+        latency = selector.health[route[0]].latency_ms
+        st.sidebar.caption(
+            f"Answering from {route[0]}" + (f" ({latency:.0f} ms)" if latency is not None else "")
+        )
 
-    bedrock_runtime = boto3.client(
-        service_name="bedrock-runtime",
-        region_name=configs["regions"][selected_region]
-    )
-    
-    model_id = configs["multimodal_llms"][selected_region][selected_model]
-    model_params = {
-        "nova-canvas": configs["nova_canvas_params"],
-        "nova-reel": configs["nova_reel_params"],
-        "anthropic": configs["claude_model_params"],
-        "nova": configs["nova_model_params"]
-    }
-    
-    params = next(
-        (params for key, params in model_params.items() if key in model_id),
-        configs["nova_model_params"]
-    )
+    region_names = {code: name for name, code in configs["regions"].items()}
+    model_id = configs["multimodal_llms"][region_names[route[0]]][selected_model]
+    capabilities = get_capability_registry().get(model_id)
+
+    ledger = get_usage_ledger()
+    budget = get_usage_budget()
+    budget_action = None
+    if capabilities.output_modality == "text":
+        # A downgraded session only answers from the regions of the route that offer the downgrade model
+        downgrade_route = [region for region in route if budget.downgrade_model_in(configs, region_names[region])]
+        budget_action = budget.action(
+            ledger.session_total(st.session_state.chat_session_id),
+            st.session_state.downgraded,
+            can_downgrade=bool(downgrade_route),
+        )
+        if budget_action == "downgrade":
+            st.session_state.downgraded = True
+        if st.session_state.downgraded and downgrade_route:
+            route = downgrade_route
+            model_id = budget.downgrade_model
+            capabilities = get_capability_registry().get(model_id)
+            st.sidebar.warning(f"Session budget reached, answering with {model_id}")
     
-    bedrock_handler = BedrockHandler(bedrock_runtime, model_id, params, configs.get("system_prompt"))
+    bedrock_handler = create_bedrock_handler(route[0], model_id, capabilities, use_inference_profile=auto_region)
+    if capabilities.output_modality == "image" and "image_seed" in st.session_state:
+        bedrock_handler.params = {**bedrock_handler.params, "seed": st.session_state.image_seed}
+    bedrock_runtime = bedrock_handler.client
 
     bedrock_agent_runtime_client = boto3.client(
         "bedrock-agent-runtime",
@@ -196,7 +424,8 @@ def main():
     retriever = KBHandler(
         bedrock_agent_runtime_client,
         configs["kb_configs"],
-        kb_id=selected_kb
+        kb_id=selected_kb,
+        mode=kb_mode
     )
 
     if "messages" not in st.session_state:
@@ -204,8 +433,10 @@ def main():
             {"role": "assistant", "content": configs["start_message"]}
         ]
 
-    if "bedrock_messages" not in st.session_state:
-        st.session_state.bedrock_messages = []
+    if "conversation_store" not in st.session_state:
+        st.session_state.conversation_store = InMemoryConversationStore()
+
+    pipeline = ChatPipeline(bedrock_handler, retriever, st.session_state.conversation_store, ledger)
         
     if "uploaded_document_content" not in st.session_state:
         st.session_state.uploaded_document_content = {}
@@ -218,9 +449,20 @@ def main():
                 if "image" in message["content"]:
                     image_data = base64.b64decode(message["content"]["image"])
                     st.image(image_data)
+                if "video" in message["content"]:
+                    render_video(message["content"]["video"], collapsed=True)
             else:
                 st.write(message["content"])
 
+    # An answer still running when a widget or Stop interrupted the run that started it
+    generation = get_generation_registry().get(st.session_state.chat_session_id)
+    if generation:
+        with st.chat_message("assistant"):
+            try:
+                show_generation(generation)
+            except (BotoCoreError, ClientError, RequestValidationError) as e:
+                show_answer_error(pipeline, e)
+
     if prompt := st.chat_input():
         st.session_state.messages.append({"role": "user", "content": prompt})
         with st.chat_message("user"):
@@ -230,27 +472,38 @@ def main():
             st.error("Please provide an S3 output location for video generation")
             return
 
-        docs = (
-            retriever.get_relevant_docs(prompt)
-            if not ("nova-canvas" in model_id or "nova-reel" in model_id)
-            else []
-        )
-        context = retriever.parse_kb_output_to_string(docs) if docs else None
-        
-        user_msg = bedrock_handler.user_message(
+        if budget_action == "stop":
+            st.error("The budget of this session is spent, start a new chat to continue")
+            render_usage(ledger, st.session_state.chat_session_id)
+            return
+        if budget_action in ("compact", "downgrade"):
+            pipeline.compact(st.session_state.chat_session_id, budget.keep_turns)
+
+        # Attachments and image or video models need the two step path
+        if retriever.generates and capabilities.output_modality == "text" and not st.session_state.uploaded_files:
+            with st.chat_message("assistant"):
+                try:
+                    handle_retrieve_and_generate(pipeline, prompt)
+                except (BotoCoreError, ClientError) as e:
+                    show_answer_error(pipeline, e)
+            render_usage(ledger, st.session_state.chat_session_id)
+            return
+
+        docs = pipeline.retrieve(prompt)
+        record_uploaded_documents(st.session_state.uploaded_files)
+        pipeline.add_user_message(
+            st.session_state.chat_session_id,
             prompt,
-            context,
-            st.session_state.uploaded_files
+            docs,
+            st.session_state.uploaded_files,
+            **({"s3_uri": s3_uri} if "nova-reel" in model_id else {})
         )
         
-        if "nova-reel" in model_id:
-            user_msg["s3_uri"] = s3_uri
-            
-        st.session_state.bedrock_messages.append(user_msg)
-        
         with st.chat_message("assistant"):
             if "nova-canvas" in model_id:
-                handle_image_generation(bedrock_handler, st.session_state.bedrock_messages)
+                handle_image_generation(
+                    bedrock_handler, pipeline.store.get(st.session_state.chat_session_id)
+                )
             elif "nova-reel" in model_id:
                 handle_video_generation(
                     bedrock_handler,
@@ -260,13 +513,26 @@ def main():
                     st.session_state.uploaded_files[0] if st.session_state.uploaded_files else None
                 )
             else:
-                handle_text_generation(
-                    bedrock_handler,
-                    st.session_state.bedrock_messages,
-                    streaming_on,
-                    docs,
-                    retriever
-                )
+                try:
+                    if auto_region:
+                        handle_text_generation_with_failover(pipeline, streaming_on, docs, route, model_id, capabilities)
+                    else:
+                        handle_text_generation(pipeline, streaming_on, docs)
+                except (BotoCoreError, ClientError, RequestValidationError) as e:
+                    show_answer_error(pipeline, e)
+
+    render_usage(ledger, st.session_state.chat_session_id)
+
+def record_uploaded_documents(files: Optional[list]) -> None:
+    """Remember which uploaded documents are sent along, for the document processing status."""
+    for file in files or []:
+        file_format = Path(file.name).suffix[1:].lower()
+        if file_format in ["pdf", "txt", "csv", "doc", "docx"]:
+            st.session_state.uploaded_document_content[file.name] = {
+                "extension": file_format,
+                "size": file.size,
+                "processed": True
+            }
 
 def handle_image_generation(bedrock_handler: BedrockHandler, messages: list) -> None:
     """Handle image generation and display."""
@@ -304,21 +570,39 @@ def handle_video_generation(
         st.session_state.video_job = job_details
         
         
+    s3_details = st.session_state.video_job["s3_details"]
+    listener = get_video_event_listener()
+    notifications = configs.get("video_notifications", {})
+    wait_seconds = notifications.get("wait_seconds", 20)
+    # A failed job writes nothing to S3, so with notifications the job status is only checked after this long
+    fallback_seconds = notifications.get("status_fallback_seconds", 300)
+    waited = 0
+
     while True:
+        if listener:
+            # Completion is pushed by the S3 event notification, no need to poll the job
+            video_path = listener.wait_for_video(
+                s3_details["bucket"], s3_details["prefix"], timeout=wait_seconds
+            )
+            if video_path:
+                finish_video_generation(status_placeholder, s3_details["bucket"], video_path)
+                break
+            waited += wait_seconds
+            if waited < fallback_seconds:
+                status_placeholder.info(f"⏳ Generating Video... This can take up to 5 minutes. Waited {waited}s")
+                continue
+            waited = 0
+
         status = get_video_status(bedrock_runtime, st.session_state.video_job["invocation_arn"])
         
         if status["completed"]:
-            s3_details = st.session_state.video_job["s3_details"]
-            video_exists, video_path = S3Handler().check_video_exists(
+            video_exists, video_path = bedrock_handler.s3_handler.check_video_exists(
                 s3_details["bucket"],
                 s3_details["prefix"]
             )
             
             if video_exists:
-                message = f"✅ Video generation completed! Video available at: s3://{s3_details['bucket']}/{video_path}"
-                status_placeholder.success(message)
-                update_chat_history({"text": message})
-                st.session_state.video_job = None
+                finish_video_generation(status_placeholder, s3_details["bucket"], video_path)
                 break
             status_placeholder.info("Video processing... Waiting for S3 upload to complete...")
                 
@@ -332,21 +616,24 @@ def handle_video_generation(
         else:
             status_placeholder.info(f"⏳ Generating Video... This can take up to 5 minutes. Status: {status['status']}")
             
-        time.sleep(10)
+        if not listener:
+            time.sleep(10)
+
+def finish_video_generation(status_placeholder: Any, bucket: str, video_path: str) -> None:
+    """Report a finished video job and play the result inline."""
+    message = f"✅ Video generation completed! Video available at: s3://{bucket}/{video_path}"
+    status_placeholder.success(message)
+    video = {"bucket": bucket, "key": video_path}
+    render_video(video)
+    update_chat_history({"text": message, "video": video})
+    st.session_state.video_job = None
 
 def handle_text_generation(
-    bedrock_handler: BedrockHandler,
-    messages: list,
+    pipeline: ChatPipeline,
     streaming: bool,
-    docs: list,
-    retriever: KBHandler
+    docs: list
 ) -> None:
     """Handle text generation with or without streaming."""
-    # For streaming API, we cannot use the system message directly as a message
-    # Instead, we need to prepend it to the first user message
-    full_messages = messages.copy()
-    system_msg = bedrock_handler.system_message()
-    
     # Log information about uploaded documents for verification
     if st.session_state.get("uploaded_files") and st.session_state.get("uploaded_document_content"):
         document_info = st.expander("📄 Document Processing Status", expanded=True)
@@ -357,57 +644,139 @@ def handle_text_generation(
             else:
                 document_info.error(f"❌ {file_name} could not be processed")
     
-    # If there's a system message and user messages, prepend system prompt to first user message
-    if system_msg and len(full_messages) > 0 and full_messages[0]["role"] == "user":
-        sys_content = system_msg["content"][0]["text"]
-        user_content = full_messages[0]["content"][0]["text"]
-        full_messages[0]["content"][0]["text"] = f"{sys_content}\n\n{user_content}"
-    
     if streaming:
-        placeholder = st.empty()
-        streamed_response = ""
-        stream = bedrock_handler.invoke_model_with_stream(full_messages).get("stream")
-        
-        if stream:
-            for event in stream:
-                if "contentBlockDelta" in event:
-                    streamed_response += event["contentBlockDelta"]["delta"]["text"]
-                placeholder.markdown(streamed_response)
-        full_response = {"text": streamed_response}
-    else:
-        # For non-streaming, we can use the system message directly in some models
-        converse_messages = full_messages
-        if "anthropic" in bedrock_handler.model_id:
-            converse_messages = []
-            if system_msg:
-                converse_messages.append(system_msg)
-            converse_messages.extend(full_messages)
-            
-        response = bedrock_handler.invoke_model(converse_messages)
-        full_response = response["output"]["message"]["content"][0]["text"]
-        st.write(full_response)
+        # The answer streams in a worker thread, so it can be stopped and survives reruns
+        session_id = st.session_state.chat_session_id
+        generation = get_generation_registry().start(
+            session_id, lambda cancel: pipeline.respond_stream(session_id, cancel), docs
+        )
+        show_generation(generation)
+        return
 
-    if docs:
-        with st.expander("📚 Knowledge Base Sources Used", expanded=True):
-            st.info(f"Found {len(docs)} relevant documents in knowledge base")
-            for i, doc in enumerate(docs):
-                st.markdown(f"**Document {i+1}** (Score: {doc['score']:.2f})")
-                st.code(doc['content']['text'][:500] + "..." if len(doc['content']['text']) > 500 else doc['content']['text'])
-                st.markdown(f"*Source: {doc['location']}*")
-                st.divider()
+    response = pipeline.respond(st.session_state.chat_session_id)
+    st.write(response["text"])
+    if response.get("cached"):
+        st.caption(f"⚡ Cached reply, saved {response['cached']['saved_seconds']:.1f}s")
+
+    render_sources(docs)
     
-    update_chat_history(full_response)
+    # The pipeline already recorded the answer in the conversation
+    update_chat_history(response["text"], record=False)
+
+def show_answer_error(pipeline: ChatPipeline, error: Exception) -> None:
+    """Show why the question was not answered, it is taken out of the conversation sent to the model."""
+    pipeline.discard_user_message(st.session_state.chat_session_id)
+    st.error(f"Error invoking model: {str(error)}")
+
+def show_generation(generation: Generation) -> None:
+    """
+    Render a streaming answer as the worker produces it, with a Stop button that keeps the partial answer.
+    A rerun while it streams, from Stop or any other widget, picks the answer up again where it was.
+    """
+    placeholder = st.empty()
+    stop_button = st.empty()
+    stop_button.button("⏹ Stop", key=f"stop_{generation.id}", on_click=stop_generation)
+    done: Dict[str, Any] = {}
+    for event in generation.events():
+        if event["event"] == "done":
+            done = event["data"]
+        placeholder.markdown(generation.text if done else generation.text + "▌")
+    stop_button.empty()
+    if done.get("stopped"):
+        st.caption("⏹ Stopped, the partial answer is kept")
+    if done.get("cached"):
+        st.caption(f"⚡ Cached reply, saved {done['cached']['saved_seconds']:.1f}s")
 
-def update_chat_history(response: Union[str, Dict[str, Any]]) -> None:
+    render_sources(generation.docs)
+
+    # The pipeline already recorded the answer in the conversation
+    update_chat_history({"text": generation.text}, record=False)
+
+def handle_retrieve_and_generate(pipeline: ChatPipeline, prompt: str) -> None:
+    """Stream an answer from RetrieveAndGenerate, continuing the Bedrock session of the knowledge base."""
+    kb_id = pipeline.retriever.kb_id
+    placeholder = st.empty()
+    streamed_response = ""
+    docs = []
+    # Models such as Claude 3.7 Sonnet answer only through their inference profile in some regions
+    model_id = inference_profile(
+        configs, base_model_id(pipeline.bedrock_handler.model_id), pipeline.retriever.client.meta.region_name
+    )
+    events = pipeline.stream_retrieve_and_generate(
+        st.session_state.chat_session_id, prompt, st.session_state.kb_sessions.get(kb_id), model_id=model_id
+    )
+    for event in events:
+        if event["event"] == "session":
+            st.session_state.kb_sessions[kb_id] = event["data"]["session_id"]
+        elif event["event"] == "delta":
+            streamed_response += event["data"]["text"]
+            placeholder.markdown(streamed_response)
+        elif event["event"] == "sources":
+            docs = event["data"]
+    render_sources(docs, cited=True)
+    update_chat_history({"text": streamed_response}, record=False)
+
+def render_sources(docs: list, cited: bool = False) -> None:
+    """List the knowledge base documents an answer is based on."""
+    if not docs:
+        return
+    with st.expander("📚 Knowledge Base Sources Used", expanded=True):
+        if cited:
+            st.info(f"The answer cites {len(docs)} documents from the knowledge base")
+        else:
+            st.info(f"Found {len(docs)} relevant documents in knowledge base")
+        for i, doc in enumerate(docs):
+            score = f"Score: {doc['score']:.2f}" if doc.get("score") is not None else "Cited"
+            st.markdown(f"**Document {i+1}** ({score})")
+            st.code(doc['content']['text'][:500] + "..." if len(doc['content']['text']) > 500 else doc['content']['text'])
+            st.markdown(f"*Source: {doc['location']}*")
+            st.divider()
+
+def handle_text_generation_with_failover(
+    pipeline: ChatPipeline,
+    streaming: bool,
+    docs: list,
+    route: list,
+    model_id: str,
+    capabilities: Any
+) -> None:
+    """
+    Answer from the first region of the route, moving on to the next one when a region fails. A region can
+    fail after part of the answer streamed, what it showed is cleared before the next region answers
+    or the error is shown.
+    """
+    selector = get_region_selector()
+    for i, region in enumerate(route):
+        if i:
+            pipeline.bedrock_handler = create_bedrock_handler(region, model_id, capabilities, use_inference_profile=True)
+        attempt = st.empty()
+        try:
+            with attempt.container():
+                handle_text_generation(pipeline, streaming, docs)
+        except (BotoCoreError, ClientError) as e:
+            attempt.empty()
+            if not is_regional_failure(e):
+                raise
+            selector.record(region, False)
+            if i == len(route) - 1:
+                raise
+            st.warning(f"{region} failed ({e}), retrying in {route[i + 1]}")
+            continue
+        selector.record(region, True)
+        return
+
+def update_chat_history(response: Union[str, Dict[str, Any]], record: bool = True) -> None:
     """Update chat history with new response."""
     st.session_state.messages.append(
         {"role": "assistant", "content": response}
     )
-    st.session_state.bedrock_messages.append(
-        BedrockHandler.assistant_message(
-            response["text"] if isinstance(response, dict) else response
+    if record:
+        st.session_state.conversation_store.append(
+            st.session_state.chat_session_id,
+            BedrockHandler.assistant_message(
+                response["text"] if isinstance(response, dict) else response
+            )
         )
-    )
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
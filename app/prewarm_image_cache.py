@@ -0,0 +1,122 @@
+"""
+Fills the image cache with the Nova Canvas images of commonly used prompts, so the app serves them from disk
+instead of waiting seconds for Bedrock. Uses the image_cache and nova_canvas_params of config.json, the seeds
+to render can be listed to warm the variations users pick most.
+
+    python app/prewarm_image_cache.py --seeds 12 42 --max_workers 4
+    python app/prewarm_image_cache.py --prompts prompts.txt --region "N. Virginia"
+    python app/prewarm_image_cache.py --local --cache_dir /tmp/image-cache
+
+--prompts is a text file with one prompt per line, without it the built-in marketing prompts are rendered.
+With --local the images come from the local stand-in endpoint, to try the cache without AWS.
+"""
+
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Tuple
+import boto3
+from pydantic import BaseModel
+from utils.bedrock import BedrockHandler
+from utils.image_cache import ImageCache
+from utils.local_bedrock import LocalBedrockEndpoint
+
+
+def load_config():
+    path = Path(__file__).parent.absolute()
+    with open(path / "config.json", encoding="utf-8") as f:
+        return json.load(f)
+
+configs = load_config()
+
+MODEL_NAME = "Amazon Nova Canvas"
+MARKETING_PROMPTS = [
+    "A smiling nurse greeting a patient in a bright modern clinic lobby, photorealistic",
+    "A doctor reviewing results on a tablet with a patient, warm natural light",
+    "A welcoming hospital reception desk with plants and daylight, wide shot",
+    "A pharmacist handing a prescription to a customer across a clean counter",
+    "A diverse care team walking down a hospital corridor, candid and confident",
+    "An elderly patient and a caregiver laughing together in a sunny garden",
+    "A clean flat lay of a stethoscope, notebook and coffee on a light desk",
+    "A telehealth video call between a doctor and a patient at home",
+]
+
+
+class PrewarmResult(BaseModel):
+    prompt: str
+    seed: int
+    cached: bool
+    seconds: float
+    error: str = ""
+
+
+def read_prompts(path: str) -> List[str]:
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def prewarm(handler: BedrockHandler, prompt: str, seed: int) -> PrewarmResult:
+    """Render a prompt with a seed unless its image is cached already."""
+    seeded = BedrockHandler(
+        handler.client, handler.model_id, {**handler.params, "seed": seed}, image_cache=handler.image_cache
+    )
+    messages = [seeded.user_message(prompt)]
+    start = time.perf_counter()
+    try:
+        cached = handler.image_cache.get(handler.image_cache.key(handler.model_id, seeded.image_request(messages)))
+        if not cached:
+            seeded.generate_image(messages)
+    except Exception as e:
+        return PrewarmResult(prompt=prompt, seed=seed, cached=False, seconds=0.0, error=str(e))
+    return PrewarmResult(
+        prompt=prompt, seed=seed, cached=cached is not None, seconds=round(time.perf_counter() - start, 3)
+    )
+
+
+def main():
+    image_configs = configs.get("image_cache", {})
+    parser = argparse.ArgumentParser(description="Render common prompts into the Nova Canvas image cache")
+    parser.add_argument("--prompts", type=str, help="Text file with one prompt per line")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[configs["nova_canvas_params"].get("seed", 12)])
+    parser.add_argument("--region", type=str, default="N. Virginia", choices=list(configs["regions"]))
+    parser.add_argument("--cache_dir", type=str, default=image_configs.get("cache_dir"))
+    parser.add_argument("--max_mb", type=float, default=image_configs.get("max_mb", 500))
+    parser.add_argument("--max_workers", type=int, default=4, help="Images rendered at the same time")
+    parser.add_argument("--local", action="store_true", help="Render with the local stand-in instead of Bedrock")
+    args = parser.parse_args()
+    if not args.cache_dir:
+        parser.error("Set image_cache.cache_dir in config.json or pass --cache_dir")
+
+    client_args = {"region_name": configs["regions"][args.region]}
+    if args.local:
+        # Runs on a daemon thread until the script exits
+        endpoint = LocalBedrockEndpoint().start()
+        client_args.update(endpoint_url=endpoint.url, aws_access_key_id="local", aws_secret_access_key="local")
+    handler = BedrockHandler(
+        boto3.client("bedrock-runtime", **client_args),
+        configs["multimodal_llms"][args.region][MODEL_NAME],
+        configs["nova_canvas_params"],
+        image_cache=ImageCache(args.cache_dir, int(args.max_mb * 1024 * 1024))
+    )
+
+    prompts = read_prompts(args.prompts) if args.prompts else MARKETING_PROMPTS
+    jobs: List[Tuple[str, int]] = [(prompt, seed) for prompt in prompts for seed in args.seeds]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.max_workers) as executor:
+        results = list(executor.map(lambda job: prewarm(handler, *job), jobs))
+    for result in results:
+        print(result.model_dump_json())
+
+    rendered = [r for r in results if not r.cached and not r.error]
+    print(
+        f"\n{len(rendered)} rendered, {sum(r.cached for r in results)} already cached, "
+        f"{sum(bool(r.error) for r in results)} failed in {time.perf_counter() - start:.1f}s"
+    )
+    if rendered:
+        print(f"Mean render time {sum(r.seconds for r in rendered) / len(rendered):.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+"""
+Headless HTTP API for the chat pipeline, answers are streamed token by token as Server-Sent Events.
+
+    python app/server.py --port 8080 --region "N. Virginia" --model "Anthropic Claude 3.5 Sonnet"
+    curl -N -X POST localhost:8080/sessions/demo/messages -d '{"prompt": "What is Amazon Bedrock?"}'
+
+Endpoints:
+    POST   /sessions/<id>/messages   {"prompt": str, "stream": bool, "kb_id": str, "model": str}
+    GET    /sessions/<id>/messages   the text of the conversation
+    GET    /sessions/<id>/usage      tokens and estimated cost of the conversation per model
+    DELETE /sessions/<id>            forget the conversation
+    GET    /health
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+from contextlib import AsyncExitStack
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional, Tuple, Union
+import boto3
+from botocore.config import Config
+from utils.bedrock import BedrockHandler, KBHandler
+from utils.bedrock_async import AsyncBedrockHandler, AsyncKBHandler, async_client
+from utils.chat import (
+    AsyncChatPipeline,
+    ChatPipeline,
+    ConversationStore,
+    FileConversationStore,
+    InMemoryConversationStore,
+)
+from utils.model_capabilities import CapabilityRegistry, RequestValidationError
+from utils.response_cache import ResponseCache
+from utils.usage import UsageBudget, UsageLedger
+
+
+def load_config():
+    path = Path(__file__).parent.absolute()
+    with open(path / "config.json", encoding="utf-8") as f:
+        return json.load(f)
+
+configs = load_config()
+
+REASONS = {
+    200: "OK",
+    204: "No Content",
+    400: "Bad Request",
+    402: "Payment Required",
+    404: "Not Found",
+    500: "Internal Server Error",
+}
+MAX_BODY_BYTES = 10 * 1024 * 1024
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+async def iterate_in_thread(iterator: Iterator[Any], executor: ThreadPoolExecutor) -> AsyncIterator[Any]:
+    """Consume a blocking iterator on the executor without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    done = object()
+    while True:
+        item = await loop.run_in_executor(executor, next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+
+class ChatServer:
+    """
+    Serves many chat sessions concurrently from one event loop. Bedrock calls run on a thread pool, or with
+    use_async on aiobotocore clients so an open stream does not hold a thread.
+    """
+
+    def __init__(
+        self,
+        region: str,
+        model: str,
+        store: ConversationStore,
+        max_workers: int = 64,
+        use_async: bool = False
+    ):
+        self.region = region
+        self.model = model
+        self.store = store
+        self.use_async = use_async
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.client_config = Config(max_pool_connections=max_workers)
+        self.region_name = configs["regions"][region]
+        if use_async:
+            # aiobotocore clients are opened by serve, within the event loop
+            self.bedrock_runtime = self.bedrock_agent_runtime = None
+        else:
+            self.bedrock_runtime = boto3.client(
+                "bedrock-runtime", region_name=self.region_name, config=self.client_config
+            )
+            self.bedrock_agent_runtime = boto3.client(
+                "bedrock-agent-runtime", region_name=self.region_name, config=self.client_config
+            )
+        self.session_locks: Dict[str, asyncio.Lock] = {}
+        self.capabilities = CapabilityRegistry.from_config(configs)
+        cache_configs = configs.get("response_cache", {})
+        self.response_cache = (
+            ResponseCache(
+                cache_configs["cache_dir"],
+                cache_configs.get("max_mb", 100) * 1024 * 1024,
+                cache_configs.get("ttl_seconds", 86400),
+            )
+            if cache_configs.get("enabled") and cache_configs.get("cache_dir")
+            else None
+        )
+        usage_configs = configs.get("usage", {})
+        self.ledger = UsageLedger(usage_configs.get("ledger_path") or None, configs.get("model_prices", {}))
+        self.budget = UsageBudget.from_config(configs, self.capabilities)
+        # Sessions that spent their budget and continue on the downgrade model
+        self.downgraded: set = set()
+
+    def pipeline(
+        self, model: Optional[str] = None, kb_id: Optional[str] = None, model_id: Optional[str] = None
+    ) -> Union[ChatPipeline, AsyncChatPipeline]:
+        """A pipeline for one request, the clients and the conversation store are shared."""
+        models = configs["multimodal_llms"][self.region]
+        model = model or self.model
+        if model not in models:
+            raise HTTPError(400, f"Unknown model {model}, choice of {list(models)}")
+        model_id = model_id or models[model]
+        capabilities = self.capabilities.get(model_id)
+        params = capabilities.params
+        if self.use_async:
+            pipeline = AsyncChatPipeline(
+                AsyncBedrockHandler(
+                    self.bedrock_runtime,
+                    model_id,
+                    params,
+                    configs.get("system_prompt"),
+                    cache=self.response_cache,
+                    capabilities=capabilities,
+                ),
+                AsyncKBHandler(self.bedrock_agent_runtime, configs["kb_configs"], kb_id=kb_id),
+                self.store,
+                self.ledger
+            )
+        else:
+            pipeline = ChatPipeline(
+                BedrockHandler(
+                    self.bedrock_runtime,
+                    model_id,
+                    params,
+                    configs.get("system_prompt"),
+                    cache=self.response_cache,
+                    capabilities=capabilities,
+                ),
+                KBHandler(self.bedrock_agent_runtime, configs["kb_configs"], kb_id=kb_id),
+                self.store,
+                self.ledger
+            )
+        if pipeline.is_generation_model:
+            raise HTTPError(400, "Image and video models are not supported by the API")
+        return pipeline
+
+    async def read_request(self, reader: asyncio.StreamReader) -> Tuple[str, str, Dict[str, Any]]:
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        if not request_line:
+            raise ConnectionResetError
+        try:
+            method, path, _ = request_line.split(" ", 2)
+        except ValueError:
+            raise HTTPError(400, "Malformed request line")
+        headers = {}
+        while (line := (await reader.readline()).decode("latin-1").strip()):
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY_BYTES:
+            raise HTTPError(400, "Request body too large")
+        body = {}
+        if length:
+            try:
+                body = json.loads(await reader.readexactly(length))
+            except ValueError:
+                raise HTTPError(400, "Request body is not valid JSON")
+        return method.upper(), path.split("?")[0].rstrip("/"), body
+
+    @staticmethod
+    async def send_json(writer: asyncio.StreamWriter, status: int, payload: Any) -> None:
+        body = json.dumps(payload, default=str).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+
+    async def send_events(
+        self,
+        writer: asyncio.StreamWriter,
+        events: Union[Iterator[Dict[str, Any]], AsyncIterator[Dict[str, Any]]],
+        on_error: Optional[Callable[[], None]] = None
+    ) -> None:
+        """Stream the events, on_error is called when the events fail or the client goes away."""
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+        await writer.drain()
+        if not hasattr(events, "__aiter__"):
+            events = iterate_in_thread(events, self.executor)
+        try:
+            async for event in events:
+                data = json.dumps(event["data"], default=str)
+                writer.write(f"event: {event['event']}\ndata: {data}\n\n".encode("utf-8"))
+                await writer.drain()
+        except (ConnectionResetError, BrokenPipeError):
+            if on_error:
+                on_error()
+            raise
+        except Exception as e:
+            if on_error:
+                on_error()
+            writer.write(f"event: error\ndata: {json.dumps({'message': str(e)})}\n\n".encode("utf-8"))
+            await writer.drain()
+
+    async def post_message(self, writer: asyncio.StreamWriter, session_id: str, body: Dict[str, Any]) -> None:
+        prompt = body.get("prompt")
+        if not prompt:
+            raise HTTPError(400, "prompt is required")
+        self.pipeline(body.get("model"), body.get("kb_id"))
+        # Turns of one conversation are answered one after the other, different sessions run concurrently
+        lock = self.session_locks.setdefault(session_id, asyncio.Lock())
+        async with lock:
+            action = self.budget.action(
+                self.ledger.session_total(session_id),
+                session_id in self.downgraded,
+                can_downgrade=self.budget.downgrade_model_in(configs, self.region) is not None,
+            )
+            if action == "stop":
+                raise HTTPError(402, f"The budget of session {session_id} is spent")
+            if action == "downgrade":
+                self.downgraded.add(session_id)
+            pipeline = self.pipeline(
+                body.get("model"),
+                body.get("kb_id"),
+                self.budget.downgrade_model if session_id in self.downgraded else None,
+            )
+            if action in ("compact", "downgrade"):
+                pipeline.compact(session_id, self.budget.keep_turns)
+            # An unanswered user message would leave two user turns in a row, which Converse rejects
+            discard = functools.partial(pipeline.discard_user_message, session_id)
+            if body.get("stream", True):
+                await self.send_events(writer, pipeline.stream(session_id, prompt), on_error=discard)
+                return
+            try:
+                if self.use_async:
+                    response = await pipeline.converse(session_id, prompt)
+                else:
+                    loop = asyncio.get_running_loop()
+                    response = await loop.run_in_executor(self.executor, pipeline.converse, session_id, prompt)
+            except Exception:
+                discard()
+                raise
+            await self.send_json(writer, 200, response)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            method, path, body = await self.read_request(reader)
+            parts = path.strip("/").split("/")
+            if method == "GET" and parts == ["health"]:
+                await self.send_json(writer, 200, {"status": "ok"})
+            elif len(parts) == 3 and parts[0] == "sessions" and parts[2] == "messages":
+                if method == "POST":
+                    await self.post_message(writer, parts[1], body)
+                elif method == "GET":
+                    messages = [
+                        {
+                            "role": message["role"],
+                            "text": "".join(c["text"] for c in message["content"] if "text" in c),
+                        }
+                        for message in self.store.get(parts[1])
+                    ]
+                    await self.send_json(writer, 200, {"messages": messages})
+                else:
+                    raise HTTPError(404, f"No route for {method} {path}")
+            elif len(parts) == 3 and parts[0] == "sessions" and parts[2] == "usage" and method == "GET":
+                total = self.ledger.session_total(parts[1])
+                await self.send_json(
+                    writer,
+                    200,
+                    {
+                        "total": total.model_dump(),
+                        "models": {m: t.model_dump() for m, t in self.ledger.totals(parts[1]).items()},
+                        "downgraded": parts[1] in self.downgraded,
+                    },
+                )
+            elif len(parts) == 2 and parts[0] == "sessions" and method == "DELETE":
+                self.store.clear(parts[1])
+                self.session_locks.pop(parts[1], None)
+                self.downgraded.discard(parts[1])
+                await self.send_json(writer, 200, {"deleted": parts[1]})
+            else:
+                raise HTTPError(404, f"No route for {method} {path}")
+        except HTTPError as e:
+            await self.send_json(writer, e.status, {"error": str(e)})
+        except RequestValidationError as e:
+            await self.send_json(writer, 400, {"error": str(e)})
+        except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            await self.send_json(writer, 500, {"error": str(e)})
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int) -> None:
+        async with AsyncExitStack() as stack:
+            if self.use_async:
+                self.bedrock_runtime = await stack.enter_async_context(
+                    async_client("bedrock-runtime", self.region_name, config=self.client_config)
+                )
+                self.bedrock_agent_runtime = await stack.enter_async_context(
+                    async_client("bedrock-agent-runtime", self.region_name, config=self.client_config)
+                )
+            server = await asyncio.start_server(self.handle, host, port, limit=MAX_BODY_BYTES)
+            print(f"Serving {self.model} ({self.region}) on http://{host}:{port}")
+            async with server:
+                await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless streaming HTTP API for the chat pipeline")
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--region", type=str, default="N. Virginia", choices=list(configs["regions"]))
+    parser.add_argument("--model", type=str, default="Anthropic Claude 3.5 Sonnet", help="Model name from config.json")
+    parser.add_argument(
+        "--conversation_dir",
+        type=str,
+        help="Keep conversations as files in this directory, shared by all workers, instead of in memory",
+    )
+    parser.add_argument("--max_workers", type=int, default=64, help="Bedrock calls in flight at the same time")
+    parser.add_argument(
+        "--async_client",
+        action="store_true",
+        help="Call Bedrock with aiobotocore from the event loop instead of from worker threads",
+    )
+    args = parser.parse_args()
+
+    store = (
+        FileConversationStore(args.conversation_dir)
+        if args.conversation_dir
+        else InMemoryConversationStore()
+    )
+    server = ChatServer(args.region, args.model, store, max_workers=args.max_workers, use_async=args.async_client)
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
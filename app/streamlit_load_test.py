@@ -0,0 +1,268 @@
+"""
+Load test of one Streamlit process: N concurrent simulated sessions drive the real app/main.py through
+Streamlit's AppTest, all in this process like the sessions of one `streamlit run`. Every session uploads an
+image and a document, chats with streaming on against a knowledge base, switches region and generates an image.
+Bedrock is the local stand-in, run in a child process so its CPU does not count, with injected latencies.
+
+    python app/streamlit_load_test.py --sessions 1 5 10 25 50
+    python app/streamlit_load_test.py --sessions 10 --turns 5 --first_token_latency 0.5 --image_latency 2
+
+For every level it reports rerun latency percentiles, the memory each session adds and the CPU the reruns use.
+A level is saturated when the reruns use most of a core, scripts of one process share the GIL, or when the
+median rerun takes twice as long as at the first level, meaning reruns queue up.
+"""
+
+import argparse
+import contextlib
+import gc
+import io
+import multiprocessing
+import os
+import random
+import resource
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from unittest.mock import MagicMock
+from PIL import Image
+from pydantic import BaseModel
+from streamlit import config
+from streamlit.delta_generator import DeltaGenerator
+from streamlit.proto.Common_pb2 import FileURLs as FileURLsProto
+from streamlit.runtime import Runtime
+from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.runtime.uploaded_file_manager import UploadedFile, UploadedFileRec
+from streamlit.testing.v1 import AppTest
+import streamlit.testing.v1.app_test as app_test
+import streamlit.testing.v1.local_script_runner as local_script_runner
+from streamlit.testing.v1.util import build_mock_config_get_option
+from utils.local_bedrock import LocalBedrockEndpoint
+
+SCRIPT = Path(__file__).parent / "main.py"
+# Session state key the simulated file uploader reads the files of a session from
+UPLOADS_KEY = "load_test_uploads"
+PROMPTS = [
+    "What should an admission orderset for community acquired pneumonia contain?",
+    "Which empiric antibiotics do the guidelines recommend?",
+    "What monitoring parameters are missing from the attached orderset?",
+]
+IMAGE_PROMPT = "A calm hospital ward at night, watercolor"
+
+
+class LevelResult(BaseModel):
+    sessions: int
+    reruns: int
+    wall_seconds: float
+    p50_rerun_seconds: float
+    p95_rerun_seconds: float
+    p99_rerun_seconds: float
+    max_rerun_seconds: float
+    cpu_cores: float
+    rss_mb: float
+    rss_per_session_mb: float
+    errors: int
+    saturated: bool = False
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def rss_mb() -> float:
+    """Resident memory of this process, the peak where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def serve_stand_in(urls: Any, options: Dict[str, Any]) -> None:
+    endpoint = LocalBedrockEndpoint(**options).start()
+    urls.put(endpoint.url)
+    threading.Event().wait()
+
+
+def install_shared_runtime() -> None:
+    """
+    AppTest swaps a mock Runtime and its config options in and out around every run, which breaks runs on
+    other threads, and compiles the script on every run. Install them once for all sessions instead, as a real
+    server has one runtime and one script cache.
+    """
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime._instance = runtime
+    app_test.Runtime = type("RuntimeSlot", (), {"_instance": None})
+    config.get_option = build_mock_config_get_option({"global.appTest": True})
+    app_test.patch_config_options = lambda overrides: contextlib.nullcontext()
+    script_cache = ScriptCache()
+    local_script_runner.ScriptCache = lambda: script_cache
+
+
+def install_file_uploader() -> None:
+    """AppTest cannot upload files, every file_uploader returns the files in the session's UPLOADS_KEY."""
+    import streamlit as st
+
+    def file_uploader(self: DeltaGenerator, label: str, *args: Any, **kwargs: Any) -> Optional[List[UploadedFile]]:
+        return st.session_state.get(UPLOADS_KEY)
+
+    DeltaGenerator.file_uploader = file_uploader
+
+
+def upload(name: str, data: bytes, mime_type: str) -> UploadedFile:
+    return UploadedFile(UploadedFileRec(file_id=uuid.uuid4().hex, name=name, type=mime_type, data=data), FileURLsProto())
+
+
+def session_files() -> List[UploadedFile]:
+    buffer = io.BytesIO()
+    Image.new("RGB", (640, 480), (200, 220, 240)).save(buffer, format="PNG")
+    orderset = "Admission orderset: CBC, BMP, blood cultures x2, ceftriaxone 1 g IV q24h, azithromycin 500 mg.\n"
+    return [
+        upload("ward.png", buffer.getvalue(), "image/png"),
+        upload("orderset.txt", (orderset * 20).encode("utf-8"), "text/plain"),
+    ]
+
+
+class SimulatedSession:
+    """One user: opens the app, uploads files, chats, switches region and generates an image."""
+
+    def __init__(self, turns: int, think_time: float, timeout: float):
+        self.turns = turns
+        self.think_time = think_time
+        self.app = AppTest.from_file(str(SCRIPT), default_timeout=timeout)
+        self.rerun_seconds: List[float] = []
+        self.errors: List[str] = []
+
+    def rerun(self, interaction: Any = None) -> None:
+        time.sleep(random.uniform(0, self.think_time))
+        start = time.perf_counter()
+        try:
+            (interaction or self.app).run()
+        except Exception as e:
+            self.errors.append(str(e))
+            return
+        self.rerun_seconds.append(time.perf_counter() - start)
+        self.errors.extend(str(e.value) for e in self.app.exception)
+
+    def widget(self, kind: str, label: str) -> Any:
+        return next(w for w in getattr(self.app, kind) if w.label == label)
+
+    def run(self) -> "SimulatedSession":
+        self.app.session_state[UPLOADS_KEY] = session_files()
+        self.rerun()
+        if self.errors:
+            return self
+        self.rerun(self.widget("selectbox", "Choose a Knowledge base").set_value("Local knowledge base"))
+        for turn in range(self.turns):
+            self.rerun(self.app.chat_input[0].set_value(PROMPTS[turn % len(PROMPTS)]))
+        self.rerun(self.app.selectbox(key="selected_region").set_value("N. Virginia"))
+        self.app.session_state[UPLOADS_KEY] = None
+        self.rerun(self.widget("selectbox", "Choose Bedrock model").set_value("Amazon Nova Canvas"))
+        self.rerun(self.app.chat_input[0].set_value(IMAGE_PROMPT))
+        return self
+
+
+def run_level(sessions: int, turns: int, think_time: float, timeout: float) -> LevelResult:
+    gc.collect()
+    rss_before = rss_mb()
+    cpu_start, start = time.process_time(), time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        results = list(executor.map(
+            lambda _: SimulatedSession(turns, think_time, timeout).run(), range(sessions)
+        ))
+    wall_seconds = time.perf_counter() - start
+    cpu_seconds = time.process_time() - cpu_start
+    # The sessions are still referenced, as a server keeps the state of open sessions
+    rss_after = rss_mb()
+    reruns = [seconds for session in results for seconds in session.rerun_seconds]
+    for error in {error for session in results for error in session.errors}:
+        print(f"  error: {error}")
+    return LevelResult(
+        sessions=sessions,
+        reruns=len(reruns),
+        wall_seconds=round(wall_seconds, 2),
+        p50_rerun_seconds=round(percentile(reruns, 50), 3),
+        p95_rerun_seconds=round(percentile(reruns, 95), 3),
+        p99_rerun_seconds=round(percentile(reruns, 99), 3),
+        max_rerun_seconds=round(max(reruns, default=0.0), 3),
+        cpu_cores=round(cpu_seconds / wall_seconds, 2),
+        rss_mb=round(rss_after, 1),
+        rss_per_session_mb=round((rss_after - rss_before) / sessions, 2),
+        errors=sum(len(session.errors) for session in results),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate concurrent sessions of the Streamlit app")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 5, 10, 25])
+    parser.add_argument("--turns", type=int, default=3, help="Chat turns of every session")
+    parser.add_argument("--think_time", type=float, default=0.5, help="Maximum random pause before each rerun")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds a rerun may take")
+    parser.add_argument("--first_token_latency", type=float, default=0.3)
+    parser.add_argument("--token_delay", type=float, default=0.02)
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--image_latency", type=float, default=1.0)
+    args = parser.parse_args()
+
+    urls = multiprocessing.Queue()
+    stand_in = multiprocessing.Process(
+        target=serve_stand_in,
+        args=(urls, {
+            "first_token_latency": args.first_token_latency,
+            "token_delay": args.token_delay,
+            "tokens": args.tokens,
+            "image_latency": args.image_latency,
+        }),
+        daemon=True
+    )
+    stand_in.start()
+    url = urls.get()
+    print(f"Local Bedrock stand-in on {url}")
+    # Every boto3 client of the app goes to the stand-in
+    os.environ.update(
+        AWS_ENDPOINT_URL=url,
+        AWS_ACCESS_KEY_ID="local",
+        AWS_SECRET_ACCESS_KEY="local",
+        AWS_DEFAULT_REGION="us-east-1",
+    )
+    install_shared_runtime()
+    install_file_uploader()
+
+    results: List[LevelResult] = []
+    for sessions in args.sessions:
+        result = run_level(sessions, args.turns, args.think_time, args.timeout)
+        baseline = results[0].p50_rerun_seconds if results else result.p50_rerun_seconds
+        result.saturated = result.cpu_cores >= 0.9 or result.p50_rerun_seconds >= 2 * baseline
+        results.append(result)
+        print(result.model_dump_json())
+
+    print(
+        f"\n{'sessions':>8} {'reruns':>6} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} {'max s':>7} "
+        f"{'cpu':>5} {'rss MB':>7} {'MB/sess':>7} {'errors':>6}"
+    )
+    for r in results:
+        print(
+            f"{r.sessions:>8} {r.reruns:>6} {r.p50_rerun_seconds:>7.3f} {r.p95_rerun_seconds:>7.3f} "
+            f"{r.p99_rerun_seconds:>7.3f} {r.max_rerun_seconds:>7.3f} {r.cpu_cores:>5.2f} {r.rss_mb:>7.1f} "
+            f"{r.rss_per_session_mb:>7.2f} {r.errors:>6}" + ("  saturated" if r.saturated else "")
+        )
+    saturated = next((r.sessions for r in results if r.saturated), None)
+    if saturated:
+        print(f"\nReruns queue up from {saturated} concurrent sessions")
+    else:
+        print(f"\nNo saturation up to {results[-1].sessions} concurrent sessions")
+    stand_in.terminate()
+
+
+if __name__ == "__main__":
+    main()
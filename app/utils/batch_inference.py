@@ -0,0 +1,265 @@
+import base64
+import json
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from pydantic import BaseModel, ConfigDict
+from utils.model_capabilities import TEXT_DOCUMENT_FORMATS
+
+# Statuses of get_model_invocation_job after which a job produces no more output
+JOB_DONE_STATUSES = {"Completed", "PartiallyCompleted", "Failed", "Stopped", "Expired"}
+MAX_RECORDS_PER_JOB = 50000
+MIN_RECORDS_PER_JOB = 100
+
+
+class BatchRecord(BaseModel):
+    model_config = ConfigDict(protected_namespaces=())
+
+    record_id: str
+    model_input: Dict[str, Any]
+
+
+class BatchResult(BaseModel):
+    record_id: str
+    text: Optional[str] = None
+    usage: Dict[str, int] = {}
+    error: Optional[str] = None
+
+
+class BatchJob(BaseModel):
+    model_config = ConfigDict(protected_namespaces=())
+
+    job_arn: str
+    job_name: str
+    model_id: str
+    input_uri: str
+    output_uri: str
+    record_ids: List[str]
+    status: str = "Submitted"
+    message: str = ""
+    submitted_at: float = 0.0
+    finished_at: float = 0.0
+
+    @property
+    def job_id(self) -> str:
+        return self.job_arn.split("/")[-1]
+
+
+def image_format(data: bytes) -> str:
+    return "jpeg" if data[:3] == b"\xff\xd8\xff" else "png"
+
+
+def _image(content: Dict[str, Any]) -> Tuple[bytes, str]:
+    """Bytes and format of an image content block, raw bytes as user_message adds them or the Converse shape."""
+    image = content["image"]
+    if isinstance(image, dict):
+        return image["source"]["bytes"], image.get("format", "png")
+    return image, image_format(image)
+
+
+def _document(content: Dict[str, Any]) -> Tuple[bytes, str, str]:
+    """Bytes, format and name of a document content block, its source has to be inline bytes."""
+    document = content["document"]
+    if "bytes" not in document["source"]:
+        raise ValueError(f"Document {document.get('name')} has no inline bytes, resolve spooled sources first")
+    return document["source"]["bytes"], document.get("format", "txt"), document.get("name", "document")
+
+
+def _anthropic_document(model_id: str, content: Dict[str, Any]) -> Dict[str, Any]:
+    """Text documents become text blocks, PDFs base64 document blocks. Office formats cannot be sent."""
+    data, fmt, name = _document(content)
+    if fmt in TEXT_DOCUMENT_FORMATS:
+        return {"type": "text", "text": f"Document {name}:\n{data.decode('utf-8', errors='replace')}"}
+    if fmt == "pdf":
+        return {
+            "type": "document",
+            "source": {"type": "base64", "media_type": "application/pdf", "data": base64.b64encode(data).decode("utf-8")}
+        }
+    raise ValueError(f"{model_id} cannot read {fmt} documents through InvokeModel, attach them as PDF or text")
+
+
+def native_model_input(model_id: str, params: Dict[str, Any], messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Render Converse messages as the InvokeModel body of the model, the format of the modelInput of a batch
+    inference record. Raises ValueError for content the model cannot read that way, instead of dropping it.
+    """
+    if "anthropic" in model_id:
+        rendered = []
+        for message in messages:
+            content = []
+            for block in message["content"]:
+                if "text" in block:
+                    content.append({"type": "text", "text": block["text"]})
+                elif "image" in block:
+                    data, fmt = _image(block)
+                    content.append({
+                        "type": "image",
+                        "source": {"type": "base64", "media_type": f"image/{fmt}", "data": base64.b64encode(data).decode("utf-8")}
+                    })
+                elif "document" in block:
+                    content.append(_anthropic_document(model_id, block))
+                else:
+                    raise ValueError(f"Unsupported content block {list(block)} for {model_id}")
+            rendered.append({"role": message["role"], "content": content})
+        return {
+            "anthropic_version": params.get("anthropic_version", "bedrock-2023-05-31"),
+            "max_tokens": params.get("max_tokens", 4096),
+            "temperature": params.get("temperature", 0.0),
+            "top_k": params.get("top_k", 100),
+            "messages": rendered
+        }
+    rendered = []
+    for message in messages:
+        content = []
+        for block in message["content"]:
+            if "text" in block:
+                content.append({"text": block["text"]})
+            elif "image" in block:
+                data, fmt = _image(block)
+                content.append({"image": {"format": fmt, "source": {"bytes": base64.b64encode(data).decode("utf-8")}}})
+            elif "document" in block:
+                data, fmt, name = _document(block)
+                content.append({
+                    "document": {"format": fmt, "name": name, "source": {"bytes": base64.b64encode(data).decode("utf-8")}}
+                })
+            else:
+                raise ValueError(f"Unsupported content block {list(block)} for {model_id}")
+        rendered.append({"role": message["role"], "content": content})
+    return {
+        "messages": rendered,
+        "inferenceConfig": {
+            "maxTokens": params.get("maxTokens", 4096),
+            "temperature": params.get("temperature", 0.0),
+            "topP": params.get("topP", 0.9)
+        }
+    }
+
+
+def parse_model_output(model_output: Dict[str, Any]) -> Tuple[str, Dict[str, int]]:
+    """Text and token usage of an InvokeModel response body, Anthropic or Nova."""
+    usage = model_output.get("usage", {})
+    if "content" in model_output:
+        text = "".join(c.get("text", "") for c in model_output["content"])
+        input_tokens, output_tokens = usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    else:
+        text = "".join(c.get("text", "") for c in model_output["output"]["message"]["content"])
+        input_tokens, output_tokens = usage.get("inputTokens", 0), usage.get("outputTokens", 0)
+    return text, {"inputTokens": input_tokens, "outputTokens": output_tokens, "totalTokens": input_tokens + output_tokens}
+
+
+def split_records(records: List[BatchRecord], max_records: int = MAX_RECORDS_PER_JOB) -> List[List[BatchRecord]]:
+    """The records in as few parts of at most max_records as possible, the part sizes differ by one at most."""
+    parts = max(1, -(-len(records) // max_records))
+    size, larger = divmod(len(records), parts)
+    split, start = [], 0
+    for part in range(parts):
+        end = start + size + (1 if part < larger else 0)
+        split.append(records[start:end])
+        start = end
+    return split
+
+
+class BatchInferenceClient:
+    """
+    Runs records through Bedrock batch inference: uploads them as JSONL, submits model invocation jobs,
+    tracks them and streams their output back record by record.
+    Args:
+        bedrock_client: boto3 bedrock client, the control plane.
+        s3_client: boto3 S3 client.
+        role_arn (str): role Bedrock assumes to read the input and write the output, it needs access to the bucket.
+        bucket (str): bucket for the input and output files.
+        prefix (str): key prefix for the input and output files.
+    """
+
+    def __init__(self, bedrock_client: Any, s3_client: Any, role_arn: str, bucket: str, prefix: str = "batch-inference"):
+        self.bedrock_client = bedrock_client
+        self.s3_client = s3_client
+        self.role_arn = role_arn
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def submit(self, model_id: str, records: List[BatchRecord], job_name: str) -> List[BatchJob]:
+        """
+        Upload the records and submit them as few jobs as MAX_RECORDS_PER_JOB allows. The records are spread
+        evenly over the jobs, so no job is left with fewer than MIN_RECORDS_PER_JOB records Bedrock would reject.
+        """
+        if len(records) < MIN_RECORDS_PER_JOB:
+            print(f"Warning: {len(records)} records, Bedrock batch jobs need at least {MIN_RECORDS_PER_JOB}")
+        jobs = []
+        for part, part_records in enumerate(split_records(records)):
+            part_name = f"{job_name}-{part}"
+            key = f"{self.prefix}/input/{part_name}.jsonl"
+            body = "\n".join(
+                json.dumps({"recordId": r.record_id, "modelInput": r.model_input}) for r in part_records
+            )
+            self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=body.encode("utf-8"))
+            input_uri = f"s3://{self.bucket}/{key}"
+            output_uri = f"s3://{self.bucket}/{self.prefix}/output/{part_name}/"
+            response = self.bedrock_client.create_model_invocation_job(
+                jobName=part_name,
+                roleArn=self.role_arn,
+                modelId=model_id,
+                inputDataConfig={"s3InputDataConfig": {"s3Uri": input_uri, "s3InputFormat": "JSONL"}},
+                outputDataConfig={"s3OutputDataConfig": {"s3Uri": output_uri}},
+            )
+            jobs.append(BatchJob(
+                job_arn=response["jobArn"],
+                job_name=part_name,
+                model_id=model_id,
+                input_uri=input_uri,
+                output_uri=output_uri,
+                record_ids=[r.record_id for r in part_records],
+                submitted_at=time.time(),
+            ))
+        return jobs
+
+    def refresh(self, job: BatchJob) -> BatchJob:
+        response = self.bedrock_client.get_model_invocation_job(jobIdentifier=job.job_arn)
+        job.status = response["status"]
+        job.message = response.get("message", "")
+        if job.status in JOB_DONE_STATUSES and not job.finished_at:
+            job.finished_at = time.time()
+        return job
+
+    def wait(self, jobs: List[BatchJob], poll_interval: float = 60, timeout: float = 24 * 3600) -> List[BatchJob]:
+        """Poll the jobs until all of them are done, printing their status on every change."""
+        deadline = time.time() + timeout
+        statuses: Dict[str, str] = {}
+        while True:
+            for job in jobs:
+                if job.status not in JOB_DONE_STATUSES:
+                    self.refresh(job)
+                if statuses.get(job.job_arn) != job.status:
+                    statuses[job.job_arn] = job.status
+                    print(f"{job.job_name} ({job.model_id}): {job.status} {job.message}".rstrip())
+            if all(job.status in JOB_DONE_STATUSES for job in jobs):
+                return jobs
+            if time.time() >= deadline:
+                raise TimeoutError(f"Batch inference jobs did not finish within {timeout}s")
+            time.sleep(poll_interval)
+
+    def results(self, job: BatchJob) -> Iterator[BatchResult]:
+        """Stream the output records of a finished job, Bedrock writes them under <output uri>/<job id>/."""
+        prefix = f"{job.output_uri.split('/', 3)[3]}{job.job_id}/"
+        list_kwargs = {"Bucket": self.bucket, "Prefix": prefix}
+        while True:
+            listing = self.s3_client.list_objects_v2(**list_kwargs)
+            for obj in listing.get("Contents", []):
+                if not obj["Key"].endswith(".jsonl.out"):
+                    continue
+                body = self.s3_client.get_object(Bucket=self.bucket, Key=obj["Key"])["Body"]
+                for line in body.iter_lines():
+                    if not line:
+                        continue
+                    record = json.loads(line)
+                    if "modelOutput" in record:
+                        text, usage = parse_model_output(record["modelOutput"])
+                        yield BatchResult(record_id=record["recordId"], text=text, usage=usage)
+                    else:
+                        error = record.get("error", {})
+                        yield BatchResult(
+                            record_id=record["recordId"],
+                            error=error.get("errorMessage", str(error)) if isinstance(error, dict) else str(error),
+                        )
+            if not listing.get("IsTruncated"):
+                return
+            list_kwargs["ContinuationToken"] = listing["NextContinuationToken"]
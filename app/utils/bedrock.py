@@ -1,9 +1,26 @@
 import base64
+import functools
 import json
-from typing import Optional, Union, Dict, List, Any
+import time
+from typing import Optional, Union, Dict, List, Any, Iterator
 from pathlib import Path
 import boto3
+from boto3.s3.transfer import TransferConfig
 import streamlit as st
+from utils.image_cache import ImageCache
+from utils.model_capabilities import ModelCapabilities, validate_messages
+from utils.regions import INFERENCE_PROFILE_PREFIX
+from utils.response_cache import ResponseCache
+from utils.uploads import UploadSpooler, resolve_spooled
+
+NOVA_REEL_OUTPUT_NAME = "output.mp4"
+
+
+@functools.lru_cache(maxsize=None)
+def caller_account_id(region_name: str) -> str:
+    """The AWS account of the credentials in use, looked up once per process."""
+    return boto3.client("sts", region_name=region_name).get_caller_identity()["Account"]
+
 
 class S3Handler:
     """Handles S3-related operations for the application."""
@@ -32,90 +49,157 @@ class S3Handler:
         """Check if video file exists in specified S3 location."""
         try:
             prefix = f"{prefix}/" if not prefix.endswith('/') else prefix
-            response = self.client.list_objects_v2(Bucket=bucket, Prefix=prefix)
-            
-            if 'Contents' not in response:
-                return False, ""
-                
-            for obj in response['Contents']:
-                if obj['Key'].endswith('.mp4'):
-                    return True, obj['Key']
-            
+
+            # Nova Reel writes to a well known key, so a single HEAD is usually enough
+            key = f"{prefix}{NOVA_REEL_OUTPUT_NAME}"
+            if self.object_exists(bucket, key):
+                return True, key
+
+            paginator = self.client.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                for obj in page.get("Contents", []):
+                    if obj["Key"].endswith(".mp4"):
+                        return True, obj["Key"]
+
             return False, ""
         except Exception as e:
             st.error(f"Error checking S3: {str(e)}")
             return False, ""
 
-class BedrockHandler:
-    """Handles interactions with Bedrock models and manages messages."""
+    def presigned_url(self, bucket: str, key: str, expires_in: int = 3600) -> str:
+        """Create a time limited GET URL so the browser can fetch the object directly."""
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": bucket, "Key": key},
+            ExpiresIn=expires_in,
+        )
 
-    def __init__(self, client: Any, model_id: str, params: Dict[str, Any]):
-        self.params = params
-        self.model_id = model_id
-        self.client = client
-        self.is_image_model = "nova-canvas" in model_id
-        self.is_video_model = "nova-reel" in model_id
-        self.s3_handler = S3Handler()
+    def upload_file(self, path: str, bucket: str, key: str) -> None:
+        """Upload a local file, in parallel parts above 8 MB so large uploads are never held in memory."""
+        self.client.upload_file(
+            path, bucket, key,
+            Config=TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024)
+        )
 
-    @staticmethod
-    def assistant_message(message: str, image_data: Optional[bytes] = None) -> Dict[str, Any]:
-        """Create a message dictionary for assistant's response."""
-        content = [{"text": message}]
-        if image_data:
-            content.append({"image": image_data})
-        return {"role": "assistant", "content": content}
+    def object_exists(self, bucket: str, key: str) -> bool:
+        """Check if a single object exists without listing the bucket."""
+        try:
+            self.client.head_object(Bucket=bucket, Key=key)
+            return True
+        except self.client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
 
+class BedrockHandler:
+    """Handles interactions with Bedrock models."""
+    
+    def __init__(
+        self,
+        client: Any,
+        model_id: str,
+        params: Dict[str, Any],
+        system_prompt: Optional[str] = None,
+        cache: Optional[ResponseCache] = None,
+        capabilities: Optional[ModelCapabilities] = None,
+        spooler: Optional[UploadSpooler] = None,
+        image_cache: Optional[ImageCache] = None
+    ):
+        self.client = client
+        self.model_id = model_id
+        self.params = params
+        self.system_prompt = system_prompt
+        self.s3_handler = S3Handler()
+        self.capabilities = capabilities
+        self.spooler = spooler
+        self.image_cache = image_cache
+        # Only temperature 0 answers are deterministic enough to be replayed
+        self.cache = cache if self.params.get("temperature", 0.0) == 0 else None
+    
     @staticmethod
     def user_message(
         message: str,
         context: Optional[str] = None,
-        uploaded_files: Optional[List] = None,
+        files: Optional[List[Any]] = None,
+        spooler: Optional[UploadSpooler] = None,
+        s3_sources: bool = False
     ) -> Dict[str, Any]:
-        """Create a message dictionary for user's query."""
-        context_message = (
-            f"You are a helpful assistant, answer the following question based on the provided context: \n\n {context} \n\n "
-            if context else ""
-        )
-        new_message = {
-            "role": "user",
-            "content": [{"text": f"{context_message} question: {message}"}],
-        }
+        """Format a user message for the model, with a spooler large files are kept out of the message."""
+        content = [{"text": message}]
+        
+        if context:
+            message = f"Context:\n{context}\n\nQuestion: {message}"
+            content = [{"text": message}]
+            
+        if files and spooler:
+            for file in files:
+                block = spooler.content_block(file, s3_sources)
+                if block:
+                    content.append(block)
+        elif files:
+            for file in files:
+                file_bytes = file.getvalue()
+                file_format = Path(file.name).suffix[1:].lower()
+                if file_format in ["png", "jpeg", "jpg"]:
+                    content.append({"image": file_bytes})
+                elif file_format in ["pdf", "txt", "csv", "doc", "docx"]:
+                    # Log that we're processing a document
+                    print(f"Processing document: {file.name} ({file_format}, {len(file_bytes)} bytes)")
+                    
+        return {"role": "user", "content": content}
+    
+    @staticmethod
+    def assistant_message(message: str) -> Dict[str, Any]:
+        """Format an assistant message for the model."""
+        return {"role": "assistant", "content": [{"text": message}]}
+    
+    def system_message(self) -> Optional[Dict[str, Any]]:
+        """Format a system message for the model."""
+        if not self.system_prompt:
+            return None
+        return {"role": "system", "content": [{"text": self.system_prompt}]}
+    
+    def invoke_model(self, messages: List[Dict[str, Any]]) -> Union[Dict[str, Any], bytes]:
+        """Invoke the model with the provided messages."""
+        try:
+            if "nova-canvas" in self.model_id:
+                return self.generate_image(self.validated(messages))
+            elif "nova-reel" in self.model_id:
+                return self.generate_video(
+                    messages[-1]["content"][0]["text"],
+                    messages[-1].get("s3_uri")
+                )
+            else:
+                return self.converse(messages)
+        except Exception as e:
+            st.error(f"Error invoking model: {str(e)}")
+            return {"output": {"message": {"content": [{"text": f"Error: {str(e)}"}]}}}
 
-        if uploaded_files:
-            for uploaded_file in uploaded_files:
-                bytes_data = uploaded_file.read()
-                extension = Path(uploaded_file.name).suffix[1:]
-                
-                if extension in ["png", "jpeg", "gif", "webp"]:
-                    new_message["content"].append({
-                        "image": {
-                            "format": extension,
-                            "source": {"bytes": bytes_data}
-                        }
-                    })
-                elif extension in ["pdf", "csv", "doc", "docx", "xls", "xlsx", "html", "txt", "md"]:
-                    new_message["content"].append({
-                        "document": {
-                            "format": extension,
-                            "name": "random-doc-name",
-                            "source": {"bytes": bytes_data}
-                        }
-                    })
-        return new_message
+    def validated(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """The messages with spooled uploads read back, checked and fitted to the model capabilities."""
+        messages = resolve_spooled(messages)
+        if not self.capabilities:
+            return messages
+        return validate_messages(self.capabilities, messages)
 
-    def generate_image(self, messages: List[Dict[str, Any]]) -> bytes:
-        """Generate an image using Nova Canvas."""
+    def image_request(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """The Nova Canvas request body for the last message, with the source images still as bytes."""
         last_message = messages[-1]
         text_prompt = last_message["content"][0]["text"]
+        negative_text = self.params.get("negativeText", "bad quality, low resolution")
 
+        generation_config = {
+            "numberOfImages": self.params.get("numberOfImages", 1),
+            "height": self.params.get("height", 512),
+            "width": self.params.get("width", 512),
+            "cfgScale": self.params.get("cfgScale", 8.0)
+        }
+        for name in ("quality", "seed"):
+            if name in self.params:
+                generation_config[name] = self.params[name]
         body = {
             "taskType": "IMAGE_VARIATION" if len(last_message["content"]) > 1 else "TEXT_IMAGE",
-            "imageGenerationConfig": {
-                "numberOfImages": self.params.get("numberOfImages", 1),
-                "height": self.params.get("height", 512),
-                "width": self.params.get("width", 512),
-                "cfgScale": self.params.get("cfgScale", 8.0)
-            }
+            "imageGenerationConfig": generation_config
         }
         
         if len(last_message["content"]) > 1:
@@ -126,23 +210,38 @@ class BedrockHandler:
                     if image_format in["png", "jpeg"]:
                         image_bytes = (content["image"]["source"]["bytes"] 
                                     if isinstance(content["image"], dict) else content["image"])
-                        base64_image = base64.b64encode(image_bytes).decode('utf-8')
-                        images.append(base64_image)
+                        images.append(image_bytes)
                     else:
                         raise ValueError("Image format must be PNG or JPEG")
                     
             
             body["imageVariationParams"] = {
                 "text": text_prompt,
-                "negativeText": "bad quality, low resolution",
+                "negativeText": negative_text,
                 "images": images,
                 "similarityStrength": 0.7,
             }
         else:
             body["textToImageParams"] = {
                 "text": text_prompt,
-                "negativeText": "bad quality, low resolution"
+                "negativeText": negative_text
             }
+        return body
+
+    def generate_image(self, messages: List[Dict[str, Any]]) -> bytes:
+        """Generate an image using Nova Canvas, served from the image cache when the request was seen before."""
+        body = self.image_request(messages)
+        # Keyed while the source images are still bytes, so they are hashed instead of their base64 text
+        key = self.image_cache.key(self.model_id, body) if self.image_cache else None
+        if key:
+            image = self.image_cache.get(key)
+            if image:
+                return image
+        if "imageVariationParams" in body:
+            body["imageVariationParams"]["images"] = [
+                base64.b64encode(image_bytes).decode('utf-8')
+                for image_bytes in body["imageVariationParams"]["images"]
+            ]
         response = self.client.invoke_model(
             modelId=self.model_id,
             body=json.dumps(body),
@@ -154,7 +253,10 @@ class BedrockHandler:
         if "error" in response_body:
             raise Exception(f"Image generation error: {response_body['error']}")
         
-        return base64.b64decode(response_body['images'][0])
+        image = base64.b64decode(response_body['images'][0])
+        if key:
+            self.image_cache.put(key, image)
+        return image
 
     def generate_video(self, prompt: str, s3_uri: str, uploaded_image: Optional[tuple[bytes, str]] = None) -> Dict[str, Any]:
         """Generate a video using Nova Reel."""
@@ -206,131 +308,176 @@ class BedrockHandler:
                 "prefix": invocation_id
             }
         }
-    def invoke_model(self, messages: List[Dict[str, Any]]) -> Union[Dict[str, Any], bytes]:
-        """Invoke the appropriate model based on type."""
-        try:
-            if self.is_image_model:
-                return self.generate_image(messages)
-            elif self.is_video_model:
-                return self.generate_video(
-                    messages[-1]["content"][0]["text"],
-                    messages[-1].get("s3_uri")
-                )
-            else:
-                return self.client.converse(
-                    modelId=self.model_id,
-                    messages=messages,
-                    inferenceConfig={"temperature": 0.0},
-                    additionalModelRequestFields={"top_k": 100} if "anthropic" in self.model_id else {}           
-                )
-        except Exception as e:
-            st.error(f"Error invoking model: {str(e)}")
-            return None
 
-    def invoke_model_with_stream(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
-        """Invoke model with streaming."""
-        if self.is_image_model or self.is_video_model:
-            raise ValueError("Streaming is not supported for image or video generation models")
-        return self.client.converse_stream(
-            modelId=self.model_id,
-            messages=messages,
-            inferenceConfig={"temperature": 0.0},
-            additionalModelRequestFields={"top_k": 100} if "anthropic" in self.model_id else {}
-        )
+    def converse_request(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """The arguments of converse and converse_stream for the messages."""
+        return {
+            "modelId": self.model_id,
+            "messages": self.validated(messages),
+            "inferenceConfig": {"temperature": self.params.get("temperature", 0.0)},
+            "additionalModelRequestFields": {"top_k": self.params.get("top_k", 100)} if "anthropic" in self.model_id else {}
+        }
+
+    def converse(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Answer the messages in one response, errors are raised to the caller. A reply from the response cache
+        carries {"cached": {"saved_seconds": float}}.
+        """
+        request = self.converse_request(messages)
+        if not self.cache:
+            return self.client.converse(**request)
+        key = self.cache.key(request)
+        entry = self.cache.get(key)
+        if entry:
+            return {**entry["response"], "cached": {"saved_seconds": entry["elapsed_seconds"]}}
+        start = time.perf_counter()
+        response = self.client.converse(**request)
+        self.cache.put(key, response, time.perf_counter() - start)
+        return response
 
-class BedrockHandler:
-    """Handles interactions with Bedrock models."""
-    
-    def __init__(self, client: Any, model_id: str, params: Dict[str, Any], system_prompt: Optional[str] = None):
-        self.client = client
-        self.model_id = model_id
-        self.params = params
-        self.system_prompt = system_prompt
-        self.s3_handler = S3Handler()
-    
     @staticmethod
-    def user_message(message: str, context: Optional[str] = None, files: Optional[List[Any]] = None) -> Dict[str, Any]:
-        """Format a user message for the model."""
-        content = [{"text": message}]
-        
-        if context:
-            message = f"Context:\n{context}\n\nQuestion: {message}"
-            content = [{"text": message}]
-            
-        if files:
-            for file in files:
-                file_bytes = file.getvalue()
-                file_format = Path(file.name).suffix[1:].lower()
-                if file_format in ["png", "jpeg", "jpg"]:
-                    content.append({"image": file_bytes})
-                elif file_format in ["pdf", "txt", "csv", "doc", "docx"]:
-                    # Log that we're processing a document
-                    print(f"Processing document: {file.name} ({file_format}, {len(file_bytes)} bytes)")
-                    
-                    # For PDF documents, we should indicate they're being sent to the model
-                    if "uploaded_document_content" in st.session_state:
-                        st.session_state.uploaded_document_content[file.name] = {
-                            "extension": file_format,
-                            "size": len(file_bytes),
-                            "processed": True
-                        }
-                    
-        return {"role": "user", "content": content}
-    
+    def replay_stream(response: Dict[str, Any], saved_seconds: float) -> Iterator[Dict[str, Any]]:
+        """The converse_stream events of a cached response, the metadata event carries the cached marker."""
+        yield {"messageStart": {"role": "assistant"}}
+        text = response["output"]["message"]["content"][0]["text"]
+        # Word sized deltas, so the answer renders like a live stream
+        for i, word in enumerate(text.split(" ")):
+            yield {"contentBlockDelta": {"contentBlockIndex": 0, "delta": {"text": word if i == 0 else f" {word}"}}}
+        yield {"contentBlockStop": {"contentBlockIndex": 0}}
+        yield {"messageStop": {"stopReason": response.get("stopReason", "end_turn")}}
+        yield {"metadata": {"usage": response.get("usage", {}), "cached": {"saved_seconds": saved_seconds}}}
+
     @staticmethod
-    def assistant_message(message: str) -> Dict[str, Any]:
-        """Format an assistant message for the model."""
-        return {"role": "assistant", "content": [{"text": message}]}
-    
-    def system_message(self) -> Optional[Dict[str, Any]]:
-        """Format a system message for the model."""
-        if not self.system_prompt:
-            return None
-        return {"role": "system", "content": [{"text": self.system_prompt}]}
-    
-    def invoke_model(self, messages: List[Dict[str, Any]]) -> Union[Dict[str, Any], bytes]:
-        """Invoke the model with the provided messages."""
-        try:
-            if "nova-canvas" in self.model_id:
-                return self.generate_image(messages)
-            elif "nova-reel" in self.model_id:
-                return self.generate_video(
-                    messages[-1]["content"][0]["text"],
-                    messages[-1].get("s3_uri")
-                )
-            else:
-                return self.client.converse(
-                    modelId=self.model_id,
-                    messages=messages,
-                    inferenceConfig={"temperature": self.params.get("temperature", 0.0)},
-                    additionalModelRequestFields={"top_k": self.params.get("top_k", 100)} if "anthropic" in self.model_id else {}           
-                )
-        except Exception as e:
-            st.error(f"Error invoking model: {str(e)}")
-            return {"output": {"message": {"content": [{"text": f"Error: {str(e)}"}]}}}
+    def collect_event(response: Dict[str, Any], event: Dict[str, Any]) -> None:
+        """Add a converse_stream event to the converse response being rebuilt from the stream."""
+        if "contentBlockDelta" in event:
+            message = response.setdefault("output", {"message": {"role": "assistant", "content": [{"text": ""}]}})
+            message["message"]["content"][0]["text"] += event["contentBlockDelta"]["delta"].get("text", "")
+        elif "messageStop" in event:
+            response["stopReason"] = event["messageStop"].get("stopReason")
+        elif "metadata" in event:
+            response["usage"] = event["metadata"].get("usage", {})
+
+    def cache_streamed_response(self, key: str, response: Dict[str, Any], elapsed_seconds: float) -> None:
+        """Cache a response rebuilt from a stream, a stream closed before messageStop is a partial answer."""
+        if "stopReason" not in response:
+            return
+        response.setdefault("output", {"message": {"role": "assistant", "content": [{"text": ""}]}})
+        self.cache.put(key, response, elapsed_seconds)
+
+    def record_stream(self, key: str, stream: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """Pass the events through and cache the response once the stream completed."""
+        start = time.perf_counter()
+        response: Dict[str, Any] = {}
+        for event in stream:
+            self.collect_event(response, event)
+            yield event
+        self.cache_streamed_response(key, response, time.perf_counter() - start)
     
     def invoke_model_with_stream(self, messages: List[Dict[str, Any]]) -> Any:
         """Invoke the model with streaming for the provided messages."""
+        if self.capabilities and not self.capabilities.streaming:
+            raise ValueError(f"Streaming is not supported by {self.model_id}")
         if "nova-canvas" in self.model_id or "nova-reel" in self.model_id:
             raise ValueError("Streaming is not supported for image or video generation models")
             
         # Filter out any system messages as they're not supported in streaming API
         valid_messages = [msg for msg in messages if msg["role"] in ["user", "assistant"]]
-        
-        return self.client.converse_stream(
-            modelId=self.model_id,
-            messages=valid_messages,
-            inferenceConfig={"temperature": self.params.get("temperature", 0.0)},
-            additionalModelRequestFields={"top_k": self.params.get("top_k", 100)} if "anthropic" in self.model_id else {}
-        )
+        request = self.converse_request(valid_messages)
+        if not self.cache:
+            return self.client.converse_stream(**request)
+        # Streamed and single responses to the same request share a cache entry
+        key = self.cache.key(request)
+        entry = self.cache.get(key)
+        if entry:
+            return {"stream": self.replay_stream(entry["response"], entry["elapsed_seconds"])}
+        response = self.client.converse_stream(**request)
+        # The connection is kept to close it when the answer is stopped
+        return {**response, "stream": self.record_stream(key, response["stream"]), "event_stream": response["stream"]}
 
 class KBHandler:
-    """Handles interactions with Bedrock knowledge bases."""
+    """Handles interactions with Bedrock knowledge bases.
+
+    In the default "retrieve" mode documents are retrieved and the model is called separately with them as
+    context. In "retrieve_and_generate" mode Bedrock retrieves and answers in one call and keeps the
+    conversation itself, so only the prompt travels from the client.
+    """
+
+    MODES = ("retrieve", "retrieve_and_generate")
 
-    def __init__(self, client: Any, kb_params: Dict[str, Any], kb_id: Optional[str] = None):
+    def __init__(self, client: Any, kb_params: Dict[str, Any], kb_id: Optional[str] = None, mode: str = "retrieve"):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown knowledge base mode {mode}, choice of {self.MODES}")
         self.client = client
         self.kb_id = kb_id
         self.params = kb_params
+        self.mode = mode
+
+    @property
+    def generates(self) -> bool:
+        """Whether answers come from RetrieveAndGenerate instead of a separate model call."""
+        return bool(self.kb_id) and self.mode == "retrieve_and_generate"
+
+    def model_arn(self, model_id: str) -> str:
+        """
+        ARN of a foundation model or of a cross-region inference profile id in the region of the client, as
+        RetrieveAndGenerate expects it. Models such as Claude 3.7 Sonnet can only be invoked through their profile.
+        """
+        region_name = self.client.meta.region_name
+        if INFERENCE_PROFILE_PREFIX.match(model_id):
+            return f"arn:aws:bedrock:{region_name}:{caller_account_id(region_name)}:inference-profile/{model_id}"
+        return f"arn:aws:bedrock:{region_name}::foundation-model/{model_id}"
+
+    def retrieve_and_generate_stream(
+        self,
+        prompt: str,
+        model_arn: str,
+        session_id: Optional[str] = None,
+        prompt_template: Optional[str] = None,
+        inference_config: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """
+        Retrieve and stream the answer in one call, the response holds the stream and the sessionId Bedrock
+        keeps the conversation under. Pass that sessionId with the next prompt to continue the conversation.
+        """
+        kb_config = {"knowledgeBaseId": self.kb_id, "modelArn": model_arn}
+        if self.params:
+            kb_config["retrievalConfiguration"] = self.params
+        generation_config = {}
+        if prompt_template:
+            generation_config["promptTemplate"] = {"textPromptTemplate": prompt_template}
+        if inference_config:
+            generation_config["inferenceConfig"] = {"textInferenceConfig": inference_config}
+        if generation_config:
+            kb_config["generationConfiguration"] = generation_config
+        request = {
+            "input": {"text": prompt},
+            "retrieveAndGenerateConfiguration": {"type": "KNOWLEDGE_BASE", "knowledgeBaseConfiguration": kb_config},
+        }
+        if session_id:
+            request["sessionId"] = session_id
+        return self.client.retrieve_and_generate_stream(**request)
+
+    @staticmethod
+    def parse_citations_to_docs(citations: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        The references of RetrieveAndGenerate citations in the shape of retrieved documents, each document
+        once. References carry no relevance score.
+        """
+        docs, seen = [], set()
+        for citation in citations:
+            for reference in citation.get("retrievedReferences", []):
+                key = (json.dumps(reference.get("location", {}), sort_keys=True), reference["content"].get("text"))
+                if key in seen:
+                    continue
+                seen.add(key)
+                docs.append({
+                    "content": reference["content"],
+                    "location": reference.get("location", {}),
+                    "metadata": reference.get("metadata", {}),
+                    "score": None,
+                })
+        return docs
 
     def get_relevant_docs(self, prompt: str) -> List[Dict[str, Any]]:
         """Retrieve relevant documents from the knowledge base."""
@@ -0,0 +1,113 @@
+import json
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+from utils.bedrock import BedrockHandler, KBHandler
+
+try:
+    from aiobotocore.session import get_session
+except ImportError:
+    get_session = None
+
+
+def async_client(service_name: str, region_name: str, **kwargs: Any) -> Any:
+    """
+    An aiobotocore client, to be used as an async context manager:
+
+        async with async_client("bedrock-runtime", "us-east-1") as client:
+            handler = AsyncBedrockHandler(client, model_id, params)
+    """
+    if get_session is None:
+        raise ImportError("The asynchronous Bedrock client needs aiobotocore, install it with: pip install -r requirements.txt")
+    return get_session().create_client(service_name, region_name=region_name, **kwargs)
+
+
+class AsyncBedrockHandler(BedrockHandler):
+    """
+    Asynchronous counterpart of BedrockHandler on an aiobotocore bedrock-runtime client. Requests are built,
+    validated and cached by BedrockHandler, a call in flight waits on the event loop instead of holding a thread.
+    """
+
+    async def converse(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Answer the messages in one response, a reply from the response cache carries the cached marker."""
+        request = self.converse_request([msg for msg in messages if msg["role"] in ["user", "assistant"]])
+        if not self.cache:
+            return await self.client.converse(**request)
+        key = self.cache.key(request)
+        entry = self.cache.get(key)
+        if entry:
+            return {**entry["response"], "cached": {"saved_seconds": entry["elapsed_seconds"]}}
+        start = time.perf_counter()
+        response = await self.client.converse(**request)
+        self.cache.put(key, response, time.perf_counter() - start)
+        return response
+
+    async def converse_stream(self, messages: List[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+        """Answer the messages as the events of converse_stream, messageStart to metadata."""
+        if self.capabilities and not self.capabilities.streaming:
+            raise ValueError(f"Streaming is not supported by {self.model_id}")
+        if "nova-canvas" in self.model_id or "nova-reel" in self.model_id:
+            raise ValueError("Streaming is not supported for image or video generation models")
+        request = self.converse_request([msg for msg in messages if msg["role"] in ["user", "assistant"]])
+        key = self.cache.key(request) if self.cache else None
+        entry = self.cache.get(key) if key else None
+        if entry:
+            for event in self.replay_stream(entry["response"], entry["elapsed_seconds"]):
+                yield event
+            return
+        start = time.perf_counter()
+        response = await self.client.converse_stream(**request)
+        streamed: Dict[str, Any] = {}
+        async for event in response["stream"]:
+            self.collect_event(streamed, event)
+            yield event
+        if key:
+            self.cache_streamed_response(key, streamed, time.perf_counter() - start)
+
+    async def invoke_model(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        """Invoke the model with a native request body, the JSON response body is returned."""
+        response = await self.client.invoke_model(
+            modelId=self.model_id,
+            body=json.dumps(body),
+            accept="application/json",
+            contentType="application/json"
+        )
+        async with response["body"] as stream:
+            return json.loads(await stream.read())
+
+    async def start_async_invoke(self, model_input: Dict[str, Any], s3_uri: str) -> Dict[str, Any]:
+        """Start an asynchronous invocation, such as a Nova Reel video, writing its output under s3_uri."""
+        response = await self.client.start_async_invoke(
+            modelId=self.model_id,
+            modelInput=model_input,
+            outputDataConfig={"s3OutputDataConfig": {"s3Uri": s3_uri}}
+        )
+        bucket = s3_uri.split("//")[1].split("/")[0]
+        return {
+            "invocation_arn": response["invocationArn"],
+            "s3_details": {"bucket": bucket, "prefix": response["invocationArn"].split("/")[-1]}
+        }
+
+
+class AsyncKBHandler:
+    """Asynchronous counterpart of KBHandler on an aiobotocore bedrock-agent-runtime client."""
+
+    parse_kb_output_to_string = staticmethod(KBHandler.parse_kb_output_to_string)
+    parse_kb_output_to_reference = staticmethod(KBHandler.parse_kb_output_to_reference)
+
+    def __init__(self, client: Any, kb_params: Dict[str, Any], kb_id: Optional[str] = None):
+        self.client = client
+        self.kb_id = kb_id
+        self.params = kb_params
+
+    async def retrieve(self, prompt: str) -> List[Dict[str, Any]]:
+        """Retrieve relevant documents from the knowledge base."""
+        if not self.kb_id:
+            return []
+        response = await self.client.retrieve(
+            retrievalQuery={"text": prompt},
+            knowledgeBaseId=self.kb_id,
+            retrievalConfiguration=self.params,
+        )
+        return response["retrievalResults"]
+
+    get_relevant_docs = retrieve
@@ -0,0 +1,404 @@
+import base64
+import copy
+import json
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+from botocore.eventstream import EventStream
+from utils.bedrock import BedrockHandler, KBHandler
+from utils.bedrock_async import AsyncBedrockHandler, AsyncKBHandler
+from utils.generation import CancelToken
+from utils.model_capabilities import FAMILY_PARAMS, model_family
+from utils.model_capabilities import estimate_tokens as estimate_message_tokens
+from utils.usage import UsageLedger, compact_history, estimate_tokens
+
+# Recorded for an answer stopped before its first token, Converse rejects empty assistant messages
+STOPPED_ANSWER = "(stopped)"
+# Recorded for a stream that ended without text, such as one cut short or holding only non-text blocks
+NO_ANSWER = "(no answer)"
+
+
+def model_params(configs: Dict[str, Any], model_id: str) -> Dict[str, Any]:
+    """Pick the inference parameters of a model family from the config."""
+    return configs[FAMILY_PARAMS[model_family(model_id)]]
+
+
+class ConversationStore:
+    """Keeps the Bedrock messages of every chat session. Subclass it to keep them elsewhere."""
+
+    def get(self, session_id: str) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def append(self, session_id: str, message: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def clear(self, session_id: str) -> None:
+        raise NotImplementedError
+
+    def replace(self, session_id: str, messages: List[Dict[str, Any]]) -> None:
+        raise NotImplementedError
+
+
+class InMemoryConversationStore(ConversationStore):
+    """Conversations of a single process, the least recently used ones are dropped beyond max_sessions."""
+
+    def __init__(self, max_sessions: int = 10000):
+        self.max_sessions = max_sessions
+        self.sessions: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, session_id: str) -> List[Dict[str, Any]]:
+        with self.lock:
+            if session_id not in self.sessions:
+                return []
+            self.sessions.move_to_end(session_id)
+            return list(self.sessions[session_id])
+
+    def append(self, session_id: str, message: Dict[str, Any]) -> None:
+        with self.lock:
+            self.sessions.setdefault(session_id, []).append(message)
+            self.sessions.move_to_end(session_id)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def clear(self, session_id: str) -> None:
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def replace(self, session_id: str, messages: List[Dict[str, Any]]) -> None:
+        with self.lock:
+            self.sessions[session_id] = list(messages)
+            self.sessions.move_to_end(session_id)
+
+
+class FileConversationStore(ConversationStore):
+    """Conversations as one JSON file per session, shared by all workers with access to the directory."""
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+
+    def _path(self, session_id: str) -> Path:
+        safe_id = "".join(c for c in session_id if c.isalnum() or c in "-_")
+        return self.directory / f"{safe_id}.json"
+
+    @staticmethod
+    def _encode(value: Any) -> Any:
+        if isinstance(value, bytes):
+            return {"__bytes__": base64.b64encode(value).decode("utf-8")}
+        raise TypeError(f"Cannot store {type(value).__name__} in a conversation")
+
+    @staticmethod
+    def _decode(value: Dict[str, Any]) -> Any:
+        if set(value) == {"__bytes__"}:
+            return base64.b64decode(value["__bytes__"])
+        return value
+
+    def get(self, session_id: str) -> List[Dict[str, Any]]:
+        path = self._path(session_id)
+        if not path.exists():
+            return []
+        with open(path, encoding="utf-8") as f:
+            return json.load(f, object_hook=self._decode)
+
+    def _write(self, session_id: str, messages: List[Dict[str, Any]]) -> None:
+        path = self._path(session_id)
+        tmp_path = path.with_suffix(".json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(messages, f, default=self._encode)
+        tmp_path.replace(path)
+
+    def append(self, session_id: str, message: Dict[str, Any]) -> None:
+        with self.lock:
+            self._write(session_id, self.get(session_id) + [message])
+
+    def replace(self, session_id: str, messages: List[Dict[str, Any]]) -> None:
+        with self.lock:
+            self._write(session_id, messages)
+
+    def clear(self, session_id: str) -> None:
+        self._path(session_id).unlink(missing_ok=True)
+
+
+class ChatPipeline:
+    """Retrieve, build the user message, converse and record the history, independent of any UI."""
+
+    def __init__(
+        self,
+        bedrock_handler: BedrockHandler,
+        retriever: KBHandler,
+        store: ConversationStore,
+        ledger: Optional[UsageLedger] = None
+    ):
+        self.bedrock_handler = bedrock_handler
+        self.retriever = retriever
+        self.store = store
+        self.ledger = ledger
+        # Knowledge base context of the last user message, for the usage breakdown
+        self.context: Optional[str] = None
+
+    @property
+    def is_generation_model(self) -> bool:
+        return "nova-canvas" in self.bedrock_handler.model_id or "nova-reel" in self.bedrock_handler.model_id
+
+    def retrieve(self, prompt: str) -> List[Dict[str, Any]]:
+        """Relevant knowledge base documents, none for image and video models."""
+        if self.is_generation_model:
+            return []
+        return self.retriever.get_relevant_docs(prompt)
+
+    def add_user_message(
+        self,
+        session_id: str,
+        prompt: str,
+        docs: Optional[List[Dict[str, Any]]] = None,
+        files: Optional[List[Any]] = None,
+        **extra: Any
+    ) -> Dict[str, Any]:
+        """Build the user message with the retrieved context and append it to the conversation."""
+        context = self.retriever.parse_kb_output_to_string(docs) if docs else None
+        self.context = context
+        handler = self.bedrock_handler
+        user_msg = handler.user_message(
+            prompt,
+            context,
+            files,
+            spooler=handler.spooler,
+            s3_sources=bool(handler.capabilities and handler.capabilities.s3_sources),
+        )
+        user_msg.update(extra)
+        self.store.append(session_id, user_msg)
+        return user_msg
+
+    def record_response(self, session_id: str, text: str) -> None:
+        """Append the assistant answer to the conversation."""
+        self.store.append(session_id, BedrockHandler.assistant_message(text))
+
+    def discard_user_message(self, session_id: str) -> None:
+        """Remove a user message that was not answered, so the conversation keeps alternating roles."""
+        messages = self.store.get(session_id)
+        if messages and messages[-1]["role"] == "user":
+            self.store.replace(session_id, messages[:-1])
+
+    def record_usage(self, session_id: str, result: Dict[str, Any]) -> None:
+        """Add the tokens, latency and cost of an answer to the usage ledger."""
+        if self.ledger:
+            self.ledger.record(
+                session_id,
+                self.bedrock_handler.model_id,
+                result.get("usage", {}),
+                latency_ms=result.get("latency_ms", 0),
+                context=self.context,
+                system_prompt=self.bedrock_handler.system_prompt,
+                cached="cached" in result,
+            )
+
+    def compact(self, session_id: str, keep_turns: int) -> None:
+        """Keep only the last keep_turns turns of the conversation, so later turns send fewer tokens."""
+        self.store.replace(session_id, compact_history(self.store.get(session_id), keep_turns))
+
+    def conversation(self, session_id: str) -> List[Dict[str, Any]]:
+        """The messages to send, with the system prompt prepended to the first user message."""
+        messages = copy.deepcopy(self.store.get(session_id))
+        system_msg = self.bedrock_handler.system_message()
+        # The Converse API has no system role in messages, so the prompt goes into the first user turn
+        if system_msg and messages and messages[0]["role"] == "user":
+            sys_content = system_msg["content"][0]["text"]
+            user_content = messages[0]["content"][0]["text"]
+            messages[0]["content"][0]["text"] = f"{sys_content}\n\n{user_content}"
+        return messages
+
+    def respond(self, session_id: str) -> Dict[str, Any]:
+        """
+        Answer the last user message of the conversation in one response and record the answer. Errors are
+        raised to the caller, the conversation is left unanswered.
+        """
+        response = self.bedrock_handler.converse(self.conversation(session_id))
+        text = response["output"]["message"]["content"][0]["text"]
+        self.record_response(session_id, text)
+        result = {
+            "text": text,
+            "usage": response.get("usage", {}),
+            "latency_ms": response.get("metrics", {}).get("latencyMs", 0),
+        }
+        if "cached" in response:
+            result["cached"] = response["cached"]
+        self.record_usage(session_id, result)
+        return result
+
+    def respond_stream(self, session_id: str, cancel: Optional[CancelToken] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Answer the last user message as a stream of events, a delta per contentBlockDelta and a final done
+        event with the full text, and the cached marker when the answer was replayed from the response cache.
+        The answer is recorded once the stream is complete, NO_ANSWER when it held no text.
+        Cancelling the token closes the stream connection, the partial answer is recorded with estimated usage
+        and the done event is marked stopped.
+        """
+        messages = self.conversation(session_id)
+        response = self.bedrock_handler.invoke_model_with_stream(messages)
+        stream = response.get("stream")
+        connection = response.get("event_stream", stream)
+        if cancel and isinstance(connection, EventStream):
+            cancel.on_cancel(connection.close)
+        streamed_response = ""
+        done = {"usage": {}, "latency_ms": 0}
+        try:
+            for event in stream or []:
+                if cancel and cancel.cancelled:
+                    break
+                if "contentBlockDelta" in event:
+                    text = event["contentBlockDelta"]["delta"].get("text", "")
+                    streamed_response += text
+                    yield {"event": "delta", "data": {"text": text}}
+                elif "metadata" in event:
+                    done["usage"] = event["metadata"].get("usage", {})
+                    done["latency_ms"] = event["metadata"].get("metrics", {}).get("latencyMs", 0)
+                    if "cached" in event["metadata"]:
+                        done["cached"] = event["metadata"]["cached"]
+        except Exception:
+            # Reading from the closed connection fails
+            if not (cancel and cancel.cancelled):
+                raise
+        if cancel and cancel.cancelled and not done["usage"]:
+            done["stopped"] = True
+            # Bedrock bills what it generated before the connection closed, without reporting it
+            done["usage"] = {
+                "inputTokens": sum(estimate_message_tokens(m) for m in messages),
+                "outputTokens": estimate_tokens(streamed_response),
+            }
+            self.record_response(session_id, streamed_response or STOPPED_ANSWER)
+        else:
+            self.record_response(session_id, streamed_response or NO_ANSWER)
+        self.record_usage(session_id, done)
+        yield {"event": "done", "data": {"text": streamed_response, **done}}
+
+    def converse(self, session_id: str, prompt: str, files: Optional[List[Any]] = None) -> Dict[str, Any]:
+        """Retrieve, add the prompt to the conversation and answer it in one response."""
+        docs = self.retrieve(prompt)
+        self.add_user_message(session_id, prompt, docs, files)
+        return {**self.respond(session_id), "docs": docs}
+
+    def stream(self, session_id: str, prompt: str, files: Optional[List[Any]] = None) -> Iterator[Dict[str, Any]]:
+        """Retrieve, add the prompt to the conversation and stream the answer, the sources are sent first."""
+        docs = self.retrieve(prompt)
+        yield {"event": "sources", "data": docs}
+        self.add_user_message(session_id, prompt, docs, files)
+        yield from self.respond_stream(session_id)
+
+    def stream_retrieve_and_generate(
+        self, session_id: str, prompt: str, kb_session_id: Optional[str] = None, model_id: Optional[str] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Retrieve and stream the answer in a single round trip with RetrieveAndGenerate. Bedrock keeps the
+        conversation under kb_session_id, so neither the history nor the retrieved context is sent. Yields a
+        session event with the Bedrock session id to pass with the next prompt, the deltas, the sources cited
+        in the answer and a final done event, and records the turn in the conversation like stream once the
+        answer is complete. model_id is the model or inference profile to answer with, the one of the handler
+        by default.
+        RetrieveAndGenerate reports no token usage, the turn is recorded with usage estimated from the prompt,
+        the cited references and the answer.
+        """
+        handler = self.bedrock_handler
+        user_msg = handler.user_message(prompt)
+        template = f"{handler.system_prompt}\n\n" if handler.system_prompt else ""
+        response = self.retriever.retrieve_and_generate_stream(
+            prompt,
+            self.retriever.model_arn(model_id or handler.model_id),
+            kb_session_id,
+            prompt_template=f"{template}$search_results$\n\n$output_format_instructions$",
+            inference_config={
+                "temperature": handler.params.get("temperature", 0.0),
+                "maxTokens": handler.params.get("max_tokens", handler.params.get("maxTokens", 4096)),
+            },
+        )
+        yield {"event": "session", "data": {"session_id": response["sessionId"]}}
+        streamed_response, citations = "", []
+        for event in response["stream"]:
+            if "output" in event:
+                text = event["output"].get("text", "")
+                streamed_response += text
+                yield {"event": "delta", "data": {"text": text}}
+            elif "citation" in event:
+                citations.append(event["citation"].get("citation", event["citation"]))
+        docs = self.retriever.parse_citations_to_docs(citations)
+        # A failed call leaves the conversation as it was
+        self.store.append(session_id, user_msg)
+        self.record_response(session_id, streamed_response or NO_ANSWER)
+        self.context = "\n\n".join(doc["content"].get("text", "") for doc in docs) or None
+        done = {
+            "usage": {
+                "inputTokens": estimate_message_tokens(user_msg) + estimate_tokens(template) + estimate_tokens(self.context),
+                "outputTokens": estimate_tokens(streamed_response),
+            }
+        }
+        self.record_usage(session_id, done)
+        yield {"event": "sources", "data": docs}
+        yield {"event": "done", "data": {"text": streamed_response, **done}}
+
+
+class AsyncChatPipeline(ChatPipeline):
+    """
+    ChatPipeline on the asynchronous handlers, retrieve, respond, respond_stream, converse and stream are
+    coroutines so one event loop serves many conversations at once.
+    """
+
+    def __init__(
+        self,
+        bedrock_handler: AsyncBedrockHandler,
+        retriever: AsyncKBHandler,
+        store: ConversationStore,
+        ledger: Optional[UsageLedger] = None
+    ):
+        super().__init__(bedrock_handler, retriever, store, ledger)
+
+    async def retrieve(self, prompt: str) -> List[Dict[str, Any]]:
+        if self.is_generation_model:
+            return []
+        return await self.retriever.retrieve(prompt)
+
+    async def respond(self, session_id: str) -> Dict[str, Any]:
+        response = await self.bedrock_handler.converse(self.conversation(session_id))
+        text = response["output"]["message"]["content"][0]["text"]
+        self.record_response(session_id, text)
+        result = {
+            "text": text,
+            "usage": response.get("usage", {}),
+            "latency_ms": response.get("metrics", {}).get("latencyMs", 0),
+        }
+        if "cached" in response:
+            result["cached"] = response["cached"]
+        self.record_usage(session_id, result)
+        return result
+
+    async def respond_stream(self, session_id: str) -> AsyncIterator[Dict[str, Any]]:
+        streamed_response = ""
+        done = {"usage": {}, "latency_ms": 0}
+        async for event in self.bedrock_handler.converse_stream(self.conversation(session_id)):
+            if "contentBlockDelta" in event:
+                text = event["contentBlockDelta"]["delta"].get("text", "")
+                streamed_response += text
+                yield {"event": "delta", "data": {"text": text}}
+            elif "metadata" in event:
+                done["usage"] = event["metadata"].get("usage", {})
+                done["latency_ms"] = event["metadata"].get("metrics", {}).get("latencyMs", 0)
+                if "cached" in event["metadata"]:
+                    done["cached"] = event["metadata"]["cached"]
+        self.record_response(session_id, streamed_response or NO_ANSWER)
+        self.record_usage(session_id, done)
+        yield {"event": "done", "data": {"text": streamed_response, **done}}
+
+    async def converse(self, session_id: str, prompt: str, files: Optional[List[Any]] = None) -> Dict[str, Any]:
+        docs = await self.retrieve(prompt)
+        self.add_user_message(session_id, prompt, docs, files)
+        return {**await self.respond(session_id), "docs": docs}
+
+    async def stream(
+        self, session_id: str, prompt: str, files: Optional[List[Any]] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        docs = await self.retrieve(prompt)
+        yield {"event": "sources", "data": docs}
+        self.add_user_message(session_id, prompt, docs, files)
+        async for event in self.respond_stream(session_id):
+            yield event
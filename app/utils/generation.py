@@ -0,0 +1,162 @@
+import queue
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+# Seconds the consumer waits for an event before it gets a waiting event, so a UI can refresh and be interrupted
+POLL_INTERVAL = 0.1
+
+
+class CancelToken:
+    """Set when an answer is stopped, and runs the registered callbacks that close its stream connection."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks: List[Callable[[], Any]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def on_cancel(self, callback: Callable[[], Any]) -> None:
+        """Run callback on cancel, right away when the token is already cancelled."""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def cancel(self) -> None:
+        with self._lock:
+            if self.cancelled:
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._call(callback)
+
+    @staticmethod
+    def _call(callback: Callable[[], Any]) -> None:
+        # Closing a connection the worker is reading from may fail in either thread, the worker handles it
+        try:
+            callback()
+        except Exception:
+            pass
+
+
+class Generation:
+    """
+    An answer streamed by a worker thread into a queue, so it outlives the script run that started it. The
+    consumer drains the queue with events, and can stop and pick up draining again at any time.
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        start: Callable[[CancelToken], Iterator[Dict[str, Any]]],
+        docs: Optional[List[Dict[str, Any]]] = None
+    ):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.docs = docs or []
+        self.token = CancelToken()
+        # The text of the deltas drained so far
+        self.text = ""
+        self.error: Optional[Exception] = None
+        self.finished = threading.Event()
+        self.drained = False
+        self.polled_at = time.time()
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, args=(start,), daemon=True)
+        self._thread.start()
+
+    def _run(self, start: Callable[[CancelToken], Iterator[Dict[str, Any]]]) -> None:
+        try:
+            for event in start(self.token):
+                self._queue.put(event)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished.set()
+            self._queue.put(None)
+
+    def cancel(self) -> None:
+        self.token.cancel()
+
+    def events(self) -> Iterator[Dict[str, Any]]:
+        """
+        The events not drained yet, a waiting event every POLL_INTERVAL without one. Raises the error of the
+        worker once its events are drained.
+        """
+        while True:
+            self.polled_at = time.time()
+            try:
+                event = self._queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                yield {"event": "waiting", "data": {}}
+                continue
+            if event is None:
+                self.drained = True
+                if self.error:
+                    raise self.error
+                return
+            if event["event"] == "delta":
+                self.text += event["data"]["text"]
+            yield event
+
+
+class GenerationRegistry:
+    """The running answer of every chat session in the process, shared by all sessions.
+
+    A generation nobody drained for abandon_after seconds belongs to a session that went away, a reaper thread
+    stops it so its stream does not run to the end, and forgets it.
+    """
+
+    def __init__(self, abandon_after: float = 30.0, reap_interval: float = 5.0):
+        self.abandon_after = abandon_after
+        self.reap_interval = reap_interval
+        self.generations: Dict[str, Generation] = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._reap_forever, daemon=True).start()
+
+    def start(
+        self,
+        session_id: str,
+        start: Callable[[CancelToken], Iterator[Dict[str, Any]]],
+        docs: Optional[List[Dict[str, Any]]] = None
+    ) -> Generation:
+        """Start answering in a worker thread, a running answer of the session is stopped first."""
+        self.cancel(session_id)
+        generation = Generation(session_id, start, docs)
+        with self._lock:
+            self.generations[session_id] = generation
+        return generation
+
+    def get(self, session_id: str) -> Optional[Generation]:
+        """The answer of the session that is still running or not drained yet."""
+        with self._lock:
+            generation = self.generations.get(session_id)
+        return generation if generation and not generation.drained else None
+
+    def cancel(self, session_id: str) -> None:
+        generation = self.get(session_id)
+        if generation:
+            generation.cancel()
+
+    def reap(self) -> None:
+        now = time.time()
+        with self._lock:
+            for session_id, generation in list(self.generations.items()):
+                if generation.drained:
+                    del self.generations[session_id]
+                elif now - generation.polled_at >= self.abandon_after:
+                    generation.cancel()
+                    if generation.finished.is_set():
+                        del self.generations[session_id]
+
+    def _reap_forever(self) -> None:
+        while True:
+            time.sleep(self.reap_interval)
+            self.reap()
@@ -0,0 +1,64 @@
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional
+from utils.response_cache import ResponseCache
+
+# Range of the seed of Nova Canvas image generation
+MAX_IMAGE_SEED = 858993459
+
+
+class ImageCache:
+    """Bounded on-disk cache of generated images with LRU eviction by size.
+
+    Nova Canvas returns the same image for the same request and seed, so an image is stored under the hash
+    of the model and the full request body: task type, prompt, negative text, generation config with the seed,
+    and the source images by the hash of their bytes. Entries are PNG files, recency is tracked through file
+    modification times like ResponseCache, so the cache is shared by all sessions and survives restarts.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model_id: str, body: Dict[str, Any]) -> str:
+        """Stable hash of an image request, with the source images still as bytes."""
+        return ResponseCache.key({"modelId": model_id, "body": body})
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self.directory / f"{key}.png"
+        with self._lock:
+            try:
+                image = path.read_bytes()
+            except OSError:
+                return None
+            os.utime(path)
+            return image
+
+    def put(self, key: str, image: bytes) -> None:
+        path = self.directory / f"{key}.png"
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        with os.fdopen(fd, "wb") as f:
+            f.write(image)
+        with self._lock:
+            os.replace(tmp_path, path)
+            self._evict(keep=path)
+
+    def _evict(self, keep: Optional[Path] = None) -> None:
+        """Remove least recently used images until the cache fits in max_bytes."""
+        entries = []
+        for p in self.directory.glob("*.png"):
+            stat = p.stat()
+            entries.append((stat.st_mtime, stat.st_size, p))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            path.unlink(missing_ok=True)
+            total -= size
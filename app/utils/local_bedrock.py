@@ -0,0 +1,296 @@
+import asyncio
+import io
+import json
+import struct
+import threading
+import time
+import uuid
+import zlib
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from botocore.response import StreamingBody
+
+# A 1x1 PNG, the image every local Nova Canvas request generates
+LOCAL_IMAGE = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
+
+
+def encode_event(event_type: str, payload: Dict[str, Any]) -> bytes:
+    """Encode one message of the AWS event stream format used by converse_stream."""
+    headers = b""
+    for name, value in ((":event-type", event_type), (":content-type", "application/json"), (":message-type", "event")):
+        encoded_name, encoded_value = name.encode("utf-8"), value.encode("utf-8")
+        # header value type 7 is a string
+        headers += struct.pack("!B", len(encoded_name)) + encoded_name
+        headers += struct.pack("!BH", 7, len(encoded_value)) + encoded_value
+    body = json.dumps(payload).encode("utf-8")
+    total_length = 12 + len(headers) + len(body) + 4
+    prelude = struct.pack("!II", total_length, len(headers))
+    message = prelude + struct.pack("!I", zlib.crc32(prelude)) + headers + body
+    return message + struct.pack("!I", zlib.crc32(message))
+
+
+class LocalBedrockEndpoint:
+    """
+    Stand-in for the Bedrock runtime and agent runtime HTTP endpoints, for load tests without AWS.
+    Answers converse, converse-stream, invoke (Nova Canvas images), retrieve, retrieve-and-generate-stream and
+    list-knowledge-bases with a configurable latency, point a client at it with endpoint_url and any
+    credentials. network_latency is added to every request, as the round trip of a client far from the region.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        first_token_latency: float = 0.3,
+        token_delay: float = 0.02,
+        tokens: int = 50,
+        network_latency: float = 0.0,
+        document_chars: int = 200,
+        image_latency: float = 1.0
+    ):
+        self.host = host
+        self.port = port
+        self.first_token_latency = first_token_latency
+        self.token_delay = token_delay
+        self.tokens = tokens
+        self.network_latency = network_latency
+        self.document_chars = document_chars
+        self.image_latency = image_latency
+        self.requests = 0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.server: Optional[asyncio.base_events.Server] = None
+        self.started = threading.Event()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, bytes]]:
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        if not request_line:
+            return None
+        method, path, _ = request_line.split(" ", 2)
+        headers = {}
+        while (line := (await reader.readline()).decode("latin-1").strip()):
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+        return method, path, body
+
+    @staticmethod
+    def write_json(writer: asyncio.StreamWriter, status: int, payload: Dict[str, Any]) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body
+        )
+
+    def usage(self) -> Dict[str, int]:
+        return {"inputTokens": 100, "outputTokens": self.tokens, "totalTokens": 100 + self.tokens}
+
+    async def converse(self, writer: asyncio.StreamWriter) -> None:
+        await asyncio.sleep(self.first_token_latency + self.token_delay * self.tokens)
+        self.write_json(writer, 200, {
+            "output": {"message": {"role": "assistant", "content": [{"text": " ".join(["token"] * self.tokens)}]}},
+            "stopReason": "end_turn",
+            "usage": self.usage(),
+            "metrics": {"latencyMs": 0}
+        })
+
+    async def converse_stream(self, writer: asyncio.StreamWriter) -> None:
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: application/vnd.amazon.eventstream\r\n"
+            b"Transfer-Encoding: chunked\r\n\r\n"
+        )
+
+        async def send(event_type: str, payload: Dict[str, Any]) -> None:
+            chunk = encode_event(event_type, payload)
+            writer.write(f"{len(chunk):x}\r\n".encode("latin-1") + chunk + b"\r\n")
+            await writer.drain()
+
+        await asyncio.sleep(self.first_token_latency)
+        await send("messageStart", {"role": "assistant"})
+        for _ in range(self.tokens):
+            await send("contentBlockDelta", {"contentBlockIndex": 0, "delta": {"text": "token "}})
+            await asyncio.sleep(self.token_delay)
+        await send("contentBlockStop", {"contentBlockIndex": 0})
+        await send("messageStop", {"stopReason": "end_turn"})
+        await send("metadata", {"usage": self.usage(), "metrics": {"latencyMs": 0}})
+        writer.write(b"0\r\n\r\n")
+
+    async def invoke(self, writer: asyncio.StreamWriter) -> None:
+        await asyncio.sleep(self.image_latency)
+        self.write_json(writer, 200, {"images": [LOCAL_IMAGE]})
+
+    def list_knowledge_bases(self, writer: asyncio.StreamWriter) -> None:
+        self.write_json(writer, 200, {"knowledgeBaseSummaries": [{
+            "knowledgeBaseId": "LOCALKB",
+            "name": "Local knowledge base",
+            "status": "ACTIVE",
+            "updatedAt": "2024-01-01T00:00:00Z",
+        }]})
+
+    def documents(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "content": {"text": (f"Local document {i}. " + "Orderset guidance. " * self.document_chars)[:self.document_chars]},
+                "location": {"type": "S3", "s3Location": {"uri": f"s3://local/document-{i}.pdf"}},
+                "score": 1.0 - i / 10
+            }
+            for i in range(5)
+        ]
+
+    async def retrieve(self, writer: asyncio.StreamWriter) -> None:
+        await asyncio.sleep(self.first_token_latency / 2)
+        self.write_json(writer, 200, {"retrievalResults": self.documents()})
+
+    async def retrieve_and_generate_stream(self, writer: asyncio.StreamWriter, body: bytes) -> None:
+        """Retrieval and generation run next to each other, the session id is kept or created like Bedrock does."""
+        session_id = json.loads(body or b"{}").get("sessionId") or str(uuid.uuid4())
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: application/vnd.amazon.eventstream\r\n"
+            + f"x-amzn-bedrock-knowledge-base-session-id: {session_id}\r\n".encode("latin-1")
+            + b"Transfer-Encoding: chunked\r\n\r\n"
+        )
+
+        async def send(event_type: str, payload: Dict[str, Any]) -> None:
+            chunk = encode_event(event_type, payload)
+            writer.write(f"{len(chunk):x}\r\n".encode("latin-1") + chunk + b"\r\n")
+            await writer.drain()
+
+        await asyncio.sleep(self.first_token_latency / 2 + self.first_token_latency)
+        for _ in range(self.tokens):
+            await send("output", {"text": "token "})
+            await asyncio.sleep(self.token_delay)
+        references = [{k: doc[k] for k in ("content", "location")} for doc in self.documents()[:2]]
+        await send("citation", {"citation": {
+            "generatedResponsePart": {"textResponsePart": {"text": "token " * self.tokens}},
+            "retrievedReferences": references,
+        }})
+        writer.write(b"0\r\n\r\n")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            # Clients keep connections alive, serve requests until they close it
+            while (request := await self.read_request(reader)):
+                method, path, body = request
+                self.requests += 1
+                if self.network_latency:
+                    await asyncio.sleep(self.network_latency)
+                if path.endswith("/retrieveAndGenerateStream"):
+                    await self.retrieve_and_generate_stream(writer, body)
+                elif path.endswith("/converse-stream"):
+                    await self.converse_stream(writer)
+                elif path.endswith("/converse"):
+                    await self.converse(writer)
+                elif path.endswith("/retrieve"):
+                    await self.retrieve(writer)
+                elif path.endswith("/invoke"):
+                    await self.invoke(writer)
+                elif path.rstrip("/").endswith("/knowledgebases"):
+                    self.list_knowledge_bases(writer)
+                else:
+                    self.write_json(writer, 404, {"message": f"{method} {path} is not supported locally"})
+                await writer.drain()
+        except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _run(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.handle, self.host, self.port, backlog=4096)
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.started.set()
+        self.loop.run_forever()
+
+    def start(self) -> "LocalBedrockEndpoint":
+        """Serve on a background thread with its own event loop."""
+        threading.Thread(target=self._run, daemon=True).start()
+        self.started.wait()
+        return self
+
+    def stop(self) -> None:
+        if self.loop and self.server:
+            self.loop.call_soon_threadsafe(self.server.close)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            time.sleep(0.1)
+
+
+class LocalS3Client:
+    """The S3 calls used by batch inference on a local directory, one sub directory per bucket."""
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+
+    def _path(self, bucket: str, key: str) -> Path:
+        return self.directory / bucket / key
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes, **kwargs: Any) -> Dict[str, Any]:
+        path = self._path(Bucket, Key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(Body)
+        return {}
+
+    def get_object(self, Bucket: str, Key: str, **kwargs: Any) -> Dict[str, Any]:
+        data = self._path(Bucket, Key).read_bytes()
+        return {"Body": StreamingBody(io.BytesIO(data), len(data)), "ContentLength": len(data)}
+
+    def list_objects_v2(self, Bucket: str, Prefix: str = "", **kwargs: Any) -> Dict[str, Any]:
+        root = self.directory / Bucket
+        keys = sorted(
+            path.relative_to(root).as_posix() for path in root.rglob("*") if path.is_file()
+        ) if root.exists() else []
+        return {"Contents": [{"Key": key} for key in keys if key.startswith(Prefix)], "IsTruncated": False}
+
+
+class LocalBedrockBatchClient:
+    """
+    The model invocation job calls of the Bedrock control plane on a LocalS3Client. Jobs answer every record
+    with a canned response in the output format of the model and complete after job_seconds.
+    """
+
+    def __init__(self, s3_client: LocalS3Client, job_seconds: float = 0.0):
+        self.s3_client = s3_client
+        self.job_seconds = job_seconds
+        # jobs are kept next to the buckets so another process can track them
+        self.jobs_directory = s3_client.directory / ".jobs"
+        self.jobs_directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def _model_output(model_id: str, record_id: str) -> Dict[str, Any]:
+        text = f"Local answer to record {record_id}"
+        if "anthropic" in model_id:
+            return {"content": [{"type": "text", "text": text}], "usage": {"input_tokens": 100, "output_tokens": 6}}
+        return {
+            "output": {"message": {"role": "assistant", "content": [{"text": text}]}},
+            "usage": {"inputTokens": 100, "outputTokens": 6}
+        }
+
+    def create_model_invocation_job(
+        self, jobName: str, roleArn: str, modelId: str, inputDataConfig: Dict[str, Any],
+        outputDataConfig: Dict[str, Any], **kwargs: Any
+    ) -> Dict[str, Any]:
+        job_id = uuid.uuid4().hex[:12]
+        input_bucket, input_key = inputDataConfig["s3InputDataConfig"]["s3Uri"][5:].split("/", 1)
+        output_bucket, output_prefix = outputDataConfig["s3OutputDataConfig"]["s3Uri"][5:].split("/", 1)
+        lines = []
+        body = self.s3_client.get_object(Bucket=input_bucket, Key=input_key)["Body"]
+        for line in body.iter_lines():
+            if line:
+                record = json.loads(line)
+                record["modelOutput"] = self._model_output(modelId, record["recordId"])
+                lines.append(json.dumps(record))
+        output_key = f"{output_prefix.rstrip('/')}/{job_id}/{input_key.split('/')[-1]}.out"
+        self.s3_client.put_object(Bucket=output_bucket, Key=output_key, Body="\n".join(lines).encode("utf-8"))
+        job_arn = f"arn:aws:bedrock:local:000000000000:model-invocation-job/{job_id}"
+        job = {"jobArn": job_arn, "jobName": jobName, "modelId": modelId, "created": time.time()}
+        (self.jobs_directory / f"{job_id}.json").write_text(json.dumps(job), encoding="utf-8")
+        return {"jobArn": job_arn}
+
+    def get_model_invocation_job(self, jobIdentifier: str) -> Dict[str, Any]:
+        job = json.loads((self.jobs_directory / f"{jobIdentifier.split('/')[-1]}.json").read_text(encoding="utf-8"))
+        done = time.time() - job["created"] >= self.job_seconds
+        return {**job, "status": "Completed" if done else "InProgress"}
@@ -0,0 +1,250 @@
+import io
+from typing import Any, Dict, List, Optional
+from PIL import Image
+from pydantic import BaseModel, ConfigDict
+
+# Estimated tokens of one image and of one character of text, to check requests against the context window
+IMAGE_TOKENS = 1600
+CHARS_PER_TOKEN = 4
+# PDF and Office files are mostly layout and compressed streams, far fewer tokens per byte than text
+TEXT_DOCUMENT_FORMATS = {"csv", "html", "txt", "md"}
+BINARY_DOCUMENT_BYTES_PER_TOKEN = 40
+
+# Converse limits per family, a "model_capabilities" entry in config.json overrides them per model id
+FAMILY_CAPABILITIES: Dict[str, Dict[str, Any]] = {
+    "anthropic": {
+        "input_modalities": ["text", "image", "document"],
+        "output_modality": "text",
+        "streaming": True,
+        "context_window": 200000,
+    },
+    "nova-micro": {
+        "input_modalities": ["text"],
+        "output_modality": "text",
+        "streaming": True,
+        "context_window": 128000,
+    },
+    "nova": {
+        "input_modalities": ["text", "image", "document", "video"],
+        "output_modality": "text",
+        "streaming": True,
+        "context_window": 300000,
+        "s3_sources": True,
+    },
+    "nova-canvas": {
+        "input_modalities": ["text", "image"],
+        "output_modality": "image",
+        "streaming": False,
+        "context_window": 0,
+        "image_formats": ["png", "jpeg"],
+        "max_images": 5,
+        "max_prompt_chars": 1024,
+    },
+    "nova-reel": {
+        "input_modalities": ["text", "image"],
+        "output_modality": "video",
+        "streaming": False,
+        "context_window": 0,
+        "image_formats": ["png", "jpeg"],
+        "max_images": 1,
+        "max_prompt_chars": 512,
+    },
+}
+
+# Keys of the model params in config.json per family
+FAMILY_PARAMS = {
+    "anthropic": "claude_model_params",
+    "nova-micro": "nova_model_params",
+    "nova": "nova_model_params",
+    "nova-canvas": "nova_canvas_params",
+    "nova-reel": "nova_reel_params",
+}
+
+
+class RequestValidationError(ValueError):
+    """
+    Thrown when a request cannot be sent to a model, even after downscaling and trimming
+    """
+
+    pass
+
+
+class ModelCapabilities(BaseModel):
+    model_config = ConfigDict(protected_namespaces=())
+
+    model_id: str
+    family: str
+    params: Dict[str, Any]
+    input_modalities: List[str]
+    output_modality: str
+    streaming: bool
+    context_window: int
+    max_output_tokens: int = 4096
+    max_prompt_chars: int = 0
+    image_formats: List[str] = ["png", "jpeg", "gif", "webp"]
+    max_image_bytes: int = 3750000
+    max_image_pixels: int = 8000
+    max_images: int = 20
+    document_formats: List[str] = ["pdf", "csv", "doc", "docx", "xls", "xlsx", "html", "txt", "md"]
+    max_document_bytes: int = 4500000
+    max_documents: int = 5
+    # Whether image and document sources may be s3Location instead of bytes
+    s3_sources: bool = False
+
+    def supports(self, modality: str) -> bool:
+        return modality in self.input_modalities
+
+
+def model_family(model_id: str) -> str:
+    """The entry of FAMILY_CAPABILITIES of a model id, the most specific one first."""
+    for family in ("nova-canvas", "nova-reel", "nova-micro", "anthropic", "nova"):
+        if family in model_id:
+            return family
+    return "nova"
+
+
+class CapabilityRegistry:
+    """Capabilities and params of every model in multimodal_llms, resolved once from the config."""
+
+    def __init__(self, capabilities: Dict[str, ModelCapabilities]):
+        self.capabilities = capabilities
+
+    @classmethod
+    def from_config(cls, configs: Dict[str, Any]) -> "CapabilityRegistry":
+        overrides = configs.get("model_capabilities", {})
+        capabilities = {}
+        for models in configs["multimodal_llms"].values():
+            for model_id in models.values():
+                if model_id not in capabilities:
+                    capabilities[model_id] = cls.resolve(configs, model_id, overrides.get(model_id, {}))
+        return cls(capabilities)
+
+    @staticmethod
+    def resolve(configs: Dict[str, Any], model_id: str, overrides: Optional[Dict[str, Any]] = None) -> ModelCapabilities:
+        family = model_family(model_id)
+        params = configs[FAMILY_PARAMS[family]]
+        return ModelCapabilities(
+            model_id=model_id,
+            family=family,
+            params=params,
+            max_output_tokens=params.get("max_tokens", params.get("maxTokens", 4096)),
+            **{**FAMILY_CAPABILITIES[family], **(overrides or {})},
+        )
+
+    def get(self, model_id: str) -> ModelCapabilities:
+        if model_id not in self.capabilities:
+            raise KeyError(f"Model {model_id} is not in multimodal_llms")
+        return self.capabilities[model_id]
+
+
+def _image_parts(content: Dict[str, Any]) -> tuple[bytes, Optional[str]]:
+    image = content["image"]
+    if isinstance(image, dict):
+        return image["source"]["bytes"], image.get("format")
+    return image, None
+
+
+def fit_image(capabilities: ModelCapabilities, data: bytes, image_format: Optional[str] = None) -> Dict[str, Any]:
+    """
+    An image in the Converse shape, re-encoded or downscaled when its format, dimensions or size exceed the
+    limits of the model.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+    except Exception as e:
+        raise RequestValidationError(f"Attached image cannot be read: {str(e)}")
+    fmt = (image_format or image.format or "png").lower().replace("jpg", "jpeg")
+    too_large = max(image.size) > capabilities.max_image_pixels or len(data) > capabilities.max_image_bytes
+    if fmt in capabilities.image_formats and not too_large:
+        return {"image": {"format": fmt, "source": {"bytes": data}}}
+
+    fmt = "jpeg" if fmt == "jpeg" or image.mode in ("RGB", "L") else "png"
+    scale = min(1.0, capabilities.max_image_pixels / max(image.size))
+    while True:
+        resized = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))))
+        buffer = io.BytesIO()
+        if fmt == "jpeg":
+            resized.convert("RGB").save(buffer, format="JPEG", quality=85)
+        else:
+            resized.save(buffer, format="PNG", optimize=True)
+        if buffer.tell() <= capabilities.max_image_bytes:
+            return {"image": {"format": fmt, "source": {"bytes": buffer.getvalue()}}}
+        if min(resized.size) <= 64:
+            raise RequestValidationError(f"Attached image cannot be reduced below {capabilities.max_image_bytes} bytes")
+        scale *= 0.75
+
+
+def estimate_tokens(message: Dict[str, Any]) -> int:
+    tokens = 0
+    for content in message["content"]:
+        if "text" in content:
+            tokens += len(content["text"]) // CHARS_PER_TOKEN + 1
+        elif "image" in content:
+            tokens += IMAGE_TOKENS
+        elif "document" in content:
+            document = content["document"]
+            size = len(document["source"].get("bytes", b""))
+            if document.get("format") in TEXT_DOCUMENT_FORMATS:
+                tokens += size // CHARS_PER_TOKEN
+            else:
+                tokens += size // BINARY_DOCUMENT_BYTES_PER_TOKEN
+    return tokens
+
+
+def validate_messages(capabilities: ModelCapabilities, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Check the messages against the capabilities of the model before they are sent. Images are converted to the
+    Converse shape and downscaled to fit, images and documents beyond the per request limits are dropped from
+    the oldest messages first, and the oldest turns are trimmed to fit the context window.
+    Raises RequestValidationError for what cannot be fixed locally.
+    """
+    # Content lists are rebuilt and blocks replaced, never changed, so attachment bytes are not copied
+    messages = [{**message} for message in messages]
+    images = documents = 0
+    # Walk newest first, so the latest attachments are the ones kept
+    for message in reversed(messages):
+        kept = []
+        for content in message["content"]:
+            if "image" in content:
+                if not capabilities.supports("image"):
+                    raise RequestValidationError(f"{capabilities.model_id} does not accept images")
+                images += 1
+                if images > capabilities.max_images:
+                    kept.append({"text": "[image omitted]"})
+                    continue
+                if not (isinstance(content["image"], dict) and "s3Location" in content["image"]["source"]):
+                    content = fit_image(capabilities, *_image_parts(content))
+            elif "document" in content:
+                if not capabilities.supports("document"):
+                    raise RequestValidationError(f"{capabilities.model_id} does not accept documents")
+                document = content["document"]
+                if document.get("format") not in capabilities.document_formats:
+                    raise RequestValidationError(f"Document format {document.get('format')} is not supported")
+                if len(document["source"].get("bytes", b"")) > capabilities.max_document_bytes:
+                    raise RequestValidationError(
+                        f"Document {document.get('name')} is larger than {capabilities.max_document_bytes} bytes"
+                    )
+                documents += 1
+                if documents > capabilities.max_documents:
+                    kept.append({"text": f"[document {document.get('name')} omitted]"})
+                    continue
+            kept.append(content)
+        message["content"] = kept
+
+    if capabilities.max_prompt_chars and messages:
+        prompt = next((c["text"] for c in messages[-1]["content"] if "text" in c), "")
+        if len(prompt) > capabilities.max_prompt_chars:
+            raise RequestValidationError(
+                f"{capabilities.model_id} accepts prompts of at most {capabilities.max_prompt_chars} characters"
+            )
+
+    if capabilities.context_window:
+        budget = capabilities.context_window - capabilities.max_output_tokens
+        # Drop the oldest user and assistant pair after the first message, which holds the system prompt
+        while sum(estimate_tokens(m) for m in messages) > budget and len(messages) > 3:
+            del messages[1:3]
+        if sum(estimate_tokens(m) for m in messages) > budget:
+            raise RequestValidationError(
+                f"The conversation does not fit in the {capabilities.context_window} token context window"
+            )
+    return messages
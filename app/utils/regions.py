@@ -0,0 +1,171 @@
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+from botocore.exceptions import BotoCoreError, ClientError
+from pydantic import BaseModel
+
+# Geography prefix of cross-region inference profile ids, such as us.anthropic.claude-3-5-sonnet-20240620-v1:0
+INFERENCE_PROFILE_PREFIX = re.compile(r"^(us|eu|apac|us-gov)\.")
+# Errors that say more about the region than about the request, worth retrying elsewhere
+REGIONAL_ERROR_CODES = {
+    "ThrottlingException",
+    "ServiceUnavailableException",
+    "InternalServerException",
+    "ModelNotReadyException",
+    "ModelTimeoutException",
+}
+
+
+def base_model_id(model_id: str) -> str:
+    """The model id of a cross-region inference profile id, other ids are returned as they are."""
+    return INFERENCE_PROFILE_PREFIX.sub("", model_id)
+
+
+def inference_profile(configs: Dict[str, Any], model_id: str, region: str) -> str:
+    """The inference profile id configured for the model in a region, or the model id itself."""
+    return configs.get("inference_profiles", {}).get(model_id, {}).get(region, model_id)
+
+
+def model_regions(configs: Dict[str, Any], model: str) -> Dict[str, str]:
+    """Region codes by region name of the regions in multimodal_llms that offer a model name."""
+    return {
+        name: configs["regions"][name]
+        for name, models in configs["multimodal_llms"].items()
+        if model in models
+    }
+
+
+def is_regional_failure(error: Exception) -> bool:
+    """Whether a failed call should count against its region and be retried in another one."""
+    if isinstance(error, ClientError):
+        code = error.response.get("Error", {}).get("Code")
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return code in REGIONAL_ERROR_CODES or status >= 500
+    return isinstance(error, BotoCoreError)
+
+
+class EndpointProbe:
+    """
+    Round trip in milliseconds of an unsigned request to the runtime endpoint of a region. The request is
+    rejected, but any answer below 500 shows the endpoint is up. Point endpoint_url at a LocalBedrockEndpoint
+    to probe without AWS.
+    """
+
+    def __init__(self, endpoint_url: str = "https://bedrock-runtime.{region}.amazonaws.com", timeout: float = 3.0):
+        self.endpoint_url = endpoint_url
+        self.timeout = timeout
+
+    def __call__(self, region: str) -> float:
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(self.endpoint_url.format(region=region), timeout=self.timeout):
+                pass
+        except urllib.error.HTTPError as e:
+            if e.code >= 500:
+                raise
+        return (time.perf_counter() - start) * 1000
+
+
+class StaticProbe:
+    """Fixed latencies in milliseconds per region, for local runs. Regions set to None fail their probe."""
+
+    def __init__(self, latencies: Dict[str, Optional[float]]):
+        self.latencies = latencies
+
+    def __call__(self, region: str) -> float:
+        latency = self.latencies.get(region)
+        if latency is None:
+            raise ConnectionError(f"Region {region} is marked as failing")
+        return float(latency)
+
+
+class RegionHealth(BaseModel):
+    region: str
+    # Exponentially weighted moving average of the probed round trips
+    latency_ms: Optional[float] = None
+    # Outcomes of the recent probes and calls, True for a success
+    outcomes: List[bool] = []
+
+    @property
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+
+class RegionSelector:
+    """Ranks regions by probed latency and recent error rate, shared by all sessions.
+
+    Every probe_interval seconds the runtime endpoints of all regions are probed in parallel. Calls
+    made by the app are recorded too, so a region that starts throttling or failing drops out of the
+    ranking before its next probe.
+    """
+
+    def __init__(
+        self,
+        regions: List[str],
+        probe: Callable[[str], float],
+        probe_interval: float = 60.0,
+        error_window: int = 10,
+        max_error_rate: float = 0.3,
+        smoothing: float = 0.3
+    ):
+        self.probe = probe
+        self.probe_interval = probe_interval
+        self.error_window = error_window
+        self.max_error_rate = max_error_rate
+        self.smoothing = smoothing
+        self.health = {region: RegionHealth(region=region) for region in regions}
+        self.probed_at = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, region: str, ok: bool, latency_ms: Optional[float] = None) -> None:
+        """Record the outcome of a probe or of a call to the region."""
+        with self._lock:
+            health = self.health.setdefault(region, RegionHealth(region=region))
+            health.outcomes = (health.outcomes + [ok])[-self.error_window:]
+            if latency_ms is not None:
+                health.latency_ms = (
+                    latency_ms
+                    if health.latency_ms is None
+                    else self.smoothing * latency_ms + (1 - self.smoothing) * health.latency_ms
+                )
+
+    def _probe(self, region: str) -> None:
+        try:
+            self.record(region, True, self.probe(region))
+        except Exception:
+            self.record(region, False)
+
+    def probe_all(self) -> None:
+        with ThreadPoolExecutor(max_workers=len(self.health) or 1) as executor:
+            list(executor.map(self._probe, list(self.health)))
+        self.probed_at = time.time()
+
+    def refresh(self) -> None:
+        """Probe the regions when the last probe is older than probe_interval."""
+        if time.time() - self.probed_at >= self.probe_interval:
+            self.probe_all()
+
+    def healthy(self, region: str) -> bool:
+        return self.health[region].error_rate <= self.max_error_rate
+
+    def ranked(self, candidates: List[str]) -> List[str]:
+        """
+        The candidate regions to try in order: healthy ones fastest first, then degraded ones by error rate.
+        """
+        self.refresh()
+        with self._lock:
+            health = {region: self.health.setdefault(region, RegionHealth(region=region)) for region in candidates}
+
+            def key(region: str) -> tuple:
+                latency = health[region].latency_ms
+                return (
+                    not self.healthy(region),
+                    health[region].error_rate if not self.healthy(region) else 0.0,
+                    latency if latency is not None else float("inf"),
+                )
+
+            return sorted(candidates, key=key)
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+
+class ResponseCache:
+    """Bounded on-disk cache of Converse responses with LRU eviction and a time to live.
+
+    Only deterministic requests should be cached, BedrockHandler uses it for temperature 0 only.
+    Entries are JSON files named by the hash of the request, recency is tracked through file
+    modification times like PosterCache, so the cache is shared by all sessions and survives restarts.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, ttl_seconds: float):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _canonical(value: Any) -> Any:
+        """Attachments are represented by the hash of their bytes."""
+        if isinstance(value, (bytes, bytearray)):
+            return {"sha256": hashlib.sha256(value).hexdigest()}
+        if isinstance(value, dict):
+            return {k: ResponseCache._canonical(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [ResponseCache._canonical(v) for v in value]
+        return value
+
+    @staticmethod
+    def key(request: Dict[str, Any]) -> str:
+        """Stable hash of a full Converse request: model, messages with attachments and inference settings."""
+        canonical = json.dumps(ResponseCache._canonical(request), sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """The cached entry, {"response", "elapsed_seconds", "created"}, or None when missing or expired."""
+        path = self.directory / f"{key}.json"
+        with self._lock:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                return None
+            if time.time() - entry["created"] > self.ttl_seconds:
+                path.unlink(missing_ok=True)
+                return None
+            os.utime(path)
+            return entry
+
+    def put(self, key: str, response: Dict[str, Any], elapsed_seconds: float) -> None:
+        """Store the parts of a response worth replaying and the seconds Bedrock took to produce it."""
+        entry = {
+            "response": {k: response[k] for k in ("output", "stopReason", "usage") if k in response},
+            "elapsed_seconds": elapsed_seconds,
+            "created": time.time(),
+        }
+        path = self.directory / f"{key}.json"
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        with self._lock:
+            os.replace(tmp_path, path)
+            self._evict(keep=path)
+
+    def _evict(self, keep: Optional[Path] = None) -> None:
+        """Remove expired entries, then least recently used ones until the cache fits in max_bytes."""
+        now = time.time()
+        entries = []
+        for p in self.directory.glob("*.json"):
+            stat = p.stat()
+            if now - stat.st_mtime > self.ttl_seconds and p != keep:
+                p.unlink(missing_ok=True)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, p))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            path.unlink(missing_ok=True)
+            total -= size
@@ -0,0 +1,125 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# Source key of a content block whose bytes are in a local spool file, resolved right before a request is sent
+SPOOLED_SOURCE = "spooled"
+IMAGE_FORMATS = {"png": "png", "jpeg": "jpeg", "jpg": "jpeg", "gif": "gif", "webp": "webp"}
+DOCUMENT_FORMATS = {"pdf", "csv", "doc", "docx", "xls", "xlsx", "html", "txt", "md"}
+
+
+def upload_buffer(file: Any) -> memoryview:
+    """The bytes of an upload without copying them, Streamlit uploads are BytesIO objects."""
+    if hasattr(file, "getbuffer"):
+        return file.getbuffer()
+    return memoryview(file.getvalue())
+
+
+def document_name(file_name: str) -> str:
+    """A document name Converse accepts: letters, digits, single spaces, hyphens, parentheses and brackets."""
+    name = re.sub(r"[^A-Za-z0-9\-\(\)\[\] ]", " ", Path(file_name).stem)
+    return re.sub(r"\s+", " ", name).strip() or "document"
+
+
+class UploadSpooler:
+    """Keeps large uploads out of the conversation history.
+
+    Uploads up to inline_max_bytes are sent inline as before. Larger ones are written once to a spool
+    directory, named by their hash so every session and turn attaching the same file shares one copy,
+    and the message only holds a reference. With an S3 location they are also uploaded with a
+    multipart transfer, and models that read from S3 get an s3Location source instead of bytes.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        inline_max_bytes: int = 1024 * 1024,
+        s3_handler: Optional[Any] = None,
+        s3_uri: Optional[str] = None,
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.inline_max_bytes = inline_max_bytes
+        self.s3_handler = s3_handler
+        self.s3_uri = s3_uri.rstrip("/") if s3_uri else None
+        self._lock = threading.Lock()
+        # Hash of every upload seen, so a file attached on every turn is hashed once
+        self._digests: Dict[str, str] = {}
+
+    def _digest(self, file: Any, data: memoryview) -> str:
+        file_id = getattr(file, "file_id", None)
+        if file_id and file_id in self._digests:
+            return self._digests[file_id]
+        digest = hashlib.sha256(data).hexdigest()
+        if file_id:
+            self._digests[file_id] = digest
+        return digest
+
+    def spool(self, file: Any, data: memoryview, suffix: str) -> Path:
+        """Write the upload to the spool directory once, returning its path."""
+        path = self.directory / f"{self._digest(file, data)}.{suffix}"
+        with self._lock:
+            if path.exists():
+                return path
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return path
+
+    def s3_location(self, path: Path) -> str:
+        """Upload a spooled file to the S3 location once, returning its URI."""
+        bucket, _, prefix = self.s3_uri[len("s3://"):].partition("/")
+        key = f"{prefix}/{path.name}" if prefix else path.name
+        if not self.s3_handler.object_exists(bucket, key):
+            self.s3_handler.upload_file(str(path), bucket, key)
+        return f"s3://{bucket}/{key}"
+
+    def content_block(self, file: Any, s3_sources: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        The Converse image or document block of an upload, None for unsupported file types.
+        s3_sources tells whether the model reads image and document sources from S3.
+        """
+        suffix = Path(file.name).suffix[1:].lower()
+        if suffix in IMAGE_FORMATS:
+            kind, block = "image", {"format": IMAGE_FORMATS[suffix]}
+        elif suffix in DOCUMENT_FORMATS:
+            kind, block = "document", {"format": suffix, "name": document_name(file.name)}
+        else:
+            return None
+        data = upload_buffer(file)
+        try:
+            if len(data) <= self.inline_max_bytes:
+                block["source"] = {"bytes": bytes(data)}
+            else:
+                path = self.spool(file, data, suffix)
+                if s3_sources and self.s3_uri and self.s3_handler:
+                    block["source"] = {"s3Location": {"uri": self.s3_location(path)}}
+                else:
+                    block["source"] = {SPOOLED_SOURCE: str(path)}
+        finally:
+            # An exported buffer keeps the upload from being resized or closed
+            data.release()
+        return {kind: block}
+
+
+def resolve_spooled(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    The messages with spooled sources replaced by the bytes of their file, only for the request being sent.
+    The stored messages keep their references, other blocks are shared rather than copied.
+    """
+    resolved = []
+    for message in messages:
+        content = []
+        for block in message["content"]:
+            kind = "image" if "image" in block else "document" if "document" in block else None
+            source = block[kind].get("source") if kind and isinstance(block[kind], dict) else None
+            if source and SPOOLED_SOURCE in source:
+                block = {kind: {**block[kind], "source": {"bytes": Path(source[SPOOLED_SOURCE]).read_bytes()}}}
+            content.append(block)
+        resolved.append({**message, "content": content})
+    return resolved
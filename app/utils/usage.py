@@ -0,0 +1,189 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from pydantic import BaseModel, ConfigDict
+from utils.model_capabilities import CapabilityRegistry
+from utils.regions import base_model_id
+
+CHARS_PER_TOKEN = 4
+
+
+class TurnUsage(BaseModel):
+    """Tokens, latency and estimated cost of one answer."""
+
+    model_config = ConfigDict(protected_namespaces=())
+
+    session_id: str
+    model_id: str
+    timestamp: float
+    input_tokens: int = 0
+    output_tokens: int = 0
+    # Estimated share of the input tokens spent on the knowledge base context and on the system prompt
+    context_tokens: int = 0
+    system_prompt_tokens: int = 0
+    latency_ms: int = 0
+    cost: float = 0.0
+    cached: bool = False
+
+
+class UsageTotals(BaseModel):
+    turns: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    context_tokens: int = 0
+    system_prompt_tokens: int = 0
+    latency_ms: int = 0
+    cost: float = 0.0
+
+    def add(self, turn: TurnUsage) -> None:
+        self.turns += 1
+        self.input_tokens += turn.input_tokens
+        self.output_tokens += turn.output_tokens
+        self.context_tokens += turn.context_tokens
+        self.system_prompt_tokens += turn.system_prompt_tokens
+        self.latency_ms += turn.latency_ms
+        self.cost += turn.cost
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    return len(text or "") // CHARS_PER_TOKEN
+
+
+def turn_cost(prices: Dict[str, Dict[str, float]], model_id: str, input_tokens: int, output_tokens: int) -> float:
+    """
+    Estimated cost in USD from the per 1k token prices in config.json, 0 for models without a price.
+    Inference profiles are priced as their model.
+    """
+    price = prices.get(model_id) or prices.get(base_model_id(model_id), {})
+    return input_tokens / 1000 * price.get("input_per_1k", 0.0) + output_tokens / 1000 * price.get("output_per_1k", 0.0)
+
+
+class UsageLedger:
+    """Records every turn as a JSONL line and keeps running totals per session and model.
+
+    The totals are rebuilt from the file on start, so they survive restarts of the app.
+    """
+
+    def __init__(self, path: Optional[str], prices: Dict[str, Dict[str, float]]):
+        self.path = Path(path) if path else None
+        self.prices = prices
+        self._lock = threading.Lock()
+        self._totals: Dict[str, Dict[str, UsageTotals]] = defaultdict(lambda: defaultdict(UsageTotals))
+        if self.path and self.path.exists():
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        turn = TurnUsage(**json.loads(line))
+                    except ValueError:
+                        continue
+                    self._totals[turn.session_id][turn.model_id].add(turn)
+
+    def record(
+        self,
+        session_id: str,
+        model_id: str,
+        usage: Dict[str, int],
+        latency_ms: int = 0,
+        context: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+        cached: bool = False
+    ) -> TurnUsage:
+        """Record the usage of a Converse response, replayed cached answers cost nothing."""
+        input_tokens, output_tokens = usage.get("inputTokens", 0), usage.get("outputTokens", 0)
+        turn = TurnUsage(
+            session_id=session_id,
+            model_id=model_id,
+            timestamp=time.time(),
+            input_tokens=0 if cached else input_tokens,
+            output_tokens=0 if cached else output_tokens,
+            context_tokens=0 if cached else estimate_tokens(context),
+            system_prompt_tokens=0 if cached else estimate_tokens(system_prompt),
+            latency_ms=0 if cached else latency_ms,
+            cost=0.0 if cached else turn_cost(self.prices, model_id, input_tokens, output_tokens),
+            cached=cached,
+        )
+        with self._lock:
+            self._totals[session_id][model_id].add(turn)
+            if self.path:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(turn.model_dump_json() + "\n")
+        return turn
+
+    def totals(self, session_id: str) -> Dict[str, UsageTotals]:
+        """Totals of a session per model id."""
+        with self._lock:
+            return {model_id: totals.model_copy() for model_id, totals in self._totals.get(session_id, {}).items()}
+
+    def session_total(self, session_id: str) -> UsageTotals:
+        total = UsageTotals()
+        for totals in self.totals(session_id).values():
+            for field in UsageTotals.model_fields:
+                setattr(total, field, getattr(total, field) + getattr(totals, field))
+        return total
+
+
+class UsageBudget(BaseModel):
+    """
+    Per session spending limit. From compact_at of the budget the history is compacted before every turn,
+    once the budget is spent the session continues on downgrade_model where the region offers it, or stops.
+    """
+
+    max_cost: float = 0.0
+    compact_at: float = 0.8
+    keep_turns: int = 4
+    downgrade_model: Optional[str] = None
+
+    @classmethod
+    def from_config(cls, configs: Dict[str, Any], registry: CapabilityRegistry) -> "UsageBudget":
+        """
+        The budget of the usage config. Raises ValueError when downgrade_model is not a text model of
+        multimodal_llms, so a misconfiguration fails on start instead of in the middle of a turn.
+        """
+        usage_configs = configs.get("usage", {})
+        budget = cls(
+            max_cost=usage_configs.get("session_budget_usd", 0),
+            compact_at=usage_configs.get("compact_at", 0.8),
+            keep_turns=usage_configs.get("keep_turns", 4),
+            downgrade_model=usage_configs.get("downgrade_model") or None,
+        )
+        if budget.downgrade_model:
+            try:
+                capabilities = registry.get(budget.downgrade_model)
+            except KeyError:
+                raise ValueError(f"usage.downgrade_model {budget.downgrade_model} is not a model id in multimodal_llms")
+            if capabilities.output_modality != "text":
+                raise ValueError(f"usage.downgrade_model {budget.downgrade_model} does not answer with text")
+        return budget
+
+    def downgrade_model_in(self, configs: Dict[str, Any], region: str) -> Optional[str]:
+        """The downgrade model if the region, a name of multimodal_llms, offers it."""
+        if self.downgrade_model and self.downgrade_model in configs["multimodal_llms"].get(region, {}).values():
+            return self.downgrade_model
+        return None
+
+    def action(self, total: UsageTotals, downgraded: bool = False, can_downgrade: bool = True) -> Optional[str]:
+        """
+        None, "compact", "downgrade" or "stop" for the next turn of a session. can_downgrade is False when the
+        region of the turn does not offer the downgrade model, the session stops there.
+        """
+        if not self.max_cost:
+            return None
+        if total.cost >= self.max_cost:
+            if self.downgrade_model and can_downgrade:
+                return "downgrade" if not downgraded else "compact"
+            return "stop"
+        if total.cost >= self.compact_at * self.max_cost:
+            return "compact"
+        return None
+
+
+def compact_history(messages: List[Dict[str, Any]], keep_turns: int) -> List[Dict[str, Any]]:
+    """The last keep_turns user and assistant pairs, starting with a user message."""
+    kept = messages[-2 * keep_turns:] if keep_turns else []
+    while kept and kept[0]["role"] != "user":
+        kept = kept[1:]
+    return kept
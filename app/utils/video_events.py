@@ -0,0 +1,174 @@
+import json
+import threading
+import time
+import uuid
+from typing import Optional, Dict, List, Any
+from urllib.parse import unquote_plus
+import boto3
+
+LOCAL_QUEUE_URL = "local"
+
+
+class LocalSQSQueue:
+    """In-process stand-in for an SQS queue receiving S3 event notifications.
+
+    Implements the subset of the SQS client API used by VideoEventListener so the
+    push path can be exercised in tests without any AWS resources. Nothing in the app
+    publishes to it, notifications are only emitted by publish_object_created.
+    """
+
+    def __init__(self, visibility_timeout: float = 30):
+        self.visibility_timeout = visibility_timeout
+        self._messages: List[Dict[str, Any]] = []
+        self._visible_at: Dict[str, float] = {}
+        self._condition = threading.Condition()
+
+    def send_message(self, QueueUrl: str, MessageBody: str) -> Dict[str, Any]:
+        """Enqueue a raw message body."""
+        message = {
+            "MessageId": uuid.uuid4().hex,
+            "ReceiptHandle": uuid.uuid4().hex,
+            "Body": MessageBody,
+            "Attributes": {"SentTimestamp": str(int(time.time() * 1000))},
+        }
+        with self._condition:
+            self._messages.append(message)
+            self._condition.notify_all()
+        return {"MessageId": message["MessageId"]}
+
+    def receive_message(
+        self, QueueUrl: str, MaxNumberOfMessages: int = 1, WaitTimeSeconds: int = 0, **kwargs
+    ) -> Dict[str, Any]:
+        """Return pending messages, blocking up to WaitTimeSeconds like SQS long polling."""
+        deadline = time.monotonic() + WaitTimeSeconds
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                messages = [
+                    m for m in self._messages
+                    if self._visible_at.get(m["ReceiptHandle"], 0) <= now
+                ][:MaxNumberOfMessages]
+                if messages or now >= deadline:
+                    break
+                self._condition.wait(timeout=deadline - now)
+            # Received messages stay hidden until deleted or the visibility timeout lapses
+            for m in messages:
+                self._visible_at[m["ReceiptHandle"]] = now + self.visibility_timeout
+        return {"Messages": messages} if messages else {}
+
+    def delete_message(self, QueueUrl: str, ReceiptHandle: str) -> None:
+        """Remove a message once it has been consumed."""
+        with self._condition:
+            self._messages = [m for m in self._messages if m["ReceiptHandle"] != ReceiptHandle]
+            self._visible_at.pop(ReceiptHandle, None)
+
+    def change_message_visibility(self, QueueUrl: str, ReceiptHandle: str, VisibilityTimeout: int) -> None:
+        """Hide a received message for VisibilityTimeout more seconds, 0 makes it visible right away."""
+        with self._condition:
+            self._visible_at[ReceiptHandle] = time.monotonic() + VisibilityTimeout
+            self._condition.notify_all()
+
+    def publish_object_created(self, bucket: str, key: str) -> None:
+        """Emit an S3 ObjectCreated notification, as S3 would on upload."""
+        self.send_message(
+            QueueUrl=LOCAL_QUEUE_URL,
+            MessageBody=json.dumps({
+                "Records": [{
+                    "eventSource": "aws:s3",
+                    "eventName": "ObjectCreated:Put",
+                    "s3": {"bucket": {"name": bucket}, "object": {"key": key}},
+                }]
+            }),
+        )
+
+
+_local_queue = LocalSQSQueue()
+
+
+def get_local_queue() -> LocalSQSQueue:
+    """Return the process wide local queue stand-in."""
+    return _local_queue
+
+
+class VideoEventListener:
+    """Waits for S3 ObjectCreated notifications delivered through SQS instead of polling S3."""
+
+    def __init__(
+        self,
+        queue_url: str,
+        region_name: str = "us-east-1",
+        client: Optional[Any] = None,
+        release_seconds: int = 1,
+        max_message_age: float = 3600
+    ):
+        self.queue_url = queue_url
+        # Other jobs' notifications stay hidden this long, so this listener does not receive them again at once
+        self.release_seconds = release_seconds
+        self.max_message_age = max_message_age
+        if client is not None:
+            self.client = client
+        elif queue_url == LOCAL_QUEUE_URL:
+            self.client = get_local_queue()
+        else:
+            self.client = boto3.client("sqs", region_name=region_name)
+
+    @staticmethod
+    def parse_object_created(body: str) -> List[tuple[str, str]]:
+        """Extract (bucket, key) pairs from an S3 event notification body."""
+        try:
+            payload = json.loads(body)
+        except (TypeError, ValueError):
+            return []
+        # Notifications fanned out through SNS are wrapped in an envelope
+        if "Message" in payload and "Records" not in payload:
+            return VideoEventListener.parse_object_created(payload["Message"])
+        return [
+            (record["s3"]["bucket"]["name"], unquote_plus(record["s3"]["object"]["key"]))
+            for record in payload.get("Records", [])
+            if record.get("eventName", "").startswith("ObjectCreated")
+        ]
+
+    def wait_for_video(self, bucket: str, prefix: str, timeout: float = 20) -> Optional[str]:
+        """Block until an mp4 lands under the prefix or the timeout expires.
+
+        Returns the object key, or None if nothing arrived in time. Notifications that are
+        not about a video, such as S3 TestEvents, are deleted. Those of other jobs are made
+        visible again after release_seconds so concurrent sessions can consume them, and
+        deleted once older than max_message_age, a session still waiting for such a job
+        finds its video through the job status.
+        """
+        prefix = f"{prefix}/" if not prefix.endswith('/') else prefix
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            response = self.client.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=10,
+                WaitTimeSeconds=max(1, min(20, int(remaining))),
+                AttributeNames=["SentTimestamp"],
+            )
+            found = None
+            for message in response.get("Messages", []):
+                videos = [
+                    (event_bucket, key)
+                    for event_bucket, key in self.parse_object_created(message["Body"])
+                    if key.endswith(".mp4")
+                ]
+                ours = [key for event_bucket, key in videos if event_bucket == bucket and key.startswith(prefix)]
+                sent_at = int(message.get("Attributes", {}).get("SentTimestamp", 0)) / 1000
+                if ours:
+                    found = found or ours[0]
+                    self.delete(message)
+                elif not videos or (sent_at and time.time() - sent_at > self.max_message_age):
+                    self.delete(message)
+                else:
+                    self.client.change_message_visibility(
+                        QueueUrl=self.queue_url,
+                        ReceiptHandle=message["ReceiptHandle"],
+                        VisibilityTimeout=self.release_seconds,
+                    )
+            if found:
+                return found
+        return None
+
+    def delete(self, message: Dict[str, Any]) -> None:
+        self.client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message["ReceiptHandle"])
@@ -0,0 +1,147 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional, Any, Set, Tuple
+
+
+class PosterCache:
+    """Bounded on-disk cache of video poster frames with LRU eviction.
+
+    Recency is tracked through file modification times, which are refreshed on every hit,
+    so the cache survives app restarts and can be shared by all sessions of a process.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_name(bucket: str, key: str) -> str:
+        """Stable file name for an S3 object."""
+        return hashlib.sha256(f"{bucket}/{key}".encode("utf-8")).hexdigest()[:32]
+
+    def path(self, bucket: str, key: str) -> Path:
+        return self.directory / f"{self.cache_name(bucket, key)}.jpg"
+
+    def get(self, bucket: str, key: str) -> Optional[bytes]:
+        path = self.path(bucket, key)
+        with self._lock:
+            try:
+                poster = path.read_bytes()
+            except OSError:
+                return None
+            os.utime(path)
+            return poster
+
+    def put(self, bucket: str, key: str, poster_path: str) -> None:
+        """Move an extracted poster into the cache."""
+        path = self.path(bucket, key)
+        with self._lock:
+            os.replace(poster_path, path)
+            self._evict(keep=path)
+
+    def _evict(self, keep: Optional[Path] = None) -> None:
+        """Remove least recently used posters until the cache fits in max_bytes."""
+        entries = []
+        for p in self.directory.glob("*.jpg"):
+            stat = p.stat()
+            entries.append((stat.st_mtime, stat.st_size, p))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            path.unlink(missing_ok=True)
+            total -= size
+
+
+class VideoPreview:
+    """Resolves playable sources and poster frames for generated videos in S3.
+
+    The browser always plays the video from a presigned URL, streaming straight from S3 with range
+    requests, so no video bytes pass through the Streamlit process. Poster frames are extracted once
+    per video by ffmpeg on a background thread, never during a script run.
+    """
+
+    def __init__(
+        self,
+        s3_handler: Any,
+        expires_in: int = 3600,
+        posters: Optional[PosterCache] = None,
+    ):
+        self.s3_handler = s3_handler
+        self.expires_in = expires_in
+        self.posters = posters
+        self._urls: Dict[Tuple[str, str], Tuple[str, float]] = {}
+        self._pending: Set[Tuple[str, str]] = set()
+        # Videos ffmpeg could not read, not retried on every rerun
+        self._failed: Set[Tuple[str, str]] = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2)
+
+    def source(self, bucket: str, key: str) -> str:
+        """
+        A presigned URL for st.video. It is reused for half its lifetime, so reruns render the same URL and the
+        browser does not reload the video.
+        """
+        with self._lock:
+            url, expires_at = self._urls.get((bucket, key), ("", 0.0))
+            if time.time() < expires_at - self.expires_in / 2:
+                return url
+        url = self.s3_handler.presigned_url(bucket, key, self.expires_in)
+        with self._lock:
+            self._urls[(bucket, key)] = (url, time.time() + self.expires_in)
+        return url
+
+    def poster(self, bucket: str, key: str) -> Optional[bytes]:
+        """The JPEG poster frame if it was extracted already, otherwise its extraction is started."""
+        if not self.posters:
+            return None
+        poster = self.posters.get(bucket, key)
+        if poster is None:
+            self.request_poster(bucket, key)
+        return poster
+
+    def request_poster(self, bucket: str, key: str) -> None:
+        """Extract the poster frame in the background, once per video."""
+        if not self.posters or not shutil.which("ffmpeg"):
+            return
+        with self._lock:
+            if (bucket, key) in self._pending or (bucket, key) in self._failed:
+                return
+            self._pending.add((bucket, key))
+        self._executor.submit(self._extract_poster, bucket, key)
+
+    def _extract_poster(self, bucket: str, key: str) -> None:
+        # Outside the cached posters, so eviction never sees a partial file
+        partial_dir = self.posters.directory / "partial"
+        partial_dir.mkdir(exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=partial_dir, suffix=".jpg")
+        os.close(fd)
+        try:
+            # ffmpeg reads only the first frame, fetching it through range requests
+            subprocess.run(
+                ["ffmpeg", "-y", "-loglevel", "error", "-i", self.source(bucket, key),
+                 "-frames:v", "1", "-vf", "scale=480:-2", tmp_path],
+                check=True,
+                timeout=30,
+            )
+            self.posters.put(bucket, key, tmp_path)
+        except (subprocess.SubprocessError, OSError) as e:
+            print(f"Failed to extract poster frame: {str(e)}")
+            with self._lock:
+                self._failed.add((bucket, key))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            with self._lock:
+                self._pending.discard((bucket, key))
@@ -0,0 +1,248 @@
+"""
+Offline recall/latency benchmark for the vector index profiles against a local OpenSearch container.
+
+Start OpenSearch locally, for example:
+    docker run -d -p 9200:9200 -e discovery.type=single-node -e DISABLE_SECURITY_PLUGIN=true opensearchproject/opensearch:2.13.0
+
+Then compare the profiles on synthetic vectors:
+    python scripts/benchmark_index.py --num_vectors 20000 --dimension 1536
+
+or on fixture vectors saved with numpy.save (one row per vector):
+    python scripts/benchmark_index.py --vectors embeddings.npy --queries queries.npy
+"""
+
+import argparse
+import json
+import time
+from typing import Optional
+import numpy as np
+from opensearchpy import OpenSearch, helpers
+from index_profiles import INDEX_PROFILES, estimated_graph_memory_mb, vector_index_body
+
+
+def synthetic_vectors(
+    num_vectors: int, dimension: int, num_clusters: int = 50, seed: int = 0
+) -> np.ndarray:
+    """
+    Generate clustered, unit length vectors that resemble text embeddings more closely than uniform noise.
+
+    Args:
+        num_vectors (int): Number of vectors.
+        dimension (int): Dimension of each vector.
+        num_clusters (int): Number of topic clusters the vectors are drawn around.
+        seed (int): Random seed, the same seed always produces the same vectors.
+
+    Returns:
+        np.ndarray: float32 array of shape (num_vectors, dimension).
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(num_clusters, dimension))
+    labels = rng.integers(0, num_clusters, size=num_vectors)
+    vectors = centers[labels] + 0.5 * rng.normal(size=(num_vectors, dimension))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype(np.float32)
+
+
+def brute_force_neighbours(
+    vectors: np.ndarray, queries: np.ndarray, k: int, space_type: str
+) -> np.ndarray:
+    """
+    Exact k nearest neighbours, the ground truth for recall.
+
+    Returns:
+        np.ndarray: Row indices of the k nearest vectors for every query.
+    """
+    if space_type == "l2":
+        # |q - v|^2 = |q|^2 - 2 q.v + |v|^2, |q|^2 is constant per query
+        scores = -2 * queries @ vectors.T + np.sum(vectors**2, axis=1)
+    elif space_type == "cosinesimil":
+        normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        scores = -(queries @ normalized.T)
+    else:
+        scores = -(queries @ vectors.T)
+    neighbours = np.argpartition(scores, k, axis=1)[:, :k]
+    order = np.take_along_axis(scores, neighbours, axis=1).argsort(axis=1)
+    return np.take_along_axis(neighbours, order, axis=1)
+
+
+def load_index(
+    client: OpenSearch,
+    index_name: str,
+    profile_name: str,
+    vectors: np.ndarray,
+    batch_size: int = 500,
+) -> float:
+    """
+    Create the index for a profile and bulk load the vectors.
+
+    Returns:
+        float: Seconds spent loading and building the index.
+    """
+    if client.indices.exists(index=index_name):
+        client.indices.delete(index=index_name)
+    client.indices.create(
+        index=index_name, body=vector_index_body(profile_name, vectors.shape[1])
+    )
+    start = time.perf_counter()
+    actions = (
+        {
+            "_index": index_name,
+            "_id": str(i),
+            "vector": vector.tolist(),
+            "text": f"document {i}",
+            "text-metadata": "{}",
+        }
+        for i, vector in enumerate(vectors)
+    )
+    helpers.bulk(client, actions, chunk_size=batch_size, request_timeout=300)
+    client.indices.refresh(index=index_name)
+    # Merge into a single segment so every query searches one graph, as a settled index would
+    client.indices.forcemerge(index=index_name, max_num_segments=1, request_timeout=600)
+    client.indices.refresh(index=index_name)
+    return time.perf_counter() - start
+
+
+def run_queries(
+    client: OpenSearch, index_name: str, queries: np.ndarray, k: int, warmup: int = 10
+) -> tuple[np.ndarray, list[float]]:
+    """
+    Run every query once, sequentially, after a few warm up queries.
+
+    Returns:
+        tuple[np.ndarray, list[float]]: The returned neighbour ids and the latency of each query in ms.
+    """
+
+    def search(query: np.ndarray) -> dict:
+        return client.search(
+            index=index_name,
+            body={
+                "size": k,
+                "_source": False,
+                "query": {"knn": {"vector": {"vector": query.tolist(), "k": k}}},
+            },
+        )
+
+    for query in queries[:warmup]:
+        search(query)
+
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        response = search(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+        ids = [int(hit["_id"]) for hit in response["hits"]["hits"]]
+        results.append(ids + [-1] * (k - len(ids)))
+    return np.array(results), latencies
+
+
+def benchmark_profile(
+    client: OpenSearch,
+    profile_name: str,
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    k: int,
+    batch_size: int,
+    keep_index: bool = False,
+) -> dict:
+    """
+    Measure recall@k against brute force ground truth and query latency percentiles for a profile.
+
+    Returns:
+        dict: The measurements.
+    """
+    profile = INDEX_PROFILES[profile_name]
+    index_name = f"benchmark-{profile_name}"
+    build_seconds = load_index(client, index_name, profile_name, vectors, batch_size)
+    found, latencies = run_queries(client, index_name, queries, k)
+    truth = brute_force_neighbours(vectors, queries, k, profile["space_type"])
+    recall = np.mean(
+        [len(set(f) & set(t)) / k for f, t in zip(found.tolist(), truth.tolist())]
+    )
+    if not keep_index:
+        client.indices.delete(index=index_name)
+    return {
+        "profile": profile_name,
+        f"recall@{k}": round(float(recall), 4),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 2),
+        "build_s": round(build_seconds, 1),
+        "graph_memory_mb": round(
+            estimated_graph_memory_mb(len(vectors), vectors.shape[1], profile.get("m", 16)),
+            1,
+        ),
+    }
+
+
+def load_vectors(path: Optional[str]) -> Optional[np.ndarray]:
+    if not path:
+        return None
+    return np.load(path).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare vector index profiles on recall@k and query latency against a local OpenSearch"
+    )
+    parser.add_argument("--host", type=str, default="localhost", help="OpenSearch host")
+    parser.add_argument("--port", type=int, default=9200, help="OpenSearch port")
+    parser.add_argument("--use_ssl", action="store_true", help="Connect with TLS")
+    parser.add_argument("--user", type=str, help="Basic auth user, if security is enabled")
+    parser.add_argument("--password", type=str, help="Basic auth password")
+    parser.add_argument(
+        "--profiles",
+        type=str,
+        nargs="+",
+        choices=list(INDEX_PROFILES.keys()),
+        default=list(INDEX_PROFILES.keys()),
+        help="Profiles to compare",
+    )
+    parser.add_argument("--vectors", type=str, help=".npy fixture with the indexed vectors")
+    parser.add_argument("--queries", type=str, help=".npy fixture with the query vectors")
+    parser.add_argument("--num_vectors", type=int, default=10000, help="Synthetic vectors to index")
+    parser.add_argument("--num_queries", type=int, default=200, help="Synthetic queries to run")
+    parser.add_argument("--dimension", type=int, default=1536, help="Dimension of synthetic vectors")
+    parser.add_argument("--k", type=int, default=5, help="Neighbours per query, numberOfResults in the app")
+    parser.add_argument("--batch_size", type=int, default=500, help="Documents per bulk request")
+    parser.add_argument("--keep_index", action="store_true", help="Do not delete the benchmark indices")
+    parser.add_argument("--output", type=str, help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    vectors = load_vectors(args.vectors)
+    if vectors is None:
+        vectors = synthetic_vectors(args.num_vectors, args.dimension)
+    queries = load_vectors(args.queries)
+    if queries is None:
+        # Queries come from the same distribution but are not part of the index
+        queries = synthetic_vectors(
+            args.num_vectors + args.num_queries, vectors.shape[1]
+        )[-args.num_queries :]
+
+    client = OpenSearch(
+        hosts=[{"host": args.host, "port": args.port}],
+        http_auth=(args.user, args.password) if args.user else None,
+        use_ssl=args.use_ssl,
+        verify_certs=False,
+        ssl_show_warn=False,
+        timeout=300,
+    )
+    print(f"Benchmarking {len(vectors)} vectors of dimension {vectors.shape[1]}, {len(queries)} queries")
+
+    results = []
+    for profile_name in args.profiles:
+        result = benchmark_profile(
+            client, profile_name, vectors, queries, args.k, args.batch_size, args.keep_index
+        )
+        print(json.dumps(result))
+        results.append(result)
+
+    columns = list(results[0].keys())
+    print("\n" + " | ".join(f"{c:>15}" for c in columns))
+    for result in results:
+        print(" | ".join(f"{str(result[c]):>15}" for c in columns))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
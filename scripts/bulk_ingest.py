@@ -0,0 +1,393 @@
+"""
+Ingest documents into the KnowledgeBase index without an ingestion job: documents are parsed and chunked
+locally in a process pool, embedded in concurrent batches and written with the OpenSearch _bulk API.
+
+Into the index of a knowledge base created by create_kb.py:
+    python scripts/bulk_ingest.py --knowledge_base_name <kb-name> --data_dir scripts/data
+
+End to end against a local OpenSearch container with a fake embedder, no AWS needed:
+    docker run -d -p 9200:9200 -e discovery.type=single-node -e DISABLE_SECURITY_PLUGIN=true opensearchproject/opensearch:2.13.0
+    python scripts/bulk_ingest.py --host localhost --index_name local-kb --embedder fake --data_dir scripts/data
+"""
+
+import argparse
+import copy
+import json
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+from opensearchpy import OpenSearch, helpers
+from pydantic import BaseModel
+from chunking import ChunkingResult, chunk_document, read_document
+from create_kb import CHUNKING_STRATEGIES
+from embedders import BedrockEmbedder, Embedder, FakeEmbedder
+from embedding_models import (
+    DEFAULT_EMBEDDING_MODEL,
+    EMBEDDING_DATA_TYPES,
+    EMBEDDING_MODELS,
+    resolve_embedding_settings,
+)
+from index_profiles import INDEX_PROFILES, vector_index_body
+from knowledge_bases_roles import KBInfo, KnowledgeBaseRoles
+
+# Field the KnowledgeBase reads the source location of a chunk from, used for citations
+SOURCE_URI_FIELD = "x-amz-bedrock-kb-source-uri"
+# Field recording the bulk ingestion run that indexed a chunk, so stale chunks are told apart from new ones
+RUN_ID_FIELD = "x-bulk-ingest-run-id"
+
+
+class BulkIngestReport(BaseModel):
+    """
+    Summary of a bulk ingestion run
+    """
+
+    run_id: str = ""
+    documents: int = 0
+    chunks: int = 0
+    indexed: int = 0
+    failed: int = 0
+    replaced: int = 0
+    errors: list[str] = []
+    # documents with chunks that were not indexed, their previous chunks are kept
+    failed_sources: set[str] = set()
+    chunk_seconds: float = 0.0
+    seconds: float = 0.0
+
+    @property
+    def chunks_per_second(self) -> float:
+        return self.indexed / self.seconds if self.seconds else 0.0
+
+    def summary(self) -> str:
+        return (
+            f"Indexed {self.indexed} of {self.chunks} chunks from {self.documents} documents, "
+            f"{self.failed} failed, {self.replaced} chunks of previous versions deleted, in {self.seconds:.1f}s ({self.chunks_per_second:.1f} chunks/s, "
+            f"{self.chunk_seconds:.1f}s waiting for chunking)"
+        )
+
+
+def chunk_file(path: Path, source_uri: str, chunking_configuration: dict) -> tuple[str, ChunkingResult]:
+    """
+    Parse and chunk a single document, runs in a worker process.
+
+    Returns:
+        tuple[str, ChunkingResult]: The source uri and the chunks of the document.
+    """
+    return source_uri, chunk_document(read_document(path), source_uri, chunking_configuration)
+
+
+class BulkIngestor:
+    """
+    Writes chunks of local documents into a vector index with the text/vector/text-metadata mapping the
+    KnowledgeBase uses, replacing the chunks of documents that were ingested before.
+    Args:
+        os_client (OpenSearch): client of the collection or of a local OpenSearch
+        index_name (str): the KnowledgeBase index
+        embedder (Embedder): turns chunk texts into vectors
+        chunking_configuration (dict): one of the CHUNKING_STRATEGIES values
+        source_uri_prefix (str): prefix of the source uri of every document, e.g. s3://bucket/
+        embed_batch_size (int): texts per embed call, capped by the embedder
+        embed_workers (int): embed calls in flight at the same time
+        bulk_size (int): documents per _bulk request
+        bulk_workers (int): _bulk requests in flight at the same time
+        chunk_processes (int): processes parsing and chunking documents, None for one per CPU
+    """
+
+    def __init__(
+        self,
+        os_client: OpenSearch,
+        index_name: str,
+        embedder: Embedder,
+        chunking_configuration: dict,
+        source_uri_prefix: str = "",
+        embed_batch_size: int = 32,
+        embed_workers: int = 8,
+        bulk_size: int = 500,
+        bulk_workers: int = 4,
+        chunk_processes: Optional[int] = None,
+    ) -> None:
+        self.os_client = os_client
+        self.index_name = index_name
+        self.embedder = embedder
+        self.chunking_configuration = chunking_configuration
+        self.source_uri_prefix = source_uri_prefix
+        self.embed_batch_size = min(embed_batch_size, embedder.max_batch_size)
+        self.embed_workers = embed_workers
+        self.bulk_size = bulk_size
+        self.bulk_workers = bulk_workers
+        self.chunk_processes = chunk_processes
+
+    def source_uri(self, path: Path, root: Path) -> str:
+        relative = path.name if root == path else path.relative_to(root).as_posix()
+        return f"{self.source_uri_prefix}{relative}"
+
+    def _batches(
+        self, results: Iterable[tuple[str, ChunkingResult]], report: BulkIngestReport
+    ) -> Iterator[list[tuple[str, str, str, str]]]:
+        """
+        Group the chunks of all documents into embed batches of (chunk id, source uri, text to embed, text to store).
+        The chunk id is made of the run id, the position of the document and of the chunk in the document.
+        """
+        batch = []
+        for document, (source_uri, result) in enumerate(results):
+            report.documents += 1
+            for i, chunk in enumerate(result.chunks):
+                # a HIERARCHICAL child is searched by its own vector but returns its parent, as in the KnowledgeBase
+                stored = result.retrieved[chunk.parent].text if chunk.parent is not None else chunk.text
+                batch.append((f"{report.run_id}-{document}-{i}", source_uri, chunk.text, stored))
+                if len(batch) == self.embed_batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def _embedded(
+        self, batches: Iterator[list[tuple[str, str, str, str]]], report: BulkIngestReport
+    ) -> Iterator[dict]:
+        """
+        Embed the batches concurrently, keeping a bounded number of calls in flight, and yield bulk actions
+        """
+
+        def embed(batch: list[tuple[str, str, str, str]]) -> list[list[float]]:
+            return self.embedder.embed([text for _, _, text, _ in batch])
+
+        with ThreadPoolExecutor(max_workers=self.embed_workers) as executor:
+            in_flight: deque[tuple[list, Future]] = deque()
+            for batch in batches:
+                in_flight.append((batch, executor.submit(embed, batch)))
+                if len(in_flight) >= 2 * self.embed_workers:
+                    yield from self._actions(*in_flight.popleft(), report)
+            while in_flight:
+                yield from self._actions(*in_flight.popleft(), report)
+
+    def _actions(
+        self, batch: list[tuple[str, str, str, str]], future: Future, report: BulkIngestReport
+    ) -> Iterator[dict]:
+        report.chunks += len(batch)
+        try:
+            vectors = future.result()
+        except Exception as e:
+            report.failed += len(batch)
+            report.failed_sources.update(source_uri for _, source_uri, _, _ in batch)
+            report.errors.append(f"Embedding {len(batch)} chunks of {batch[0][1]} failed: {e}")
+            return
+        for (chunk_id, source_uri, _, stored), vector in zip(batch, vectors):
+            yield {
+                "_index": self.index_name,
+                "_op_type": "index",
+                "_id": chunk_id,
+                "vector": vector,
+                "text": stored,
+                "text-metadata": json.dumps({"source": source_uri}),
+                SOURCE_URI_FIELD: source_uri,
+                RUN_ID_FIELD: report.run_id,
+            }
+
+    def delete_sources(self, source_uris: list[str], keep_run_id: str) -> int:
+        """
+        Remove the chunks of previously ingested versions of the documents, the chunks of keep_run_id stay.
+
+        Returns:
+            int: Number of deleted chunks.
+        """
+        deleted = 0
+        for start in range(0, len(source_uris), 500):
+            query = {
+                "bool": {
+                    "filter": [{"terms": {f"{SOURCE_URI_FIELD}.keyword": source_uris[start : start + 500]}}],
+                    "must_not": [{"term": {f"{RUN_ID_FIELD}.keyword": keep_run_id}}],
+                }
+            }
+            response = self.os_client.delete_by_query(
+                index=self.index_name,
+                body={"query": query},
+                params={"conflicts": "proceed", "refresh": "true"},
+            )
+            deleted += response.get("deleted", 0)
+        return deleted
+
+    def ingest(self, path: Path, replace: bool = True) -> BulkIngestReport:
+        """
+        Chunk, embed and index every readable document below a path.
+
+        Args:
+            path (Path): A directory or a single document.
+            replace (bool): Delete chunks that were indexed for the same documents before. They are deleted only
+                after all chunks of the new version of a document were indexed, so a failed run never leaves
+                a document without chunks.
+
+        Returns:
+            BulkIngestReport: What was indexed and what failed.
+        """
+        report = BulkIngestReport(run_id=uuid.uuid4().hex)
+        start = time.perf_counter()
+        files = [path] if path.is_file() else sorted(p for p in path.rglob("*") if p.is_file())
+        source_uris = [self.source_uri(file, path) for file in files]
+
+        with ProcessPoolExecutor(max_workers=self.chunk_processes) as pool:
+            results = pool.map(
+                chunk_file,
+                files,
+                source_uris,
+                [self.chunking_configuration] * len(files),
+                chunksize=4,
+            )
+
+            def timed(results: Iterator) -> Iterator:
+                while True:
+                    chunk_start = time.perf_counter()
+                    try:
+                        result = next(results)
+                    except StopIteration:
+                        return
+                    report.chunk_seconds += time.perf_counter() - chunk_start
+                    yield result
+
+            actions = self._embedded(self._batches(timed(results), report), report)
+            for ok, info in helpers.parallel_bulk(
+                self.os_client,
+                actions,
+                thread_count=self.bulk_workers,
+                chunk_size=self.bulk_size,
+                raise_on_error=False,
+                raise_on_exception=False,
+                request_timeout=300,
+            ):
+                if ok:
+                    report.indexed += 1
+                else:
+                    report.failed += 1
+                    # the chunk id carries the position of its document
+                    item = next(iter(info.values()))
+                    report.failed_sources.add(source_uris[int(item["_id"].split("-")[1])])
+                    if len(report.errors) < 20:
+                        report.errors.append(json.dumps(info, default=str))
+
+        self.os_client.indices.refresh(index=self.index_name)
+        if replace:
+            replaced = [uri for uri in source_uris if uri not in report.failed_sources]
+            if replaced:
+                report.replaced = self.delete_sources(replaced, keep_run_id=report.run_id)
+        report.seconds = time.perf_counter() - start
+        return report
+
+
+def ensure_index(
+    os_client: OpenSearch, index_name: str, embedder: Embedder, index_profile: str = "default"
+) -> None:
+    """
+    Create the index with the KnowledgeBase mapping if it does not exist yet, e.g. in a local container
+    """
+    if os_client.indices.exists(index=index_name):
+        return
+    os_client.indices.create(
+        index=index_name,
+        body=vector_index_body(index_profile, embedder.dimension, embedder.data_type),
+    )
+    print(f"Created index {index_name} with profile {index_profile}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Chunk, embed and bulk index documents into a KnowledgeBase index without an ingestion job"
+    )
+    parser.add_argument(
+        "--data_dir",
+        type=str,
+        default=str(Path(__file__).parent / "data"),
+        help="Directory or document to ingest",
+    )
+    parser.add_argument(
+        "--knowledge_base_name",
+        type=str,
+        help="Knowledge base created by create_kb.py, its index, bucket and embedding model are used",
+    )
+    parser.add_argument("--host", type=str, default="localhost", help="Local OpenSearch host, without --knowledge_base_name")
+    parser.add_argument("--port", type=int, default=9200, help="Local OpenSearch port")
+    parser.add_argument("--index_name", type=str, default="local-kb", help="Index in the local OpenSearch")
+    parser.add_argument(
+        "--index_profile",
+        type=str,
+        choices=list(INDEX_PROFILES.keys()),
+        default="default",
+        help="Profile of the local index if it has to be created",
+    )
+    parser.add_argument("--embedder", type=str, choices=["bedrock", "fake"], default="bedrock")
+    parser.add_argument(
+        "--embedding_model",
+        type=str,
+        choices=list(EMBEDDING_MODELS.keys()),
+        default=DEFAULT_EMBEDDING_MODEL,
+        help="Embedding model, without --knowledge_base_name",
+    )
+    parser.add_argument("--dimensions", type=int, default=0, help="Vector dimension, 0 for the model default")
+    parser.add_argument("--embedding_data_type", type=str, choices=EMBEDDING_DATA_TYPES, default="FLOAT32")
+    parser.add_argument("--region", type=str, default="us-east-1", help="Region of the Bedrock embedding model")
+    parser.add_argument(
+        "--chunking_strategy",
+        type=str,
+        choices=list(CHUNKING_STRATEGIES.keys()),
+        default="FIXED_SIZE",
+    )
+    parser.add_argument("--embed_batch_size", type=int, default=32, help="Texts per embedding call")
+    parser.add_argument("--embed_workers", type=int, default=8, help="Concurrent embedding calls")
+    parser.add_argument("--bulk_size", type=int, default=500, help="Documents per _bulk request")
+    parser.add_argument("--bulk_workers", type=int, default=4, help="Concurrent _bulk requests")
+    parser.add_argument("--chunk_processes", type=int, help="Processes chunking documents, one per CPU by default")
+    parser.add_argument(
+        "--no_replace",
+        action="store_true",
+        help="Keep chunks of earlier ingestions of the same documents",
+    )
+    args = parser.parse_args()
+
+    embedding_model, dimensions, data_type = (
+        args.embedding_model,
+        args.dimensions,
+        args.embedding_data_type,
+    )
+    if args.knowledge_base_name:
+        with open(Path(__file__).parent / f"{args.knowledge_base_name}.json", encoding="utf-8") as f:
+            kb_info = KBInfo.model_validate(json.load(f))
+        os_client = KnowledgeBaseRoles(kb_info.region_name).create_os_client(kb_info.collection_id)
+        index_name = kb_info.index_name
+        region_name = kb_info.region_name
+        source_uri_prefix = f"s3://{kb_info.bucket_name}/"
+        embedding_model = kb_info.embedding_model
+        dimensions = kb_info.embedding_dimensions
+        data_type = kb_info.embedding_data_type
+    else:
+        os_client = OpenSearch(hosts=[{"host": args.host, "port": args.port}], timeout=300)
+        index_name = args.index_name
+        region_name = args.region
+        source_uri_prefix = "file://" + str(Path(args.data_dir).absolute()) + "/"
+
+    if args.embedder == "fake":
+        embedder = FakeEmbedder(*resolve_embedding_settings(embedding_model, dimensions, data_type))
+    else:
+        embedder = BedrockEmbedder(region_name, embedding_model, dimensions, data_type)
+    if not args.knowledge_base_name:
+        ensure_index(os_client, index_name, embedder, args.index_profile)
+
+    ingestor = BulkIngestor(
+        os_client,
+        index_name,
+        embedder,
+        copy.deepcopy(CHUNKING_STRATEGIES[args.chunking_strategy]),
+        source_uri_prefix=source_uri_prefix,
+        embed_batch_size=args.embed_batch_size,
+        embed_workers=args.embed_workers,
+        bulk_size=args.bulk_size,
+        bulk_workers=args.bulk_workers,
+        chunk_processes=args.chunk_processes,
+    )
+    report = ingestor.ingest(Path(args.data_dir), replace=not args.no_replace)
+    print(report.summary())
+    for error in report.errors:
+        print(error)
+
+
+if __name__ == "__main__":
+    main()
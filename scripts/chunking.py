@@ -0,0 +1,251 @@
+"""
+Local approximations of the KnowledgeBase chunking strategies, used to compare them without an ingestion job
+"""
+
+import math
+import re
+from collections import Counter
+from pathlib import Path
+from typing import Iterator, Optional
+from pydantic import BaseModel
+from pypdf import PdfReader
+
+# Text formats a KnowledgeBase data source can ingest that are read as plain text
+TEXT_EXTENSIONS = {".txt", ".md", ".html", ".htm", ".csv", ".json"}
+
+# Roughly one embedding model token per four characters of a word, punctuation is a token of its own
+TOKEN_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+SENTENCE_PATTERN = re.compile(r"[^.!?\n]+(?:[.!?]+|\n+|$)")
+WORD_PATTERN = re.compile(r"[a-z0-9]{3,}")
+
+
+class Chunk(BaseModel):
+    """
+    A piece of a document as it would be embedded, or returned by a retrieval
+    """
+
+    source: str
+    text: str
+    tokens: int
+    parent: Optional[int] = None
+
+
+class ChunkingResult(BaseModel):
+    """
+    The chunks of one document for a strategy
+    Args:
+        chunks: the chunks that are embedded and stored in the vector index
+        retrieved: what a query returns for a matching chunk, the parents for HIERARCHICAL, else the chunks
+        breakpoint_embeddings: sentence groups embedded only to find semantic breakpoints
+        breakpoint_tokens: tokens of those sentence groups
+    """
+
+    chunks: list[Chunk] = []
+    retrieved: list[Chunk] = []
+    breakpoint_embeddings: int = 0
+    breakpoint_tokens: int = 0
+
+
+def read_document(path: Path) -> str:
+    """
+    Extract the text of a text or PDF document.
+
+    Args:
+        path (Path): The document.
+
+    Returns:
+        str: The text, empty if the format is not supported.
+    """
+    suffix = path.suffix.lower()
+    if suffix in TEXT_EXTENSIONS:
+        text = path.read_text(encoding="utf-8", errors="ignore")
+        if suffix in (".html", ".htm"):
+            text = re.sub(r"<[^>]+>", " ", text)
+        return text
+    if suffix == ".pdf":
+        return "\n".join(page.extract_text() or "" for page in PdfReader(path).pages)
+    return ""
+
+
+def load_documents(path: Path) -> Iterator[tuple[Path, str]]:
+    """
+    Walk a directory, as the data source would, and yield the text of every readable document.
+
+    Args:
+        path (Path): A directory or a single document.
+
+    Returns:
+        Iterator[tuple[Path, str]]: The path and text of every non empty document.
+    """
+    files = [path] if path.is_file() else sorted(p for p in path.rglob("*") if p.is_file())
+    for file in files:
+        text = read_document(file)
+        if text.strip():
+            yield file, text
+
+
+def count_tokens(text: str) -> int:
+    """
+    Approximate the number of embedding model tokens of a text.
+    """
+    return len(TOKEN_PATTERN.findall(text))
+
+
+def _token_spans(text: str) -> list[tuple[int, int]]:
+    return [match.span() for match in TOKEN_PATTERN.finditer(text)]
+
+
+def _window_chunks(
+    text: str, source: str, max_tokens: int, overlap_tokens: int
+) -> list[Chunk]:
+    """
+    Slide a window of max_tokens over the text, repeating overlap_tokens between consecutive chunks
+    """
+    spans = _token_spans(text)
+    step = max(1, max_tokens - overlap_tokens)
+    chunks = []
+    for start in range(0, len(spans), step):
+        window = spans[start : start + max_tokens]
+        chunks.append(
+            Chunk(
+                source=source,
+                text=text[window[0][0] : window[-1][1]],
+                tokens=len(window),
+            )
+        )
+        if start + max_tokens >= len(spans):
+            break
+    return chunks
+
+
+def fixed_size_chunks(
+    text: str, source: str, max_tokens: int, overlap_percentage: int
+) -> ChunkingResult:
+    chunks = _window_chunks(
+        text, source, max_tokens, max_tokens * overlap_percentage // 100
+    )
+    return ChunkingResult(chunks=chunks, retrieved=chunks)
+
+
+def hierarchical_chunks(
+    text: str,
+    source: str,
+    parent_max_tokens: int,
+    child_max_tokens: int,
+    overlap_tokens: int,
+) -> ChunkingResult:
+    """
+    Split into parent chunks and every parent into child chunks. Only the children are embedded, but a
+    retrieval returns the parent of a matching child.
+    """
+    parents = _window_chunks(text, source, parent_max_tokens, overlap_tokens)
+    children = []
+    for index, parent in enumerate(parents):
+        for child in _window_chunks(
+            parent.text, source, child_max_tokens, overlap_tokens
+        ):
+            child.parent = index
+            children.append(child)
+    return ChunkingResult(chunks=children, retrieved=parents)
+
+
+def _cosine_distance(a: Counter, b: Counter) -> float:
+    dot = sum(count * b[word] for word, count in a.items())
+    norm = math.sqrt(sum(v * v for v in a.values())) * math.sqrt(
+        sum(v * v for v in b.values())
+    )
+    return 1 - dot / norm if norm else 1.0
+
+
+def semantic_chunks(
+    text: str,
+    source: str,
+    max_tokens: int,
+    buffer_size: int,
+    breakpoint_percentile_threshold: int,
+) -> ChunkingResult:
+    """
+    Split into sentences and start a new chunk where consecutive sentences are dissimilar. The KnowledgeBase
+    compares embeddings of every sentence together with buffer_size sentences on each side, here the
+    embeddings are approximated by bag of words vectors.
+    """
+    sentences = [s.strip() for s in SENTENCE_PATTERN.findall(text) if s.strip()]
+    if not sentences:
+        return ChunkingResult()
+    groups = [
+        " ".join(sentences[max(0, i - buffer_size) : i + buffer_size + 1])
+        for i in range(len(sentences))
+    ]
+    vectors = [Counter(WORD_PATTERN.findall(group.lower())) for group in groups]
+    distances = [_cosine_distance(a, b) for a, b in zip(vectors, vectors[1:])]
+    if distances:
+        ranked = sorted(distances)
+        threshold = ranked[
+            min(len(ranked) - 1, len(ranked) * breakpoint_percentile_threshold // 100)
+        ]
+    else:
+        threshold = 1.0
+
+    chunks, current, current_tokens = [], [], 0
+    for index, sentence in enumerate(sentences):
+        tokens = count_tokens(sentence)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(" ".join(current))
+            current, current_tokens = [], 0
+        current.append(sentence)
+        current_tokens += tokens
+        if index < len(distances) and distances[index] > threshold:
+            chunks.append(" ".join(current))
+            current, current_tokens = [], 0
+    if current:
+        chunks.append(" ".join(current))
+
+    result = []
+    for chunk in chunks:
+        # a single sentence longer than max_tokens is cut like a fixed size chunk
+        result.extend(_window_chunks(chunk, source, max_tokens, 0))
+    return ChunkingResult(
+        chunks=result,
+        retrieved=result,
+        breakpoint_embeddings=len(groups),
+        breakpoint_tokens=sum(count_tokens(group) for group in groups),
+    )
+
+
+def chunk_document(text: str, source: str, chunking_configuration: dict) -> ChunkingResult:
+    """
+    Chunk a document with a strategy configuration in the format of the CHUNKING_STRATEGIES in create_kb.py
+
+    Args:
+        text (str): The document text.
+        source (str): Where the text comes from, stored on every chunk.
+        chunking_configuration (dict): One of the CHUNKING_STRATEGIES values.
+
+    Returns:
+        ChunkingResult: The chunks.
+    """
+    if "fixedSizeChunkingConfiguration" in chunking_configuration:
+        config = chunking_configuration["fixedSizeChunkingConfiguration"]
+        return fixed_size_chunks(
+            text, source, int(config["maxTokens"]), int(config["overlapPercentage"])
+        )
+    if "hierarchicalChunkingConfiguration" in chunking_configuration:
+        config = chunking_configuration["hierarchicalChunkingConfiguration"]
+        parent, child = config["levelConfigurations"]
+        return hierarchical_chunks(
+            text,
+            source,
+            int(parent["maxTokens"]),
+            int(child["maxTokens"]),
+            int(config["overlapTokens"]),
+        )
+    if "semanticChunkingConfiguration" in chunking_configuration:
+        config = chunking_configuration["semanticChunkingConfiguration"]
+        return semantic_chunks(
+            text,
+            source,
+            int(config["maxTokens"]),
+            int(config["bufferSize"]),
+            int(config["breakpointPercentileThreshold"]),
+        )
+    raise ValueError(f"Unknown chunking configuration {chunking_configuration}")
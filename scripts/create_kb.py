@@ -10,10 +10,27 @@ import time
 import boto3
 import uuid
 from pathlib import Path
-from retrying import retry
+from typing import Optional
 from botocore.exceptions import ClientError
-from opensearchpy import RequestError
-from knowledge_bases_roles import interactive_sleep, KnowledgeBaseRoles, KBInfo
+from opensearchpy import OpenSearch, RequestError, TransportError
+from embedding_models import (
+    DEFAULT_EMBEDDING_MODEL,
+    EMBEDDING_DATA_TYPES,
+    EMBEDDING_MODELS,
+    embedding_model_configuration,
+    resolve_embedding_settings,
+)
+from index_profiles import INDEX_PROFILES, estimated_graph_memory_mb, vector_index_body
+from knowledge_bases_roles import (
+    IngestionJobStats,
+    KnowledgeBaseRoles,
+    KBInfo,
+    get_or_create,
+)
+from ingestion import IngestionScheduler, changed_data_sources
+from s3_sync import S3Sync, SyncReport, shard_prefixes
+from provisioning import ProvisioningExecutor, Step
+from waiter import Waiter
 
 
 CHUNKING_STRATEGIES = {
@@ -64,6 +81,12 @@ class CreateKB:
         index_name (str): name of the OpenSearch index
         kb_name (str): name of the KnowledgeBase data source
         vector_store_name (str): name of the vector stote
+        kb_info (KBInfo): resources of an already (partially) created KnowledgeBase, used when resuming or updating it
+        embedding_model (str): Bedrock embedding model, one of EMBEDDING_MODELS
+        dimensions (int): vector dimension, 0 for the model default
+        embedding_data_type (str): FLOAT32 or BINARY vectors
+        num_data_sources (int): spread the uploaded documents over this many data sources, ingested in parallel
+        data_source_prefixes (list[str]): existing S3 prefixes to create one data source each for, instead
     """
 
     def __init__(
@@ -73,6 +96,12 @@ class CreateKB:
         index_name: str,
         kb_name: str,
         vector_store_name: str,
+        kb_info: Optional[KBInfo] = None,
+        embedding_model: str = DEFAULT_EMBEDDING_MODEL,
+        dimensions: int = 0,
+        embedding_data_type: str = "FLOAT32",
+        num_data_sources: int = 1,
+        data_source_prefixes: Optional[list[str]] = None,
     ) -> None:
         self.region_name = region_name
         self.bucket_name = bucket_name
@@ -80,8 +109,28 @@ class CreateKB:
         self.kb_name = kb_name
         self.vector_store_name = vector_store_name
         self.printer = pprint.PrettyPrinter(indent=2)
+        self.waiter = Waiter()
+        if kb_info:
+            self.kb_roles = KnowledgeBaseRoles(
+                region_name,
+                bedrock_execution_role_name=kb_info.bedrock_execution_role_name,
+                fm_policy_name=kb_info.fm_policy_name,
+                s3_policy_name=kb_info.s3_policy_name,
+                oss_policy_name=kb_info.oss_policy_name,
+                suffix=kb_info.suffix or None,
+            )
+            self.kb_info = kb_info
+            return
         self.kb_roles = KnowledgeBaseRoles(region_name)
+        dimensions, embedding_data_type = resolve_embedding_settings(
+            embedding_model, dimensions, embedding_data_type
+        )
         self.kb_info = KBInfo(
+            embedding_model=embedding_model,
+            embedding_dimensions=dimensions,
+            embedding_data_type=embedding_data_type,
+            suffix=self.kb_roles.suffix,
+            vector_store_name=self.vector_store_name,
             index_name=self.index_name,
             bucket_name=self.bucket_name,
             region_name=self.region_name,
@@ -89,6 +138,8 @@ class CreateKB:
             fm_policy_name=self.kb_roles.fm_policy_name,
             s3_policy_name=self.kb_roles.s3_policy_name,
             oss_policy_name=self.kb_roles.oss_policy_name,
+            data_source_prefixes=data_source_prefixes or shard_prefixes(num_data_sources),
+            upload_shards=1 if data_source_prefixes else num_data_sources,
         )
 
     def create_bucket(self, s3_client: boto3.client) -> None:
@@ -108,44 +159,62 @@ class CreateKB:
                 CreateBucketConfiguration={"LocationConstraint": self.region_name},
             )
 
-    def upload_directory(self, path: str) -> None:
+    def upload_directory(
+        self,
+        path: str,
+        s3_client: boto3.client,
+        manifest_path: Optional[Path] = None,
+        max_workers: int = 16,
+    ) -> SyncReport:
         """
-        Upload all files in the given directory to the specified S3 bucket.
+        Sync all files in the given directory to the specified S3 bucket, keeping their relative paths as keys.
+        Files that did not change since the last sync are skipped.
 
         Args:
             path (str): The path to the directory containing the files to upload.
+            s3_client (boto3.client): The boto3 client for S3 service.
+            manifest_path (Path): Local file that remembers the state of the last sync.
+            max_workers (int): Number of files uploaded concurrently.
+
+        Returns:
+            SyncReport: The uploaded, skipped and deleted files with throughput.
         """
-        s3_client = boto3.client("s3")
-        for root, _, files in os.walk(path):
-            for file in files:
-                s3_client.upload_file(os.path.join(root, file), self.bucket_name, file)
+        s3_sync = S3Sync(
+            s3_client,
+            self.bucket_name,
+            manifest_path=manifest_path,
+            max_workers=max_workers,
+            num_shards=self.kb_info.upload_shards,
+        )
+        report = s3_sync.sync(Path(path))
+        print(report.summary())
+        return report
 
-    def create_os_polices_and_collection(
-        self,
-        aoss_client: boto3.client,
-    ) -> tuple[dict, str, str]:
+    def create_execution_role(self) -> None:
+        """
+        Create the IAM role, with its foundation model and S3 policies, that Bedrock assumes for the KnowledgeBase.
+        The role and policies an interrupted run already created are reused.
         """
-        Create security, network, and data access policies within OpenSearch Serverless (OSS),
-        and create an OSS collection for the vector store.
+        bedrock_kb_execution_role = self.kb_roles.create_bedrock_execution_role(
+            bucket_name=self.bucket_name,
+            embedding_model_id=self.kb_info.embedding_model,
+        )
+        self.kb_info.bedrock_execution_role_arn = bedrock_kb_execution_role["Role"]["Arn"]
+
+    def create_security_policies(self, aoss_client: boto3.client) -> None:
+        """
+        Create the encryption and network policies the OpenSearch Serverless collection needs to be created.
+        A policy an interrupted run already created is reused.
 
         Args:
             aoss_client (boto3.client): The boto3 client for OpenSearch Serverless.
-
-        Returns:
-            tuple[dict, str, str]: A tuple containing the created collection, collection ID, and Bedrock execution role ARN.
         """
-        bedrock_kb_execution_role = self.kb_roles.create_bedrock_execution_role(
-            bucket_name=self.bucket_name
-        )
-        bedrock_kb_execution_role_arn = bedrock_kb_execution_role["Role"]["Arn"]
-        encryption_policy, network_policy, access_policy = (
-            self.kb_roles.create_policies_in_oss(
+        encryption_policy, network_policy = (
+            self.kb_roles.create_security_policies_in_oss(
                 vector_store_name=self.vector_store_name,
                 aoss_client=aoss_client,
-                bedrock_kb_execution_role_arn=bedrock_kb_execution_role_arn,
             )
         )
-        self.kb_info.access_policy_name = access_policy["accessPolicyDetail"]["name"]
         self.kb_info.network_policy_name = network_policy["securityPolicyDetail"][
             "name"
         ]
@@ -153,36 +222,95 @@ class CreateKB:
             "name"
         ]
 
-        collection = aoss_client.create_collection(
-            name=self.vector_store_name, type="VECTORSEARCH"
+    def create_access_policy(self, aoss_client: boto3.client) -> None:
+        """
+        Create the data access policy granting the caller and the Bedrock execution role access to the collection
+
+        Args:
+            aoss_client (boto3.client): The boto3 client for OpenSearch Serverless.
+        """
+        access_policy = self.kb_roles.create_access_policy_in_oss(
+            vector_store_name=self.vector_store_name,
+            aoss_client=aoss_client,
+            bedrock_kb_execution_role_arn=self.kb_info.bedrock_execution_role_arn,
         )
-        self.printer.pprint(collection)
+        self.kb_info.access_policy_name = access_policy["accessPolicyDetail"]["name"]
+
+    def create_collection(self, aoss_client: boto3.client) -> None:
+        """
+        Create an OSS collection for the vector store and wait until it is active.
+        A collection created by an interrupted run is reused, also when the run stopped before recording it.
+
+        Args:
+            aoss_client (boto3.client): The boto3 client for OpenSearch Serverless.
+        """
+        if not self.kb_info.collection_id:
+            collection = get_or_create(
+                f"collection {self.vector_store_name}",
+                lambda: aoss_client.create_collection(
+                    name=self.vector_store_name, type="VECTORSEARCH"
+                )["createCollectionDetail"],
+                lambda: aoss_client.batch_get_collection(names=[self.vector_store_name])[
+                    "collectionDetails"
+                ][0],
+            )
+            self.printer.pprint(collection)
+            self.kb_info.collection_id = collection["id"]
+            self.kb_info.collection_arn = collection["arn"]
 
-        collection_id = collection["createCollectionDetail"]["id"]
-        self.kb_info.collection_id = collection_id
         # wait for collection creation
         # This can take couple of minutes to finish
+        self.waiter.wait(
+            "OpenSearch collection ACTIVE",
+            lambda: self.collection_active(aoss_client),
+            timeout=900,
+        )
         response = aoss_client.batch_get_collection(names=[self.vector_store_name])
-        # Periodically check collection status
-        while (response["collectionDetails"][0]["status"]) == "CREATING":
-            print("Creating collection...")
-            interactive_sleep(30)
-            response = aoss_client.batch_get_collection(names=[self.vector_store_name])
         print("\nCollection successfully created:")
         self.printer.pprint(response["collectionDetails"])
 
-        # create opensearch serverless access policy and attach it to Bedrock execution role
+    def attach_oss_policy(self) -> None:
+        """
+        Create opensearch serverless access policy and attach it to Bedrock execution role
+        """
         self.kb_roles.create_oss_policy_attach_bedrock_execution_role(
-            collection_id=collection_id,
-            bedrock_kb_execution_role=bedrock_kb_execution_role,
+            collection_id=self.kb_info.collection_id,
+            bedrock_kb_execution_role={
+                "Role": {"RoleName": self.kb_info.bedrock_execution_role_name}
+            },
         )
-        # It can take up to a minute for data access rules to be enforced
-        interactive_sleep(60)
-        return collection, collection_id, bedrock_kb_execution_role_arn
+
+    def collection_active(self, aoss_client: boto3.client) -> bool:
+        """
+        Readiness probe for the OpenSearch Serverless collection
+        """
+        status = aoss_client.batch_get_collection(names=[self.vector_store_name])[
+            "collectionDetails"
+        ][0]["status"]
+        if status == "FAILED":
+            raise KnowledgeBaseCreationException(
+                f"Collection {self.vector_store_name} failed to create"
+            )
+        return status == "ACTIVE"
+
+    def data_access_effective(self, oss_client: OpenSearch) -> bool:
+        """
+        Readiness probe for the data access policy, requests are rejected with 403 until it is enforced
+        """
+        oss_client.indices.exists(index=self.index_name)
+        return True
+
+    def index_queryable(self, oss_client: OpenSearch) -> bool:
+        """
+        Readiness probe for the vector index, succeeds once a search against it returns
+        """
+        oss_client.search(index=self.index_name, body={"size": 0})
+        return True
 
     def create_vector_index(
         self,
         collection_id: str,
+        index_profile: str = "default",
     ) -> None:
         """
         Create a vector index in OpenSearch Serverless with the knn_vector field index mapping,
@@ -190,32 +318,36 @@ class CreateKB:
 
         Args:
             collection_id (str): The ID of the OpenSearch Serverless collection.
+            index_profile (str): One of INDEX_PROFILES, sets the HNSW parameters, shards, replicas, space type and engine.
         """
+        self.kb_info.index_profile = index_profile
         oss_client = self.kb_roles.create_os_client(collection_id)
+        # It can take up to a minute for data access rules to be enforced,
+        # probe with our own principal which is granted by the same data access policy
+        self.waiter.wait(
+            "Data access policy effective",
+            lambda: self.data_access_effective(oss_client),
+            timeout=300,
+            retry_on=(TransportError,),
+        )
 
-        body_json = {
-            "settings": {
-                "index.knn": "true",
-                "number_of_shards": 1,
-                "knn.algo_param.ef_search": 512,
-                "number_of_replicas": 0,
-            },
-            "mappings": {
-                "properties": {
-                    "vector": {
-                        "type": "knn_vector",
-                        "dimension": 1536,
-                        "method": {
-                            "name": "hnsw",
-                            "engine": "faiss",
-                            "space_type": "l2",
-                        },
-                    },
-                    "text": {"type": "text"},
-                    "text-metadata": {"type": "text"},
-                }
-            },
-        }
+        body_json = vector_index_body(
+            index_profile,
+            self.kb_info.embedding_dimensions,
+            self.kb_info.embedding_data_type,
+        )
+        print(f"Using index profile {index_profile}: {INDEX_PROFILES[index_profile]}")
+        for num_vectors in (100_000, 1_000_000):
+            memory_mb = estimated_graph_memory_mb(
+                num_vectors,
+                self.kb_info.embedding_dimensions,
+                INDEX_PROFILES[index_profile].get("m", 16),
+                self.kb_info.embedding_data_type,
+            )
+            print(
+                f"Estimated vector memory for {num_vectors:,} chunks of {self.kb_info.embedding_model} "
+                f"({self.kb_info.embedding_dimensions} dims, {self.kb_info.embedding_data_type}): {memory_mb:,.0f} MB"
+            )
 
         try:
             response = oss_client.indices.create(
@@ -227,7 +359,12 @@ class CreateKB:
             self.printer.pprint(response)
 
             # index creation can take up to a minute
-            interactive_sleep(60)
+            self.waiter.wait(
+                "Vector index queryable",
+                lambda: self.index_queryable(oss_client),
+                timeout=300,
+                retry_on=(TransportError,),
+            )
         except RequestError as e:
             # you can delete the index if its already exists
             # oss_client.indices.delete(index=index_name)
@@ -235,32 +372,36 @@ class CreateKB:
 
     def create_knowledge_base(
         self,
-        collection: dict,
-        bedrock_kb_execution_role_arn: str,
         bedrock_agent_client: boto3.client,
         chunking_strategy: str,
-    ) -> tuple[dict, dict]:
+    ) -> tuple[dict, list[dict]]:
         """
-        Create a Knowledge Base and a Data Source within the Knowledge Base.
+        Create a Knowledge Base and its Data Sources, one per configured S3 prefix or a single one over the
+        whole bucket. Resources already created by an interrupted run are reused.
 
         Args:
-            collection (dict): The created OpenSearch Serverless collection.
-            bedrock_kb_execution_role_arn (str): The ARN of the Bedrock execution role.
             bedrock_agent_client (boto3.client): The boto3 client for Bedrock Agent.
+            chunking_strategy (str): One of CHUNKING_STRATEGIES.
 
         Returns:
-            tuple[dict, dict]: A tuple containing the created Knowledge Base and Data Source.
+            tuple[dict, list[dict]]: A tuple containing the created Knowledge Base and Data Sources.
         """
 
-        @retry(wait_random_min=1000, wait_random_max=2000, stop_max_attempt_number=7)
-        def create_knowledge_base_func():
+        created = {}
+
+        def create_knowledge_base_func() -> bool:
             create_kb_response = bedrock_agent_client.create_knowledge_base(
                 name=self.kb_name,
                 roleArn=role_arn,
                 knowledgeBaseConfiguration={
                     "type": "VECTOR",
                     "vectorKnowledgeBaseConfiguration": {
-                        "embeddingModelArn": embedding_model_arn
+                        "embeddingModelArn": embedding_model_arn,
+                        **embedding_model_configuration(
+                            self.kb_info.embedding_model,
+                            self.kb_info.embedding_dimensions,
+                            self.kb_info.embedding_data_type,
+                        ),
                     },
                 },
                 storageConfiguration={
@@ -268,10 +409,11 @@ class CreateKB:
                     "opensearchServerlessConfiguration": opensearch_serverless_configuration,
                 },
             )
-            return create_kb_response["knowledgeBase"]
+            created.update(create_kb_response["knowledgeBase"])
+            return True
 
         opensearch_serverless_configuration = {
-            "collectionArn": collection["createCollectionDetail"]["arn"],
+            "collectionArn": self.kb_info.collection_arn,
             "vectorIndexName": self.index_name,
             "fieldMapping": {
                 "vectorField": "vector",
@@ -286,84 +428,312 @@ class CreateKB:
             **CHUNKING_STRATEGIES[chunking_strategy],
         }
 
-        # The data source to ingest documents from, into the OpenSearch serverless knowledge base index
-        s3_configuration = {
-            "bucketArn": f"arn:aws:s3:::{self.bucket_name}",
-            # "inclusionPrefixes":["*.*"] # you can use this if you want to create a KB using data within s3 prefixes.
-        }
+        # The data sources to ingest documents from, into the OpenSearch serverless knowledge base index.
+        # A data source accepts a single inclusion prefix, so every prefix gets a data source of its own.
+        def s3_configuration(prefix: str) -> dict:
+            configuration = {"bucketArn": f"arn:aws:s3:::{self.bucket_name}"}
+            if prefix:
+                configuration["inclusionPrefixes"] = [prefix]
+            return configuration
 
         # The embedding model used by Bedrock to embed ingested documents, and realtime prompts
-        embedding_model_arn = f"arn:aws:bedrock:{self.region_name}::foundation-model/amazon.titan-embed-text-v1"
-        role_arn = bedrock_kb_execution_role_arn
-
-        knowledge_base = create_knowledge_base_func()
+        embedding_model_arn = f"arn:aws:bedrock:{self.region_name}::foundation-model/{self.kb_info.embedding_model}"
+        role_arn = self.kb_info.bedrock_execution_role_arn
+
+        if self.kb_info.kb_id:
+            knowledge_base = bedrock_agent_client.get_knowledge_base(
+                knowledgeBaseId=self.kb_info.kb_id
+            )["knowledgeBase"]
+        else:
+            # Bedrock rejects the role with a ValidationException until the role and its OSS policy have
+            # propagated through IAM, which can take well over a minute
+            self.waiter.wait(
+                "Knowledge base created",
+                create_knowledge_base_func,
+                timeout=300,
+                retry_on=(bedrock_agent_client.exceptions.ValidationException,),
+            )
+            knowledge_base = created
+            self.kb_info.kb_id = knowledge_base["knowledgeBaseId"]
         self.printer.pprint(knowledge_base)
 
-        # Create a DataSource in KnowledgeBase
-        create_ds_response = bedrock_agent_client.create_data_source(
-            name=self.kb_name,
-            knowledgeBaseId=knowledge_base["knowledgeBaseId"],
-            dataSourceConfiguration={"type": "S3", "s3Configuration": s3_configuration},
-            vectorIngestionConfiguration={
-                "chunkingConfiguration": chunking_strategy_configuration
-            },
-        )
-        data_source = create_ds_response["dataSource"]
-        self.printer.pprint(data_source)
-        bedrock_agent_client.get_data_source(
-            knowledgeBaseId=knowledge_base["knowledgeBaseId"],
-            dataSourceId=data_source["dataSourceId"],
+        # Create the DataSources in KnowledgeBase
+        if self.kb_info.ds_id and not self.kb_info.ds_ids:
+            self.kb_info.ds_ids.append(self.kb_info.ds_id)
+        data_sources = []
+        for index, prefix in enumerate(self.kb_info.data_source_prefixes or [""]):
+            if index < len(self.kb_info.ds_ids):
+                data_source = bedrock_agent_client.get_data_source(
+                    knowledgeBaseId=knowledge_base["knowledgeBaseId"],
+                    dataSourceId=self.kb_info.ds_ids[index],
+                )["dataSource"]
+            else:
+                create_ds_response = bedrock_agent_client.create_data_source(
+                    name=f"{self.kb_name}-{index}" if prefix else self.kb_name,
+                    knowledgeBaseId=knowledge_base["knowledgeBaseId"],
+                    dataSourceConfiguration={
+                        "type": "S3",
+                        "s3Configuration": s3_configuration(prefix),
+                    },
+                    vectorIngestionConfiguration={
+                        "chunkingConfiguration": chunking_strategy_configuration
+                    },
+                )
+                data_source = create_ds_response["dataSource"]
+                self.kb_info.ds_ids.append(data_source["dataSourceId"])
+            self.printer.pprint(data_source)
+            data_sources.append(data_source)
+        self.kb_info.ds_id = self.kb_info.ds_ids[0]
+
+        self.waiter.wait(
+            "Knowledge base ACTIVE",
+            lambda: self.knowledge_base_active(
+                bedrock_agent_client, knowledge_base["knowledgeBaseId"]
+            ),
+            timeout=600,
         )
 
-        kb_respone = bedrock_agent_client.get_knowledge_base(
-            knowledgeBaseId=knowledge_base["knowledgeBaseId"]
+        return knowledge_base, data_sources
+
+    @staticmethod
+    def knowledge_base_active(bedrock_agent_client: boto3.client, kb_id: str) -> bool:
+        """
+        Readiness probe for the Bedrock KnowledgeBase
+        """
+        status = bedrock_agent_client.get_knowledge_base(knowledgeBaseId=kb_id)[
+            "knowledgeBase"
+        ]["status"]
+        if status == "FAILED":
+            raise KnowledgeBaseCreationException("Failed to create knowledge base")
+        return status == "ACTIVE"
+
+    def start_ingestion_jobs(
+        self,
+        bedrock_agent_client: boto3.client,
+        data_sources: Optional[dict[str, str]] = None,
+        timeout: int = 3600,
+        max_concurrent: int = 5,
+    ) -> list[IngestionJobStats]:
+        """
+        Start an ingestion job for every Data Source within the Knowledge Base, run them concurrently,
+        wait for them to finish and record their statistics in the KBInfo.
+
+        Args:
+            bedrock_agent_client (boto3.client): The boto3 client for Bedrock Agent.
+            data_sources (dict[str, str]): Data source ids and their prefixes, all data sources if None.
+            timeout (int): Maximum number of seconds to wait for all jobs.
+            max_concurrent (int): Ingestion jobs running at the same time.
+
+        Returns:
+            list[IngestionJobStats]: The statistics of the finished jobs.
+        """
+        kb_id = self.kb_info.kb_id
+        scheduler = IngestionScheduler(
+            bedrock_agent_client,
+            kb_id,
+            data_sources if data_sources is not None else self.kb_info.data_sources(),
+            max_concurrent=max_concurrent,
         )
-        retries = 0
-        while kb_respone["knowledgeBase"]["status"] == "CREATING":
-            interactive_sleep(30)
-            kb_respone = bedrock_agent_client.get_knowledge_base(
-                knowledgeBaseId=knowledge_base["knowledgeBaseId"]
+        start = time.perf_counter()
+        try:
+            jobs = scheduler.run(timeout)
+        finally:
+            self.waiter.timings["Ingestion jobs"] = time.perf_counter() - start
+        self.kb_info.ingestion_jobs.extend(jobs)
+
+        for job_stats in jobs:
+            print(
+                f"Ingestion job {job_stats.ingestion_job_id} of {job_stats.data_source_id} {job_stats.status}: "
+                f"scanned {job_stats.documents_scanned}, "
+                f"indexed {job_stats.documents_new_indexed + job_stats.documents_modified_indexed}, "
+                f"deleted {job_stats.documents_deleted}, failed {job_stats.documents_failed} "
+                f"in {job_stats.duration_seconds}s"
+            )
+        if any(job.documents_new_indexed + job.documents_modified_indexed for job in jobs):
+            oss_client = self.kb_roles.create_os_client(self.kb_info.collection_id)
+            self.waiter.wait(
+                "Indexed documents searchable",
+                lambda: oss_client.count(index=self.kb_info.index_name)["count"] > 0,
+                timeout=120,
+                retry_on=(TransportError,),
             )
-            retries += 1
-            if retries > 20:
-                raise KnowledgeBaseCreationException("Failed to create knowledge base")
 
-        self.kb_info.kb_id = knowledge_base["knowledgeBaseId"]
-        self.kb_info.ds_id = data_source["dataSourceId"]
-        return knowledge_base, data_source
+        # Print the knowledge base Id in bedrock, that corresponds to the Opensearch index in the collection we created before, we will use it for the invocation later
+        self.printer.pprint(kb_id)
+        return jobs
+
+    def save(self, path: Path) -> None:
+        """
+        Write the KBInfo atomically, so an interrupted run never leaves a truncated file behind
 
-    def start_ingestion_job(
-        self, bedrock_agent_client: boto3.client, kb: dict, ds: dict
-    ) -> None:
+        Args:
+            path (Path): The KBInfo JSON file.
+        """
+        tmp_path = path.with_suffix(".json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(self.kb_info.model_dump(), file, indent=4)  # indent=4 for pretty-printing
+        os.replace(tmp_path, path)
+
+    def update(
+        self,
+        bedrock_agent_client: boto3.client,
+        s3_client: boto3.client,
+        path: Path,
+        manifest_path: Path,
+        max_workers: int = 16,
+        use_s3: bool = False,
+        max_concurrent: int = 5,
+    ) -> list[IngestionJobStats]:
         """
-        Start an ingestion job for the created Data Source within the Knowledge Base.
+        Sync the data directory against the last synced manifest and start ingestion jobs
+        only for the data sources whose documents were added, modified or removed.
 
         Args:
             bedrock_agent_client (boto3.client): The boto3 client for Bedrock Agent.
-            kb (dict): The created Knowledge Base.
-            ds (dict): The created Data Source.
+            s3_client (boto3.client): The boto3 client for S3 service.
+            path (Path): The path to the directory containing the documents.
+            manifest_path (Path): Local file that remembers the state of the last sync.
+            max_workers (int): Number of files uploaded concurrently.
+            use_s3 (bool): The documents are managed directly in S3, always re-ingest.
+            max_concurrent (int): Ingestion jobs running at the same time.
+
+        Returns:
+            list[IngestionJobStats]: The statistics of the ingestion jobs, empty if nothing changed.
         """
+        data_sources = self.kb_info.data_sources()
+        if not use_s3:
+            report = S3Sync(
+                s3_client,
+                self.bucket_name,
+                manifest_path=manifest_path,
+                max_workers=max_workers,
+                num_shards=self.kb_info.upload_shards,
+            ).sync(path, delete_removed=True)
+            print(report.summary())
+            if not report.changed:
+                print("No changes since the last sync, skipping ingestion")
+                return []
+            data_sources = changed_data_sources(
+                data_sources, report.uploaded + report.deleted
+            )
 
-        start_job_response = bedrock_agent_client.start_ingestion_job(
-            knowledgeBaseId=kb["knowledgeBaseId"], dataSourceId=ds["dataSourceId"]
+        return self.start_ingestion_jobs(
+            bedrock_agent_client, data_sources, max_concurrent=max_concurrent
         )
-        job = start_job_response["ingestionJob"]
-        self.printer.pprint(job)
-
-        while job["status"] in ["IN_PROGRESS", "STARTING"]:
-            get_job_response = bedrock_agent_client.get_ingestion_job(
-                knowledgeBaseId=kb["knowledgeBaseId"],
-                dataSourceId=ds["dataSourceId"],
-                ingestionJobId=job["ingestionJobId"],
+
+
+def provisioning_steps(
+    kb_instance: CreateKB,
+    args: argparse.Namespace,
+    s3_client: boto3.client,
+    aoss_client: boto3.client,
+    bedrock_agent_client: boto3.client,
+    manifest_path: Path,
+) -> list[Step]:
+    """
+    The provisioning graph. IAM, the S3 upload and the OSS security policies do not depend on each other
+    and run concurrently.
+
+    Returns:
+        list[Step]: The steps with their dependencies.
+    """
+
+    def upload() -> None:
+        # Upload data to s3 to the bucket that was configured as a data source to the knowledge base
+        if not args.use_s3:
+            kb_instance.upload_directory(
+                Path(args.data_dir),
+                s3_client,
+                manifest_path=manifest_path,
+                max_workers=args.upload_workers,
             )
-            job = get_job_response["ingestionJob"]
-            time.sleep(5)
-        self.printer.pprint(job)
-        interactive_sleep(40)
 
-        # Print the knowledge base Id in bedrock, that corresponds to the Opensearch index in the collection we created before, we will use it for the invocation later
-        kb_id = kb["knowledgeBaseId"]
-        self.printer.pprint(kb_id)
+    def ingestion() -> None:
+        kb_instance.start_ingestion_jobs(
+            bedrock_agent_client, max_concurrent=args.max_concurrent_ingestion_jobs
+        )
+
+    return [
+        Step("bucket", lambda: kb_instance.create_bucket(s3_client)),
+        Step("execution_role", kb_instance.create_execution_role),
+        Step(
+            "oss_security_policies",
+            lambda: kb_instance.create_security_policies(aoss_client),
+        ),
+        Step(
+            "oss_access_policy",
+            lambda: kb_instance.create_access_policy(aoss_client),
+            depends_on=["execution_role"],
+        ),
+        Step(
+            "collection",
+            lambda: kb_instance.create_collection(aoss_client),
+            depends_on=["oss_security_policies"],
+        ),
+        Step(
+            "oss_role_policy",
+            kb_instance.attach_oss_policy,
+            depends_on=["execution_role", "collection"],
+        ),
+        # Create the vector index in Opensearch serverless, with the knn_vector field index mapping, specifying the dimension size, name and engine.
+        Step(
+            "vector_index",
+            lambda: kb_instance.create_vector_index(
+                kb_instance.kb_info.collection_id, args.index_profile
+            ),
+            depends_on=["collection", "oss_access_policy"],
+        ),
+        Step("upload", upload, depends_on=["bucket"]),
+        Step(
+            "knowledge_base",
+            lambda: kb_instance.create_knowledge_base(
+                bedrock_agent_client, args.chunking_strategy
+            ),
+            depends_on=["vector_index", "oss_role_policy"],
+        ),
+        Step("ingestion", ingestion, depends_on=["knowledge_base", "upload"]),
+    ]
+
+
+def update(args: argparse.Namespace, path: Path) -> None:
+    """
+    Refresh an existing knowledge base: upload what changed and ingest only if needed
+
+    Args:
+        args (argparse.Namespace): The parsed command line arguments.
+        path (Path): The directory the KBInfo file was saved to.
+    """
+    kb_info_path = path / f"{args.knowledge_base_name}.json"
+    with open(kb_info_path, encoding="utf-8") as f:
+        kb_info = KBInfo.model_validate(json.load(f))
+    if kb_info.data_source_prefixes and kb_info.upload_shards == 1 and not args.use_s3:
+        raise ValueError(
+            f"{args.knowledge_base_name} ingests the existing S3 prefixes {kb_info.data_source_prefixes}, "
+            "update it with --use_s3"
+        )
+
+    boto3_session = boto3.session.Session(region_name=kb_info.region_name)
+    bedrock_agent_client = boto3_session.client("bedrock-agent")
+    s3_client = boto3_session.client("s3")
+    kb_instance = CreateKB(
+        kb_info.region_name,
+        kb_info.bucket_name,
+        kb_info.index_name,
+        args.knowledge_base_name,
+        "",
+        kb_info=kb_info,
+    )
+    kb_instance.update(
+        bedrock_agent_client,
+        s3_client,
+        Path(args.data_dir),
+        path / f"{args.knowledge_base_name}.manifest.json",
+        max_workers=args.upload_workers,
+        use_s3=bool(args.use_s3),
+        max_concurrent=args.max_concurrent_ingestion_jobs,
+    )
+    kb_instance.save(kb_info_path)
+    print(kb_instance.waiter.report())
 
 
 def main():
@@ -414,8 +784,89 @@ def main():
         help=f"Chunking strategy, choice of {CHUNKING_STRATEGIES.keys()}",
         default=f"FIXED_SIZE",
     )
+    parser.add_argument(
+        "--index_profile",
+        type=str,
+        required=False,
+        choices=list(INDEX_PROFILES.keys()),
+        help="Vector index profile, see index_profiles.py and benchmark_index.py to compare them",
+        default="default",
+    )
+    parser.add_argument(
+        "--embedding_model",
+        type=str,
+        required=False,
+        choices=list(EMBEDDING_MODELS.keys()),
+        help="Bedrock embedding model used to embed documents and queries",
+        default=DEFAULT_EMBEDDING_MODEL,
+    )
+    parser.add_argument(
+        "--dimensions",
+        type=int,
+        required=False,
+        help="Embedding vector dimension, e.g. 256, 512 or 1024 for Titan v2. Defaults to the largest dimension of the model",
+        default=0,
+    )
+    parser.add_argument(
+        "--embedding_data_type",
+        type=str,
+        required=False,
+        choices=EMBEDDING_DATA_TYPES,
+        help="Store FLOAT32 vectors or BINARY vectors (1 bit per dimension, 32x smaller)",
+        default="FLOAT32",
+    )
+    parser.add_argument(
+        "--mode",
+        type=str,
+        required=False,
+        choices=["create", "update"],
+        help="create provisions a new knowledge base, update syncs the data directory of an existing one and re-ingests only if documents changed",
+        default="create",
+    )
+    parser.add_argument(
+        "--data_dir",
+        type=str,
+        required=False,
+        help="Directory with the documents to upload",
+        default=str(Path(__file__).parent.absolute() / "data"),
+    )
+    parser.add_argument(
+        "--upload_workers",
+        type=int,
+        required=False,
+        help="Number of files uploaded to S3 concurrently",
+        default=16,
+    )
+    parser.add_argument(
+        "--num_data_sources",
+        type=int,
+        required=False,
+        help="Spread the uploaded documents over this many shard-NN/ prefixes with a data source each, ingested in parallel",
+        default=1,
+    )
+    parser.add_argument(
+        "--data_source_prefixes",
+        type=str,
+        nargs="+",
+        required=False,
+        help="Create one data source per existing S3 prefix instead, requires --use_s3",
+    )
+    parser.add_argument(
+        "--max_concurrent_ingestion_jobs",
+        type=int,
+        required=False,
+        help="Ingestion jobs running at the same time, jobs above the service quota are queued",
+        default=5,
+    )
 
     args = parser.parse_args()
+    if args.data_source_prefixes and not args.use_s3:
+        # the data directory would be uploaded to the bucket root, which none of the data sources ingests
+        parser.error("--data_source_prefixes ingests documents already in S3, use it together with --use_s3")
+    path = Path(__file__).parent.absolute()  # gets path of parent directory
+    if args.mode == "update":
+        update(args, path)
+        return
 
     region_name = args.region_name
     allowed_regions = [
@@ -436,6 +887,14 @@ def main():
     if args.chunking_strategy not in CHUNKING_STRATEGIES.keys():
         raise Exception("Un supported chunking strategy")
 
+    kb_info_path = path / f"{args.knowledge_base_name}.json"
+    kb_info = None
+    if kb_info_path.exists():
+        # Resume a previous run, reusing its resource names instead of a new suffix
+        with open(kb_info_path, encoding="utf-8") as f:
+            kb_info = KBInfo.model_validate(json.load(f))
+        region_name = kb_info.region_name
+
     boto3.setup_default_session(region_name=region_name)
     boto3_session = boto3.session.Session(region_name=region_name)
     bedrock_agent_client = boto3_session.client(
@@ -447,46 +906,50 @@ def main():
     bucket_name = (
         f"bedrock-kb-{s3_suffix}" if not args.bucket_name else args.bucket_name
     )
-    kb_instance = CreateKB(
-        region_name,
-        bucket_name,
-        args.index_name,
-        args.knowledge_base_name,
-        args.vectorstore_name,
-    )
-
-    # Step 1: Create an S3 bucket if not existing
-    kb_instance.create_bucket(s3_client)
-
-    # Step 2: Create OSS policies and collection
-    collection, collection_id, bedrock_kb_execution_role_arn = (
-        kb_instance.create_os_polices_and_collection(aoss_client)
-    )
-
-    # Step 3: Create vector index
-    # Create the vector index in Opensearch serverless, with the knn_vector field index mapping, specifying the dimension size, name and engine.
-    kb_instance.create_vector_index(collection_id)
-
-    # Upload data to s3 to the bucket that was configured as a data source to the knowledge base
-    if not args.use_s3:
-        kb_instance.upload_directory(Path(__file__).parent.absolute() / "data")
+    if kb_info:
+        kb_instance = CreateKB(
+            kb_info.region_name,
+            kb_info.bucket_name,
+            kb_info.index_name,
+            args.knowledge_base_name,
+            kb_info.vector_store_name,
+            kb_info=kb_info,
+        )
+    else:
+        kb_instance = CreateKB(
+            region_name,
+            bucket_name,
+            args.index_name,
+            args.knowledge_base_name,
+            args.vectorstore_name,
+            embedding_model=args.embedding_model,
+            dimensions=args.dimensions,
+            embedding_data_type=args.embedding_data_type,
+            num_data_sources=args.num_data_sources,
+            data_source_prefixes=args.data_source_prefixes,
+        )
 
-    # Step 4: Create Knowledge Base
-    kb, ds = kb_instance.create_knowledge_base(
-        collection,
-        bedrock_kb_execution_role_arn,
+    steps = provisioning_steps(
+        kb_instance,
+        args,
+        s3_client,
+        aoss_client,
         bedrock_agent_client,
-        args.chunking_strategy,
+        path / f"{args.knowledge_base_name}.manifest.json",
     )
-
-    # Step 5: Start an ingestion job
-    kb_instance.start_ingestion_job(bedrock_agent_client, kb, ds)
-    path = Path(__file__).parent.absolute()  # gets path of parent directory
-    with open(path / f"{args.knowledge_base_name}.json", "w", encoding="utf-8") as file:
-        json.dump(
-            kb_instance.kb_info.model_dump(), file, indent=4
-        )  # indent=4 for pretty-printing
-
+    if kb_info and kb_info.kb_id and not kb_info.completed_steps:
+        # Written by a version without checkpoints, which only saved the file after a full run
+        kb_info.completed_steps.extend(step.name for step in steps)
+    executor = ProvisioningExecutor(
+        steps,
+        kb_instance.kb_info.completed_steps,
+        checkpoint=lambda: kb_instance.save(kb_info_path),
+    )
+    try:
+        executor.run()
+    finally:
+        print(executor.report())
+        print(kb_instance.waiter.report())
 
 if __name__ == "__main__":
     main()
@@ -5,34 +5,246 @@ This class is copied from https://github.com/aws-samples/amazon-bedrock-workshop
 import argparse
 import json
 import boto3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Optional
+from botocore.exceptions import ClientError
+from opensearchpy import NotFoundError, TransportError
 from knowledge_bases_roles import KnowledgeBaseRoles, KBInfo
+from provisioning import ProvisioningExecutor, Step
+from waiter import Waiter
 from pathlib import Path
 
+# Error codes AWS services return for resources that no longer exist
+NOT_FOUND_CODES = {
+    "ResourceNotFoundException",
+    "NoSuchEntity",
+    "NoSuchBucket",
+    "NotFound",
+    "404",
+}
 
-def delete_bucket(bucket_name: str, s3_client: boto3.client) -> None:
+
+def ignore_missing(resource: str, func: Callable, **kwargs) -> None:
     """
-    Delete an S3 bucket and all objects within it.
+    Run a delete call and treat a resource that is already gone as deleted.
     Args:
-      bucket_name: The name of the bucket to be deleted.
+      resource: Description of the resource, used in output.
+      func: The delete call, kwargs are passed to it.
     """
-    objects = s3_client.list_objects(Bucket=bucket_name, MaxKeys=1000)
-    if "Contents" in objects:
-        while objects["Contents"]:
-            keys = [obj["Key"] for obj in objects["Contents"]]
-            s3_client.delete_objects(
-                Bucket=bucket_name, Delete={"Objects": [{"Key": key} for key in keys]}
-            )
-            if "NextContinuationToken" in objects:
-                objects = s3_client.list_objects(
-                    Bucket=bucket_name,
-                    MaxKeys=1000,
-                    ContinuationToken=objects["NextContinuationToken"],
+    try:
+        func(**kwargs)
+        print(f"Deleted {resource}")
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in NOT_FOUND_CODES:
+            raise
+        print(f"{resource} does not exist, skipping")
+    except NotFoundError:
+        print(f"{resource} does not exist, skipping")
+
+
+def delete_bucket(
+    bucket_name: str, keys: set[str], s3_client: boto3.client, max_workers: int = 8
+) -> None:
+    """
+    Delete the given objects, including old versions and delete markers, and the bucket once nothing else is
+    left in it. The default bucket is shared by every knowledge base of the account and region, so objects of
+    other knowledge bases are never touched.
+    Args:
+      bucket_name: The name of the bucket.
+      keys: The objects of this knowledge base.
+      max_workers: Number of delete_objects batches in flight at the same time.
+    """
+
+    def delete_batch(batch: list[dict]) -> int:
+        response = s3_client.delete_objects(
+            Bucket=bucket_name, Delete={"Objects": batch, "Quiet": True}
+        )
+        for error in response.get("Errors", []):
+            print(f"Failed to delete {error['Key']}: {error['Message']}")
+        return len(batch) - len(response.get("Errors", []))
+
+    others = 0
+    try:
+        paginator = s3_client.get_paginator("list_object_versions")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            for page in paginator.paginate(Bucket=bucket_name, MaxKeys=1000):
+                versions = page.get("Versions", []) + page.get("DeleteMarkers", [])
+                batch = [
+                    {"Key": obj["Key"], "VersionId": obj["VersionId"]}
+                    for obj in versions
+                    if obj["Key"] in keys
+                ]
+                others += len(versions) - len(batch)
+                if batch:
+                    futures.append(executor.submit(delete_batch, batch))
+            deleted = sum(future.result() for future in futures)
+        print(f"Deleted {deleted} objects and versions from bucket '{bucket_name}'")
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in NOT_FOUND_CODES:
+            raise
+        print(f"bucket '{bucket_name}' does not exist, skipping")
+        return
+
+    if others:
+        print(f"Keeping bucket '{bucket_name}', it holds {others} objects and versions of other knowledge bases")
+        return
+    ignore_missing(f"bucket '{bucket_name}'", s3_client.delete_bucket, Bucket=bucket_name)
+
+
+def is_deleted(resource: str, func: Callable, **kwargs) -> bool:
+    """
+    Readiness probe for an asynchronous delete, True once the get call no longer finds the resource.
+    Args:
+      resource: Description of the resource, used in output.
+      func: The get call of a Bedrock knowledge base or data source, kwargs are passed to it.
+    """
+    try:
+        response = func(**kwargs)
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in NOT_FOUND_CODES:
+            raise
+        return True
+    details = response.get("knowledgeBase") or response.get("dataSource") or {}
+    if details.get("status") == "DELETE_UNSUCCESSFUL":
+        raise RuntimeError(f"Failed to delete {resource}: {details.get('failureReasons')}")
+    return False
+
+
+def teardown_steps(
+    kb_info: KBInfo,
+    kb_roles: KnowledgeBaseRoles,
+    bedrock_agent_client: boto3.client,
+    aoss_client: boto3.client,
+    s3_client: boto3.client,
+    uploaded_keys: Iterable[str] = (),
+    waiter: Optional[Waiter] = None,
+) -> list[Step]:
+    """
+    The teardown graph. Resources only wait for the ones that reference them, everything else is deleted in
+    parallel. Resources that were never created by an interrupted run are skipped.
+    Bedrock deletes data sources and knowledge bases asynchronously, their steps complete once they are gone.
+    Only the uploaded_keys, the objects create_kb.py synced, are deleted from the bucket.
+    """
+    waiter = waiter or Waiter()
+
+    def delete_data_sources() -> None:
+        if not kb_info.kb_id:
+            return
+        data_source_ids = list(kb_info.data_sources())
+        if not data_source_ids:
+            return
+        with ThreadPoolExecutor(max_workers=len(data_source_ids)) as executor:
+            futures = [
+                executor.submit(
+                    ignore_missing,
+                    f"data source {ds_id}",
+                    bedrock_agent_client.delete_data_source,
+                    dataSourceId=ds_id,
+                    knowledgeBaseId=kb_info.kb_id,
                 )
-            else:
-                break
+                for ds_id in data_source_ids
+            ]
+            for future in futures:
+                future.result()
+        # The data source removes its vectors from the index while it is DELETING
+        for ds_id in data_source_ids:
+            waiter.wait(
+                f"Data source {ds_id} deleted",
+                lambda ds_id=ds_id: is_deleted(
+                    f"data source {ds_id}",
+                    bedrock_agent_client.get_data_source,
+                    dataSourceId=ds_id,
+                    knowledgeBaseId=kb_info.kb_id,
+                ),
+                timeout=600,
+            )
 
-    s3_client.delete_bucket(Bucket=bucket_name)
-    print(f"Bucket '{bucket_name}' has been deleted successfully.")
+    def delete_knowledge_base() -> None:
+        if kb_info.kb_id:
+            ignore_missing(
+                f"knowledge base {kb_info.kb_id}",
+                bedrock_agent_client.delete_knowledge_base,
+                knowledgeBaseId=kb_info.kb_id,
+            )
+            waiter.wait(
+                f"Knowledge base {kb_info.kb_id} deleted",
+                lambda: is_deleted(
+                    f"knowledge base {kb_info.kb_id}",
+                    bedrock_agent_client.get_knowledge_base,
+                    knowledgeBaseId=kb_info.kb_id,
+                ),
+                timeout=600,
+            )
+
+    def delete_index() -> None:
+        if not (kb_info.collection_id and kb_info.index_name):
+            return
+        # The endpoint of a deleted collection no longer resolves, a rerun would fail to connect
+        collections = aoss_client.batch_get_collection(ids=[kb_info.collection_id])
+        if not collections["collectionDetails"]:
+            print(f"collection {kb_info.collection_id} does not exist, skipping index {kb_info.index_name}")
+            return
+        oss_client = kb_roles.create_os_client(kb_info.collection_id)
+        try:
+            ignore_missing(
+                f"index {kb_info.index_name}",
+                oss_client.indices.delete,
+                index=kb_info.index_name,
+            )
+        except TransportError as e:
+            # Deleting the collection removes the index with it, so the policies and the collection are still deleted
+            print(f"Failed to delete index {kb_info.index_name}, it is removed with its collection: {str(e)}")
+
+    def delete_collection() -> None:
+        if kb_info.collection_id:
+            ignore_missing(
+                f"collection {kb_info.collection_id}",
+                aoss_client.delete_collection,
+                id=kb_info.collection_id,
+            )
+
+    def delete_policy(policy_type: str, name: str) -> Callable[[], None]:
+        def delete() -> None:
+            if not name:
+                return
+            delete_func = (
+                aoss_client.delete_access_policy
+                if policy_type == "data"
+                else aoss_client.delete_security_policy
+            )
+            ignore_missing(f"{policy_type} policy {name}", delete_func, type=policy_type, name=name)
+
+        return delete
+
+    def delete_bucket_step() -> None:
+        if kb_info.bucket_name:
+            delete_bucket(kb_info.bucket_name, set(uploaded_keys), s3_client)
+
+    return [
+        Step("data_sources", delete_data_sources),
+        Step("knowledge_base", delete_knowledge_base, depends_on=["data_sources"]),
+        # deleting a data source removes its vectors, so the index has to outlive the knowledge base
+        Step("index", delete_index, depends_on=["knowledge_base"]),
+        Step("collection", delete_collection, depends_on=["index"]),
+        Step(
+            "access_policy",
+            delete_policy("data", kb_info.access_policy_name),
+            depends_on=["index"],
+        ),
+        Step(
+            "network_policy",
+            delete_policy("network", kb_info.network_policy_name),
+            depends_on=["collection"],
+        ),
+        Step(
+            "encryption_policy",
+            delete_policy("encryption", kb_info.encryption_policy_name),
+            depends_on=["collection"],
+        ),
+        Step("iam", kb_roles.delete_iam_role_and_policies, depends_on=["knowledge_base"]),
+        Step("bucket", delete_bucket_step),
+    ]
 
 
 if __name__ == "__main__":
@@ -45,7 +257,7 @@ if __name__ == "__main__":
     args = parser.parse_args()
     path = Path(__file__).parent.absolute()  # gets path of parent directory
     with open(path / f"{args.knowledge_base_name}.json", encoding="utf-8") as f:
-        kb_info = KBInfo.parse_obj(json.load(f))
+        kb_info = KBInfo.model_validate(json.load(f))
 
     boto3_session = boto3.session.Session(region_name=kb_info.region_name)
     bedrock_agent_client = boto3_session.client(
@@ -60,20 +272,32 @@ if __name__ == "__main__":
         s3_policy_name=kb_info.s3_policy_name,
         oss_policy_name=kb_info.oss_policy_name,
     )
-    oss_client = kb_roles.create_os_client(kb_info.collection_id)
     aoss_client = boto3_session.client("opensearchserverless")
+    # The objects create_kb.py uploaded, documents that were already in S3 are left alone
+    manifest_path = path / f"{args.knowledge_base_name}.manifest.json"
+    uploaded_keys = []
+    if manifest_path.exists():
+        with open(manifest_path, encoding="utf-8") as f:
+            uploaded_keys = list(json.load(f))
 
-    bedrock_agent_client.delete_data_source(
-        dataSourceId=kb_info.ds_id, knowledgeBaseId=kb_info.kb_id
+    waiter = Waiter()
+    executor = ProvisioningExecutor(
+        teardown_steps(
+            kb_info,
+            kb_roles,
+            bedrock_agent_client,
+            aoss_client,
+            s3_client,
+            uploaded_keys=uploaded_keys,
+            waiter=waiter,
+        ),
+        completed=[],
+        checkpoint=lambda: None,
+        max_workers=8,
+        name="Teardown",
     )
-    bedrock_agent_client.delete_knowledge_base(knowledgeBaseId=kb_info.kb_id)
-    oss_client.indices.delete(index=kb_info.index_name)
-    aoss_client.delete_collection(id=kb_info.collection_id)
-    aoss_client.delete_access_policy(type="data", name=kb_info.access_policy_name)
-    aoss_client.delete_security_policy(type="network", name=kb_info.network_policy_name)
-    aoss_client.delete_security_policy(
-        type="encryption", name=kb_info.encryption_policy_name
-    )
-
-    kb_roles.delete_iam_role_and_policies()
-    delete_bucket(kb_info.bucket_name, s3_client)
+    try:
+        executor.run()
+    finally:
+        print(executor.report())
+        print(waiter.report())
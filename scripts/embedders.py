@@ -0,0 +1,138 @@
+"""
+Embedders for the local ingestion pipeline. Any object with a dimension, a data_type and an embed method can
+be used, the FakeEmbedder allows running the pipeline without AWS.
+"""
+
+import hashlib
+import json
+import random
+import boto3
+from botocore.config import Config
+from embedding_models import DEFAULT_EMBEDDING_MODEL, resolve_embedding_settings
+
+
+def pack_bits(bits: list[int]) -> list[int]:
+    """
+    Pack a list of 0/1 values into signed bytes, the format of OpenSearch binary vectors
+
+    Args:
+        bits (list[int]): One value per dimension, the dimension is a multiple of 8.
+
+    Returns:
+        list[int]: dimension / 8 values between -128 and 127.
+    """
+    packed = []
+    for start in range(0, len(bits), 8):
+        value = int("".join(str(int(bit)) for bit in bits[start : start + 8]), 2)
+        packed.append(value - 256 if value > 127 else value)
+    return packed
+
+
+class Embedder:
+    """
+    Turns texts into vectors for the index
+    Args:
+        dimension (int): dimension of the vectors
+        data_type (str): FLOAT32, or BINARY for vectors packed by pack_bits
+        max_batch_size (int): most texts a single embed call accepts
+    """
+
+    def __init__(self, dimension: int, data_type: str = "FLOAT32", max_batch_size: int = 96) -> None:
+        self.dimension = dimension
+        self.data_type = data_type
+        self.max_batch_size = max_batch_size
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        raise NotImplementedError
+
+
+class FakeEmbedder(Embedder):
+    """
+    Deterministic pseudo random unit vectors derived from a hash of the text, for tests against a local
+    OpenSearch. The same text always gets the same vector.
+    """
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        vectors = []
+        for text in texts:
+            rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+            if self.data_type == "BINARY":
+                vectors.append(pack_bits([rng.randint(0, 1) for _ in range(self.dimension)]))
+                continue
+            vector = [rng.gauss(0, 1) for _ in range(self.dimension)]
+            norm = sum(v * v for v in vector) ** 0.5
+            vectors.append([v / norm for v in vector])
+        return vectors
+
+
+class BedrockEmbedder(Embedder):
+    """
+    Embeds documents with a Bedrock embedding model. Titan models take one text per request, Cohere models
+    up to 96. Throttled requests are retried with adaptive backoff by botocore.
+    Args:
+        region_name (str): AWS region
+        model_id (str): one of EMBEDDING_MODELS
+        dimensions (int): vector dimension, 0 for the model default
+        data_type (str): FLOAT32 or BINARY
+    """
+
+    def __init__(
+        self,
+        region_name: str,
+        model_id: str = DEFAULT_EMBEDDING_MODEL,
+        dimensions: int = 0,
+        data_type: str = "FLOAT32",
+    ) -> None:
+        dimensions, data_type = resolve_embedding_settings(model_id, dimensions, data_type)
+        super().__init__(
+            dimensions, data_type, 96 if model_id.startswith("cohere.") else 1
+        )
+        self.model_id = model_id
+        self.client = boto3.client(
+            "bedrock-runtime",
+            region_name=region_name,
+            config=Config(retries={"max_attempts": 10, "mode": "adaptive"}),
+        )
+
+    def _invoke(self, body: dict) -> dict:
+        response = self.client.invoke_model(
+            modelId=self.model_id,
+            body=json.dumps(body),
+            accept="application/json",
+            contentType="application/json",
+        )
+        return json.loads(response["body"].read())
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        if self.model_id.startswith("cohere."):
+            embedding_type = "ubinary" if self.data_type == "BINARY" else "float"
+            response = self._invoke(
+                {
+                    "texts": texts,
+                    "input_type": "search_document",
+                    "truncate": "END",
+                    "embedding_types": [embedding_type],
+                }
+            )
+            vectors = response["embeddings"][embedding_type]
+            if self.data_type == "BINARY":
+                return [[v - 256 if v > 127 else v for v in vector] for vector in vectors]
+            return vectors
+
+        vectors = []
+        for text in texts:
+            if self.model_id == "amazon.titan-embed-text-v1":
+                vectors.append(self._invoke({"inputText": text})["embedding"])
+                continue
+            embedding_type = "binary" if self.data_type == "BINARY" else "float"
+            response = self._invoke(
+                {
+                    "inputText": text,
+                    "dimensions": self.dimension,
+                    "normalize": True,
+                    "embeddingTypes": [embedding_type],
+                }
+            )
+            vector = response["embeddingsByType"][embedding_type]
+            vectors.append(pack_bits(vector) if self.data_type == "BINARY" else vector)
+        return vectors
@@ -0,0 +1,101 @@
+"""
+Embedding models a KnowledgeBase can be created with, and the vector settings each one supports
+"""
+
+DEFAULT_EMBEDDING_MODEL = "amazon.titan-embed-text-v1"
+
+# Bedrock KnowledgeBases store vectors either as FLOAT32 or as BINARY (one bit per dimension)
+EMBEDDING_DATA_TYPES = ["FLOAT32", "BINARY"]
+
+# On demand prices in USD (us-east-1), used for cost estimates only
+EMBEDDING_MODELS = {
+    "amazon.titan-embed-text-v1": {
+        "dimensions": [1536],
+        "data_types": ["FLOAT32"],
+        "configurable": False,
+        "price_per_1k_tokens": 0.0001,
+    },
+    "amazon.titan-embed-text-v2:0": {
+        "dimensions": [1024, 512, 256],
+        "data_types": ["FLOAT32", "BINARY"],
+        "configurable": True,
+        "price_per_1k_tokens": 0.00002,
+    },
+    "cohere.embed-english-v3": {
+        "dimensions": [1024],
+        "data_types": ["FLOAT32", "BINARY"],
+        "configurable": True,
+        "price_per_1k_tokens": 0.0001,
+    },
+    "cohere.embed-multilingual-v3": {
+        "dimensions": [1024],
+        "data_types": ["FLOAT32", "BINARY"],
+        "configurable": True,
+        "price_per_1k_tokens": 0.0001,
+    },
+}
+
+
+class UnsupportedEmbeddingSettingsException(Exception):
+    """
+    Thrown when an embedding model is combined with a dimension or data type it does not support
+    """
+
+    pass
+
+
+def resolve_embedding_settings(
+    model_id: str, dimensions: int = 0, data_type: str = "FLOAT32"
+) -> tuple[int, str]:
+    """
+    Validate the embedding settings, defaulting to the largest dimension of the model.
+
+    Args:
+        model_id (str): One of EMBEDDING_MODELS.
+        dimensions (int): Requested vector dimension, 0 for the model default.
+        data_type (str): One of EMBEDDING_DATA_TYPES.
+
+    Returns:
+        tuple[int, str]: The dimension and data type to use.
+    """
+    if model_id not in EMBEDDING_MODELS:
+        raise UnsupportedEmbeddingSettingsException(
+            f"Unsupported embedding model {model_id}, choice of {list(EMBEDDING_MODELS.keys())}"
+        )
+    model = EMBEDDING_MODELS[model_id]
+    dimensions = dimensions or model["dimensions"][0]
+    if dimensions not in model["dimensions"]:
+        raise UnsupportedEmbeddingSettingsException(
+            f"{model_id} supports dimensions {model['dimensions']}, got {dimensions}"
+        )
+    if data_type not in model["data_types"]:
+        raise UnsupportedEmbeddingSettingsException(
+            f"{model_id} supports data types {model['data_types']}, got {data_type}"
+        )
+    return dimensions, data_type
+
+
+def embedding_model_configuration(
+    model_id: str, dimensions: int, data_type: str
+) -> dict:
+    """
+    The vectorKnowledgeBaseConfiguration fields for create_knowledge_base
+
+    Args:
+        model_id (str): One of EMBEDDING_MODELS.
+        dimensions (int): The vector dimension.
+        data_type (str): One of EMBEDDING_DATA_TYPES.
+
+    Returns:
+        dict: embeddingModelConfiguration, empty for models that only have one setting.
+    """
+    if not EMBEDDING_MODELS[model_id]["configurable"]:
+        return {}
+    return {
+        "embeddingModelConfiguration": {
+            "bedrockEmbeddingModelConfiguration": {
+                "dimensions": dimensions,
+                "embeddingDataType": data_type,
+            }
+        }
+    }
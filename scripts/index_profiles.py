@@ -0,0 +1,117 @@
+"""
+Named vector index profiles for the KnowledgeBase OpenSearch index
+"""
+
+# HNSW graph parameters trade recall against latency and memory:
+# m is the number of graph neighbours per vector (memory grows linearly with it),
+# ef_construction the candidate list size while building, ef_search the one while querying.
+INDEX_PROFILES = {
+    # The settings the index was always created with, engine defaults for m and ef_construction
+    "default": {
+        "engine": "faiss",
+        "space_type": "l2",
+        "ef_search": 512,
+        "number_of_shards": 1,
+        "number_of_replicas": 0,
+    },
+    "latency": {
+        "engine": "faiss",
+        "space_type": "l2",
+        "m": 16,
+        "ef_construction": 128,
+        "ef_search": 64,
+        "number_of_shards": 1,
+        "number_of_replicas": 0,
+    },
+    "recall": {
+        "engine": "faiss",
+        "space_type": "l2",
+        "m": 32,
+        "ef_construction": 512,
+        "ef_search": 512,
+        "number_of_shards": 1,
+        "number_of_replicas": 1,
+    },
+    "memory": {
+        "engine": "faiss",
+        "space_type": "l2",
+        "m": 8,
+        "ef_construction": 128,
+        "ef_search": 128,
+        "number_of_shards": 1,
+        "number_of_replicas": 0,
+    },
+}
+
+
+def vector_index_body(
+    profile_name: str, dimension: int = 1536, data_type: str = "FLOAT32"
+) -> dict:
+    """
+    Build the index settings and mappings for a profile, using the text/vector/text-metadata field mapping
+    the KnowledgeBase expects.
+
+    Args:
+        profile_name (str): One of INDEX_PROFILES.
+        dimension (int): The dimension of the embedding vectors.
+        data_type (str): FLOAT32, or BINARY for one bit per dimension vectors compared by hamming distance.
+
+    Returns:
+        dict: The body for indices.create.
+    """
+    profile = INDEX_PROFILES[profile_name]
+    method = {
+        "name": "hnsw",
+        # binary vectors are only supported by faiss
+        "engine": "faiss" if data_type == "BINARY" else profile["engine"],
+        "space_type": "hamming" if data_type == "BINARY" else profile["space_type"],
+    }
+    parameters = {
+        name: profile[name] for name in ("m", "ef_construction") if name in profile
+    }
+    if parameters:
+        method["parameters"] = parameters
+
+    vector_mapping = {
+        "type": "knn_vector",
+        "dimension": dimension,
+        "method": method,
+    }
+    if data_type == "BINARY":
+        vector_mapping["data_type"] = "binary"
+
+    return {
+        "settings": {
+            "index.knn": "true",
+            "number_of_shards": profile["number_of_shards"],
+            "knn.algo_param.ef_search": profile["ef_search"],
+            "number_of_replicas": profile["number_of_replicas"],
+        },
+        "mappings": {
+            "properties": {
+                "vector": vector_mapping,
+                "text": {"type": "text"},
+                "text-metadata": {"type": "text"},
+            }
+        },
+    }
+
+
+def estimated_graph_memory_mb(
+    num_vectors: int, dimension: int, m: int = 16, data_type: str = "FLOAT32"
+) -> float:
+    """
+    Native memory of a faiss HNSW graph as estimated in the OpenSearch k-NN documentation,
+    1.1 * (bytes per vector + 8 * m) per vector
+
+    Args:
+        num_vectors (int): Number of indexed vectors (chunks).
+        dimension (int): The dimension of the embedding vectors.
+        m (int): The HNSW m parameter.
+        data_type (str): FLOAT32 (4 bytes per dimension) or BINARY (1 bit per dimension).
+
+    Returns:
+        float: The estimate in MB.
+    """
+    bytes_per_vector = dimension / 8 if data_type == "BINARY" else 4 * dimension
+    return 1.1 * (bytes_per_vector + 8 * m) * num_vectors / 1024 / 1024
@@ -0,0 +1,187 @@
+"""
+Runs ingestion jobs of several KnowledgeBase data sources concurrently and monitors them from one dashboard
+"""
+
+import time
+import boto3
+from botocore.exceptions import ClientError
+from knowledge_bases_roles import IngestionJobStats
+
+# Errors start_ingestion_job returns while too many jobs are running, the job is started again later
+RETRYABLE_START_CODES = {
+    "ConflictException",
+    "ServiceQuotaExceededException",
+    "ThrottlingException",
+}
+
+
+class IngestionJobException(Exception):
+    """
+    Thrown when an ingestion job does not finish before its deadline
+    """
+
+    pass
+
+
+def job_stats(job: dict, duration_seconds: float) -> IngestionJobStats:
+    """
+    Convert an ingestion job returned by get_ingestion_job into the statistics recorded in the KBInfo
+    """
+    statistics = job.get("statistics", {})
+    return IngestionJobStats(
+        ingestion_job_id=job["ingestionJobId"],
+        data_source_id=job["dataSourceId"],
+        status=job["status"],
+        started_at=str(job.get("startedAt", "")),
+        documents_scanned=statistics.get("numberOfDocumentsScanned", 0),
+        documents_new_indexed=statistics.get("numberOfNewDocumentsIndexed", 0),
+        documents_modified_indexed=statistics.get("numberOfModifiedDocumentsIndexed", 0),
+        documents_deleted=statistics.get("numberOfDocumentsDeleted", 0),
+        documents_failed=statistics.get("numberOfDocumentsFailed", 0),
+        duration_seconds=round(duration_seconds, 1),
+    )
+
+
+class IngestionScheduler:
+    """
+    Starts one ingestion job per data source, at most max_concurrent at a time, and polls all running jobs
+    together. Jobs the service refuses to start because of its concurrency quotas are queued and started
+    again once another job finished.
+    Args:
+        bedrock_agent_client (boto3.client): The boto3 client for Bedrock Agent.
+        kb_id (str): the KnowledgeBase
+        data_sources (dict[str, str]): data source id to the S3 prefix it ingests, shown on the dashboard
+        max_concurrent (int): ingestion jobs running at the same time
+        poll_interval (float): seconds between two dashboard refreshes
+    """
+
+    def __init__(
+        self,
+        bedrock_agent_client: boto3.client,
+        kb_id: str,
+        data_sources: dict[str, str],
+        max_concurrent: int = 5,
+        poll_interval: float = 10.0,
+    ) -> None:
+        self.client = bedrock_agent_client
+        self.kb_id = kb_id
+        self.data_sources = data_sources
+        self.max_concurrent = max_concurrent
+        self.poll_interval = poll_interval
+        self.jobs: dict[str, dict] = {}
+        self.started: dict[str, float] = {}
+        self.finished: dict[str, IngestionJobStats] = {}
+
+    def _start(self, ds_id: str) -> bool:
+        try:
+            job = self.client.start_ingestion_job(
+                knowledgeBaseId=self.kb_id, dataSourceId=ds_id
+            )["ingestionJob"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in RETRYABLE_START_CODES:
+                raise
+            return False
+        self.jobs[ds_id] = job
+        self.started[ds_id] = time.perf_counter()
+        return True
+
+    def _poll(self, ds_id: str) -> None:
+        job = self.client.get_ingestion_job(
+            knowledgeBaseId=self.kb_id,
+            dataSourceId=ds_id,
+            ingestionJobId=self.jobs[ds_id]["ingestionJobId"],
+        )["ingestionJob"]
+        self.jobs[ds_id] = job
+        if job["status"] not in ["IN_PROGRESS", "STARTING", "STOPPING"]:
+            self.finished[ds_id] = job_stats(job, time.perf_counter() - self.started[ds_id])
+
+    def dashboard(self) -> str:
+        """
+        Progress of every data source: documents indexed per second and failures
+        """
+        header = f"  {'source':<24} {'status':<12} {'scanned':>8} {'indexed':>8} {'failed':>7} {'elapsed':>8} {'docs/s':>7}"
+        lines = [header]
+        total_indexed = total_failed = 0
+        now = time.perf_counter()
+        for ds_id, prefix in self.data_sources.items():
+            job = self.jobs.get(ds_id)
+            if not job:
+                lines.append(f"  {prefix or '(bucket)':<24} {'QUEUED':<12}")
+                continue
+            statistics = job.get("statistics", {})
+            indexed = statistics.get("numberOfNewDocumentsIndexed", 0) + statistics.get(
+                "numberOfModifiedDocumentsIndexed", 0
+            )
+            failed = statistics.get("numberOfDocumentsFailed", 0)
+            elapsed = (
+                self.finished[ds_id].duration_seconds
+                if ds_id in self.finished
+                else now - self.started[ds_id]
+            )
+            total_indexed += indexed
+            total_failed += failed
+            lines.append(
+                f"  {prefix or '(bucket)':<24} {job['status']:<12} "
+                f"{statistics.get('numberOfDocumentsScanned', 0):>8} {indexed:>8} {failed:>7} "
+                f"{elapsed:>7.0f}s {indexed / elapsed if elapsed else 0:>7.1f}"
+            )
+        elapsed = now - min(self.started.values()) if self.started else 0
+        lines.append(
+            f"  {'total':<24} {'':<12} {'':>8} {total_indexed:>8} {total_failed:>7} "
+            f"{elapsed:>7.0f}s {total_indexed / elapsed if elapsed else 0:>7.1f}"
+        )
+        return "\n".join(lines)
+
+    def run(self, timeout: float = 3600) -> list[IngestionJobStats]:
+        """
+        Ingest all data sources and wait for every job to finish.
+
+        Args:
+            timeout (float): Maximum number of seconds for all jobs together.
+
+        Returns:
+            list[IngestionJobStats]: The statistics of every finished job, in data source order.
+        """
+        deadline = time.perf_counter() + timeout
+        queued = list(self.data_sources)
+        while queued or len(self.finished) < len(self.jobs):
+            running = [ds_id for ds_id in self.jobs if ds_id not in self.finished]
+            while queued and len(running) < self.max_concurrent:
+                if not self._start(queued[0]):
+                    # the service limits concurrent jobs, wait for a running job to finish
+                    break
+                running.append(queued.pop(0))
+            if not running and queued:
+                print("Ingestion job limit reached by jobs outside this run, retrying")
+            for ds_id in running:
+                self._poll(ds_id)
+            print(self.dashboard())
+            if not queued and len(self.finished) == len(self.jobs):
+                break
+            if time.perf_counter() >= deadline:
+                raise IngestionJobException(
+                    f"Ingestion of {len(queued) + len(running)} data sources did not finish within {timeout}s"
+                )
+            time.sleep(self.poll_interval)
+        return [self.finished[ds_id] for ds_id in self.data_sources]
+
+
+def changed_data_sources(
+    data_sources: dict[str, str], changed_keys: list[str]
+) -> dict[str, str]:
+    """
+    The data sources whose prefix contains one of the changed S3 keys
+
+    Args:
+        data_sources (dict[str, str]): data source id to S3 prefix, an empty prefix covers the whole bucket
+        changed_keys (list[str]): uploaded and deleted keys
+
+    Returns:
+        dict[str, str]: The data sources that need an ingestion job.
+    """
+    return {
+        ds_id: prefix
+        for ds_id, prefix in data_sources.items()
+        if any(key.startswith(prefix) for key in changed_keys)
+    }
+
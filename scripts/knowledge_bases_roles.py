@@ -4,22 +4,48 @@ This class is copied from https://github.com/aws-samples/amazon-bedrock-workshop
 
 import json
 import uuid
-import time
 import boto3
-from typing import Optional
+from typing import Callable, Optional
+from botocore.exceptions import ClientError
 from pydantic import BaseModel
 from opensearchpy import AWSV4SignerAuth, OpenSearch, RequestsHttpConnection
 
+# Error codes IAM and OpenSearch Serverless return when a resource of the same name was already created
+ALREADY_EXISTS_CODES = {"EntityAlreadyExists", "ConflictException"}
 
-def interactive_sleep(seconds: int) -> None:
+
+def get_or_create(resource: str, create: Callable[[], dict], get: Callable[[], dict]) -> dict:
+    """
+    Create a resource, or read it back when an interrupted run already created it, so a step can be rerun
+    Args:
+      resource: Description of the resource, used in output.
+      create: The create call.
+      get: Reads the existing resource, returning the same shape as create.
+    """
+    try:
+        return create()
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ALREADY_EXISTS_CODES:
+            raise
+        print(f"{resource} already exists, reusing it")
+        return get()
+
+
+class IngestionJobStats(BaseModel):
     """
-    Sleep with prints to the user
+    Statistics of a single ingestion job run against the KnowledgeBase data source
     """
-    dots = ""
-    for _ in range(seconds):
-        dots += "."
-        print(dots, end="\r")
-        time.sleep(1)
+
+    ingestion_job_id: str = ""
+    data_source_id: str = ""
+    status: str = ""
+    started_at: str = ""
+    documents_scanned: int = 0
+    documents_new_indexed: int = 0
+    documents_modified_indexed: int = 0
+    documents_deleted: int = 0
+    documents_failed: int = 0
+    duration_seconds: float = 0.0
 
 
 class KBInfo(BaseModel):
@@ -27,19 +53,42 @@ class KBInfo(BaseModel):
     A class that saves all the resources names created when a Bedrock KB is created. Can be used later for deletion
     """
 
+    suffix: str = ""
     ds_id: str = ""
+    ds_ids: list[str] = []
+    data_source_prefixes: list[str] = []
+    upload_shards: int = 1
     kb_id: str = ""
     index_name: str = ""
+    index_profile: str = ""
+    embedding_model: str = "amazon.titan-embed-text-v1"
+    embedding_dimensions: int = 1536
+    embedding_data_type: str = "FLOAT32"
+    vector_store_name: str = ""
     collection_id: str = ""
+    collection_arn: str = ""
     access_policy_name: str = ""
     network_policy_name: str = ""
     encryption_policy_name: str = ""
     bucket_name: str = ""
     region_name: str = ""
     bedrock_execution_role_name: str = ""
+    bedrock_execution_role_arn: str = ""
     fm_policy_name: str = ""
     s3_policy_name: str = ""
     oss_policy_name: str = ""
+    ingestion_jobs: list[IngestionJobStats] = []
+    completed_steps: list[str] = []
+
+    def data_sources(self) -> dict[str, str]:
+        """
+        Data source ids mapped to the S3 prefix they ingest, an empty prefix covers the whole bucket.
+        Files of KnowledgeBases created with a single data source only have the ds_id.
+        """
+        if self.ds_ids:
+            prefixes = self.data_source_prefixes or [""]
+            return dict(zip(self.ds_ids, prefixes))
+        return {self.ds_id: ""} if self.ds_id else {}
 
 
 class KnowledgeBaseRoles:
@@ -47,6 +96,7 @@ class KnowledgeBaseRoles:
     Class is responsible for creating all policies and roles associated with KnowledgeBase creation
     Args:
         region_name (str): name of the AWS region
+        suffix (str): suffix of generated resource names, reused when resuming a previous run
     """
 
     def __init__(
@@ -56,8 +106,9 @@ class KnowledgeBaseRoles:
         fm_policy_name: Optional[str] = None,
         s3_policy_name: Optional[str] = None,
         oss_policy_name: Optional[str] = None,
+        suffix: Optional[str] = None,
     ) -> None:
-        self.suffix = uuid.uuid4().hex[:6]
+        self.suffix = suffix or uuid.uuid4().hex[:6]
         self.region_name = region_name
         self.boto3_session = boto3.session.Session(region_name=self.region_name)
         self.iam_client = self.boto3_session.client("iam")
@@ -86,13 +137,14 @@ class KnowledgeBaseRoles:
         )
 
     def create_bedrock_execution_role(
-        self, bucket_name: str
+        self, bucket_name: str, embedding_model_id: str = "amazon.titan-embed-text-v1"
     ) -> dict[str, dict[str, str]]:
         """
         Create an IAM role with necessary policies for Amazon Bedrock Knowledge Base Execution.
 
         Args:
             bucket_name (str): The name of the S3 bucket containing the documents.
+            embedding_model_id (str): The embedding model the Knowledge Base is allowed to invoke.
 
         Returns:
             dict[str, dict[str, str]]: A dictionary containing the created IAM role details.
@@ -106,7 +158,7 @@ class KnowledgeBaseRoles:
                         "bedrock:InvokeModel",
                     ],
                     "Resource": [
-                        f"arn:aws:bedrock:{self.region_name}::foundation-model/amazon.titan-embed-text-v1"
+                        f"arn:aws:bedrock:{self.region_name}::foundation-model/{embedding_model_id}"
                     ],
                 }
             ],
@@ -142,24 +194,28 @@ class KnowledgeBaseRoles:
             ],
         }
         # create policies based on the policy documents
-        fm_policy = self.iam_client.create_policy(
-            PolicyName=self.fm_policy_name,
-            PolicyDocument=json.dumps(foundation_model_policy_document),
-            Description="Policy for accessing foundation model",
+        fm_policy = self._create_policy(
+            self.fm_policy_name,
+            foundation_model_policy_document,
+            "Policy for accessing foundation model",
         )
 
-        s3_policy = self.iam_client.create_policy(
-            PolicyName=self.s3_policy_name,
-            PolicyDocument=json.dumps(s3_policy_document),
-            Description="Policy for reading documents from s3",
+        s3_policy = self._create_policy(
+            self.s3_policy_name,
+            s3_policy_document,
+            "Policy for reading documents from s3",
         )
 
         # create bedrock execution role
-        bedrock_kb_execution_role = self.iam_client.create_role(
-            RoleName=self.bedrock_execution_role_name,
-            AssumeRolePolicyDocument=json.dumps(assume_role_policy_document),
-            Description="Amazon Bedrock Knowledge Base Execution Role for accessing OSS and S3",
-            MaxSessionDuration=3600,
+        bedrock_kb_execution_role = get_or_create(
+            f"role {self.bedrock_execution_role_name}",
+            lambda: self.iam_client.create_role(
+                RoleName=self.bedrock_execution_role_name,
+                AssumeRolePolicyDocument=json.dumps(assume_role_policy_document),
+                Description="Amazon Bedrock Knowledge Base Execution Role for accessing OSS and S3",
+                MaxSessionDuration=3600,
+            ),
+            lambda: self.iam_client.get_role(RoleName=self.bedrock_execution_role_name),
         )
 
         # fetch arn of the policies and role created above
@@ -200,10 +256,10 @@ class KnowledgeBaseRoles:
                 }
             ],
         }
-        oss_policy = self.iam_client.create_policy(
-            PolicyName=self.oss_policy_name,
-            PolicyDocument=json.dumps(oss_policy_document),
-            Description="Policy for accessing opensearch serverless",
+        oss_policy = self._create_policy(
+            self.oss_policy_name,
+            oss_policy_document,
+            "Policy for accessing opensearch serverless",
         )
         oss_policy_arn = oss_policy["Policy"]["Arn"]
         print("Opensearch serverless arn: ", oss_policy_arn)
@@ -213,6 +269,22 @@ class KnowledgeBaseRoles:
             PolicyArn=oss_policy_arn,
         )
 
+    def _create_policy(self, name: str, document: dict, description: str) -> dict:
+        """
+        Create a customer managed IAM policy, or read back the one an interrupted run created
+        """
+        return get_or_create(
+            f"policy {name}",
+            lambda: self.iam_client.create_policy(
+                PolicyName=name,
+                PolicyDocument=json.dumps(document),
+                Description=description,
+            ),
+            lambda: self.iam_client.get_policy(
+                PolicyArn=f"arn:aws:iam::{self.account_number}:policy/{name}"
+            ),
+        )
+
     def create_policies_in_oss(
         self,
         vector_store_name: str,
@@ -230,30 +302,37 @@ class KnowledgeBaseRoles:
         Returns:
             tuple[dict, dict, dict]: A tuple containing the encryption policy, network policy, and access policy dictionaries.
         """
+        encryption_policy, network_policy = self.create_security_policies_in_oss(
+            vector_store_name, aoss_client
+        )
+        access_policy = self.create_access_policy_in_oss(
+            vector_store_name, aoss_client, bedrock_kb_execution_role_arn
+        )
+        return encryption_policy, network_policy, access_policy
+
+    def create_security_policies_in_oss(
+        self,
+        vector_store_name: str,
+        aoss_client: boto3.client,
+    ) -> tuple[dict, dict]:
+        """
+        Create the encryption and network policies in OpenSearch Serverless, they do not depend on the execution role.
+
+        Args:
+            vector_store_name (str): The name of the vector store.
+            aoss_client (boto3.client): The boto3 client for OpenSearch Serverless.
+
+        Returns:
+            tuple[dict, dict]: A tuple containing the encryption policy and network policy dictionaries.
+        """
         encryption_policy_name = f"bedrock-sample-rag-sp-{self.suffix}"
         network_policy_name = f"bedrock-sample-rag-np-{self.suffix}"
-        access_policy_name = f"bedrock-sample-rag-ap-{self.suffix}"
 
-        encryption_policy = aoss_client.create_security_policy(
-            name=encryption_policy_name,
-            policy=json.dumps(
-                {
-                    "Rules": [
-                        {
-                            "Resource": ["collection/" + vector_store_name],
-                            "ResourceType": "collection",
-                        }
-                    ],
-                    "AWSOwnedKey": True,
-                }
-            ),
-            type="encryption",
-        )
-
-        network_policy = aoss_client.create_security_policy(
-            name=network_policy_name,
-            policy=json.dumps(
-                [
+        encryption_policy = get_or_create(
+            f"encryption policy {encryption_policy_name}",
+            lambda: aoss_client.create_security_policy(
+                name=encryption_policy_name,
+                policy=json.dumps(
                     {
                         "Rules": [
                             {
@@ -261,53 +340,100 @@ class KnowledgeBaseRoles:
                                 "ResourceType": "collection",
                             }
                         ],
-                        "AllowFromPublic": True,
+                        "AWSOwnedKey": True,
                     }
-                ]
+                ),
+                type="encryption",
             ),
-            type="network",
+            lambda: aoss_client.get_security_policy(name=encryption_policy_name, type="encryption"),
         )
-        access_policy = aoss_client.create_access_policy(
-            name=access_policy_name,
-            policy=json.dumps(
-                [
-                    {
-                        "Rules": [
-                            {
-                                "Resource": ["collection/" + vector_store_name],
-                                "Permission": [
-                                    "aoss:CreateCollectionItems",
-                                    "aoss:DeleteCollectionItems",
-                                    "aoss:UpdateCollectionItems",
-                                    "aoss:DescribeCollectionItems",
-                                ],
-                                "ResourceType": "collection",
-                            },
-                            {
-                                "Resource": ["index/" + vector_store_name + "/*"],
-                                "Permission": [
-                                    "aoss:CreateIndex",
-                                    "aoss:DeleteIndex",
-                                    "aoss:UpdateIndex",
-                                    "aoss:DescribeIndex",
-                                    "aoss:ReadDocument",
-                                    "aoss:WriteDocument",
-                                ],
-                                "ResourceType": "index",
-                            },
-                        ],
-                        "Principal": [self.identity, bedrock_kb_execution_role_arn],
-                        "Description": "Easy data policy",
-                    }
-                ]
+
+        network_policy = get_or_create(
+            f"network policy {network_policy_name}",
+            lambda: aoss_client.create_security_policy(
+                name=network_policy_name,
+                policy=json.dumps(
+                    [
+                        {
+                            "Rules": [
+                                {
+                                    "Resource": ["collection/" + vector_store_name],
+                                    "ResourceType": "collection",
+                                }
+                            ],
+                            "AllowFromPublic": True,
+                        }
+                    ]
+                ),
+                type="network",
             ),
-            type="data",
+            lambda: aoss_client.get_security_policy(name=network_policy_name, type="network"),
         )
-        return encryption_policy, network_policy, access_policy
+        return encryption_policy, network_policy
+
+    def create_access_policy_in_oss(
+        self,
+        vector_store_name: str,
+        aoss_client: boto3.client,
+        bedrock_kb_execution_role_arn: str,
+    ) -> dict:
+        """
+        Create the data access policy in OpenSearch Serverless for the caller and the Bedrock execution role.
+
+        Args:
+            vector_store_name (str): The name of the vector store.
+            aoss_client (boto3.client): The boto3 client for OpenSearch Serverless.
+            bedrock_kb_execution_role_arn (str): The ARN of the Bedrock execution role.
+
+        Returns:
+            dict: The access policy dictionary.
+        """
+        access_policy_name = f"bedrock-sample-rag-ap-{self.suffix}"
+        access_policy = get_or_create(
+            f"data access policy {access_policy_name}",
+            lambda: aoss_client.create_access_policy(
+                name=access_policy_name,
+                policy=json.dumps(
+                    [
+                        {
+                            "Rules": [
+                                {
+                                    "Resource": ["collection/" + vector_store_name],
+                                    "Permission": [
+                                        "aoss:CreateCollectionItems",
+                                        "aoss:DeleteCollectionItems",
+                                        "aoss:UpdateCollectionItems",
+                                        "aoss:DescribeCollectionItems",
+                                    ],
+                                    "ResourceType": "collection",
+                                },
+                                {
+                                    "Resource": ["index/" + vector_store_name + "/*"],
+                                    "Permission": [
+                                        "aoss:CreateIndex",
+                                        "aoss:DeleteIndex",
+                                        "aoss:UpdateIndex",
+                                        "aoss:DescribeIndex",
+                                        "aoss:ReadDocument",
+                                        "aoss:WriteDocument",
+                                    ],
+                                    "ResourceType": "index",
+                                },
+                            ],
+                            "Principal": [self.identity, bedrock_kb_execution_role_arn],
+                            "Description": "Easy data policy",
+                        }
+                    ]
+                ),
+                type="data",
+            ),
+            lambda: aoss_client.get_access_policy(name=access_policy_name, type="data"),
+        )
+        return access_policy
 
     def delete_iam_role_and_policies(self) -> None:
         """
-        Deletes the IAM roles and polices created earlier
+        Deletes the IAM roles and polices created earlier, skipping the ones that are already gone
         """
         fm_policy_arn = (
             f"arn:aws:iam::{self.account_number}:policy/{self.fm_policy_name}"
@@ -318,21 +444,26 @@ class KnowledgeBaseRoles:
         oss_policy_arn = (
             f"arn:aws:iam::{self.account_number}:policy/{self.oss_policy_name}"
         )
-        self.iam_client.detach_role_policy(
-            RoleName=self.bedrock_execution_role_name, PolicyArn=s3_policy_arn
-        )
-        self.iam_client.detach_role_policy(
-            RoleName=self.bedrock_execution_role_name, PolicyArn=fm_policy_arn
+        policy_arns = [s3_policy_arn, fm_policy_arn, oss_policy_arn]
+        for policy_arn in policy_arns:
+            self._ignore_missing(
+                self.iam_client.detach_role_policy,
+                RoleName=self.bedrock_execution_role_name,
+                PolicyArn=policy_arn,
+            )
+        self._ignore_missing(
+            self.iam_client.delete_role, RoleName=self.bedrock_execution_role_name
         )
-        self.iam_client.detach_role_policy(
-            RoleName=self.bedrock_execution_role_name, PolicyArn=oss_policy_arn
-        )
-        self.iam_client.delete_role(RoleName=self.bedrock_execution_role_name)
-        self.iam_client.delete_policy(PolicyArn=s3_policy_arn)
-        self.iam_client.delete_policy(PolicyArn=fm_policy_arn)
-        self.iam_client.delete_policy(PolicyArn=oss_policy_arn)
+        for policy_arn in policy_arns:
+            self._ignore_missing(self.iam_client.delete_policy, PolicyArn=policy_arn)
         return 0
 
+    def _ignore_missing(self, func, **kwargs) -> None:
+        try:
+            func(**kwargs)
+        except self.iam_client.exceptions.NoSuchEntityException:
+            print(f"{func.__name__}: {kwargs} does not exist, skipping")
+
     def create_os_client(self, collection_id: str):
         """
         Creates OpenSearch Client with authentication
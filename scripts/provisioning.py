@@ -0,0 +1,156 @@
+"""
+Runs provisioning steps as a dependency graph, concurrently where possible and resumable after a failure
+"""
+
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Optional
+
+
+class ProvisioningException(Exception):
+    """
+    Thrown when a provisioning step fails or the step graph is invalid
+    """
+
+    pass
+
+
+class Step:
+    """
+    A single provisioning step
+    Args:
+        name (str): unique name of the step, recorded in the checkpoint once completed
+        func (Callable[[], None]): does the work, results are stored on the KBInfo by the step itself
+        depends_on (list[str]): steps that have to be completed before this one starts
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[], None],
+        depends_on: Optional[list[str]] = None,
+    ) -> None:
+        self.name = name
+        self.func = func
+        self.depends_on = depends_on or []
+
+
+class ProvisioningExecutor:
+    """
+    Executes steps as soon as all of their dependencies are completed, running independent steps in parallel.
+    After every completed step the checkpoint callback is invoked, so a rerun can skip steps that already
+    finished.
+    Args:
+        steps (list[Step]): the step graph
+        completed (list[str]): names of steps completed in a previous run, appended to in place
+        checkpoint (Callable[[], None]): persists the progress, called after every step and on failure
+        max_workers (int): maximum number of steps running at the same time
+        name (str): what the steps do, used in output
+    """
+
+    def __init__(
+        self,
+        steps: list[Step],
+        completed: list[str],
+        checkpoint: Callable[[], None],
+        max_workers: int = 4,
+        name: str = "Provisioning",
+    ) -> None:
+        self.name = name
+        self.steps = {step.name: step for step in steps}
+        self.completed = completed
+        self.checkpoint = checkpoint
+        self.max_workers = max_workers
+        self.durations: dict[str, float] = {}
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+        self._validate()
+
+    def _validate(self) -> None:
+        """
+        Reject unknown dependencies and cycles before anything is created
+        """
+        for step in self.steps.values():
+            unknown = set(step.depends_on) - set(self.steps)
+            if unknown:
+                raise ProvisioningException(
+                    f"Step {step.name} depends on unknown steps {sorted(unknown)}"
+                )
+        visiting, visited = set(), set()
+
+        def visit(name: str) -> None:
+            if name in visited:
+                return
+            if name in visiting:
+                raise ProvisioningException(f"Dependency cycle through step {name}")
+            visiting.add(name)
+            for dependency in self.steps[name].depends_on:
+                visit(dependency)
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in self.steps:
+            visit(name)
+
+    def _run_step(self, step: Step) -> None:
+        start = time.perf_counter()
+        print(f"[{step.name}] started")
+        step.func()
+        self.durations[step.name] = time.perf_counter() - start
+        print(f"[{step.name}] completed in {self.durations[step.name]:.1f}s")
+        with self._lock:
+            self.completed.append(step.name)
+            self.checkpoint()
+
+    def run(self) -> None:
+        """
+        Run all steps that are not completed yet. If a step fails, the steps already running are allowed to
+        finish, progress is checkpointed and the first error is raised.
+        """
+        pending = {name for name in self.steps if name not in self.completed}
+        if not pending:
+            print("All provisioning steps are already completed")
+            return
+        skipped = [name for name in self.steps if name in self.completed]
+        if skipped:
+            print(f"Resuming, skipping completed steps: {', '.join(skipped)}")
+
+        start = time.perf_counter()
+        running: dict[Future, str] = {}
+        failure = None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if failure is None:
+                    ready = [
+                        name
+                        for name in sorted(pending)
+                        if all(dep in self.completed for dep in self.steps[name].depends_on)
+                    ]
+                    for name in ready:
+                        pending.discard(name)
+                        running[executor.submit(self._run_step, self.steps[name])] = name
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if future.exception() and failure is None:
+                        print(f"[{name}] failed: {future.exception()}")
+                        failure = (name, future.exception())
+        self.elapsed = time.perf_counter() - start
+
+        if failure:
+            self.checkpoint()
+            name, error = failure
+            raise ProvisioningException(
+                f"{self.name} step {name} failed, rerun to resume from the last completed step"
+            ) from error
+
+    def report(self) -> str:
+        """
+        Summary of how long every step of this run took
+        """
+        lines = [f"  {name:<40} {seconds:7.1f}s" for name, seconds in self.durations.items()]
+        lines.append(f"  {'wall clock':<40} {self.elapsed:7.1f}s")
+        return f"{self.name} steps:\n" + "\n".join(lines)
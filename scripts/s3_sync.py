@@ -0,0 +1,234 @@
+"""
+Incremental, concurrent upload of a local directory to S3
+"""
+
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Optional
+import boto3
+from boto3.s3.transfer import TransferConfig
+from pydantic import BaseModel
+
+MB = 1024 * 1024
+SHARD_PREFIX = "shard-{:02d}/"
+
+
+def shard_prefixes(num_shards: int) -> list[str]:
+    """
+    The key prefixes files are spread over when a directory is synced into num_shards shards
+    """
+    return [SHARD_PREFIX.format(shard) for shard in range(num_shards)] if num_shards > 1 else []
+
+
+def shard_prefix(relative_key: str, num_shards: int) -> str:
+    """
+    The shard a file belongs to, stable across runs so a file is never moved to another shard
+    """
+    if num_shards <= 1:
+        return ""
+    digest = hashlib.md5(relative_key.encode("utf-8"), usedforsecurity=False).hexdigest()
+    return SHARD_PREFIX.format(int(digest, 16) % num_shards)
+
+
+class SyncReport(BaseModel):
+    """
+    Summary of a sync run, the changed keys are used to decide if an ingestion job is needed
+    """
+
+    uploaded: list[str] = []
+    skipped: int = 0
+    deleted: list[str] = []
+    bytes_uploaded: int = 0
+    seconds: float = 0.0
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.uploaded or self.deleted)
+
+    @property
+    def throughput_mb_s(self) -> float:
+        return self.bytes_uploaded / MB / self.seconds if self.seconds else 0.0
+
+    def summary(self) -> str:
+        return (
+            f"Uploaded {len(self.uploaded)} files ({self.bytes_uploaded / MB:.1f} MB), "
+            f"skipped {self.skipped} unchanged, deleted {len(self.deleted)} "
+            f"in {self.seconds:.1f}s ({self.throughput_mb_s:.1f} MB/s)"
+        )
+
+
+class S3Sync:
+    """
+    Syncs a local directory to an S3 prefix, keeping relative paths as keys.
+    Unchanged files are detected by comparing a locally computed ETag with the remote one,
+    and a manifest of size/mtime/ETag avoids re-hashing files that were not touched.
+    Args:
+        s3_client (boto3.client): The boto3 client for S3 service.
+        bucket_name (str): name of the destination bucket
+        prefix (str): key prefix under which the directory is mirrored
+        manifest_path (Path): local JSON file remembering the last synced state
+        max_workers (int): number of files uploaded concurrently
+        multipart_threshold_mb (int): files above this size are uploaded in parts
+        multipart_chunksize_mb (int): size of each part, also used to compute multipart ETags
+        num_shards (int): spread the files over this many shard-NN/ prefixes, one per data source
+    """
+
+    def __init__(
+        self,
+        s3_client: boto3.client,
+        bucket_name: str,
+        prefix: str = "",
+        manifest_path: Optional[Path] = None,
+        max_workers: int = 16,
+        multipart_threshold_mb: int = 8,
+        multipart_chunksize_mb: int = 8,
+        num_shards: int = 1,
+    ) -> None:
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.manifest_path = manifest_path
+        self.max_workers = max_workers
+        self.num_shards = num_shards
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold_mb * MB,
+            multipart_chunksize=multipart_chunksize_mb * MB,
+            max_concurrency=4,
+            use_threads=True,
+        )
+
+    def load_manifest(self) -> dict[str, dict]:
+        """
+        Load the last synced state, keyed by S3 key
+        """
+        if self.manifest_path and Path(self.manifest_path).exists():
+            with open(self.manifest_path, encoding="utf-8") as f:
+                return json.load(f)
+        return {}
+
+    def save_manifest(self, manifest: dict[str, dict]) -> None:
+        if self.manifest_path:
+            with open(self.manifest_path, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=4, sort_keys=True)
+
+    def local_etag(self, path: Path) -> str:
+        """
+        Compute the ETag S3 will report for the file when uploaded with our transfer config.
+
+        Args:
+            path (Path): The local file.
+
+        Returns:
+            str: The md5 for single part uploads, or the md5 of part md5s suffixed with the part count.
+        """
+        chunk_size = self.transfer_config.multipart_chunksize
+        size = path.stat().st_size
+        with open(path, "rb") as f:
+            if size < self.transfer_config.multipart_threshold:
+                return hashlib.md5(f.read(), usedforsecurity=False).hexdigest()
+            part_digests = []
+            while chunk := f.read(chunk_size):
+                part_digests.append(hashlib.md5(chunk, usedforsecurity=False).digest())
+        combined = hashlib.md5(b"".join(part_digests), usedforsecurity=False).hexdigest()
+        return f"{combined}-{len(part_digests)}"
+
+    def remote_etags(self) -> dict[str, str]:
+        """
+        List all objects under the prefix with their ETags
+        """
+        etags = {}
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.prefix):
+            for obj in page.get("Contents", []):
+                etags[obj["Key"]] = obj["ETag"].strip('"')
+        return etags
+
+    def scan(self, path: Path) -> dict[str, dict]:
+        """
+        Build the local state of the directory, reusing manifest hashes for untouched files.
+
+        Args:
+            path (Path): The directory to scan.
+
+        Returns:
+            dict[str, dict]: size, mtime, etag and local path keyed by S3 key.
+        """
+        manifest = self.load_manifest()
+        state = {}
+        for root, _, files in os.walk(path):
+            for file in files:
+                file_path = Path(root) / file
+                relative_key = file_path.relative_to(path).as_posix()
+                key = self.prefix + shard_prefix(relative_key, self.num_shards) + relative_key
+                stat = file_path.stat()
+                previous = manifest.get(key, {})
+                if previous.get("size") == stat.st_size and previous.get("mtime") == stat.st_mtime:
+                    etag = previous["etag"]
+                else:
+                    etag = self.local_etag(file_path)
+                state[key] = {
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime,
+                    "etag": etag,
+                    "path": str(file_path),
+                }
+        return state
+
+    def sync(self, path: Path, delete_removed: bool = False) -> SyncReport:
+        """
+        Upload new and modified files concurrently and skip unchanged ones.
+
+        Args:
+            path (Path): The directory containing the files to upload.
+            delete_removed (bool): Delete the objects of the last sync that no longer exist locally. Only keys
+                recorded in the manifest are deleted, so other objects sharing the bucket are never touched.
+
+        Returns:
+            SyncReport: What was uploaded, skipped and deleted, with throughput.
+        """
+        start = time.perf_counter()
+        report = SyncReport()
+        previous = self.load_manifest()
+        local = self.scan(Path(path))
+        remote = self.remote_etags()
+        to_upload = [key for key, entry in local.items() if remote.get(key) != entry["etag"]]
+        report.skipped = len(local) - len(to_upload)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(
+                    self.s3_client.upload_file,
+                    local[key]["path"],
+                    self.bucket_name,
+                    key,
+                    Config=self.transfer_config,
+                ): key
+                for key in to_upload
+            }
+            for future in as_completed(futures):
+                key = futures[future]
+                future.result()
+                report.uploaded.append(key)
+                report.bytes_uploaded += local[key]["size"]
+
+        removed = sorted((set(previous) & set(remote)) - set(local))
+        if delete_removed and removed:
+            for i in range(0, len(removed), 1000):
+                self.s3_client.delete_objects(
+                    Bucket=self.bucket_name,
+                    Delete={"Objects": [{"Key": key} for key in removed[i : i + 1000]]},
+                )
+            report.deleted = removed
+
+        self.save_manifest(
+            {
+                key: {k: v for k, v in entry.items() if k != "path"}
+                for key, entry in local.items()
+            }
+        )
+        report.seconds = time.perf_counter() - start
+        return report
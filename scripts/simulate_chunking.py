@@ -0,0 +1,247 @@
+"""
+Compare the KnowledgeBase chunking strategies on a local corpus before paying for an ingestion run.
+Nothing is sent to AWS, token counts and semantic breakpoints are approximations.
+
+    python scripts/simulate_chunking.py --data_dir scripts/data
+    python scripts/simulate_chunking.py --strategies FIXED_SIZE --max_tokens 300 --overlap_percentage 10
+"""
+
+import argparse
+import copy
+import json
+import statistics
+from pathlib import Path
+from typing import Optional
+from pydantic import BaseModel
+from chunking import Chunk, chunk_document, count_tokens, load_documents
+from create_kb import CHUNKING_STRATEGIES
+from embedding_models import DEFAULT_EMBEDDING_MODEL, EMBEDDING_MODELS
+
+
+class ChunkingReport(BaseModel):
+    """
+    Chunk statistics and cost estimate of a strategy over a corpus
+    """
+
+    strategy: str
+    configuration: dict
+    documents: int = 0
+    source_tokens: int = 0
+    chunks: int = 0
+    embedded_tokens: int = 0
+    breakpoint_tokens: int = 0
+    chunk_tokens_mean: float = 0.0
+    chunk_tokens_p50: int = 0
+    chunk_tokens_p90: int = 0
+    chunk_tokens_max: int = 0
+    overlap_overhead: float = 0.0
+    embedding_calls: int = 0
+    embedding_cost_usd: float = 0.0
+    context_tokens_per_query: int = 0
+
+    def summary(self) -> str:
+        return (
+            f"{self.strategy}: {self.chunks} chunks from {self.documents} documents, "
+            f"{self.chunk_tokens_mean:.0f} tokens per chunk (p50 {self.chunk_tokens_p50}, "
+            f"p90 {self.chunk_tokens_p90}, max {self.chunk_tokens_max}), "
+            f"{self.overlap_overhead:.0%} overlap overhead, {self.embedding_calls} embedding calls "
+            f"costing ${self.embedding_cost_usd:.4f}, {self.context_tokens_per_query} context tokens per query"
+        )
+
+
+def percentile(values: list[int], q: int) -> int:
+    return sorted(values)[min(len(values) - 1, len(values) * q // 100)] if values else 0
+
+
+def strategy_configuration(strategy: str, args: argparse.Namespace) -> dict:
+    """
+    The CHUNKING_STRATEGIES configuration of a strategy with the parameters given on the command line applied
+    """
+    configuration = copy.deepcopy(CHUNKING_STRATEGIES[strategy])
+    overrides = {
+        "fixedSizeChunkingConfiguration": {
+            "maxTokens": args.max_tokens,
+            "overlapPercentage": args.overlap_percentage,
+        },
+        "hierarchicalChunkingConfiguration": {"overlapTokens": args.overlap_tokens},
+        "semanticChunkingConfiguration": {
+            "maxTokens": args.max_tokens,
+            "bufferSize": args.buffer_size,
+            "breakpointPercentileThreshold": args.breakpoint_percentile_threshold,
+        },
+    }
+    for key, config in configuration.items():
+        config.update(
+            {name: value for name, value in overrides[key].items() if value is not None}
+        )
+    if "hierarchicalChunkingConfiguration" in configuration:
+        levels = configuration["hierarchicalChunkingConfiguration"]["levelConfigurations"]
+        for level, value in zip(levels, (args.parent_max_tokens, args.child_max_tokens)):
+            if value is not None:
+                level["maxTokens"] = value
+    return configuration
+
+
+def simulate(
+    strategy: str,
+    configuration: dict,
+    documents: list[tuple[Path, str]],
+    number_of_results: int,
+    embedding_model: str = DEFAULT_EMBEDDING_MODEL,
+) -> ChunkingReport:
+    """
+    Chunk every document with a strategy and estimate what ingesting and querying the corpus would cost.
+
+    Args:
+        strategy (str): Name of the strategy, used in the report.
+        configuration (dict): The strategy configuration, in the CHUNKING_STRATEGIES format.
+        documents (list[tuple[Path, str]]): Path and text of every document.
+        number_of_results (int): Chunks returned per query, numberOfResults of the app.
+        embedding_model (str): One of EMBEDDING_MODELS, for the price.
+
+    Returns:
+        ChunkingReport: The statistics.
+    """
+    chunks: list[Chunk] = []
+    retrieved: list[Chunk] = []
+    breakpoint_embeddings = 0
+    report = ChunkingReport(strategy=strategy, configuration=configuration)
+    for path, text in documents:
+        result = chunk_document(text, str(path), configuration)
+        chunks.extend(result.chunks)
+        retrieved.extend(result.retrieved)
+        breakpoint_embeddings += result.breakpoint_embeddings
+        report.breakpoint_tokens += result.breakpoint_tokens
+        report.source_tokens += count_tokens(text)
+        report.documents += 1
+
+    tokens = [chunk.tokens for chunk in chunks]
+    report.chunks = len(chunks)
+    report.embedded_tokens = sum(tokens)
+    report.chunk_tokens_mean = statistics.fmean(tokens) if tokens else 0.0
+    report.chunk_tokens_p50 = percentile(tokens, 50)
+    report.chunk_tokens_p90 = percentile(tokens, 90)
+    report.chunk_tokens_max = max(tokens, default=0)
+    report.overlap_overhead = (
+        report.embedded_tokens / report.source_tokens - 1 if report.source_tokens else 0.0
+    )
+    # Semantic chunking embeds every sentence with its buffer once to find the breakpoints
+    report.embedding_calls = report.chunks + breakpoint_embeddings
+    report.embedding_cost_usd = (
+        (report.embedded_tokens + report.breakpoint_tokens)
+        / 1000
+        * EMBEDDING_MODELS[embedding_model]["price_per_1k_tokens"]
+    )
+    retrieved_tokens = [chunk.tokens for chunk in retrieved]
+    report.context_tokens_per_query = round(
+        number_of_results * statistics.fmean(retrieved_tokens) if retrieved_tokens else 0
+    )
+    return report
+
+
+def configured_number_of_results() -> int:
+    """
+    numberOfResults from the app configuration, 5 if it is not set
+    """
+    config_path = Path(__file__).parent.parent / "app" / "config.json"
+    try:
+        with open(config_path, encoding="utf-8") as f:
+            config = json.load(f)
+        return config["kb_configs"]["vectorSearchConfiguration"]["numberOfResults"]
+    except (OSError, KeyError, ValueError):
+        return 5
+
+
+def main(argv: Optional[list[str]] = None) -> list[ChunkingReport]:
+    parser = argparse.ArgumentParser(
+        description="Estimate chunk counts, embedding cost and context size of the chunking strategies locally"
+    )
+    parser.add_argument(
+        "--data_dir",
+        type=str,
+        default=str(Path(__file__).parent / "data"),
+        help="Directory with the documents of the knowledge base",
+    )
+    parser.add_argument(
+        "--strategies",
+        type=str,
+        nargs="+",
+        choices=list(CHUNKING_STRATEGIES.keys()),
+        default=list(CHUNKING_STRATEGIES.keys()),
+        help="Strategies to compare",
+    )
+    parser.add_argument(
+        "--embedding_model",
+        type=str,
+        choices=list(EMBEDDING_MODELS.keys()),
+        default=DEFAULT_EMBEDDING_MODEL,
+        help="Embedding model used for the cost estimate",
+    )
+    parser.add_argument(
+        "--number_of_results",
+        type=int,
+        default=configured_number_of_results(),
+        help="Chunks retrieved per query, defaults to numberOfResults in app/config.json",
+    )
+    parser.add_argument("--max_tokens", type=int, help="maxTokens of FIXED_SIZE and SEMANTIC")
+    parser.add_argument("--overlap_percentage", type=int, help="overlapPercentage of FIXED_SIZE")
+    parser.add_argument("--parent_max_tokens", type=int, help="Parent maxTokens of HIERARCHICAL")
+    parser.add_argument("--child_max_tokens", type=int, help="Child maxTokens of HIERARCHICAL")
+    parser.add_argument("--overlap_tokens", type=int, help="overlapTokens of HIERARCHICAL")
+    parser.add_argument("--buffer_size", type=int, help="bufferSize of SEMANTIC")
+    parser.add_argument(
+        "--breakpoint_percentile_threshold",
+        type=int,
+        help="breakpointPercentileThreshold of SEMANTIC",
+    )
+    parser.add_argument("--output", type=str, help="Write the reports as JSON to this file")
+    args = parser.parse_args(argv)
+
+    documents = list(load_documents(Path(args.data_dir)))
+    if not documents:
+        print(f"No readable documents found in {args.data_dir}")
+        return []
+    print(
+        f"Simulating {len(documents)} documents, {args.number_of_results} results per query, "
+        f"prices of {args.embedding_model}"
+    )
+
+    reports = []
+    for strategy in args.strategies:
+        report = simulate(
+            strategy,
+            strategy_configuration(strategy, args),
+            documents,
+            args.number_of_results,
+            args.embedding_model,
+        )
+        print(report.summary())
+        reports.append(report)
+
+    columns = [
+        "strategy",
+        "chunks",
+        "chunk_tokens_mean",
+        "chunk_tokens_p90",
+        "overlap_overhead",
+        "embedding_calls",
+        "embedding_cost_usd",
+        "context_tokens_per_query",
+    ]
+    print("\n" + " | ".join(f"{c:>24}" for c in columns))
+    for report in reports:
+        values = report.model_dump()
+        print(
+            " | ".join(
+                f"{values[c]:>24.4f}" if isinstance(values[c], float) else f"{values[c]:>24}"
+                for c in columns
+            )
+        )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump([report.model_dump() for report in reports], f, indent=4)
+    return reports
+
+
+if __name__ == "__main__":
+    main()
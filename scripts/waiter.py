@@ -0,0 +1,98 @@
+"""
+Readiness polling with exponential backoff, used instead of fixed sleeps while provisioning
+"""
+
+import random
+import time
+from typing import Callable
+
+
+class WaitTimeoutException(Exception):
+    """
+    Thrown when a resource does not become ready before the deadline
+    """
+
+    pass
+
+
+class Waiter:
+    """
+    Polls readiness probes with exponential backoff and jitter, and keeps track of how long every step waited
+    Args:
+        initial_delay (float): seconds to wait after the first failed probe
+        max_delay (float): upper bound for the delay between two probes
+        backoff (float): factor the delay grows by after every failed probe
+        jitter (float): fraction of the delay that is randomized to spread out concurrent pollers
+    """
+
+    def __init__(
+        self,
+        initial_delay: float = 1.0,
+        max_delay: float = 20.0,
+        backoff: float = 2.0,
+        jitter: float = 0.3,
+    ) -> None:
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.jitter = jitter
+        self.timings: dict[str, float] = {}
+
+    def wait(
+        self,
+        name: str,
+        probe: Callable[[], bool],
+        timeout: float = 600,
+        retry_on: tuple[type[Exception], ...] = (),
+    ) -> float:
+        """
+        Call the probe until it returns True or the deadline expires.
+
+        Args:
+            name (str): Name of the step, used in progress output and the timing report.
+            probe (Callable[[], bool]): Returns True once the resource is ready. It may raise to abort waiting.
+            timeout (float): Overall deadline in seconds.
+            retry_on (tuple[type[Exception], ...]): Exceptions raised by the probe that mean "not ready yet",
+                the last one is the cause of the timeout.
+
+        Returns:
+            float: The number of seconds waited.
+        """
+        start = time.perf_counter()
+        deadline = start + timeout
+        delay = self.initial_delay
+        attempt = 0
+        last_error = None
+        while True:
+            attempt += 1
+            try:
+                ready = probe()
+            except retry_on as e:
+                print(f"{name}: not ready yet ({type(e).__name__})")
+                last_error = e
+                ready = False
+            if ready:
+                break
+            now = time.perf_counter()
+            if now >= deadline:
+                self.timings[name] = now - start
+                raise WaitTimeoutException(
+                    f"{name} was not ready after {timeout}s ({attempt} probes)"
+                ) from last_error
+            sleep = min(delay, self.max_delay)
+            sleep += random.uniform(-self.jitter, self.jitter) * sleep
+            time.sleep(max(0.0, min(sleep, deadline - now)))
+            delay *= self.backoff
+
+        waited = time.perf_counter() - start
+        self.timings[name] = waited
+        print(f"{name}: ready after {waited:.1f}s ({attempt} probes)")
+        return waited
+
+    def report(self) -> str:
+        """
+        Summary of how long every step waited
+        """
+        lines = [f"  {name:<40} {seconds:7.1f}s" for name, seconds in self.timings.items()]
+        lines.append(f"  {'total':<40} {sum(self.timings.values()):7.1f}s")
+        return "Time spent waiting for resources:\n" + "\n".join(lines)
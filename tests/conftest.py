@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# The app and the scripts are run from their own directories and import their modules from there
+ROOT = Path(__file__).parent.parent
+sys.path[:0] = [str(ROOT / "app"), str(ROOT / "scripts")]
@@ -0,0 +1,114 @@
+import json
+import pytest
+from batch_qa import BatchRunner, Question
+from utils.batch_inference import MIN_RECORDS_PER_JOB, BatchInferenceClient, BatchRecord, native_model_input, split_records
+from utils.local_bedrock import LocalBedrockBatchClient, LocalS3Client
+
+NOVA = "amazon.nova-pro-v1:0"
+CLAUDE = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+
+
+def message(*blocks):
+    return [{"role": "user", "content": [{"text": "Summarize the attachment"}, *blocks]}]
+
+
+def document(fmt, data):
+    return {"document": {"format": fmt, "name": "orderset", "source": {"bytes": data}}}
+
+
+def test_documents_are_rendered_for_nova_and_anthropic():
+    nova = native_model_input(NOVA, {}, message(document("docx", b"PK")))
+    assert nova["messages"][0]["content"][1] == {"document": {"format": "docx", "name": "orderset", "source": {"bytes": "UEs="}}}
+
+    claude = native_model_input(CLAUDE, {}, message(document("txt", b"Aspirin 81 mg"), document("pdf", b"%PDF")))
+    assert claude["messages"][0]["content"][1] == {"type": "text", "text": "Document orderset:\nAspirin 81 mg"}
+    assert claude["messages"][0]["content"][2]["type"] == "document"
+
+
+def test_documents_anthropic_cannot_read_raise():
+    with pytest.raises(ValueError, match="docx"):
+        native_model_input(CLAUDE, {}, message(document("docx", b"PK")))
+
+
+def test_batch_run_on_the_local_stand_in(tmp_path):
+    (tmp_path / "orderset.txt").write_text("Aspirin 81 mg daily")
+    (tmp_path / "orderset.docx").write_bytes(b"PK\x03\x04")
+    questions = [
+        Question(id="q1", prompt="What dose?", attachments=[str(tmp_path / "orderset.txt")]),
+        Question(id="q2", prompt="What dose?", attachments=[str(tmp_path / "orderset.docx")]),
+    ]
+    s3_client = LocalS3Client(str(tmp_path / "local"))
+    batch_client = BatchInferenceClient(LocalBedrockBatchClient(s3_client), s3_client, "local", "local")
+    runner = BatchRunner("N. Virginia", ["Amazon Nova Pro", "Anthropic Claude 3.5 Sonnet"])
+    output = tmp_path / "answers.jsonl"
+
+    summaries = runner.run_batch(questions, str(output), batch_client, poll_interval=0)
+
+    answers = {(a["id"], a["model"]): a for a in map(json.loads, output.read_text().splitlines())}
+    assert len(answers) == 4
+    assert answers[("q2", "Anthropic Claude 3.5 Sonnet")]["error"].startswith("Cannot render the batch record")
+    assert all(a["answer"].startswith("Local answer") for key, a in answers.items() if not a["error"])
+    assert {s.model: s.errors for s in summaries} == {"Amazon Nova Pro": 0, "Anthropic Claude 3.5 Sonnet": 1}
+    # the documents reached the records
+    inputs = [
+        json.loads(line)
+        for path in (tmp_path / "local" / "local").rglob("input/*.jsonl")
+        for line in path.read_text().splitlines()
+    ]
+    rendered = json.dumps([record["modelInput"] for record in inputs])
+    assert "Aspirin 81 mg daily" in rendered and '"format": "docx"' in rendered
+    assert not (tmp_path / "answers.jsonl.jobs.json").exists()
+
+
+class EndingBatchClient(LocalBedrockBatchClient):
+    """Jobs end with status and only write output for the first kept records, like a failed or partial job"""
+
+    def __init__(self, s3_client, status, kept):
+        super().__init__(s3_client)
+        self.status = status
+        self.kept = kept
+
+    def create_model_invocation_job(self, jobName, roleArn, modelId, inputDataConfig, outputDataConfig, **kwargs):
+        response = super().create_model_invocation_job(
+            jobName, roleArn, modelId, inputDataConfig, outputDataConfig, **kwargs
+        )
+        for path in (self.s3_client.directory / "local").rglob("*.jsonl.out"):
+            path.write_text("\n".join(path.read_text().splitlines()[:self.kept]))
+        return response
+
+    def get_model_invocation_job(self, jobIdentifier):
+        return {**super().get_model_invocation_job(jobIdentifier), "status": self.status, "message": "Quota exceeded"}
+
+
+@pytest.mark.parametrize("status, kept", [("Failed", 0), ("PartiallyCompleted", 2)])
+def test_records_without_output_are_written_as_errors(tmp_path, status, kept):
+    questions = [Question(id=f"q{i}", prompt="What dose?") for i in range(3)]
+    s3_client = LocalS3Client(str(tmp_path / "local"))
+    batch_client = BatchInferenceClient(EndingBatchClient(s3_client, status, kept), s3_client, "local", "local")
+    runner = BatchRunner("N. Virginia", ["Amazon Nova Pro"])
+    output = tmp_path / "answers.jsonl"
+
+    summaries = runner.run_batch(questions, str(output), batch_client, poll_interval=0)
+
+    answers = {a["id"]: a for a in map(json.loads, output.read_text().splitlines())}
+    assert set(answers) == {"q0", "q1", "q2"}
+    errors = [a["error"] for a in answers.values() if a["error"]]
+    assert len(errors) == 3 - kept
+    assert all(f"ended {status}: Quota exceeded" in error for error in errors)
+    assert (summaries[0].answered, summaries[0].errors) == (kept, 3 - kept)
+    assert not (tmp_path / "answers.jsonl.jobs.json").exists()
+
+
+@pytest.mark.parametrize("count, sizes", [
+    (50000, [50000]),
+    (50050, [25025, 25025]),
+    (100001, [33334, 33334, 33333]),
+])
+def test_records_are_spread_evenly_over_the_jobs(count, sizes):
+    records = [BatchRecord(record_id=str(i), model_input={}) for i in range(count)]
+
+    parts = split_records(records)
+
+    assert [len(part) for part in parts] == sizes
+    assert [record for part in parts for record in part] == records
+    assert min(sizes) >= MIN_RECORDS_PER_JOB
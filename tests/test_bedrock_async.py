@@ -0,0 +1,70 @@
+import asyncio
+from utils.bedrock import BedrockHandler
+from utils.bedrock_async import AsyncBedrockHandler
+from utils.response_cache import ResponseCache
+
+MODEL_ID = "amazon.nova-lite-v1:0"
+MESSAGES = [BedrockHandler.user_message("What is a knowledge base?")]
+
+
+class FakeAsyncRuntime:
+    """The converse calls of an aiobotocore bedrock-runtime client"""
+
+    def __init__(self):
+        self.requests = []
+
+    async def converse(self, **request):
+        self.requests.append(request)
+        return {
+            "output": {"message": {"role": "assistant", "content": [{"text": "An index of documents."}]}},
+            "stopReason": "end_turn",
+            "usage": {"inputTokens": 5, "outputTokens": 4},
+        }
+
+    async def converse_stream(self, **request):
+        self.requests.append(request)
+
+        async def stream():
+            yield {"messageStart": {"role": "assistant"}}
+            for text in ("An index", " of documents."):
+                yield {"contentBlockDelta": {"contentBlockIndex": 0, "delta": {"text": text}}}
+            yield {"messageStop": {"stopReason": "end_turn"}}
+            yield {"metadata": {"usage": {"inputTokens": 5, "outputTokens": 4}}}
+
+        return {"stream": stream()}
+
+
+async def collect(events):
+    return [event async for event in events]
+
+
+def test_requests_are_built_like_the_sync_handler(tmp_path):
+    client = FakeAsyncRuntime()
+    handler = AsyncBedrockHandler(client, MODEL_ID, {"temperature": 0.0})
+
+    asyncio.run(handler.converse(MESSAGES))
+    assert client.requests == [BedrockHandler(None, MODEL_ID, {"temperature": 0.0}).converse_request(MESSAGES)]
+
+
+def test_converse_is_served_from_the_response_cache(tmp_path):
+    client = FakeAsyncRuntime()
+    handler = AsyncBedrockHandler(client, MODEL_ID, {}, cache=ResponseCache(str(tmp_path), 1024 * 1024, 3600))
+
+    first = asyncio.run(handler.converse(MESSAGES))
+    second = asyncio.run(handler.converse(MESSAGES))
+    assert "cached" not in first and "cached" in second
+    assert len(client.requests) == 1
+
+
+def test_streamed_answer_is_cached_and_replayed(tmp_path):
+    client = FakeAsyncRuntime()
+    handler = AsyncBedrockHandler(client, MODEL_ID, {}, cache=ResponseCache(str(tmp_path), 1024 * 1024, 3600))
+
+    asyncio.run(collect(handler.converse_stream(MESSAGES)))
+    replayed = asyncio.run(collect(handler.converse_stream(MESSAGES)))
+    text = "".join(e["contentBlockDelta"]["delta"]["text"] for e in replayed if "contentBlockDelta" in e)
+    assert text == "An index of documents."
+    assert "cached" in replayed[-1]["metadata"]
+    assert len(client.requests) == 1
+    # the single response shares the cache entry of the stream
+    assert asyncio.run(handler.converse(MESSAGES))["output"]["message"]["content"][0]["text"] == text
@@ -0,0 +1,94 @@
+import json
+from opensearchpy import OpenSearch
+from bulk_ingest import RUN_ID_FIELD, SOURCE_URI_FIELD, BulkIngestor
+from create_kb import CHUNKING_STRATEGIES
+from embedders import FakeEmbedder
+
+
+class FakeIndices:
+    def exists(self, index):
+        return True
+
+    def refresh(self, index):
+        pass
+
+
+class FakeOpenSearch(OpenSearch):
+    """The _bulk and _delete_by_query calls of an index, documents with text containing reject fail to index"""
+
+    def __init__(self):
+        # never connects, only the serializer of the transport is used by the bulk helpers
+        super().__init__(hosts=[{"host": "localhost", "port": 9200}])
+        self.indices = FakeIndices()
+        self.docs = {}
+        self.reject = None
+
+    def bulk(self, body, **kwargs):
+        lines = body.strip().split("\n")
+        items = []
+        for action, source in zip(lines[::2], lines[1::2]):
+            meta, doc = json.loads(action)["index"], json.loads(source)
+            if self.reject and self.reject in doc["text"]:
+                items.append({"index": {"_id": meta["_id"], "status": 400, "error": "rejected"}})
+                continue
+            self.docs[meta["_id"]] = doc
+            items.append({"index": {"_id": meta["_id"], "status": 201}})
+        return {"errors": any(item["index"]["status"] >= 300 for item in items), "items": items}
+
+    def delete_by_query(self, index, body, params):
+        query = body["query"]["bool"]
+        sources = query["filter"][0]["terms"][f"{SOURCE_URI_FIELD}.keyword"]
+        keep = query["must_not"][0]["term"][f"{RUN_ID_FIELD}.keyword"]
+        stale = [
+            doc_id for doc_id, doc in self.docs.items()
+            if doc[SOURCE_URI_FIELD] in sources and doc.get(RUN_ID_FIELD) != keep
+        ]
+        for doc_id in stale:
+            del self.docs[doc_id]
+        return {"deleted": len(stale)}
+
+    def texts(self, source_uri):
+        return sorted(doc["text"] for doc in self.docs.values() if doc[SOURCE_URI_FIELD] == source_uri)
+
+
+def ingestor(client):
+    return BulkIngestor(
+        client,
+        "local-kb",
+        FakeEmbedder(16, "FLOAT32"),
+        CHUNKING_STRATEGIES["FIXED_SIZE"],
+        source_uri_prefix="file://",
+        chunk_processes=1,
+    )
+
+
+def test_replace_deletes_previous_chunks_after_the_new_ones_are_indexed(tmp_path):
+    (tmp_path / "a.txt").write_text("The first version of a.")
+    (tmp_path / "b.txt").write_text("The first version of b.")
+    client = FakeOpenSearch()
+    ingestor(client).ingest(tmp_path)
+
+    (tmp_path / "a.txt").write_text("The second version of a.")
+    report = ingestor(client).ingest(tmp_path)
+
+    assert report.indexed == 2
+    assert report.replaced == 2
+    assert client.texts("file://a.txt") == ["The second version of a."]
+    assert client.texts("file://b.txt") == ["The first version of b."]
+
+
+def test_documents_that_failed_to_index_keep_their_previous_chunks(tmp_path):
+    (tmp_path / "a.txt").write_text("The first version of a.")
+    (tmp_path / "b.txt").write_text("The first version of b.")
+    client = FakeOpenSearch()
+    ingestor(client).ingest(tmp_path)
+
+    (tmp_path / "a.txt").write_text("The broken version of a.")
+    (tmp_path / "b.txt").write_text("The second version of b.")
+    client.reject = "broken"
+    report = ingestor(client).ingest(tmp_path)
+
+    assert report.failed == 1
+    assert report.failed_sources == {"file://a.txt"}
+    assert client.texts("file://a.txt") == ["The first version of a."]
+    assert client.texts("file://b.txt") == ["The second version of b."]
@@ -0,0 +1,86 @@
+import pytest
+from botocore.exceptions import ClientError
+from utils.bedrock import BedrockHandler, KBHandler
+from utils.chat import ChatPipeline, InMemoryConversationStore
+from utils.usage import UsageLedger
+
+
+class ThrottledRuntime:
+    def converse(self, **request):
+        raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "Too many requests"}}, "Converse")
+
+
+def test_respond_raises_converse_errors_without_recording_an_answer():
+    pipeline = ChatPipeline(
+        BedrockHandler(ThrottledRuntime(), "amazon.nova-lite-v1:0", {}),
+        KBHandler(None, {}),
+        InMemoryConversationStore(),
+    )
+    pipeline.add_user_message("s1", "Hello")
+
+    with pytest.raises(ClientError):
+        pipeline.respond("s1")
+    assert [m["role"] for m in pipeline.store.get("s1")] == ["user"]
+
+    pipeline.discard_user_message("s1")
+    assert pipeline.store.get("s1") == []
+
+
+class FakeAgentRuntime:
+    """retrieve_and_generate_stream of a bedrock-agent-runtime client, failing when fail is set"""
+
+    meta = type("Meta", (), {"region_name": "us-east-1"})()
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.requests = []
+
+    def retrieve_and_generate_stream(self, **request):
+        self.requests.append(request)
+        if self.fail:
+            raise ClientError({"Error": {"Code": "ValidationException", "Message": "Invalid model"}}, "RetrieveAndGenerateStream")
+        reference = {"content": {"text": "Aspirin 81 mg daily"}, "location": {"type": "S3"}}
+        return {
+            "sessionId": "kb-session",
+            "stream": [
+                {"output": {"text": "Take 81 mg"}},
+                {"citation": {"citation": {"retrievedReferences": [reference]}}},
+                {"output": {"text": " daily."}},
+            ],
+        }
+
+
+def rag_pipeline(client, ledger=None):
+    return ChatPipeline(
+        BedrockHandler(None, "anthropic.claude-3-7-sonnet-20250219-v1:0", {}),
+        KBHandler(client, {}, kb_id="kb", mode="retrieve_and_generate"),
+        InMemoryConversationStore(),
+        ledger,
+    )
+
+
+def test_retrieve_and_generate_records_the_turn_and_estimated_usage(monkeypatch):
+    monkeypatch.setattr("utils.bedrock.caller_account_id", lambda region_name: "123456789012")
+    client = FakeAgentRuntime()
+    pipeline = rag_pipeline(client, UsageLedger(None, {}))
+
+    events = list(pipeline.stream_retrieve_and_generate(
+        "s1", "What dose?", model_id="us.anthropic.claude-3-7-sonnet-20250219-v1:0"
+    ))
+
+    model_arn = client.requests[0]["retrieveAndGenerateConfiguration"]["knowledgeBaseConfiguration"]["modelArn"]
+    assert model_arn == (
+        "arn:aws:bedrock:us-east-1:123456789012:inference-profile/us.anthropic.claude-3-7-sonnet-20250219-v1:0"
+    )
+    assert [m["role"] for m in pipeline.store.get("s1")] == ["user", "assistant"]
+    usage = events[-1]["data"]["usage"]
+    assert usage["inputTokens"] > 0 and usage["outputTokens"] > 0
+    assert pipeline.ledger.session_total("s1").input_tokens == usage["inputTokens"]
+
+
+def test_failed_retrieve_and_generate_leaves_the_conversation_unchanged():
+    pipeline = rag_pipeline(FakeAgentRuntime(fail=True))
+
+    with pytest.raises(ClientError):
+        list(pipeline.stream_retrieve_and_generate("s1", "What dose?"))
+    assert pipeline.store.get("s1") == []
@@ -0,0 +1,141 @@
+import pytest
+from botocore.exceptions import ClientError
+from create_kb import CreateKB
+from provisioning import ProvisioningException, ProvisioningExecutor, Step
+
+
+def already_exists(code, operation):
+    return ClientError({"Error": {"Code": code, "Message": "already exists"}}, operation)
+
+
+class FakeSTS:
+    def get_caller_identity(self):
+        return {"Account": "123456789012", "Arn": "arn:aws:iam::123456789012:user/dev"}
+
+
+class FakeIAM:
+    """IAM that crashes once, on creating the policy named in fail_on"""
+
+    def __init__(self, fail_on):
+        self.fail_on = fail_on
+        self.policies, self.roles, self.attached = {}, {}, set()
+
+    def create_policy(self, PolicyName, PolicyDocument, Description):
+        if PolicyName == self.fail_on:
+            self.fail_on = None
+            raise ConnectionError("Connection reset by peer")
+        arn = f"arn:aws:iam::123456789012:policy/{PolicyName}"
+        if arn in self.policies:
+            raise already_exists("EntityAlreadyExists", "CreatePolicy")
+        self.policies[arn] = PolicyName
+        return {"Policy": {"PolicyName": PolicyName, "Arn": arn}}
+
+    def get_policy(self, PolicyArn):
+        return {"Policy": {"PolicyName": self.policies[PolicyArn], "Arn": PolicyArn}}
+
+    def create_role(self, RoleName, **kwargs):
+        if RoleName in self.roles:
+            raise already_exists("EntityAlreadyExists", "CreateRole")
+        self.roles[RoleName] = {"RoleName": RoleName, "Arn": f"arn:aws:iam::123456789012:role/{RoleName}"}
+        return {"Role": self.roles[RoleName]}
+
+    def get_role(self, RoleName):
+        return {"Role": self.roles[RoleName]}
+
+    def attach_role_policy(self, RoleName, PolicyArn):
+        self.attached.add((RoleName, PolicyArn))
+
+
+class FakeAOSS:
+    """OpenSearch Serverless that crashes once, on creating the policy type named in fail_on"""
+
+    def __init__(self, fail_on):
+        self.fail_on = fail_on
+        self.policies = {}
+
+    def create_security_policy(self, name, policy, type):
+        if type == self.fail_on:
+            self.fail_on = None
+            raise ConnectionError("Connection reset by peer")
+        if (type, name) in self.policies:
+            raise already_exists("ConflictException", "CreateSecurityPolicy")
+        self.policies[(type, name)] = policy
+        return {"securityPolicyDetail": {"name": name, "type": type}}
+
+    def get_security_policy(self, name, type):
+        return {"securityPolicyDetail": {"name": name, "type": type}}
+
+
+@pytest.fixture
+def kb(monkeypatch):
+    monkeypatch.setattr("knowledge_bases_roles.boto3.client", lambda service, **kwargs: FakeSTS())
+    return CreateKB("us-east-1", "bucket", "index", "kb", "store")
+
+
+def resume(steps, kb):
+    with pytest.raises(ProvisioningException):
+        ProvisioningExecutor(steps, kb.kb_info.completed_steps, checkpoint=lambda: None).run()
+    assert kb.kb_info.completed_steps == []
+    ProvisioningExecutor(steps, kb.kb_info.completed_steps, checkpoint=lambda: None).run()
+    assert kb.kb_info.completed_steps == [step.name for step in steps]
+
+
+def test_execution_role_step_resumes_after_failing_between_its_policies(kb):
+    iam = FakeIAM(fail_on=kb.kb_roles.s3_policy_name)
+    kb.kb_roles.iam_client = iam
+
+    resume([Step("execution_role", kb.create_execution_role)], kb)
+
+    role_name = kb.kb_roles.bedrock_execution_role_name
+    assert kb.kb_info.bedrock_execution_role_arn == f"arn:aws:iam::123456789012:role/{role_name}"
+    assert {arn for _, arn in iam.attached} == set(iam.policies)
+    assert len(iam.policies) == 2
+
+
+def test_security_policies_step_resumes_after_failing_between_its_policies(kb):
+    aoss = FakeAOSS(fail_on="network")
+
+    resume([Step("oss_security_policies", lambda: kb.create_security_policies(aoss))], kb)
+
+    assert kb.kb_info.encryption_policy_name == f"bedrock-sample-rag-sp-{kb.kb_roles.suffix}"
+    assert kb.kb_info.network_policy_name == f"bedrock-sample-rag-np-{kb.kb_roles.suffix}"
+    assert {type for type, _ in aoss.policies} == {"encryption", "network"}
+
+
+class ValidationException(ClientError):
+    pass
+
+
+class FakeBedrockAgent:
+    """Rejects the execution role until it has propagated, after role_propagation_attempts calls"""
+
+    exceptions = type("Exceptions", (), {"ValidationException": ValidationException})
+
+    def __init__(self, role_propagation_attempts):
+        self.role_propagation_attempts = role_propagation_attempts
+        self.create_calls = 0
+
+    def create_knowledge_base(self, **request):
+        self.create_calls += 1
+        if self.create_calls <= self.role_propagation_attempts:
+            raise ValidationException(
+                {"Error": {"Code": "ValidationException", "Message": "Unable to assume role"}}, "CreateKnowledgeBase"
+            )
+        return {"knowledgeBase": {"knowledgeBaseId": "KB123", "status": "CREATING"}}
+
+    def get_knowledge_base(self, knowledgeBaseId):
+        return {"knowledgeBase": {"knowledgeBaseId": knowledgeBaseId, "status": "ACTIVE"}}
+
+    def create_data_source(self, **request):
+        return {"dataSource": {"dataSourceId": "DS123"}}
+
+
+def test_knowledge_base_creation_waits_for_the_execution_role(kb, monkeypatch):
+    monkeypatch.setattr("waiter.time.sleep", lambda seconds: None)
+    agent = FakeBedrockAgent(role_propagation_attempts=10)
+
+    knowledge_base, _ = kb.create_knowledge_base(agent, "FIXED_SIZE")
+
+    assert agent.create_calls == 11
+    assert knowledge_base["knowledgeBaseId"] == kb.kb_info.kb_id == "KB123"
+    assert kb.kb_info.ds_ids == ["DS123"]
@@ -0,0 +1,202 @@
+from botocore.exceptions import ClientError
+from opensearchpy import ConnectionError
+from delete_kb import delete_bucket, teardown_steps
+from knowledge_bases_roles import KBInfo
+from provisioning import ProvisioningExecutor
+from waiter import Waiter
+
+
+class FakeAOSS:
+    def __init__(self, collections):
+        self.collections = collections
+        self.deleted = []
+
+    def batch_get_collection(self, ids):
+        return {"collectionDetails": [{"id": i} for i in ids if i in self.collections]}
+
+    def delete_collection(self, id):
+        self.deleted.append(("collection", id))
+
+    def delete_access_policy(self, type, name):
+        self.deleted.append((type, name))
+
+    def delete_security_policy(self, type, name):
+        self.deleted.append((type, name))
+
+
+class UnreachableIndices:
+    def delete(self, index):
+        raise ConnectionError("N/A", "Name or service not known", None)
+
+
+class FakeRoles:
+    def __init__(self):
+        self.os_clients = 0
+
+    def create_os_client(self, collection_id):
+        self.os_clients += 1
+        client = type("Client", (), {})()
+        client.indices = UnreachableIndices()
+        return client
+
+    def delete_iam_role_and_policies(self):
+        pass
+
+
+KB_INFO = KBInfo(
+    index_name="index",
+    collection_id="abc",
+    access_policy_name="access",
+    network_policy_name="network",
+    encryption_policy_name="encryption",
+)
+
+
+def teardown(aoss, roles):
+    executor = ProvisioningExecutor(
+        teardown_steps(KB_INFO, roles, None, aoss, None), completed=[], checkpoint=lambda: None
+    )
+    executor.run()
+    return executor
+
+
+def test_rerun_after_collection_was_deleted_still_deletes_policies():
+    aoss, roles = FakeAOSS(collections=[]), FakeRoles()
+    executor = teardown(aoss, roles)
+
+    assert roles.os_clients == 0
+    assert set(executor.steps) == set(executor.completed)
+    assert {"data", "network", "encryption"} <= {kind for kind, _ in aoss.deleted}
+
+
+def test_unreachable_index_does_not_block_the_collection_and_policies():
+    aoss, roles = FakeAOSS(collections=["abc"]), FakeRoles()
+    executor = teardown(aoss, roles)
+
+    assert roles.os_clients == 1
+    assert set(executor.steps) == set(executor.completed)
+    assert ("collection", "abc") in aoss.deleted
+
+
+def not_found(operation):
+    return ClientError({"Error": {"Code": "ResourceNotFoundException", "Message": "not found"}}, operation)
+
+
+class FakeBedrockAgent:
+    """Knowledge bases and data sources stay DELETING for a few get calls after their delete"""
+
+    def __init__(self, events, deleting_polls=2):
+        self.events = events
+        self.deleting_polls = deleting_polls
+        self.polls = {}
+
+    def delete_data_source(self, dataSourceId, knowledgeBaseId):
+        self.polls[dataSourceId] = 0
+
+    def delete_knowledge_base(self, knowledgeBaseId):
+        self.polls[knowledgeBaseId] = 0
+
+    def _get(self, resource_id, key, operation):
+        self.polls[resource_id] += 1
+        if self.polls[resource_id] > self.deleting_polls:
+            self.events.append(f"{resource_id} gone")
+            raise not_found(operation)
+        return {key: {"status": "DELETING"}}
+
+    def get_data_source(self, dataSourceId, knowledgeBaseId):
+        return self._get(dataSourceId, "dataSource", "GetDataSource")
+
+    def get_knowledge_base(self, knowledgeBaseId):
+        return self._get(knowledgeBaseId, "knowledgeBase", "GetKnowledgeBase")
+
+
+class RecordingIndices:
+    def __init__(self, events):
+        self.events = events
+
+    def delete(self, index):
+        self.events.append("index deleted")
+
+
+class RecordingRoles(FakeRoles):
+    def __init__(self, events):
+        super().__init__()
+        self.events = events
+
+    def create_os_client(self, collection_id):
+        client = type("Client", (), {})()
+        client.indices = RecordingIndices(self.events)
+        return client
+
+    def delete_iam_role_and_policies(self):
+        self.events.append("iam deleted")
+
+
+def test_index_and_role_outlive_the_knowledge_base_deletion():
+    events = []
+    kb_info = KB_INFO.model_copy(
+        update={"kb_id": "KB", "ds_ids": ["DS1", "DS2"], "data_source_prefixes": ["shard-00/", "shard-01/"]}
+    )
+    steps = teardown_steps(
+        kb_info,
+        RecordingRoles(events),
+        FakeBedrockAgent(events),
+        FakeAOSS(collections=["abc"]),
+        None,
+        waiter=Waiter(initial_delay=0, jitter=0),
+    )
+    ProvisioningExecutor(steps, completed=[], checkpoint=lambda: None).run()
+
+    assert events.index("DS1 gone") < events.index("KB gone")
+    assert events.index("DS2 gone") < events.index("KB gone")
+    assert events.index("KB gone") < events.index("index deleted")
+    assert events.index("KB gone") < events.index("iam deleted")
+
+
+class FakeS3:
+    def __init__(self, keys):
+        self.versions = {key: ["v1", "v2"] for key in keys}
+        self.bucket_deleted = False
+
+    def get_paginator(self, operation):
+        s3 = self
+
+        class Paginator:
+            def paginate(self, Bucket, MaxKeys):
+                yield {
+                    "Versions": [
+                        {"Key": key, "VersionId": version}
+                        for key, versions in s3.versions.items()
+                        for version in versions
+                    ]
+                }
+
+        return Paginator()
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete["Objects"]:
+            self.versions[obj["Key"]].remove(obj["VersionId"])
+            if not self.versions[obj["Key"]]:
+                del self.versions[obj["Key"]]
+        return {}
+
+    def delete_bucket(self, Bucket):
+        self.bucket_deleted = True
+
+
+def test_shared_bucket_keeps_the_objects_of_other_knowledge_bases():
+    s3 = FakeS3(["mine/a.pdf", "mine/b.pdf", "theirs/c.pdf"])
+
+    delete_bucket("shared", {"mine/a.pdf", "mine/b.pdf"}, s3)
+
+    assert list(s3.versions) == ["theirs/c.pdf"]
+    assert not s3.bucket_deleted
+
+
+def test_bucket_is_deleted_once_only_our_objects_were_in_it():
+    s3 = FakeS3(["mine/a.pdf", "mine/b.pdf"])
+
+    delete_bucket("shared", {"mine/a.pdf", "mine/b.pdf"}, s3)
+
+    assert s3.versions == {}
+    assert s3.bucket_deleted
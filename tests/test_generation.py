@@ -0,0 +1,113 @@
+import threading
+import time
+import pytest
+from utils.bedrock import BedrockHandler, KBHandler
+from utils.chat import NO_ANSWER, ChatPipeline, InMemoryConversationStore
+from utils.generation import Generation, GenerationRegistry
+from utils.usage import UsageLedger
+
+WORDS = [f"word{i} " for i in range(50)]
+
+
+class StreamingRuntime:
+    """converse_stream of a bedrock-runtime client, a delta every delay seconds"""
+
+    def __init__(self, words, delay=0.02):
+        self.words = words
+        self.delay = delay
+
+    def converse_stream(self, **request):
+        def stream():
+            yield {"messageStart": {"role": "assistant"}}
+            for word in self.words:
+                time.sleep(self.delay)
+                yield {"contentBlockDelta": {"contentBlockIndex": 0, "delta": {"text": word}}}
+            yield {"messageStop": {"stopReason": "end_turn"}}
+            yield {"metadata": {"usage": {"inputTokens": 10, "outputTokens": len(self.words)}}}
+
+        return {"stream": stream()}
+
+
+def pipeline(words):
+    chat = ChatPipeline(
+        BedrockHandler(StreamingRuntime(words), "amazon.nova-lite-v1:0", {}),
+        KBHandler(None, {}),
+        InMemoryConversationStore(),
+        UsageLedger(None, {}),
+    )
+    chat.add_user_message("s1", "Tell me a long story")
+    return chat
+
+
+def test_cancel_mid_stream_records_the_partial_answer_and_estimated_usage():
+    chat = pipeline(WORDS)
+    generation = Generation("s1", lambda cancel: chat.respond_stream("s1", cancel))
+
+    done = None
+    for event in generation.events():
+        if event["event"] == "delta" and generation.text.count("word") == 2:
+            generation.cancel()
+        if event["event"] == "done":
+            done = event["data"]
+
+    assert done["stopped"]
+    answer = chat.store.get("s1")[-1]["content"][0]["text"]
+    assert answer == done["text"] == generation.text
+    assert 2 <= answer.count("word") < len(WORDS)
+    total = chat.ledger.session_total("s1")
+    assert total.input_tokens > 0 and 0 < total.output_tokens < len(WORDS)
+
+
+def test_stream_without_text_records_a_placeholder_answer():
+    chat = pipeline([])
+
+    events = list(chat.respond_stream("s1"))
+
+    assert events[-1]["event"] == "done"
+    assert [m["role"] for m in chat.store.get("s1")] == ["user", "assistant"]
+    assert chat.store.get("s1")[-1]["content"] == [{"text": NO_ANSWER}]
+
+
+def test_worker_errors_are_raised_to_the_consumer():
+    def start(cancel):
+        yield {"event": "delta", "data": {"text": "Hi"}}
+        raise RuntimeError("stream broke")
+
+    generation = Generation("s1", start)
+    with pytest.raises(RuntimeError, match="stream broke"):
+        list(generation.events())
+    assert generation.text == "Hi"
+
+
+def until_cancelled(cancel):
+    while not cancel.cancelled:
+        time.sleep(0.01)
+    yield {"event": "done", "data": {"stopped": True}}
+
+
+def test_reap_stops_abandoned_generations_and_forgets_finished_ones():
+    registry = GenerationRegistry(abandon_after=60, reap_interval=3600)
+    abandoned = registry.start("gone", until_cancelled)
+    watched = registry.start("active", until_cancelled)
+    abandoned.polled_at -= 120
+
+    registry.reap()
+    assert abandoned.token.cancelled and not watched.token.cancelled
+    abandoned.finished.wait(1)
+    registry.reap()
+    assert set(registry.generations) == {"active"}
+
+    watched.cancel()
+    list(watched.events())
+    registry.reap()
+    assert registry.generations == {}
+
+
+def test_starting_a_new_answer_stops_the_running_one():
+    registry = GenerationRegistry(reap_interval=3600)
+    first = registry.start("s1", until_cancelled)
+    second = registry.start("s1", until_cancelled)
+
+    assert first.token.cancelled
+    assert registry.get("s1") is second
+    second.cancel()
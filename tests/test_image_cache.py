@@ -0,0 +1,95 @@
+import os
+import time
+import boto3
+import pytest
+from prewarm_image_cache import MODEL_NAME, configs, prewarm
+from utils.bedrock import BedrockHandler, KBHandler
+from utils.chat import ChatPipeline, InMemoryConversationStore
+from utils.image_cache import ImageCache
+from utils.local_bedrock import LocalBedrockEndpoint
+from utils.model_capabilities import CapabilityRegistry
+
+PROMPT = "A smiling nurse greeting a patient in a bright modern clinic lobby, photorealistic"
+
+
+@pytest.fixture
+def endpoint():
+    endpoint = LocalBedrockEndpoint(image_latency=0.0).start()
+    yield endpoint
+    endpoint.stop()
+
+
+def runtime_client(endpoint):
+    return boto3.client(
+        "bedrock-runtime",
+        region_name="us-east-1",
+        endpoint_url=endpoint.url,
+        aws_access_key_id="local",
+        aws_secret_access_key="local",
+    )
+
+
+def app_image(client, image_cache, seed, prompt=PROMPT):
+    """Generate an image the way the app does: capabilities, the session seed and the pipeline's user message"""
+    model_id = configs["multimodal_llms"]["N. Virginia"][MODEL_NAME]
+    capabilities = CapabilityRegistry.from_config(configs).get(model_id)
+    handler = BedrockHandler(
+        client, model_id, capabilities.params, configs.get("system_prompt"),
+        capabilities=capabilities, image_cache=image_cache,
+    )
+    handler.params = {**handler.params, "seed": seed}
+    pipeline = ChatPipeline(handler, KBHandler(None, {}), InMemoryConversationStore())
+    pipeline.add_user_message("s1", prompt, [], [])
+    messages = pipeline.store.get("s1")
+    key = image_cache.key(model_id, handler.image_request(handler.validated(messages)))
+    return key, handler.invoke_model(messages)
+
+
+def test_prewarmed_images_are_served_to_the_app(tmp_path, endpoint):
+    client = runtime_client(endpoint)
+    image_cache = ImageCache(str(tmp_path), 10 * 1024 * 1024)
+    handler = BedrockHandler(
+        client,
+        configs["multimodal_llms"]["N. Virginia"][MODEL_NAME],
+        configs["nova_canvas_params"],
+        image_cache=image_cache,
+    )
+
+    result = prewarm(handler, PROMPT, seed=42)
+    assert not result.error and not result.cached
+    assert prewarm(handler, PROMPT, seed=42).cached
+    requests = endpoint.requests
+
+    key, image = app_image(client, image_cache, seed=42)
+
+    assert [p.stem for p in tmp_path.glob("*.png")] == [key]
+    assert image == (tmp_path / f"{key}.png").read_bytes()
+    assert endpoint.requests == requests
+    # another seed is another image
+    other_key, _ = app_image(client, image_cache, seed=7)
+    assert other_key != key
+    assert endpoint.requests == requests + 1
+
+
+def test_least_recently_used_images_are_evicted_to_fit_max_bytes(tmp_path):
+    image_cache = ImageCache(str(tmp_path), max_bytes=300)
+    for i, key in enumerate(["a", "b", "c"]):
+        image_cache.put(key, bytes(100))
+        # distinct modification times, oldest first
+        os.utime(tmp_path / f"{key}.png", (time.time() - 30 + i, time.time() - 30 + i))
+    # reading a makes it the most recently used
+    assert image_cache.get("a") == bytes(100)
+
+    image_cache.put("d", bytes(100))
+
+    assert sorted(p.stem for p in tmp_path.glob("*.png")) == ["a", "c", "d"]
+    assert image_cache.get("b") is None
+
+
+def test_an_image_larger_than_max_bytes_is_kept_alone(tmp_path):
+    image_cache = ImageCache(str(tmp_path), max_bytes=300)
+    image_cache.put("small", bytes(100))
+
+    image_cache.put("large", bytes(500))
+
+    assert [p.stem for p in tmp_path.glob("*.png")] == ["large"]
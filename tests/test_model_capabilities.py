@@ -0,0 +1,154 @@
+import io
+import random
+import pytest
+from PIL import Image
+from utils.model_capabilities import (
+    FAMILY_CAPABILITIES,
+    ModelCapabilities,
+    RequestValidationError,
+    fit_image,
+    validate_messages,
+)
+
+NOVA = "amazon.nova-pro-v1:0"
+
+
+def capabilities(model_id=NOVA, family="nova", **overrides):
+    return ModelCapabilities(model_id=model_id, family=family, params={}, **{**FAMILY_CAPABILITIES[family], **overrides})
+
+
+def image_bytes(size=(64, 48), fmt="PNG", mode="RGB", noise=False):
+    image = Image.new(mode, size, "white")
+    if noise:
+        image = Image.frombytes(mode, size, random.Random(0).randbytes(size[0] * size[1] * len(mode)))
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def image_size(block):
+    return Image.open(io.BytesIO(block["image"]["source"]["bytes"])).size
+
+
+def user(*content):
+    return {"role": "user", "content": list(content)}
+
+
+def test_fitting_images_are_passed_through():
+    data = image_bytes(fmt="JPEG")
+
+    assert fit_image(capabilities(), data) == {"image": {"format": "jpeg", "source": {"bytes": data}}}
+
+
+def test_images_larger_than_max_pixels_are_downscaled():
+    block = fit_image(capabilities(max_image_pixels=100), image_bytes((400, 200)))
+
+    assert block["image"]["format"] == "jpeg"
+    assert image_size(block) == (100, 50)
+
+
+def test_images_over_max_bytes_are_shrunk_until_they_fit():
+    data = image_bytes((512, 512), noise=True)
+    caps = capabilities(max_image_bytes=len(data) // 10)
+
+    block = fit_image(caps, data)
+
+    assert len(block["image"]["source"]["bytes"]) <= caps.max_image_bytes
+    assert max(image_size(block)) < 512
+
+
+def test_unsupported_formats_are_re_encoded():
+    block = fit_image(capabilities(image_formats=["png", "jpeg"]), image_bytes(fmt="GIF", mode="P"))
+
+    assert block["image"]["format"] == "png"
+    assert Image.open(io.BytesIO(block["image"]["source"]["bytes"])).format == "PNG"
+
+
+def test_unreadable_images_raise():
+    with pytest.raises(RequestValidationError, match="cannot be read"):
+        fit_image(capabilities(), b"not an image")
+
+
+def test_images_that_cannot_shrink_enough_raise():
+    with pytest.raises(RequestValidationError, match="cannot be reduced"):
+        fit_image(capabilities(max_image_bytes=10), image_bytes((256, 256), noise=True))
+
+
+def test_images_beyond_max_images_are_dropped_from_the_oldest_messages():
+    oldest, newer, newest = image_bytes(), image_bytes((32, 32)), image_bytes((16, 16))
+    messages = [
+        user({"text": "first"}, {"image": oldest}),
+        {"role": "assistant", "content": [{"text": "ok"}]},
+        user({"text": "second"}, {"image": newer}, {"image": newest}),
+    ]
+
+    validated = validate_messages(capabilities(max_images=2), messages)
+
+    assert validated[0]["content"] == [{"text": "first"}, {"text": "[image omitted]"}]
+    assert [image_size(c) for c in validated[2]["content"][1:]] == [(32, 32), (16, 16)]
+    # the caller's messages are left as they were
+    assert messages[0]["content"][1] == {"image": oldest}
+
+
+def test_documents_beyond_max_documents_are_dropped_from_the_oldest_messages():
+    def document(name):
+        return {"document": {"format": "txt", "name": name, "source": {"bytes": b"Aspirin 81 mg"}}}
+
+    messages = [user(document("old")), user(document("middle"), document("new"))]
+
+    validated = validate_messages(capabilities(max_documents=2), messages)
+
+    assert validated[0]["content"] == [{"text": "[document old omitted]"}]
+    assert validated[1]["content"] == messages[1]["content"]
+
+
+def test_oldest_turns_are_trimmed_to_fit_the_context_window():
+    def turn(role, text):
+        return {"role": role, "content": [{"text": text}]}
+
+    long_text = "x" * 400
+    messages = [
+        turn("user", "system prompt"),
+        turn("assistant", long_text),
+        turn("user", long_text),
+        turn("assistant", long_text),
+        turn("user", "latest question"),
+    ]
+    # room for the first message, one pair and the question, but not for two pairs
+    caps = capabilities(context_window=300, max_output_tokens=0)
+
+    validated = validate_messages(caps, messages)
+
+    assert validated == [messages[0], messages[3], messages[4]]
+
+
+def test_conversations_that_cannot_be_trimmed_enough_raise():
+    messages = [user({"text": "x" * 2000})]
+
+    with pytest.raises(RequestValidationError, match="context window"):
+        validate_messages(capabilities(context_window=300, max_output_tokens=0), messages)
+
+
+@pytest.mark.parametrize("family, content, match", [
+    ("nova-micro", {"image": image_bytes()}, "does not accept images"),
+    ("nova-micro", {"document": {"format": "txt", "name": "d", "source": {"bytes": b"x"}}}, "does not accept documents"),
+    ("nova", {"document": {"format": "exe", "name": "d", "source": {"bytes": b"x"}}}, "format exe is not supported"),
+])
+def test_unsupported_attachments_raise(family, content, match):
+    with pytest.raises(RequestValidationError, match=match):
+        validate_messages(capabilities(family=family), [user({"text": "Read this"}, content)])
+
+
+def test_documents_over_max_document_bytes_raise():
+    document = {"document": {"format": "pdf", "name": "orderset", "source": {"bytes": b"%PDF" * 10}}}
+
+    with pytest.raises(RequestValidationError, match="orderset is larger than 20 bytes"):
+        validate_messages(capabilities(max_document_bytes=20), [user(document)])
+
+
+def test_prompts_over_max_prompt_chars_raise():
+    caps = capabilities("amazon.nova-canvas-v1:0", "nova-canvas")
+
+    assert validate_messages(caps, [user({"text": "a red apple"})])
+    with pytest.raises(RequestValidationError, match="at most 1024 characters"):
+        validate_messages(caps, [user({"text": "a" * 1025})])
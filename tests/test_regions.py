@@ -0,0 +1,94 @@
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+from utils.regions import RegionSelector, StaticProbe, is_regional_failure
+
+
+def client_error(code, status=400):
+    return ClientError(
+        {"Error": {"Code": code, "Message": code}, "ResponseMetadata": {"HTTPStatusCode": status}}, "ConverseStream"
+    )
+
+
+@pytest.mark.parametrize("error, regional", [
+    (client_error("ThrottlingException"), True),
+    (client_error("ModelNotReadyException"), True),
+    (client_error("SomethingNew", status=503), True),
+    (client_error("ValidationException"), False),
+    (client_error("AccessDeniedException", status=403), False),
+    (EndpointConnectionError(endpoint_url="https://bedrock-runtime.us-east-1.amazonaws.com"), True),
+    (ValueError("not a call"), False),
+])
+def test_is_regional_failure(error, regional):
+    assert is_regional_failure(error) is regional
+
+
+def selector(latencies, **kwargs):
+    return RegionSelector(list(latencies), StaticProbe(latencies), **kwargs)
+
+
+def test_ranked_fastest_first_and_failing_probes_last():
+    regions = selector({"us-east-1": 80, "us-west-2": 20, "eu-central-1": None})
+
+    assert regions.ranked(["us-east-1", "us-west-2", "eu-central-1"]) == ["us-west-2", "us-east-1", "eu-central-1"]
+
+
+def test_ranked_only_returns_the_candidates():
+    regions = selector({"us-east-1": 80, "us-west-2": 20})
+
+    assert regions.ranked(["us-east-1"]) == ["us-east-1"]
+    # a candidate nobody probed yet ranks after the measured ones
+    assert regions.ranked(["ap-south-1", "us-east-1"]) == ["us-east-1", "ap-south-1"]
+
+
+def test_failed_calls_demote_a_region_before_its_next_probe():
+    regions = selector({"us-east-1": 80, "us-west-2": 20}, probe_interval=3600, max_error_rate=0.3)
+    assert regions.ranked(["us-east-1", "us-west-2"])[0] == "us-west-2"
+    for _ in range(3):
+        regions.record("us-west-2", True)
+
+    regions.record("us-west-2", False)
+    assert regions.ranked(["us-east-1", "us-west-2"])[0] == "us-west-2"
+    regions.record("us-west-2", False)
+
+    assert regions.health["us-west-2"].error_rate == 2 / 6
+    assert regions.ranked(["us-east-1", "us-west-2"]) == ["us-east-1", "us-west-2"]
+
+
+def test_degraded_regions_rank_by_error_rate():
+    regions = selector({"us-east-1": 80, "us-west-2": 20}, probe_interval=3600, error_window=4)
+    regions.ranked(["us-east-1", "us-west-2"])
+    for ok in [False, False, False]:
+        regions.record("us-west-2", ok)
+    regions.record("us-east-1", False)
+    regions.record("us-east-1", False)
+
+    assert not regions.healthy("us-east-1") and not regions.healthy("us-west-2")
+    assert regions.ranked(["us-west-2", "us-east-1"]) == ["us-east-1", "us-west-2"]
+
+
+def test_record_keeps_the_error_window_and_smooths_latency():
+    regions = RegionSelector(["us-east-1"], StaticProbe({}), error_window=3, smoothing=0.5)
+
+    regions.record("us-east-1", False)
+    for _ in range(3):
+        regions.record("us-east-1", True)
+    regions.record("us-east-1", True, latency_ms=100)
+    regions.record("us-east-1", True, latency_ms=50)
+
+    assert regions.health["us-east-1"].outcomes == [True, True, True]
+    assert regions.health["us-east-1"].error_rate == 0.0
+    assert regions.health["us-east-1"].latency_ms == 75
+
+
+def test_probes_run_again_after_the_interval(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("utils.regions.time.time", lambda: now[0])
+    latencies = {"us-east-1": 80, "us-west-2": 20}
+    regions = selector(latencies, probe_interval=60, smoothing=1.0)
+    regions.ranked(["us-east-1", "us-west-2"])
+
+    latencies["us-west-2"] = 200
+    now[0] += 30
+    assert regions.ranked(["us-east-1", "us-west-2"])[0] == "us-west-2"
+    now[0] += 30
+    assert regions.ranked(["us-east-1", "us-west-2"])[0] == "us-east-1"
@@ -0,0 +1,175 @@
+import json
+import os
+import time
+from utils.bedrock import BedrockHandler
+from utils.response_cache import ResponseCache
+
+NOVA = "amazon.nova-lite-v1:0"
+
+
+def converse_response(text):
+    return {
+        "output": {"message": {"role": "assistant", "content": [{"text": text}]}},
+        "stopReason": "end_turn",
+        "usage": {"inputTokens": 10, "outputTokens": 3, "totalTokens": 13},
+        "ResponseMetadata": {"RequestId": "r1"},
+    }
+
+
+class CountingRuntime:
+    """converse and converse_stream of a bedrock-runtime client, counting the calls that reach it"""
+
+    def __init__(self, text="Take 81 mg daily"):
+        self.text = text
+        self.calls = 0
+
+    def converse(self, **request):
+        self.calls += 1
+        return converse_response(self.text)
+
+    def converse_stream(self, **request):
+        self.calls += 1
+        words = self.text.split(" ")
+        events = [{"messageStart": {"role": "assistant"}}]
+        events += [
+            {"contentBlockDelta": {"contentBlockIndex": 0, "delta": {"text": word if i == 0 else f" {word}"}}}
+            for i, word in enumerate(words)
+        ]
+        events += [
+            {"contentBlockStop": {"contentBlockIndex": 0}},
+            {"messageStop": {"stopReason": "end_turn"}},
+            {"metadata": {"usage": {"inputTokens": 10, "outputTokens": 3}}},
+        ]
+        return {"stream": iter(events)}
+
+
+def messages(prompt="What dose?"):
+    return [{"role": "user", "content": [{"text": prompt}]}]
+
+
+def handler(runtime, cache, temperature=0.0):
+    return BedrockHandler(runtime, NOVA, {"temperature": temperature}, cache=cache)
+
+
+def streamed_text(response):
+    return "".join(
+        event["contentBlockDelta"]["delta"]["text"] for event in response["stream"] if "contentBlockDelta" in event
+    )
+
+
+def test_converse_replays_a_cached_response(tmp_path):
+    runtime = CountingRuntime()
+    bedrock = handler(runtime, ResponseCache(str(tmp_path), max_bytes=1 << 20, ttl_seconds=60))
+
+    first = bedrock.converse(messages())
+    second = bedrock.converse(messages())
+
+    assert runtime.calls == 1
+    assert "cached" not in first
+    assert second["output"] == first["output"] and second["usage"] == first["usage"]
+    assert second["cached"]["saved_seconds"] >= 0
+    assert "ResponseMetadata" not in second
+    bedrock.converse(messages("Another question"))
+    assert runtime.calls == 2
+
+
+def test_non_zero_temperature_skips_the_cache(tmp_path):
+    runtime = CountingRuntime()
+    bedrock = handler(runtime, ResponseCache(str(tmp_path), max_bytes=1 << 20, ttl_seconds=60), temperature=0.7)
+
+    assert bedrock.cache is None
+    bedrock.converse(messages())
+    bedrock.converse(messages())
+    streamed_text(bedrock.invoke_model_with_stream(messages()))
+
+    assert runtime.calls == 3
+    assert list(tmp_path.glob("*.json")) == []
+
+
+def test_a_completed_stream_is_cached_and_shared_with_converse(tmp_path):
+    runtime = CountingRuntime()
+    bedrock = handler(runtime, ResponseCache(str(tmp_path), max_bytes=1 << 20, ttl_seconds=60))
+
+    assert streamed_text(bedrock.invoke_model_with_stream(messages())) == "Take 81 mg daily"
+    replayed = bedrock.invoke_model_with_stream(messages())
+    events = list(replayed["stream"])
+
+    assert runtime.calls == 1
+    assert "event_stream" not in replayed
+    assert "".join(e["contentBlockDelta"]["delta"]["text"] for e in events if "contentBlockDelta" in e) == "Take 81 mg daily"
+    assert "cached" in events[-1]["metadata"]
+    assert bedrock.converse(messages())["output"]["message"]["content"][0]["text"] == "Take 81 mg daily"
+    assert runtime.calls == 1
+
+
+def test_a_cancelled_stream_is_not_cached(tmp_path):
+    runtime = CountingRuntime()
+    bedrock = handler(runtime, ResponseCache(str(tmp_path), max_bytes=1 << 20, ttl_seconds=60))
+
+    stream = bedrock.invoke_model_with_stream(messages())["stream"]
+    for event in stream:
+        if "contentBlockDelta" in event:
+            break
+    stream.close()
+
+    assert list(tmp_path.glob("*.json")) == []
+    streamed_text(bedrock.invoke_model_with_stream(messages()))
+    assert runtime.calls == 2
+
+
+def test_a_stream_closed_before_message_stop_is_not_cached(tmp_path):
+    bedrock = handler(CountingRuntime(), ResponseCache(str(tmp_path), max_bytes=1 << 20, ttl_seconds=60))
+    events = [
+        {"messageStart": {"role": "assistant"}},
+        {"contentBlockDelta": {"contentBlockIndex": 0, "delta": {"text": "Take"}}},
+    ]
+
+    assert list(bedrock.record_stream("partial", iter(events))) == events
+    assert bedrock.cache.get("partial") is None
+
+    complete = events + [{"messageStop": {"stopReason": "end_turn"}}, {"metadata": {"usage": {"outputTokens": 1}}}]
+    list(bedrock.record_stream("complete", iter(complete)))
+    assert bedrock.cache.get("complete")["response"] == {
+        "output": {"message": {"role": "assistant", "content": [{"text": "Take"}]}},
+        "stopReason": "end_turn",
+        "usage": {"outputTokens": 1},
+    }
+
+
+def test_expired_entries_are_not_returned(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=1 << 20, ttl_seconds=60)
+    cache.put("old", converse_response("Old"), 1.0)
+    path = tmp_path / "old.json"
+    entry = json.loads(path.read_text())
+    path.write_text(json.dumps({**entry, "created": entry["created"] - 120}))
+
+    assert cache.get("old") is None
+    assert not path.exists()
+
+
+def test_expired_entries_are_evicted_on_put(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=1 << 20, ttl_seconds=60)
+    cache.put("old", converse_response("Old"), 1.0)
+    hour_ago = time.time() - 3600
+    os.utime(tmp_path / "old.json", (hour_ago, hour_ago))
+
+    cache.put("new", converse_response("New"), 1.0)
+
+    assert sorted(p.name for p in tmp_path.glob("*.json")) == ["new.json"]
+
+
+def test_least_recently_used_entries_are_evicted_to_fit_max_bytes(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=1 << 20, ttl_seconds=3600)
+    for i, key in enumerate(["a", "b", "c"]):
+        cache.put(key, converse_response(key), 1.0)
+        # distinct modification times, oldest first
+        os.utime(tmp_path / f"{key}.json", (time.time() - 30 + i, time.time() - 30 + i))
+    # room for three entries but not four, their sizes differ by a few bytes of timestamp
+    cache.max_bytes = 3 * max(p.stat().st_size for p in tmp_path.glob("*.json")) + 20
+    # reading a makes it the most recently used
+    assert cache.get("a") is not None
+
+    cache.put("d", converse_response("d"), 1.0)
+
+    assert sorted(p.stem for p in tmp_path.glob("*.json")) == ["a", "c", "d"]
+    assert cache.get("b") is None
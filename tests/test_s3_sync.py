@@ -0,0 +1,44 @@
+import hashlib
+from s3_sync import S3Sync
+
+
+class FakeS3:
+    """An in-memory bucket with the calls S3Sync makes"""
+
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+
+    def upload_file(self, path, bucket, key, Config=None):
+        with open(path, "rb") as f:
+            self.objects[key] = hashlib.md5(f.read()).hexdigest()
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        yield {"Contents": [
+            {"Key": key, "ETag": f'"{etag}"'} for key, etag in self.objects.items() if key.startswith(Prefix)
+        ]}
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete["Objects"]:
+            del self.objects[obj["Key"]]
+
+
+def test_delete_removed_only_deletes_keys_of_the_last_sync(tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    (data / "a.txt").write_text("a")
+    (data / "b.txt").write_text("b")
+    s3 = FakeS3({"other-kb/doc.pdf": "0" * 32, "c.txt": "0" * 32})
+    sync = S3Sync(s3, "bucket", manifest_path=tmp_path / "manifest.json")
+
+    report = sync.sync(data, delete_removed=True)
+    assert sorted(report.uploaded) == ["a.txt", "b.txt"]
+    assert report.deleted == []
+
+    (data / "b.txt").unlink()
+    report = sync.sync(data, delete_removed=True)
+    assert report.deleted == ["b.txt"]
+    assert report.skipped == 1
+    assert sorted(s3.objects) == ["a.txt", "c.txt", "other-kb/doc.pdf"]
@@ -0,0 +1,78 @@
+import asyncio
+import json
+from botocore.exceptions import ClientError
+from server import ChatServer
+from utils.chat import InMemoryConversationStore
+
+
+class FlakyRuntime:
+    """converse and converse_stream of a bedrock-runtime client, throttled on the first call"""
+
+    def __init__(self):
+        self.calls = 0
+        self.requests = []
+
+    def _call(self, request):
+        self.calls += 1
+        self.requests.append(request)
+        if self.calls == 1:
+            raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "Too many requests"}}, "Converse")
+
+    def converse(self, **request):
+        self._call(request)
+        return {
+            "output": {"message": {"role": "assistant", "content": [{"text": "Hello."}]}},
+            "usage": {"inputTokens": 3, "outputTokens": 2},
+        }
+
+    def converse_stream(self, **request):
+        self._call(request)
+        return {"stream": iter([
+            {"contentBlockDelta": {"contentBlockIndex": 0, "delta": {"text": "Hello."}}},
+            {"messageStop": {"stopReason": "end_turn"}},
+            {"metadata": {"usage": {"inputTokens": 3, "outputTokens": 2}}},
+        ])}
+
+
+async def post(port, session_id, body):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    payload = json.dumps(body).encode("utf-8")
+    writer.write(
+        f"POST /sessions/{session_id}/messages HTTP/1.1\r\nContent-Length: {len(payload)}\r\n\r\n".encode("latin-1")
+        + payload
+    )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return response.decode("utf-8")
+
+
+def run_turns(stream):
+    server = ChatServer("N. Virginia", "Amazon Nova Lite", InMemoryConversationStore())
+    server.bedrock_runtime = FlakyRuntime()
+
+    async def turns():
+        listener = await asyncio.start_server(server.handle, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        async with listener:
+            return [await post(port, "s1", {"prompt": prompt, "stream": stream}) for prompt in ("Hi", "Hi again")]
+
+    return server, asyncio.run(turns())
+
+
+def test_a_failed_streamed_turn_leaves_the_conversation_answerable():
+    server, (failed, answered) = run_turns(stream=True)
+
+    assert "event: error" in failed and "ThrottlingException" in failed
+    assert "event: done" in answered
+    assert [m["role"] for m in server.bedrock_runtime.requests[-1]["messages"]] == ["user"]
+    assert [m["role"] for m in server.store.get("s1")] == ["user", "assistant"]
+
+
+def test_a_failed_turn_leaves_the_conversation_answerable():
+    server, (failed, answered) = run_turns(stream=False)
+
+    assert failed.startswith("HTTP/1.1 500")
+    assert answered.startswith("HTTP/1.1 200") and "Hello." in answered
+    assert [m["role"] for m in server.bedrock_runtime.requests[-1]["messages"]] == ["user"]
+    assert [m["role"] for m in server.store.get("s1")] == ["user", "assistant"]
@@ -0,0 +1,95 @@
+import json
+import pytest
+from utils.model_capabilities import CapabilityRegistry
+from utils.usage import UsageBudget, UsageLedger, UsageTotals, compact_history
+
+CONFIGS = {
+    "claude_model_params": {"temperature": 0.0},
+    "nova_model_params": {"temperature": 0.0},
+    "nova_canvas_params": {},
+    "nova_reel_params": {},
+    "multimodal_llms": {
+        "N. Virginia": {
+            "Claude": "anthropic.claude-3-5-sonnet-20240620-v1:0",
+            "Nova Micro": "amazon.nova-micro-v1:0",
+            "Nova Canvas": "amazon.nova-canvas-v1:0",
+        },
+        "Frankfurt": {"Claude": "anthropic.claude-3-5-sonnet-20240620-v1:0"},
+    },
+}
+PRICES = {"amazon.nova-micro-v1:0": {"input_per_1k": 0.001, "output_per_1k": 0.002}}
+
+
+def budget(downgrade_model=None):
+    configs = {**CONFIGS, "usage": {"session_budget_usd": 1.0, "compact_at": 0.8, "downgrade_model": downgrade_model}}
+    return UsageBudget.from_config(configs, CapabilityRegistry.from_config(configs))
+
+
+@pytest.mark.parametrize(
+    "cost, downgraded, can_downgrade, action",
+    [
+        (0.5, False, True, None),
+        (0.8, False, True, "compact"),
+        (1.0, False, True, "downgrade"),
+        (1.2, True, True, "compact"),
+        (1.0, False, False, "stop"),
+        (1.2, True, False, "stop"),
+    ],
+)
+def test_action_compacts_downgrades_and_stops(cost, downgraded, can_downgrade, action):
+    assert budget("amazon.nova-micro-v1:0").action(UsageTotals(cost=cost), downgraded, can_downgrade) == action
+
+
+def test_action_stops_without_downgrade_model_and_never_limits_without_budget():
+    assert budget().action(UsageTotals(cost=1.0)) == "stop"
+    assert UsageBudget().action(UsageTotals(cost=100.0)) is None
+
+
+def test_downgrade_model_is_validated_on_start():
+    with pytest.raises(ValueError, match="not a model id"):
+        budget("amazon.nova-nano-v1:0")
+    with pytest.raises(ValueError, match="does not answer with text"):
+        budget("amazon.nova-canvas-v1:0")
+
+
+def test_downgrade_model_is_picked_per_region():
+    downgrade = budget("amazon.nova-micro-v1:0")
+
+    assert downgrade.downgrade_model_in(CONFIGS, "N. Virginia") == "amazon.nova-micro-v1:0"
+    assert downgrade.downgrade_model_in(CONFIGS, "Frankfurt") is None
+
+
+def turns(count):
+    return [
+        {"role": role, "content": [{"text": f"{role} {i}"}]}
+        for i in range(count)
+        for role in ("user", "assistant")
+    ]
+
+
+def test_compact_history_keeps_the_last_turns_starting_with_a_user_message():
+    assert compact_history(turns(5), 2) == turns(5)[-4:]
+    # A pending user message makes the window start with an assistant message, which is dropped
+    pending = turns(3) + [{"role": "user", "content": [{"text": "user 3"}]}]
+    assert [m["content"][0]["text"] for m in compact_history(pending, 2)] == ["user 2", "assistant 2", "user 3"]
+    assert compact_history(turns(3), 0) == []
+
+
+def test_ledger_totals_survive_a_restart(tmp_path):
+    path = tmp_path / "usage" / "ledger.jsonl"
+    ledger = UsageLedger(str(path), PRICES)
+    ledger.record("s1", "amazon.nova-micro-v1:0", {"inputTokens": 1000, "outputTokens": 500}, context="x" * 400)
+    ledger.record("s1", "us.amazon.nova-micro-v1:0", {"inputTokens": 1000, "outputTokens": 0})
+    ledger.record("s1", "amazon.nova-micro-v1:0", {"inputTokens": 1000, "outputTokens": 500}, cached=True)
+    ledger.record("s2", "amazon.nova-micro-v1:0", {"inputTokens": 10, "outputTokens": 10})
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("{truncated\n")
+
+    reloaded = UsageLedger(str(path), PRICES)
+
+    assert reloaded.totals("s1") == ledger.totals("s1")
+    total = reloaded.session_total("s1")
+    assert (total.turns, total.input_tokens, total.output_tokens, total.context_tokens) == (3, 2000, 500, 100)
+    assert total.cost == pytest.approx(0.003)
+    assert len(path.read_text(encoding="utf-8").splitlines()) == 5
+    assert json.loads(path.read_text(encoding="utf-8").splitlines()[2])["cached"] is True
@@ -0,0 +1,75 @@
+import json
+import threading
+import time
+from utils.video_events import LOCAL_QUEUE_URL, LocalSQSQueue, VideoEventListener
+
+
+def test_wait_for_video_returns_key_published_to_local_queue():
+    queue = LocalSQSQueue()
+    listener = VideoEventListener(LOCAL_QUEUE_URL, client=queue)
+    queue.publish_object_created("videos", "jobs/abc/output.mp4")
+
+    assert listener.wait_for_video("videos", "jobs/abc", timeout=1) == "jobs/abc/output.mp4"
+    # The consumed notification is deleted
+    assert queue.receive_message(LOCAL_QUEUE_URL, MaxNumberOfMessages=10) == {}
+
+
+def test_long_poll_wakes_up_on_publish():
+    queue = LocalSQSQueue()
+    listener = VideoEventListener(LOCAL_QUEUE_URL, client=queue)
+    threading.Timer(0.2, queue.publish_object_created, args=("videos", "jobs/abc/output.mp4")).start()
+
+    assert listener.wait_for_video("videos", "jobs/abc", timeout=5) == "jobs/abc/output.mp4"
+
+
+def test_notifications_of_other_jobs_stay_on_the_queue():
+    queue = LocalSQSQueue(visibility_timeout=0)
+    listener = VideoEventListener(LOCAL_QUEUE_URL, client=queue)
+    queue.publish_object_created("videos", "jobs/other/output.mp4")
+
+    assert listener.wait_for_video("videos", "jobs/abc", timeout=1) is None
+    assert VideoEventListener(LOCAL_QUEUE_URL, client=queue).wait_for_video(
+        "videos", "jobs/other", timeout=1
+    ) == "jobs/other/output.mp4"
+
+
+def test_notifications_of_other_jobs_are_released_before_the_visibility_timeout():
+    queue = LocalSQSQueue(visibility_timeout=30)
+    listener = VideoEventListener(LOCAL_QUEUE_URL, client=queue, release_seconds=0)
+    queue.publish_object_created("videos", "jobs/other/output.mp4")
+
+    assert listener.wait_for_video("videos", "jobs/abc", timeout=1) is None
+    assert VideoEventListener(LOCAL_QUEUE_URL, client=queue).wait_for_video(
+        "videos", "jobs/other", timeout=1
+    ) == "jobs/other/output.mp4"
+
+
+def test_notifications_that_are_not_videos_are_deleted():
+    queue = LocalSQSQueue(visibility_timeout=0)
+    listener = VideoEventListener(LOCAL_QUEUE_URL, client=queue)
+    queue.send_message(LOCAL_QUEUE_URL, json.dumps({"Service": "Amazon S3", "Event": "s3:TestEvent"}))
+    queue.publish_object_created("videos", "jobs/abc/manifest.json")
+
+    assert listener.wait_for_video("videos", "jobs/abc", timeout=1) is None
+    assert queue.receive_message(LOCAL_QUEUE_URL, MaxNumberOfMessages=10) == {}
+
+
+def test_old_notifications_of_other_jobs_are_deleted():
+    queue = LocalSQSQueue(visibility_timeout=0)
+    listener = VideoEventListener(LOCAL_QUEUE_URL, client=queue, max_message_age=0)
+    queue.publish_object_created("videos", "jobs/other/output.mp4")
+    time.sleep(0.01)
+
+    assert listener.wait_for_video("videos", "jobs/abc", timeout=1) is None
+    assert queue.receive_message(LOCAL_QUEUE_URL, MaxNumberOfMessages=10) == {}
+
+
+def test_parse_object_created_unwraps_sns_and_decodes_keys():
+    records = {"Records": [{
+        "eventName": "ObjectCreated:Put",
+        "s3": {"bucket": {"name": "videos"}, "object": {"key": "jobs/a+b/output.mp4"}},
+    }]}
+    envelope = json.dumps({"Message": json.dumps(records)})
+
+    assert VideoEventListener.parse_object_created(envelope) == [("videos", "jobs/a b/output.mp4")]
+    assert VideoEventListener.parse_object_created("not json") == []
@@ -0,0 +1,79 @@
+import pytest
+from waiter import Waiter, WaitTimeoutException
+
+
+class FakeClock:
+    """perf_counter and sleep of the time module, sleeping only advances the clock"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def perf_counter(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr("waiter.time", clock)
+    return clock
+
+
+def ready_after(probes, error=None):
+    calls = []
+
+    def probe():
+        calls.append(1)
+        if len(calls) < probes:
+            if error:
+                raise error
+            return False
+        return True
+
+    return probe
+
+
+def test_delay_grows_by_the_backoff_up_to_the_max_delay(clock):
+    waiter = Waiter(initial_delay=1, max_delay=5, backoff=2, jitter=0)
+
+    waited = waiter.wait("collection", ready_after(6))
+
+    assert clock.sleeps == [1, 2, 4, 5, 5]
+    assert waited == waiter.timings["collection"] == 17
+
+
+def test_retry_on_errors_count_as_not_ready(clock):
+    waiter = Waiter(initial_delay=1, jitter=0)
+
+    waiter.wait("index", ready_after(3, KeyError("index")), retry_on=(KeyError,))
+    assert len(clock.sleeps) == 2
+
+    with pytest.raises(ValueError):
+        waiter.wait("index", ready_after(3, ValueError("invalid")), retry_on=(KeyError,))
+
+
+def test_deadline_raises_with_the_last_error_and_is_not_overslept(clock):
+    waiter = Waiter(initial_delay=4, backoff=2, jitter=0)
+
+    with pytest.raises(WaitTimeoutException) as e:
+        waiter.wait("role", ready_after(100, KeyError("role")), timeout=10, retry_on=(KeyError,))
+
+    assert isinstance(e.value.__cause__, KeyError)
+    assert clock.sleeps == [4, 6]
+    assert waiter.timings["role"] == 10
+
+
+def test_report_lists_every_wait_and_the_total(clock):
+    waiter = Waiter(initial_delay=1, jitter=0)
+    waiter.wait("collection", ready_after(2))
+    waiter.wait("index", ready_after(3))
+
+    lines = waiter.report().splitlines()
+    assert lines[0] == "Time spent waiting for resources:"
+    assert [line.split()[0] for line in lines[1:]] == ["collection", "index", "total"]
+    assert lines[-1].split()[-1] == "4.0s"